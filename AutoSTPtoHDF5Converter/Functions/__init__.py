@@ -4,9 +4,21 @@ Author: Ayush Doshi
 This module contains necessary helper functions for the main AutoSTPtoHDF5Converter.
 """
 
+from .backfill import run_backfill
+from .concurrency_controller import AUTOSCALE_AVAILABLE
 from .convert_files import convert_files
 from .deidentify_file_names import deidentify_file_names
+from .file_watcher import FileWatcher
 from .find_files import find_files
+from .lease_queue import start_lease_heartbeat
 from .merge_files_w_patient_info import merge_files_w_patient_info
+from .metrics import start_metrics
+from .native_hdf5_writer import NATIVE_WRITER_AVAILABLE
+from .output_catalog import VIRTUAL_DATASETS_AVAILABLE
+from .run_pipeline import run_pipeline
+from .run_streaming_pass import run_streaming_pass
+from .scan_index import ScanIndex
+from .scheduling import SCHEDULING_POLICIES
+from .state_journal import resume_journal
 from .update_completed_files_database import update_completed_files_database
 from .update_patient_database import update_patient_database
@@ -0,0 +1,483 @@
+"""
+Author: Ayush Doshi
+
+Contains the "async_converter" coroutine and the "AsyncConversionExecutor" that run the conversion tools directly as
+asyncio subprocesses instead of from ProcessPoolExecutor workers.
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import contextvars
+import datetime
+import glob
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from .conversion_tools import confirm_xml_streaming_rejection, converted_files, formatconverter_params, \
+    move_converted_files, reject_xml_streaming, release_named_pipe, remove_converted_files, stptoolkit_params, \
+    xml_streaming_enabled
+from .job_monitor import CHECK_INTERVAL, ConversionPreempted, ConversionStalled, StallMonitor, conversion_timeout
+from .lease_queue import claim_file
+from .metrics import stage_timer
+from .native_hdf5_writer import native_writer_enabled, write_native_hdf5
+from .staging import stage_input_file
+from .state_journal import record_state, resume_conversion
+
+# Semaphores of the conversion stages that are limited by the executor running the current conversion
+STAGE_SEMAPHORES = contextvars.ContextVar('STAGE_SEMAPHORES', default={})
+
+# Progress callback of the executor running the current conversion
+PROGRESS_CALLBACK = contextvars.ContextVar('PROGRESS_CALLBACK', default=None)
+
+
+async def async_converter(input_stp_path: str, filename: str, offset: int, args: argparse.Namespace,
+                          progress_callback=None) -> datetime.timedelta:
+    """
+    Convert a given .STP file to .HDF5 file and de-identify internal timestamps using the provided negative offset from
+    the patient offset database, running the conversion tools as asyncio subprocesses.
+
+    :param input_stp_path: String that is the path to the .STP file in the Input folder.
+    :type input_stp_path: str
+    :param filename: String that is the filename of the .STP file.
+    :type filename: str
+    :param offset: Integer that is the offset specific to the .STP file retrieved from the patient offset database.
+    :type offset: int
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param progress_callback: Function called as progress_callback(filename, stage) when the conversion of the file
+    enters a new stage ('copy', 'stptoolkit', 'formatconverter', 'stream', 'move', 'done', or 'failed') or None to use
+    the progress callback of the executor running the conversion.
+    :type progress_callback: Callable[[str, str], None]
+    :return: datetime.timedelta for the time that the entire conversion process took.
+    :rtype: datetime.timedelta
+    """
+
+    # Save the start time of the process in epoch seconds
+    process_start_time = time.time()
+
+    if progress_callback is None:
+        progress_callback = PROGRESS_CALLBACK.get()
+
+    def report(stage: str) -> None:
+        if progress_callback is not None:
+            progress_callback(filename, stage)
+
+    # Report the end of the conversion if it fails or is cancelled, so the callback does not see it in a stage forever
+    try:
+        await convert_stages(input_stp_path, filename, offset, args, report)
+    except BaseException:
+        report('failed')
+        raise
+
+    report('done')
+    return datetime.timedelta(seconds=time.time() - process_start_time)
+
+
+async def convert_stages(input_stp_path: str, filename: str, offset: int, args: argparse.Namespace, report) -> None:
+    """
+    Run the stages of the conversion of async_converter and report each stage as it is entered.
+
+    :param input_stp_path: String that is the path to the .STP file in the Input folder.
+    :type input_stp_path: str
+    :param filename: String that is the filename of the .STP file.
+    :type filename: str
+    :param offset: Integer that is the offset specific to the .STP file retrieved from the patient offset database.
+    :type offset: int
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param report: Function called as report(stage) when the conversion enters a new stage.
+    :type report: Callable[[str], None]
+    :return: None
+    :rtype: None
+    """
+
+    loop = asyncio.get_running_loop()
+
+    # Claim the file so no other node that shares the input folder converts it as well
+    await loop.run_in_executor(None, claim_file, args, input_stp_path, filename)
+
+    # Get the basename (filename w/o extension) from the filename, and resume from the last durable step of an earlier
+    # conversion if its outputs are intact, otherwise cleanup the processing folder to prevent FileExistsError
+    basename = os.path.splitext(filename)[0]
+    resumed = await loop.run_in_executor(None, resume_conversion, args, input_stp_path, filename)
+
+    # Create the paths for the .STP file and converted .XML file in the processing folder
+    processing_stp_path = os.path.join('Processing', filename)
+    processing_xml_path = os.path.join('Processing', basename + '.xml')
+
+    # Get the timeout of each tool for a file of this size without blocking the event loop on the conversion history,
+    # and watch the outputs for progress
+    size = await loop.run_in_executor(None, os.path.getsize, input_stp_path)
+    timeout = await loop.run_in_executor(None, conversion_timeout, args, filename, size)
+    monitor = StallMonitor(basename, args.stall_timeout)
+
+    # Hold a slot in the XML spool from before the .XML file is created until it is deleted
+    async with stage_slot('spool'):
+
+        # Stage the .STP file into the Processing folder without blocking the event loop, convert it to an .XML file,
+        # and delete the .STP file in the Processing folder
+        streamed = False
+        failed_tool = None
+        if resumed != 'xml_done':
+            async with stage_slot('stptoolkit'):
+                if resumed is None:
+                    report('copy')
+                    with stage_timer('copy', filename):
+                        await loop.run_in_executor(None, stage_input_file, args, input_stp_path, filename,
+                                                   processing_stp_path)
+                    await loop.run_in_executor(None, record_state, args, [filename], 'staged', [processing_stp_path])
+
+                # Stream the .XML file straight into the formatconverter through a named pipe if desired and fall
+                # back to the .XML file for this file if a tool fails
+                if xml_streaming_enabled(args):
+                    async with stage_slot('formatconverter'):
+                        report('stream')
+                        with stage_timer('stream', filename):
+                            failed_tool = await stream_xml(args, processing_stp_path, processing_xml_path, offset,
+                                                           timeout, monitor)
+                    streamed = failed_tool is None
+
+                if not streamed:
+                    report('stptoolkit')
+                    with stage_timer('stptoolkit', filename):
+                        await run_tool(stptoolkit_params(args, processing_stp_path, processing_xml_path), timeout,
+                                       monitor)
+                    await loop.run_in_executor(None, record_state, args, [filename], 'xml_done', [processing_xml_path])
+                    await loop.run_in_executor(None, os.remove, processing_stp_path)
+
+        # Convert the .XML file to .HDF5 file(s)
+        if not streamed:
+            async with stage_slot('formatconverter'):
+                report('formatconverter')
+                with stage_timer('formatconverter', filename):
+                    if not (native_writer_enabled(args) and await loop.run_in_executor(
+                            None, write_native_hdf5, args, processing_xml_path, offset)):
+                        await run_tool(formatconverter_params(args, processing_xml_path, offset), timeout, monitor)
+
+        # Move the .HDF5 file(s) from the Processing folder to the Output\Converted folder, and delete the .STP or
+        # .XML file in the Processing folder once the .HDF5 file(s) are recorded, so a crash before can resume from it
+        report('move')
+        with stage_timer('move', filename):
+            await loop.run_in_executor(None, move_converted_files, args, basename)
+        hdf5_paths = await loop.run_in_executor(None, converted_files, args, basename)
+        await loop.run_in_executor(None, record_state, args, [filename], 'hdf5_done', hdf5_paths)
+        confirm_xml_streaming_rejection(failed_tool, hdf5_paths)
+        await loop.run_in_executor(None, os.remove, processing_stp_path if streamed else processing_xml_path)
+
+
+async def stream_xml(args: argparse.Namespace, processing_stp_path: str, processing_xml_path: str, offset: int,
+                     timeout: float, monitor: StallMonitor) -> [str, None]:
+    """
+    Run the StpToolkit and the formatconverter at the same time, connected through a named pipe in place of the .XML
+    file, so the .XML file never touches the disk.
+
+    If the named pipe cannot be created, streaming is turned off for the rest of the run. If either tool fails, i.e. it
+    exits with an error or no .HDF5 file is created, the partial outputs are removed and the name of the tool is
+    returned so the caller can fall back to the file-based conversion for this file only.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param processing_stp_path: String that is the path to the .STP file in the Processing folder.
+    :type processing_stp_path: str
+    :param processing_xml_path: String that is the path where the named pipe should be created.
+    :type processing_xml_path: str
+    :param offset: Integer that is the offset specific to the .STP file retrieved from the patient offset database.
+    :type offset: int
+    :param timeout: Float that is the number of seconds to wait for the tools before they are killed.
+    :type timeout: float
+    :param monitor: StallMonitor of the conversion that kills the tools once they stall.
+    :type monitor: StallMonitor
+    :return: None if the .HDF5 file(s) were created through the named pipe, otherwise the name of what failed.
+    :rtype: [str, None]
+    """
+
+    basename = os.path.splitext(os.path.basename(processing_stp_path))[0]
+    hdf5_pattern = os.path.join('Processing', glob.escape(basename) + '-_-*.hdf5')
+    loop = asyncio.get_running_loop()
+
+    # Without a named pipe there is nothing to stream through, so do not try again for later files
+    try:
+        await loop.run_in_executor(None, os.mkfifo, processing_xml_path)
+    except OSError as error:
+        reject_xml_streaming(f'the named pipe could not be created: {error}')
+        return 'mkfifo'
+
+    # Start the reader first so the StpToolkit does not wait long for the other end of the pipe
+    tools = {asyncio.ensure_future(run_tool(formatconverter_params(args, processing_xml_path, offset), timeout,
+                                            monitor)):
+             'formatconverter',
+             asyncio.ensure_future(run_tool(stptoolkit_params(args, processing_stp_path, processing_xml_path), timeout,
+                                            monitor)):
+             'StpToolkit'}
+    failed_tool = failure = None
+
+    try:
+        pending = set(tools)
+        while pending and failure is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.result() != 0:
+                    failed_tool, failure = tools[task], f'{tools[task]} exited with code {task.result()}'
+                elif tools[task] == 'StpToolkit':
+                    await loop.run_in_executor(None, release_named_pipe, processing_xml_path)
+                elif pending and not await loop.run_in_executor(None, glob.glob, hdf5_pattern):
+                    failed_tool, failure = 'formatconverter', 'formatconverter did not create any .HDF5 files'
+
+        # Stop the other tool if one of them failed
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    except BaseException:
+        for task in tools:
+            task.cancel()
+        await asyncio.gather(*tools, return_exceptions=True)
+        raise
+
+    finally:
+        await loop.run_in_executor(None, os.remove, processing_xml_path)
+
+    if failure is None and not await loop.run_in_executor(None, glob.glob, hdf5_pattern):
+        failed_tool, failure = 'formatconverter', 'formatconverter did not create any .HDF5 files'
+
+    if failure is not None:
+        await loop.run_in_executor(None, remove_converted_files, basename)
+        print(f'Streaming {basename}.xml through a named pipe failed ({failure}). Converting the .XML file instead...')
+
+    return failed_tool
+
+
+@contextlib.asynccontextmanager
+async def stage_slot(stage: str):
+    """
+    Wait for a free slot of a conversion stage if the executor running the conversion limits that stage, otherwise do
+    not wait at all.
+
+    :param stage: String that is the name of the stage: 'stptoolkit', 'formatconverter', or 'spool'.
+    :type stage: str
+    """
+
+    semaphore = STAGE_SEMAPHORES.get().get(stage)
+    if semaphore is None:
+        yield
+        return
+
+    async with semaphore:
+        yield
+
+
+async def run_tool(params: list, timeout: float, monitor: [StallMonitor, None] = None) -> int:
+    """
+    Run a conversion tool as an asyncio subprocess in its own process group while ignoring outputs, killing the whole
+    process tree if it times out, stalls, or the conversion is cancelled.
+
+    :param params: List of the executable and its parameters.
+    :type params: list
+    :param timeout: Float that is the number of seconds to wait for the tool before it is killed.
+    :type timeout: float
+    :param monitor: StallMonitor of the conversion or None to only use the timeout.
+    :type monitor: [StallMonitor, None]
+    :return: Integer that is the return code of the tool.
+    :rtype: int
+    """
+
+    # Start the tool in a new process group/session so that it and any processes it starts can be killed together
+    if sys.platform == 'win32':
+        process = await asyncio.create_subprocess_exec(*params, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT,
+                                                       creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
+    else:
+        process = await asyncio.create_subprocess_exec(*params, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT,
+                                                       start_new_session=True)
+
+    # Wake up every CHECK_INTERVAL seconds to check the tool for progress until it exits or times out, checking the
+    # outputs in the default executor so the event loop does not wait on the disk
+    loop = asyncio.get_running_loop()
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            try:
+                return await asyncio.wait_for(process.wait(),
+                                              max(0.0, min(deadline - time.monotonic(), CHECK_INTERVAL)))
+            except asyncio.TimeoutError:
+                if time.monotonic() >= deadline:
+                    raise subprocess.TimeoutExpired(params, timeout)
+                if monitor is not None and await loop.run_in_executor(None, monitor.stalled):
+                    raise ConversionStalled(params, monitor.stall_timeout)
+                if monitor is not None and await loop.run_in_executor(None, monitor.preempted):
+                    raise ConversionPreempted(f"Command '{params}' was preempted")
+    except (subprocess.TimeoutExpired, ConversionPreempted):
+        await kill_process_tree(process)
+        raise
+    except asyncio.CancelledError:
+        await kill_process_tree(process)
+        raise
+
+
+async def kill_process_tree(process: asyncio.subprocess.Process) -> None:
+    """
+    Kill a tool process along with every process it started and wait for it to exit.
+
+    :param process: asyncio.subprocess.Process of the tool.
+    :type process: asyncio.subprocess.Process
+    :return: None
+    :rtype: None
+    """
+
+    if process.returncode is None:
+        try:
+            if sys.platform == 'win32':
+                taskkill = await asyncio.create_subprocess_exec('taskkill', '/F', '/T', '/PID', str(process.pid),
+                                                                stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+                await taskkill.wait()
+            else:
+                os.killpg(process.pid, signal.SIGKILL)
+        except (ProcessLookupError, OSError):
+            pass
+
+        # Make sure the tool itself is gone even if killing its process tree failed
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+
+    await process.wait()
+
+
+class AsyncConversionExecutor(concurrent.futures.Executor):
+    """
+    concurrent.futures.Executor that runs conversion coroutines, e.g. async_converter, on an asyncio event loop in a
+    background thread, with at most max_conversions of them running at once.
+
+    There is no worker interpreter per conversion, so many more conversions can run concurrently than with a
+    ProcessPoolExecutor. The returned futures are ordinary concurrent.futures.Future objects; cancelling one kills the
+    process tree of the tool it is running.
+
+    Individual stages of the conversions can be limited separately with stage_limits, e.g. so that the StpToolkit of
+    one file overlaps with the formatconverter of another while each stage keeps its own concurrency limit.
+    """
+
+    def __init__(self, max_conversions: int, stage_limits: [dict, None] = None, progress_callback=None) -> None:
+        """
+        :param max_conversions: Integer that is the maximum number of conversions that can run at once.
+        :type max_conversions: int
+        :param stage_limits: Dictionary of stage name ('stptoolkit', 'formatconverter', or 'spool') to the maximum
+        number of conversions that can be in that stage at once or None to not limit individual stages.
+        :type stage_limits: [dict, None]
+        :param progress_callback: Function called on the event loop as progress_callback(filename, stage) when a
+        conversion enters a new stage or None.
+        :type progress_callback: Callable[[str, str], None]
+        """
+
+        self.max_conversions = max_conversions
+        self.stage_limits = stage_limits if stage_limits else {}
+        self.progress_callback = progress_callback
+        self.futures = set()
+        self.lock = threading.Lock()
+
+        # Start the event loop in a background thread and create the semaphore that limits concurrent conversions
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='AsyncConversionExecutor', daemon=True)
+        self.thread.start()
+        self.semaphore, self.stage_semaphores = \
+            asyncio.run_coroutine_threadsafe(self.create_semaphores(), self.loop).result()
+
+    async def create_semaphores(self) -> tuple:
+        """
+        Create the semaphores that limit concurrent conversions and their stages on the event loop.
+
+        :return: Tuple of asyncio.Semaphore with max_conversions slots and dictionary of stage name to its
+        asyncio.Semaphore.
+        :rtype: tuple
+        """
+
+        return (asyncio.Semaphore(self.max_conversions),
+                {stage: asyncio.Semaphore(limit) for stage, limit in self.stage_limits.items()})
+
+    async def run_limited(self, coroutine_function, *args, **kwargs):
+        """
+        Wait for a free conversion slot and run the coroutine function in it.
+
+        :param coroutine_function: Coroutine function to run.
+        :param args: Positional arguments to pass to the coroutine function.
+        :param kwargs: Keyword arguments to pass to the coroutine function.
+        :return: Result of the coroutine function.
+        """
+
+        STAGE_SEMAPHORES.set(self.stage_semaphores)
+        PROGRESS_CALLBACK.set(self.progress_callback)
+        async with self.semaphore:
+            return await coroutine_function(*args, **kwargs)
+
+    async def drain(self) -> None:
+        """
+        Wait for every other task on the event loop to finish, including the clean-up of cancelled conversions.
+
+        :return: None
+        :rtype: None
+        """
+
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def submit(self, coroutine_function, *args, **kwargs) -> concurrent.futures.Future:
+        """
+        Schedule a coroutine function to run on the event loop once a conversion slot is free.
+
+        :param coroutine_function: Coroutine function to run, e.g. async_converter.
+        :param args: Positional arguments to pass to the coroutine function.
+        :param kwargs: Keyword arguments to pass to the coroutine function.
+        :return: concurrent.futures.Future for the result of the coroutine.
+        :rtype: concurrent.futures.Future
+        """
+
+        future = asyncio.run_coroutine_threadsafe(self.run_limited(coroutine_function, *args, **kwargs), self.loop)
+        with self.lock:
+            self.futures.add(future)
+        future.add_done_callback(self.discard_future)
+        return future
+
+    def discard_future(self, future: concurrent.futures.Future) -> None:
+        """
+        Forget a finished future.
+
+        :param future: concurrent.futures.Future that finished.
+        :type future: concurrent.futures.Future
+        :return: None
+        :rtype: None
+        """
+
+        with self.lock:
+            self.futures.discard(future)
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False) -> None:
+        """
+        Stop the executor, cancelling the conversions that are still pending or running if desired.
+
+        :param wait: Boolean that waits for the remaining conversions to finish before returning.
+        :type wait: bool
+        :param cancel_futures: Boolean that cancels the remaining conversions, killing the tools they are running.
+        :type cancel_futures: bool
+        :return: None
+        :rtype: None
+        """
+
+        with self.lock:
+            futures = list(self.futures)
+
+        if cancel_futures:
+            for future in futures:
+                future.cancel()
+
+        if wait:
+            asyncio.run_coroutine_threadsafe(self.drain(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+        else:
+            self.loop.call_soon_threadsafe(self.loop.stop)
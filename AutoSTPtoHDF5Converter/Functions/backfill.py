@@ -0,0 +1,427 @@
+"""
+Author: Ayush Doshi
+
+Contains the "run_backfill" function that converts an archive of .STP files in a single pass at full throughput, the
+"Backfill" class that walks the archive and reports the progress, and the "BackfillCheckpoint" class that lets an
+interrupted backfill resume.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import datetime
+import fnmatch
+import os
+import sqlite3
+import time
+
+import pandas
+
+from .scan_index import STP_PATTERN
+from .find_files import remove_completed_files
+from .merge_files_w_patient_info import merge_files_w_patient_info
+from .metrics import event, gauge
+from .run_streaming_pass import convert_chunks, finish_chunk
+
+# Path to the Backfill database relative to the folder the AutoSTPtoHDF5Converter is run from
+BACKFILL_DATABASE = os.path.join('AutoSTPtoHDF5Converter', 'Backfill.db')
+
+# Number of ready files per chunk when no chunk_size is given
+BACKFILL_CHUNK_SIZE = 1000
+
+
+class BackfillCheckpoint:
+    """
+    Durable record of the directories of an input folder whose .STP files were all converted or moved out, with the
+    modification time of the directory when they were, and of the files, bytes, and seconds the backfill took so far.
+
+    Successfully converted files stay in the Input folder unless delete_stp is used, so a resumed backfill would find
+    every one of them again. Instead, the files of a finished directory are not looked at again as long as the
+    modification time of the directory did not change, i.e. no file was added, removed, or renamed in it since.
+    """
+
+    def __init__(self, database_path: str, input_folder: str) -> None:
+        """
+        :param database_path: String that is the path to the Backfill SQLite database.
+        :type database_path: str
+        :param input_folder: String that is the path to the input folder that is backfilled.
+        :type input_folder: str
+        """
+
+        self.input_folder = os.path.abspath(input_folder)
+
+        self.conn = sqlite3.connect(database_path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS "BackfillDirectories" ("Input" TEXT, "Directory" TEXT, '
+                          '"Mtime" REAL, PRIMARY KEY("Input", "Directory"))')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS "BackfillProgress" ("Input" TEXT PRIMARY KEY, "Files" INTEGER, '
+                          '"Bytes" INTEGER, "Seconds" REAL, "Drained" REAL)')
+
+        # Start the progress over if the previous backfill of the input folder was drained
+        self.conn.execute('INSERT OR IGNORE INTO BackfillProgress VALUES (?, 0, 0, 0, NULL)', (self.input_folder,))
+        self.conn.execute('UPDATE BackfillProgress SET Files = 0, Bytes = 0, Seconds = 0, Drained = NULL WHERE '
+                          'Input = ? AND Drained IS NOT NULL', (self.input_folder,))
+        self.conn.commit()
+
+    def finished_directories(self) -> dict:
+        """
+        Get the directories whose files were all converted or moved out.
+
+        :return: Dictionary of the path of every finished directory to its modification time when it was finished.
+        :rtype: dict
+        """
+
+        return dict(self.conn.execute('SELECT Directory, Mtime FROM BackfillDirectories WHERE Input = ?',
+                                      (self.input_folder,)))
+
+    def finish_directories(self, directories: dict) -> None:
+        """
+        Record directories whose files were all converted or moved out.
+
+        :param directories: Dictionary of the path of every finished directory to its current modification time.
+        :type directories: dict
+        :return: None
+        :rtype: None
+        """
+
+        self.conn.executemany('INSERT OR REPLACE INTO BackfillDirectories VALUES (?, ?, ?)',
+                              ((self.input_folder, directory, mtime) for directory, mtime in directories.items()))
+        self.conn.commit()
+
+    def add_progress(self, files: int, size: int, seconds: float) -> tuple:
+        """
+        Add to the files, bytes, and seconds of the backfill.
+
+        :param files: Integer that is the number of files that were finished.
+        :type files: int
+        :param size: Integer that is the number of bytes of the finished files.
+        :type size: int
+        :param seconds: Float that is the number of seconds it took.
+        :type seconds: float
+        :return: Tuple of the total files, bytes, and seconds of the backfill, including earlier runs.
+        :rtype: tuple
+        """
+
+        self.conn.execute('UPDATE BackfillProgress SET Files = Files + ?, Bytes = Bytes + ?, Seconds = Seconds + ? '
+                          'WHERE Input = ?', (files, size, seconds, self.input_folder))
+        self.conn.commit()
+        return self.conn.execute('SELECT Files, Bytes, Seconds FROM BackfillProgress WHERE Input = ?',
+                                 (self.input_folder,)).fetchone()
+
+    def drain(self) -> None:
+        """
+        Record that the input folder was drained, so the next backfill starts its progress over.
+
+        :return: None
+        :rtype: None
+        """
+
+        self.conn.execute('UPDATE BackfillProgress SET Drained = ? WHERE Input = ?', (time.time(), self.input_folder))
+        self.conn.commit()
+
+
+def list_directory(directory: str, finished_mtime: [float, None], min_age: float) -> tuple:
+    """
+    List a single directory of the input folder.
+
+    :param directory: String that is the path to the directory.
+    :type directory: str
+    :param finished_mtime: Float that is the modification time of the directory when it was finished or None.
+    :type finished_mtime: [float, None]
+    :param min_age: Float that is the time, in seconds, since their last modification after which files are ready.
+    :type min_age: float
+    :return: Tuple of the directory, its modification time, a list of (path, size) tuples of its ready .STP files, the
+    number of its .STP files that are not ready yet, and a list of its subdirectories.
+    :rtype: tuple
+    """
+
+    files = []
+    young_files = 0
+    subdirectories = []
+    try:
+        mtime = os.stat(directory).st_mtime
+        entries = os.scandir(directory)
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return directory, None, files, young_files, subdirectories
+
+    # The files of a directory that did not change since it was finished are skipped without looking at them
+    skip_files = finished_mtime is not None and finished_mtime == mtime
+    now = time.time()
+
+    with entries:
+        for entry in entries:
+
+            # Skip hidden entries the way the recursive glob does
+            if entry.name.startswith('.'):
+                continue
+            try:
+                if entry.is_dir():
+                    subdirectories.append(entry.path)
+                elif not skip_files and fnmatch.fnmatch(entry.name, STP_PATTERN):
+                    stat = entry.stat()
+                    if now - stat.st_mtime >= min_age:
+                        files.append((entry.path, stat.st_size))
+                    else:
+                        young_files += 1
+
+            # The entry was moved or deleted while the directory was listed
+            except FileNotFoundError:
+                continue
+
+    return directory, mtime, files, young_files, subdirectories
+
+
+def walk_input_shards(input_folder: str, workers: int, finished: dict, min_age: float):
+    """
+    Walk the input folder with several threads at once, each listing a different directory, which hides the latency of
+    network shares. Only the directories that are left to walk and the listings that are waiting to be taken are kept in
+    memory.
+
+    :param input_folder: String that is the path to the input folder.
+    :type input_folder: str
+    :param workers: Integer that is the maximum number of directories listed at once.
+    :type workers: int
+    :param finished: Dictionary of the path of every finished directory to its modification time when it was finished.
+    :type finished: dict
+    :param min_age: Float that is the time, in seconds, since their last modification after which files are ready.
+    :type min_age: float
+    :return: Generator of the listings of the directories as returned by list_directory.
+    :rtype: Generator[tuple]
+    """
+
+    directories = [input_folder]
+    listing = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        while directories or listing:
+
+            # Keep every thread busy with a directory and a few more waiting for it
+            while directories and len(listing) < 2 * workers:
+                directory = directories.pop()
+                listing.add(executor.submit(list_directory, directory, finished.get(directory), min_age))
+
+            done, listing = concurrent.futures.wait(listing, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                listed = future.result()
+                directories.extend(listed[4])
+                yield listed
+
+
+class Backfill:
+    """
+    Single pass over an archive of .STP files that treats every file that was not modified for backfill_age as ready,
+    converts the files in chunks while the archive is still being walked, and checkpoints the directories whose files
+    were all converted or moved out.
+
+    A directory is finished once every one of its ready files was either converted, whether the conversion succeeded or
+    not, or moved out of the Input folder, and it has no files that are too new for the backfill. Files that are left in
+    the Input folder, e.g. duplicates deferred to a later pass or files converted by another node, keep their
+    directory from being finished, so a resumed backfill looks at them again.
+    """
+
+    def __init__(self, args: argparse.Namespace, checkpoint: BackfillCheckpoint) -> None:
+        """
+        :param args: argparse.Namespace that contains the arguments provided by the user.
+        :type args: argparse.Namespace
+        :param checkpoint: BackfillCheckpoint of the input folder.
+        :type checkpoint: BackfillCheckpoint
+        """
+
+        self.args = args
+        self.checkpoint = checkpoint
+        self.start_time = time.time()
+        self.last_progress_time = self.start_time
+
+        # Number of ready files of every directory that were neither converted nor moved out yet
+        self.unfinished_files = collections.Counter()
+
+        # Files and bytes found by the walk so far, and finished by this run, and whether the walk is still going
+        self.found_files = 0
+        self.found_bytes = 0
+        self.finished_files = 0
+        self.finished_bytes = 0
+        self.walking = True
+
+    def chunks(self):
+        """
+        Walk the archive and yield the ready files that have not already been converted and have patient information in
+        chunks of chunk_size files.
+
+        :return: Generator of pandas.DataFrame that contains [Path, Filename, Size, PatientID, Offset] for the files of
+        each chunk.
+        :rtype: Generator[pandas.DataFrame]
+        """
+
+        chunk = []
+        finished_directories = {}
+        for directory, mtime, files, young_files, _ in walk_input_shards(
+                self.args.input, self.args.backfill_walkers, self.checkpoint.finished_directories(),
+                self.args.backfill_age):
+
+            # A directory without ready files is finished right away unless it has files that are too new
+            if mtime is not None and not files and not young_files:
+                finished_directories[directory] = mtime
+            if files and not young_files:
+                self.unfinished_files[directory] += len(files)
+            self.found_files += len(files)
+            self.found_bytes += sum(size for _, size in files)
+            chunk.extend(files)
+
+            # Check the files in chunks of chunk_size files, where a directory may span several chunks
+            while len(chunk) >= self.args.chunk_size:
+                files = self.check_chunk(chunk[:self.args.chunk_size], finished_directories)
+                chunk = chunk[self.args.chunk_size:]
+                if not files.empty:
+                    yield files
+
+        self.walking = False
+        if chunk:
+            files = self.check_chunk(chunk, finished_directories)
+            if not files.empty:
+                yield files
+        self.checkpoint.finish_directories(finished_directories)
+
+    def check_chunk(self, chunk: list, finished_directories: dict) -> pandas.DataFrame:
+        """
+        Move the files of a chunk that were already converted or do not have patient information to the skipped output
+        folders and get the rest.
+
+        :param chunk: List of (path, size) tuples of the ready files of the chunk.
+        :type chunk: list
+        :param finished_directories: Dictionary of directories that were finished since the last checkpoint to their
+        modification time, which is updated in place and written to the checkpoint.
+        :type finished_directories: dict
+        :return: pandas.DataFrame that contains [Path, Filename, Size, PatientID, Offset] for the files to convert.
+        :rtype: pandas.DataFrame
+        """
+
+        files = pandas.DataFrame(chunk, columns=['Path', 'Size'])
+        files['Filename'] = files['Path'].map(os.path.basename)
+        new_files = merge_files_w_patient_info(self.args, remove_completed_files(self.args, files))
+
+        # The files that will not be converted are finished now, and the ones that were left in the Input folder keep
+        # their directory from being finished
+        left_out = files.loc[~files['Path'].isin(new_files['Path'])]
+        self.finish_files(left_out, finished_directories, keep_present=True)
+        self.checkpoint.finish_directories(finished_directories)
+        finished_directories.clear()
+
+        return new_files
+
+    def finish_files(self, files: pandas.DataFrame, finished_directories: dict, keep_present: bool = False) -> None:
+        """
+        Count files as finished and finish the directories that have no unfinished files left.
+
+        :param files: pandas.DataFrame that contains at least [Path, Size] for the finished files.
+        :type files: pandas.DataFrame
+        :param finished_directories: Dictionary of finished directories to their modification time, updated in place.
+        :type finished_directories: dict
+        :param keep_present: Boolean that is True if files that are still in the Input folder keep their directory from
+        being finished.
+        :type keep_present: bool
+        :return: None
+        :rtype: None
+        """
+
+        self.finished_files += len(files)
+        self.finished_bytes += int(files['Size'].sum())
+        for path in files['Path']:
+            directory = os.path.dirname(path)
+            if directory not in self.unfinished_files:
+                continue
+            if keep_present and os.path.exists(path):
+                del self.unfinished_files[directory]
+                continue
+            self.unfinished_files[directory] -= 1
+            if self.unfinished_files[directory] <= 0:
+                del self.unfinished_files[directory]
+                try:
+                    finished_directories[directory] = os.stat(directory).st_mtime
+                except FileNotFoundError:
+                    continue
+
+    def finish_chunk(self, args: argparse.Namespace, files: pandas.DataFrame) -> None:
+        """
+        De-identify and record a chunk whose conversions all finished, checkpoint its finished directories, and print
+        the progress of the backfill.
+
+        :param args: argparse.Namespace that contains the arguments provided by the user.
+        :type args: argparse.Namespace
+        :param files: pandas.DataFrame that contains [Path, Filename, Size, PatientID, Offset] for the files of the
+        chunk.
+        :type files: pandas.DataFrame
+        :return: None
+        :rtype: None
+        """
+
+        finish_chunk(args, files)
+
+        # Checkpoint the directories only once the files of the chunk are recorded in the CompletedFiles database
+        finished_directories = {}
+        self.finish_files(files, finished_directories)
+        self.checkpoint.finish_directories(finished_directories)
+        self.print_progress(len(files), int(files['Size'].sum()))
+
+    def print_progress(self, files: int, size: int) -> None:
+        """
+        Print the files and bytes that were finished, the throughput, and the time left for the files found so far.
+
+        :param files: Integer that is the number of files that were just finished.
+        :type files: int
+        :param size: Integer that is the number of bytes of the files that were just finished.
+        :type size: int
+        :return: None
+        :rtype: None
+        """
+
+        # Measure the throughput over this and earlier runs of the backfill
+        now = time.time()
+        total_files, total_bytes, total_seconds = self.checkpoint.add_progress(files, size,
+                                                                               now - self.last_progress_time)
+        self.last_progress_time = now
+        files_per_hour = total_files / max(total_seconds, 1e-9) * 3600
+        gb_per_hour = total_bytes / 1024 ** 3 / max(total_seconds, 1e-9) * 3600
+
+        # Estimate the time left from the bytes of the files that were found but not finished yet, which is only a
+        # lower bound while the archive is still being walked
+        remaining_bytes = max(0, self.found_bytes - self.finished_bytes)
+        eta = datetime.timedelta(seconds=round(remaining_bytes / 1024 ** 3 / gb_per_hour * 3600)) if gb_per_hour \
+            else 'unknown'
+        found = f"{self.found_files}{'+' if self.walking else ''}"
+
+        print(f"Backfill: {self.finished_files}/{found} file(s) ({self.finished_bytes / 1024 ** 3:.1f}/"
+              f"{self.found_bytes / 1024 ** 3:.1f} GB) done at {files_per_hour:.0f} files/hour and {gb_per_hour:.1f} "
+              f"GB/hour, {'at least ' if self.walking else ''}{eta} left")
+        gauge('stp_backfill_remaining_bytes', remaining_bytes)
+        event('backfill', finished_files=self.finished_files, found_files=self.found_files,
+              finished_bytes=self.finished_bytes, found_bytes=self.found_bytes, walking=self.walking,
+              files_per_hour=files_per_hour, gb_per_hour=gb_per_hour)
+
+
+def run_backfill(args: argparse.Namespace) -> int:
+    """
+    Convert every .STP file of an archive that was not modified for backfill_age in a single pass and return once the
+    archive is drained. Unlike the daemon cycle, files are ready without waiting for a second search, the archive is
+    walked by backfill_walkers threads at once while the first chunks are converted, and an interrupted backfill
+    resumes from its checkpoint.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :return: Integer that is the number of files that were submitted for conversion.
+    :rtype: int
+    """
+
+    print(f"Backfilling .STP files that were not modified for {args.backfill_age} sec from {args.input}...")
+
+    # Convert the archive in chunks, which bounds the files held in memory the same way streaming passes do
+    if not args.chunk_size:
+        args.chunk_size = BACKFILL_CHUNK_SIZE
+    checkpoint = BackfillCheckpoint(BACKFILL_DATABASE, args.input)
+    backfill = Backfill(args, checkpoint)
+    submitted = convert_chunks(args, backfill.chunks(), backfill.finish_chunk)
+
+    checkpoint.drain()
+    print(f"Backfill drained: {backfill.finished_files} file(s) ({backfill.finished_bytes / 1024 ** 3:.1f} GB) in "
+          f"{datetime.timedelta(seconds=round(time.time() - backfill.start_time))}. Files that were modified within "
+          f"{args.backfill_age} sec were left for the daemon.")
+
+    return submitted
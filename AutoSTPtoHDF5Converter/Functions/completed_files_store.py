@@ -0,0 +1,184 @@
+"""
+Author: Ayush Doshi
+
+Contains the "CompletedFilesStore" class that answers which .STP files were already converted and keeps the content
+fingerprints of the converted files next to their completion records.
+"""
+
+import functools
+import os
+import sqlite3
+
+# Path to the CompletedFiles database relative to the folder the AutoSTPtoHDF5Converter is run from
+COMPLETED_FILES_DATABASE = os.path.join('AutoSTPtoHDF5Converter', 'CompletedFiles.db')
+
+# Maximum number of filenames to look up with a single IN (...) query before a temporary table join is used instead,
+# which stays below the default SQLite limit on the number of query parameters
+MAX_LOOKUP_PARAMETERS = 900
+
+
+class CompletedFilesStore:
+    """
+    Keyed access to the CompletedFiles table that only looks up the candidate filenames against the primary key
+    instead of reading the whole table, and commits completed files in small transactions.
+
+    Filenames that are found to be completed are kept in an in-memory set across passes. A completed file is never
+    removed from the table, so the set never has to be invalidated and repeated candidates are answered without a
+    query.
+
+    The content fingerprints of files that were found but not converted yet wait in pending_fingerprints, a dictionary
+    of filename to (path, size, sample hash, full hash or None), and are written to the Fingerprints table together
+    with the completion records of their files.
+    """
+
+    def __init__(self, database_path: str = COMPLETED_FILES_DATABASE) -> None:
+        """
+        :param database_path: String that is the path to the CompletedFiles SQLite database.
+        :type database_path: str
+        """
+
+        self.database_path = database_path
+        self.completed_files = set()
+        self.pending_fingerprints = {}
+
+        # Use the default rollback journal, also for databases that earlier versions switched to write-ahead logging, so
+        # the CompletedFiles database stays a single file that can be read from a network share
+        self.conn = sqlite3.connect(database_path)
+        self.conn.execute('PRAGMA journal_mode=DELETE')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS "CompletedFiles" ("CompletedFiles" TEXT UNIQUE, '
+                          'PRIMARY KEY("CompletedFiles"))')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS "Fingerprints" ("Filename" TEXT PRIMARY KEY, "Size" INTEGER, '
+                          '"SampleHash" TEXT, "FullHash" TEXT, "Path" TEXT)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS "FingerprintsSampleHash" ON "Fingerprints" ("SampleHash", '
+                          '"Size")')
+        self.conn.commit()
+
+    def filter_completed(self, filenames) -> set:
+        """
+        Get the filenames out of the candidates that were already converted.
+
+        :param filenames: Iterable of .STP filenames to look up.
+        :type filenames: Iterable[str]
+        :return: Set of the filenames that are in the CompletedFiles table.
+        :rtype: set
+        """
+
+        candidates = set(filenames)
+        completed = candidates & self.completed_files
+        unknown = list(candidates - completed)
+
+        # Look up few candidates directly against the primary key and many through a join with a temporary table
+        if len(unknown) <= MAX_LOOKUP_PARAMETERS:
+            found = {row[0] for row in self.conn.execute(
+                f'SELECT CompletedFiles FROM CompletedFiles WHERE CompletedFiles IN ({", ".join("?" * len(unknown))})',
+                unknown)} if unknown else set()
+        else:
+            self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS Candidates (Filename TEXT PRIMARY KEY)')
+            self.conn.execute('DELETE FROM Candidates')
+            self.conn.executemany('INSERT INTO Candidates VALUES (?)', ((filename,) for filename in unknown))
+            found = {row[0] for row in self.conn.execute(
+                'SELECT CompletedFiles FROM Candidates JOIN CompletedFiles ON Filename = CompletedFiles')}
+            self.conn.execute('DELETE FROM Candidates')
+            self.conn.commit()
+
+        self.completed_files |= found
+        return completed | found
+
+    def add(self, filenames) -> None:
+        """
+        Record converted .STP files in a single small transaction.
+
+        :param filenames: Iterable of .STP filenames that were converted.
+        :type filenames: Iterable[str]
+        :return: None
+        :rtype: None
+        """
+
+        filenames = set(filenames)
+
+        # Write the fingerprints of the files in the same transaction, so a completion record never misses its
+        # fingerprint
+        fingerprints = [(filename,) + self.pending_fingerprints.pop(filename) for filename in filenames
+                        if filename in self.pending_fingerprints]
+        with self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO CompletedFiles (CompletedFiles) VALUES (?)',
+                                  ((filename,) for filename in filenames))
+            self.conn.executemany('INSERT OR REPLACE INTO Fingerprints (Filename, Path, Size, SampleHash, FullHash) '
+                                  'VALUES (?, ?, ?, ?, ?)', fingerprints)
+        self.completed_files |= filenames
+
+    def find_fingerprints(self, fingerprints: set) -> dict:
+        """
+        Get the converted files whose size and sample hash match any of the fingerprints.
+
+        :param fingerprints: Set of (size, sample hash) tuples to look up.
+        :type fingerprints: set
+        :return: Dictionary of (size, sample hash) to a list of (filename, full hash or None, path) of the matching
+        converted files, with only the fingerprints that matched.
+        :rtype: dict
+        """
+
+        # Look up the sample hashes against their index a batch of query parameters at a time
+        matches = {}
+        samples = list({sample for _, sample in fingerprints})
+        for start in range(0, len(samples), MAX_LOOKUP_PARAMETERS):
+            batch = samples[start:start + MAX_LOOKUP_PARAMETERS]
+            for filename, size, sample, full, path in self.conn.execute(
+                    f'SELECT Filename, Size, SampleHash, FullHash, Path FROM Fingerprints WHERE SampleHash IN '
+                    f'({", ".join("?" * len(batch))})', batch):
+                if (size, sample) in fingerprints:
+                    matches.setdefault((size, sample), []).append((filename, full, path))
+        return matches
+
+    def set_full_hash(self, filename: str, full: str) -> None:
+        """
+        Store the full hash of a converted file once it was needed to confirm a duplicate.
+
+        :param filename: String that is the filename of the converted .STP file.
+        :type filename: str
+        :param full: String that is the full hash of the file.
+        :type full: str
+        :return: None
+        :rtype: None
+        """
+
+        with self.conn:
+            self.conn.execute('UPDATE Fingerprints SET FullHash = ? WHERE Filename = ?', (full, filename))
+
+    def close(self) -> None:
+        """
+        Close the connection to the CompletedFiles database.
+
+        :return: None
+        :rtype: None
+        """
+
+        self.conn.close()
+
+
+@functools.lru_cache(maxsize=None)
+def get_completed_files_store(database_path: str, pid: int) -> CompletedFilesStore:
+    """
+    Get the completed files store for the database, opening it only once per process so its cache stays warm across
+    passes. The process ID is part of the cache key so a forked worker never uses the connection of its parent.
+
+    :param database_path: String that is the path to the CompletedFiles SQLite database.
+    :type database_path: str
+    :param pid: Integer that is the ID of the current process.
+    :type pid: int
+    :return: CompletedFilesStore for the database.
+    :rtype: CompletedFilesStore
+    """
+
+    return CompletedFilesStore(database_path)
+
+
+def completed_files_store() -> CompletedFilesStore:
+    """
+    Get the completed files store of this process for the default CompletedFiles database.
+
+    :return: CompletedFilesStore for the default CompletedFiles database.
+    :rtype: CompletedFilesStore
+    """
+
+    return get_completed_files_store(COMPLETED_FILES_DATABASE, os.getpid())
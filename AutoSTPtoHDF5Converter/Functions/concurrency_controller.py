@@ -0,0 +1,246 @@
+"""
+Author: Ayush Doshi
+
+Contains the "ConcurrencyController" class that raises or lowers the number of concurrent conversions within bounds
+based on samples of the CPU utilization, I/O wait, available memory, and free space of the host.
+"""
+
+import argparse
+import functools
+import math
+import os
+import shutil
+import time
+
+from .metrics import event, gauge
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# The host is sampled through psutil where it is installed and through the /proc file system of Linux otherwise
+AUTOSCALE_AVAILABLE = psutil is not None or os.path.isfile('/proc/stat')
+
+# Fraction of CPU time the conversions are scaled up to, which leaves room for the rest of the host
+CPU_TARGET = 0.90
+
+# Fraction of CPU time spent waiting for I/O above which the disks, or swapping, are the bottleneck
+IOWAIT_HIGH = 0.20
+
+# Fraction of the memory that has to stay available, below which the conversions start to swap
+MEMORY_LOW = 0.10
+
+
+def read_cpu_times() -> tuple:
+    """
+    Read the CPU time of the host that was spent busy, waiting for I/O, and in total since boot.
+
+    :return: Tuple of floats of the busy, I/O wait, and total CPU time.
+    :rtype: tuple
+    """
+
+    if psutil is not None:
+        cpu_times = psutil.cpu_times()
+        iowait = getattr(cpu_times, 'iowait', 0)
+        total = sum(cpu_times)
+        return total - cpu_times.idle - iowait, iowait, total
+
+    # The first line of /proc/stat is "cpu user nice system idle iowait irq softirq steal guest guest_nice", where the
+    # guest times are already part of the user times
+    with open('/proc/stat') as stat_file:
+        times = [float(value) for value in stat_file.readline().split()[1:9]]
+    idle, iowait, total = times[3], times[4], sum(times)
+    return total - idle - iowait, iowait, total
+
+
+def available_memory_fraction() -> float:
+    """
+    Get the fraction of the memory of the host that is available without swapping.
+
+    :return: Float that is the available memory divided by the total memory.
+    :rtype: float
+    """
+
+    if psutil is not None:
+        memory = psutil.virtual_memory()
+        return memory.available / memory.total
+
+    meminfo = {}
+    with open('/proc/meminfo') as meminfo_file:
+        for line in meminfo_file:
+            name, value = line.split(':', 1)
+            meminfo[name] = float(value.split()[0])
+    return meminfo.get('MemAvailable', meminfo.get('MemFree', 0)) / meminfo['MemTotal']
+
+
+class ConcurrencyController:
+    """
+    Adjusts the number of conversions that may run at once from periodic samples of the host, one step per interval:
+
+    - Lowers the limit while memory, I/O, or the free space of the Processing, output, or scratch folders runs short,
+      since more conversions would only swap, queue on the disks, or fail to write their outputs.
+    - Raises the limit while files wait for a conversion slot, the CPUs are below their target, and nothing runs short,
+      in proportion to the room the CPUs have left but at most to twice the limit at once.
+    - Keeps the limit otherwise.
+
+    Lowering the limit never stops running conversions; fewer conversions are started until enough of them finished.
+    """
+
+    def __init__(self, min_conversions: int, max_conversions: int, interval: float, folders: list,
+                 min_free_gb: float) -> None:
+        """
+        :param min_conversions: Integer that is the lowest number of concurrent conversions.
+        :type min_conversions: int
+        :param max_conversions: Integer that is the highest number of concurrent conversions.
+        :type max_conversions: int
+        :param interval: Float that is the time, in seconds, in between samples of the host.
+        :type interval: float
+        :param folders: List of the paths to the folders whose free space is checked.
+        :type folders: list
+        :param min_free_gb: Float that is the free space, in GB, every folder has to keep.
+        :type min_free_gb: float
+        """
+
+        self.min_conversions = min_conversions
+        self.max_conversions = max_conversions
+        self.interval = interval
+        self.folders = folders
+        self.min_free_gb = min_free_gb
+
+        # Start from a conversion per CPU and let the samples move the limit from there
+        self.limit = max(min_conversions, min(max_conversions, os.cpu_count() or min_conversions))
+        self.previous_cpu_times = read_cpu_times()
+        self.last_sample_time = time.monotonic()
+        gauge('stp_concurrency_limit', self.limit)
+
+    def update(self, demand: int) -> int:
+        """
+        Sample the host once the interval passed since the last sample and adjust the limit.
+
+        :param demand: Integer that is the number of conversions that are running or waiting for a slot.
+        :type demand: int
+        :return: Integer that is the number of conversions that may run at once.
+        :rtype: int
+        """
+
+        elapsed = time.monotonic() - self.last_sample_time
+        if elapsed < self.interval:
+            return self.limit
+        self.last_sample_time = time.monotonic()
+
+        # Start over from a fresh sample after a gap of more than two intervals, e.g. in between passes, since the host
+        # was not running conversions for most of it
+        sample = self.sample()
+        if elapsed > 2 * self.interval:
+            return self.limit
+
+        limit, reason = self.decide(sample, demand)
+
+        if limit != self.limit:
+            print(f"{'Raising' if limit > self.limit else 'Lowering'} concurrent conversions from {self.limit} to "
+                  f"{limit} because {reason} (CPU {sample['cpu']:.0%}, I/O wait {sample['iowait']:.0%}, "
+                  f"{sample['memory']:.0%} memory available, {sample['free_gb']:.1f} GB free, {demand} running or "
+                  f"waiting)")
+            event('concurrency', previous=self.limit, limit=limit, reason=reason, demand=demand, **sample)
+            self.limit = limit
+        gauge('stp_concurrency_limit', self.limit)
+
+        return self.limit
+
+    def sample(self) -> dict:
+        """
+        Sample the CPU utilization and I/O wait since the previous sample, the available memory, and the lowest free
+        space of the folders.
+
+        :return: Dictionary of 'cpu', 'iowait', and 'memory' fractions and 'free_gb'.
+        :rtype: dict
+        """
+
+        busy, iowait, total = read_cpu_times()
+        previous_busy, previous_iowait, previous_total = self.previous_cpu_times
+        self.previous_cpu_times = busy, iowait, total
+        elapsed = max(total - previous_total, 1e-9)
+
+        free_bytes = min((shutil.disk_usage(folder).free for folder in self.folders if os.path.isdir(folder)),
+                         default=float('inf'))
+
+        return {'cpu': (busy - previous_busy) / elapsed, 'iowait': (iowait - previous_iowait) / elapsed,
+                'memory': available_memory_fraction(), 'free_gb': free_bytes / 1024 ** 3}
+
+    def decide(self, sample: dict, demand: int) -> tuple:
+        """
+        Decide the next limit from a sample of the host.
+
+        :param sample: Dictionary of a sample of the host as returned by sample.
+        :type sample: dict
+        :param demand: Integer that is the number of conversions that are running or waiting for a slot.
+        :type demand: int
+        :return: Tuple of the next limit and the reason it changed, which is None if it did not.
+        :rtype: tuple
+        """
+
+        # Step down while any resource runs short
+        if sample['memory'] < MEMORY_LOW:
+            reason = f"less than {MEMORY_LOW:.0%} of the memory is available"
+        elif sample['iowait'] > IOWAIT_HIGH:
+            reason = f"more than {IOWAIT_HIGH:.0%} of the CPU time is spent waiting for I/O"
+        elif sample['free_gb'] < self.min_free_gb:
+            reason = f"less than {self.min_free_gb} GB are free"
+        else:
+            reason = None
+        if reason is not None:
+            return max(self.min_conversions, self.limit - 1), reason
+
+        # Scale up toward the CPU target while the limit holds back conversions, since a limit that is not reached says
+        # nothing about whether more conversions would help
+        if demand > self.limit and sample['cpu'] < CPU_TARGET:
+            limit = math.ceil(self.limit * CPU_TARGET / max(sample['cpu'], 0.01))
+            limit = min(self.max_conversions, max(self.limit + 1, min(2 * self.limit, limit)))
+            return limit, f"the CPUs are only {sample['cpu']:.0%} busy"
+
+        return self.limit, None
+
+
+@functools.lru_cache(maxsize=None)
+def get_concurrency_controller(min_conversions: int, max_conversions: int, interval: float, folders: tuple,
+                               min_free_gb: float) -> ConcurrencyController:
+    """
+    Get the concurrency controller for the bounds, creating it only once per process so the limit it found carries over
+    from one pass to the next.
+
+    :param min_conversions: Integer that is the lowest number of concurrent conversions.
+    :type min_conversions: int
+    :param max_conversions: Integer that is the highest number of concurrent conversions.
+    :type max_conversions: int
+    :param interval: Float that is the time, in seconds, in between samples of the host.
+    :type interval: float
+    :param folders: Tuple of the paths to the folders whose free space is checked.
+    :type folders: tuple
+    :param min_free_gb: Float that is the free space, in GB, every folder has to keep.
+    :type min_free_gb: float
+    :return: ConcurrencyController for the bounds.
+    :rtype: ConcurrencyController
+    """
+
+    return ConcurrencyController(min_conversions, max_conversions, interval, list(folders), min_free_gb)
+
+
+def create_concurrency_controller(args: argparse.Namespace, max_conversions: int) -> [ConcurrencyController, None]:
+    """
+    Get the concurrency controller if desired based on the user arguments.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param max_conversions: Integer that is the highest number of conversions the conversion engine can run at once.
+    :type max_conversions: int
+    :return: ConcurrencyController or None if the number of concurrent conversions is fixed.
+    :rtype: [ConcurrencyController, None]
+    """
+
+    if not args.autoscale:
+        return None
+
+    folders = ('Processing', args.output) + ((args.scratch,) if args.scratch else ())
+    return get_concurrency_controller(min(args.min_cores, max_conversions), max_conversions, args.autoscale_interval,
+                                      folders, args.min_free_gb)
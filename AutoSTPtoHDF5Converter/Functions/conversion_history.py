@@ -0,0 +1,165 @@
+"""
+Author: Ayush Doshi
+
+Contains the "ConversionHistory" class that records how long past conversions took and predicts the duration of new
+ones.
+"""
+
+import functools
+import os
+import sqlite3
+import threading
+
+import pandas
+
+# Path to the ConversionHistory database relative to the folder the AutoSTPtoHDF5Converter is run from
+CONVERSION_HISTORY_DATABASE = os.path.join('AutoSTPtoHDF5Converter', 'ConversionHistory.db')
+
+# Minimum number of recorded conversions before the history is trusted to predict durations, either overall or for a
+# single bed
+MIN_HISTORY_SAMPLES = 10
+
+
+class ConversionHistory:
+    """
+    Records the size and duration of every successful conversion and predicts the duration of new conversions from it.
+
+    Conversions are only compared with conversions of the same EHR system and wave data setting. A bed with enough
+    recorded conversions is predicted from its own seconds per byte, since the monitors and wave forms recorded at a bed
+    decide how long a byte takes to convert. Other beds are predicted from a linear fit of duration against size over
+    all conversions. The fit only needs running sums, so it is computed by SQLite instead of loading the history.
+
+    The history is shared by the threads of a process, e.g. the event loop of the asyncio engine predicts timeouts while
+    the main thread records finished conversions, so its connection is guarded by a lock.
+    """
+
+    def __init__(self, database_path: str = CONVERSION_HISTORY_DATABASE) -> None:
+        """
+        :param database_path: String that is the path to the ConversionHistory SQLite database.
+        :type database_path: str
+        """
+
+        self.database_path = database_path
+        self.lock = threading.Lock()
+
+        # Use write-ahead logging so recording a conversion does not block on and is not blocked by predictions
+        self.conn = sqlite3.connect(database_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS "ConversionHistory" ("Filename" TEXT, "Bed" TEXT, '
+                          '"System" TEXT, "WaveData" INTEGER, "Size" INTEGER, "Seconds" REAL, '
+                          'PRIMARY KEY("Filename", "System", "WaveData"))')
+        self.conn.commit()
+
+    def add(self, filename: str, size: int, seconds: float, system: str, wave_data: bool) -> None:
+        """
+        Record the size and duration of a successful conversion, replacing an earlier record of the same file.
+
+        :param filename: String that is the filename of the converted .STP file.
+        :type filename: str
+        :param size: Integer that is the size of the .STP file in bytes.
+        :type size: int
+        :param seconds: Float that is the number of seconds the conversion took.
+        :type seconds: float
+        :param system: String that is the EHR system the .STP file was converted from.
+        :type system: str
+        :param wave_data: Boolean that is True if the wave data was converted as well.
+        :type wave_data: bool
+        :return: None
+        :rtype: None
+        """
+
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO ConversionHistory (Filename, Bed, System, WaveData, Size, '
+                              'Seconds) VALUES (?, ?, ?, ?, ?, ?)',
+                              (filename, bed_of(filename), system, int(wave_data), size, seconds))
+
+    def predict(self, files: pandas.DataFrame, system: str, wave_data: bool) -> [pandas.Series, None]:
+        """
+        Predict how many seconds the conversion of each file will take.
+
+        :param files: pandas.DataFrame that contains at least [Filename, Size] for the files to predict.
+        :type files: pandas.DataFrame
+        :param system: String that is the EHR system the .STP files will be converted from.
+        :type system: str
+        :param wave_data: Boolean that is True if the wave data will be converted as well.
+        :type wave_data: bool
+        :return: pandas.Series of the predicted seconds with the index of files or None if there is not enough history.
+        :rtype: [pandas.Series, None]
+        """
+
+        # Fit seconds = intercept + slope * size over all recorded conversions with the same system and wave data
+        # setting
+        with self.lock:
+            count, sum_x, sum_y, sum_xx, sum_xy = self.conn.execute(
+                'SELECT COUNT(*), SUM(Size), SUM(Seconds), SUM(1.0 * Size * Size), SUM(Size * Seconds) '
+                'FROM ConversionHistory WHERE System = ? AND WaveData = ?', (system, int(wave_data))).fetchone()
+        if count < MIN_HISTORY_SAMPLES:
+            return None
+        variance = count * sum_xx - sum_x * sum_x
+        slope = (count * sum_xy - sum_x * sum_y) / variance if variance > 0 else 0.0
+        intercept = (sum_y - slope * sum_x) / count
+        if slope <= 0:
+            slope, intercept = sum_y / max(sum_x, 1), 0.0
+
+        # Get the seconds per byte of every bed with enough recorded conversions
+        with self.lock:
+            bed_rates = dict(self.conn.execute(
+                'SELECT Bed, SUM(Seconds) / SUM(Size) FROM ConversionHistory '
+                'WHERE System = ? AND WaveData = ? AND Size > 0 GROUP BY Bed HAVING COUNT(*) >= ?',
+                (system, int(wave_data), MIN_HISTORY_SAMPLES)))
+
+        rates = files['Filename'].apply(bed_of).map(bed_rates)
+        return (rates * files['Size']).fillna(intercept + slope * files['Size'])
+
+    def close(self) -> None:
+        """
+        Close the connection to the ConversionHistory database.
+
+        :return: None
+        :rtype: None
+        """
+
+        with self.lock:
+            self.conn.close()
+
+
+def bed_of(filename: str) -> str:
+    """
+    Get the bed from an .STP filename, which is formatted as <Bed>-<Data start in epoch seconds>.Stp.
+
+    :param filename: String that is the filename of the .STP file.
+    :type filename: str
+    :return: String that is the bed.
+    :rtype: str
+    """
+
+    return os.path.splitext(filename)[0].rsplit('-', 1)[0]
+
+
+@functools.lru_cache(maxsize=None)
+def get_conversion_history(database_path: str, pid: int) -> ConversionHistory:
+    """
+    Get the conversion history for the database, opening it only once per process. The process ID is part of the cache
+    key so a forked worker never uses the connection of its parent.
+
+    :param database_path: String that is the path to the ConversionHistory SQLite database.
+    :type database_path: str
+    :param pid: Integer that is the ID of the current process.
+    :type pid: int
+    :return: ConversionHistory for the database.
+    :rtype: ConversionHistory
+    """
+
+    return ConversionHistory(database_path)
+
+
+def conversion_history() -> ConversionHistory:
+    """
+    Get the conversion history of this process for the default ConversionHistory database.
+
+    :return: ConversionHistory for the default ConversionHistory database.
+    :rtype: ConversionHistory
+    """
+
+    return get_conversion_history(CONVERSION_HISTORY_DATABASE, os.getpid())
@@ -0,0 +1,279 @@
+"""
+Author: Ayush Doshi
+
+Contains the helper functions shared by the conversion engines to build the StpToolkit and formatconverter commands and
+to manage the Processing folder.
+"""
+
+import argparse
+import glob
+import os
+import shlex
+import shutil
+import signal
+import subprocess
+import sys
+
+from .metrics import count
+from .native_hdf5_writer import native_writer_enabled
+
+# Reasons that streaming the .XML file through a named pipe was rejected by a tool during this run
+XML_STREAMING_REJECTED = []
+
+
+def stptoolkit_params(args: argparse.Namespace, processing_stp_path: str, processing_xml_path: str) -> list:
+    """
+    Create the list of parameters to run the StpToolkit that converts an .STP file to an .XML file.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param processing_stp_path: String that is the path to the .STP file in the Processing folder.
+    :type processing_stp_path: str
+    :param processing_xml_path: String that is the path where the converted .XML file should be saved.
+    :type processing_xml_path: str
+    :return: List of the StpToolkit executable and its parameters.
+    :rtype: list
+    """
+
+    # Create a list of parameters: the StpToolkit command, path to the .STP file in the processing folder, -o flag and
+    # associated path to save the converted .XML file output, -blnk to remove any existing patient data from the .STP
+    # file, and the type of EHR system used stated by user argument
+    params = tool_command(args.stptoolkit, 'StpToolkit.exe') + [processing_stp_path, '-o', processing_xml_path, '-blnk',
+                                                                '-' + args.system]
+
+    # If wave_data is False, add the '-xw' parameter to the list of parameters to ignore the wave_data
+    if not args.wave_data:
+        params.append('-xw')
+
+    return params
+
+
+def formatconverter_params(args: argparse.Namespace, processing_xml_path: str, offset: int) -> list:
+    """
+    Create the list of parameters to run the formatconverter that converts an .XML file to de-identified .HDF5 file(s).
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param processing_xml_path: String that is the path to the .XML file in the Processing folder.
+    :type processing_xml_path: str
+    :param offset: Integer that is the offset specific to the .STP file retrieved from the patient offset database.
+    :type offset: int
+    :return: List of the formatconverter executable and its parameters.
+    :rtype: list
+    """
+
+    # Create a list of parameters: the formatconverter command, -t flag and hdf5 to set the output to a .HDF5 file, -C
+    # to skip caching locally, -p and %d%i-_-%s.%t to specify the output .HDF5 naming structure, --offset and the
+    # specific negative offset for the file, and the .XML file in the Processing folder as the input
+    params = tool_command(args.formatconverter, 'formatconverter.exe') + ['-t', 'hdf5', '-C', '-p', '%d%i-_-%s.%t',
+                                                                          '--offset', f'-{offset}', processing_xml_path]
+
+    # If single_hdf5_file is True, add '-n' before the .XML path to create only 1 .HDF5 file per .XML file instead of
+    # creating 1 .HDF5 per day
+    if args.single_hdf5_file:
+        params.insert(-1, '-n')
+
+    return params
+
+
+def tool_command(command: [str, None], executable: str) -> list:
+    """
+    Get the command that runs a conversion tool, which is either the command provided by the user, e.g. to run the
+    tool through mono or to use a stand-in tool, or the executable in the UniversalFileConverter folder.
+
+    :param command: String that is the command provided by the user or None.
+    :type command: [str, None]
+    :param executable: String that is the filename of the executable in the UniversalFileConverter folder.
+    :type executable: str
+    :return: List of the executable and any parameters that come before the tool's own parameters.
+    :rtype: list
+    """
+
+    if command:
+        return shlex.split(command, posix=sys.platform != 'win32')
+
+    return [os.path.join('AutoSTPtoHDF5Converter', 'UniversalFileConverter', executable)]
+
+
+def xml_streaming_enabled(args: argparse.Namespace) -> bool:
+    """
+    Check if the .XML file should be streamed from the StpToolkit to the formatconverter through a named pipe, which
+    requires the user to ask for it, named pipe support, that a tool has not rejected a named pipe before, and that the
+    formatconverter is used instead of the native writer.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :return: True if the .XML file should be streamed, otherwise False.
+    :rtype: bool
+    """
+
+    return args.stream_xml and hasattr(os, 'mkfifo') and not XML_STREAMING_REJECTED and not native_writer_enabled(args)
+
+
+def reject_xml_streaming(reason: str) -> None:
+    """
+    Stop streaming .XML files through named pipes for the rest of the run because a tool rejected a non-seekable input
+    or output, so later files do not pay for a failed attempt before falling back to the file-based conversion.
+
+    :param reason: String that describes why streaming failed.
+    :type reason: str
+    :return: None
+    :rtype: None
+    """
+
+    if not XML_STREAMING_REJECTED:
+        print(f"Streaming the .XML file through a named pipe failed ({reason}). Falling back to .XML files...")
+    XML_STREAMING_REJECTED.append(reason)
+
+
+def confirm_xml_streaming_rejection(failed_tool: [str, None], hdf5_paths: list) -> None:
+    """
+    Stop streaming .XML files through named pipes for the rest of the run if the formatconverter failed on the named
+    pipe of an .STP file but converted the .XML file of the same .STP file, i.e. the pipe and not the data was at fault.
+
+    :param failed_tool: String that is the name of the tool that failed on the named pipe or None.
+    :type failed_tool: [str, None]
+    :param hdf5_paths: List of the paths of the .HDF5 file(s) created from the .XML file of the same .STP file.
+    :type hdf5_paths: list
+    :return: None
+    :rtype: None
+    """
+
+    if failed_tool == 'formatconverter' and hdf5_paths:
+        reject_xml_streaming('the formatconverter failed on the named pipe but converted the .XML file')
+
+
+def release_named_pipe(path: str) -> None:
+    """
+    Briefly open the writing end of a named pipe so that a reader that is still waiting for a writer sees the end of the
+    file instead of waiting forever, e.g. when the StpToolkit exited without opening its output.
+
+    :param path: String that is the path to the named pipe.
+    :type path: str
+    :return: None
+    :rtype: None
+    """
+
+    try:
+        os.close(os.open(path, os.O_WRONLY | os.O_NONBLOCK))
+    except OSError:
+        pass
+
+
+def terminate_process_tree(process: subprocess.Popen) -> None:
+    """
+    Kill a tool process that was started in its own process group/session along with every process it started.
+
+    :param process: subprocess.Popen of the tool.
+    :type process: subprocess.Popen
+    :return: None
+    :rtype: None
+    """
+
+    if process.poll() is None:
+        try:
+            if sys.platform == 'win32':
+                subprocess.run(['taskkill', '/F', '/T', '/PID', str(process.pid)], stdout=subprocess.DEVNULL,
+                               stderr=subprocess.STDOUT)
+            else:
+                os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        try:
+            process.kill()
+        except OSError:
+            pass
+    process.wait()
+
+
+def remove_converted_files(basename: str) -> None:
+    """
+    Delete the (partial) .HDF5 file(s) created for an .STP file in the Processing folder, e.g. after a failed attempt.
+
+    :param basename: String that is the basename (filename w/o extension) of the .STP file of interest.
+    :type basename: str
+    :return: None
+    :rtype: None
+    """
+
+    for processing_hdf5_path in glob.glob(os.path.join('Processing', glob.escape(basename) + '-_-*.hdf5')):
+        os.remove(processing_hdf5_path)
+
+
+def move_converted_files(args: argparse.Namespace, basename: str) -> None:
+    """
+    Move the .HDF5 file(s) created for an .STP file from the Processing folder to the Output\Converted folder.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param basename: String that is the basename (filename w/o extension) of the .STP file of interest.
+    :type basename: str
+    :return: None
+    :rtype: None
+    """
+
+    # Find all of the .HDF5 that were created in the Processing folder with the .STP file's specific basename
+    processing_hdf5_paths = glob.glob(os.path.join('Processing', glob.escape(basename) + '-_-*.hdf5'))
+
+    # Create the end paths for the .HDF5 files in Output\Converted and move them from the Processing folder to the
+    # Output\Converted folder
+    for processing_hdf5_path in processing_hdf5_paths:
+        hdf5_filename = os.path.basename(processing_hdf5_path)
+        converted_hdf5_path = os.path.join(args.output, 'Converted', hdf5_filename)
+        count('hdf5_output_bytes_total', os.path.getsize(processing_hdf5_path))
+        shutil.move(processing_hdf5_path, converted_hdf5_path)
+
+
+def converted_files(args: argparse.Namespace, basename: str) -> list:
+    """
+    Get the paths of the .HDF5 file(s) of an .STP file in the Output\Converted folder.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param basename: String that is the basename (filename w/o extension) of the .STP file of interest.
+    :type basename: str
+    :return: List of the paths of the .HDF5 file(s) in the Output\Converted folder.
+    :rtype: list
+    """
+
+    return glob.glob(os.path.join(args.output, 'Converted', glob.escape(basename) + '-_-*.hdf5'))
+
+
+def rename_if_exists(source_path: str, destination_path: str) -> None:
+    """
+    Move a file with os.renames unless it is already gone, e.g. because another node that shares the input folder moved
+    it first.
+
+    :param source_path: String that is the path to the file to move.
+    :type source_path: str
+    :param destination_path: String that is the path to move the file to.
+    :type destination_path: str
+    :return: None
+    :rtype: None
+    """
+
+    try:
+        os.renames(source_path, destination_path)
+    except FileNotFoundError:
+        if os.path.exists(source_path):
+            raise
+
+
+def cleanup(basename: str) -> None:
+    """
+    Delete leftover intermediate processing files in the Processing folder with a specified basename.
+
+    :param basename: String that is the basename (filename w/o extension) of the .STP file of interest.
+    :type basename: str
+    :return: None
+    :rtype: None
+    """
+
+    # Find any leftover processing files in the Processing folder with the specified basename and delete them, i.e. the
+    # .STP, .XML, and marker files named <basename>.* and the .HDF5 files named <basename>-_-*, but not the files of
+    # other .STP files whose basename starts with this one
+    escaped_basename = glob.escape(basename)
+    leftover_files = glob.glob(os.path.join('Processing', escaped_basename + '.*')) + \
+        glob.glob(os.path.join('Processing', escaped_basename + '-_-*'))
+    for leftover_file in leftover_files:
+        os.remove(leftover_file)
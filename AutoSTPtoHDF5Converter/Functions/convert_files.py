@@ -5,109 +5,363 @@ Contains the "convert_files" function as well as necessary subfunctions.
 """
 
 import argparse
+import collections
 import concurrent.futures
 import datetime
 import glob
 import os
-import shutil
 import subprocess
 import time
 
 import pandas
 
+from .async_converter import AsyncConversionExecutor, async_converter
+from .concurrency_controller import ConcurrencyController, create_concurrency_controller
+from .conversion_history import conversion_history
+from .conversion_tools import cleanup, confirm_xml_streaming_rejection, converted_files, formatconverter_params, \
+    move_converted_files, reject_xml_streaming, release_named_pipe, remove_converted_files, stptoolkit_params, \
+    terminate_process_tree, xml_streaming_enabled
+from .job_monitor import ConversionPreempted, ConversionStalled, StallMonitor, conversion_timeout, run_monitored_tool
+from .lease_queue import FileClaimed, claim_file, release_file
+from .metrics import count, event, gauge, stage_timer, track_conversion_stage, worker_initializer
+from .native_hdf5_writer import native_writer_enabled, write_native_hdf5
+from .scheduling import order_files
+from .staging import create_prefetcher, stage_input_file
+from .state_journal import forget_state, record_state, resume_conversion
+
 
 def convert_files(args: argparse.Namespace, files: pandas.DataFrame) -> None:
     """
     Parallelize the conversion of .STP to .HDF5 files using the PreVent Tools developed by Ryan Bobko and move to the
-    Output\Converted staging folder for filename de-identification.
+    Output\Converted staging folder for filename de-identification. Conversions either run in a ProcessPoolExecutor
+    worker per core or, with the 'asyncio' engine, directly as asyncio subprocesses.
 
     :param args: argparse.Namespace that contains the arguments provided by the user.
     :type args: argparse.Namespace
-    :param files: pandas.DataFrame that contains [Path, Filename, PatientID, Offset] for the convertable files.
+    :param files: pandas.DataFrame that contains [Path, Filename, Size, PatientID, Offset] for the convertable files.
     :type files: pandas.DataFrame
     :return: None
     :rtype: None
     """
 
-    # Get [Path, Filename, Offset] from dataframe of ready files and convert to a list of tuples
-    files = files.loc[:, ['Path', 'Filename', 'Offset']]
+    # Order the files by the scheduling policy chosen by the user, get [Path, Filename, Offset] from dataframe of ready
+    # files, and convert to a list of tuples
+    files = order_files(args, files).loc[:, ['Path', 'Filename', 'Offset']]
     file_tuples = files.to_records(index=False)
 
     print(f"Converting {len(files)} files: {file_tuples}")
 
-    # Create a concurrent.futures multi-processing executor pool
-    with concurrent.futures.ProcessPoolExecutor(max_workers=args.cores) as executor:
+    # Stage the files into the scratch folder ahead of their conversions if desired based on the user arguments
+    prefetcher = create_prefetcher(args)
+    if prefetcher is not None:
+        prefetcher.add([(path, os.path.basename(path), os.path.getsize(path)) for path, _, _ in file_tuples])
+
+    # Adjust the number of concurrent conversions to the load of the host if desired based on the user arguments
+    controller = create_concurrency_controller(args, max_concurrent_conversions(args))
+
+    # Create a concurrent.futures executor for the conversion engine chosen by the user arguments
+    with create_conversion_executor(args) as executor:
 
         # Save the start time of the conversion process
         global_start_time = time.time()
 
-        # Create a dictionary where the key is the submitted future job of the 'converter' function with the necessary
-        # arguments and the value is the path to the file that will be converted by that future job.
-        futures = \
-            {executor.submit(converter, path, filename, offset, args): path
-             for path, filename, offset in file_tuples}
+        # Create a queue of the files that were not submitted yet and a dictionary where the key is the submitted future
+        # job of the 'converter' function with the necessary arguments and the value is the path to the file that will
+        # be converted by that future job.
+        queued_files = collections.deque(file_tuples)
+        futures = {}
+
+        # Create a counter for finished, timed-out, and errored-out conversions to log progress
+        counts = collections.Counter()
+
+        while queued_files or futures:
+
+            # Submit files until every conversion slot is in use
+            max_running = concurrency_limit(args, controller, len(futures) + len(queued_files))
+            while queued_files and len(futures) < max_running:
+                path, filename, offset = queued_files.popleft()
+                futures[executor.submit(get_converter(args), path, filename, offset, args)] = path
+            update_queue_gauges(len(futures), len(queued_files), max_running)
+
+            # Wait until a conversion is completed, or until the controller samples the host again, and handle the
+            # outcome of every completed conversion
+            done, _ = concurrent.futures.wait(futures, timeout=controller.interval if controller else None,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                path = futures.pop(future)
+                handle_conversion_result(args, future, path, counts, global_start_time, len(file_tuples))
+                if prefetcher is not None:
+                    prefetcher.release(os.path.basename(path))
+
+    # Delete the staged files that were not taken
+    if prefetcher is not None:
+        prefetcher.close()
+
+
+def update_queue_gauges(pending: int, queued: int, max_running: int) -> None:
+    """
+    Update the backlog and in-flight metrics from the number of unfinished conversions.
+
+    :param pending: Integer that is the number of submitted conversions that have not finished.
+    :type pending: int
+    :param queued: Integer that is the number of files that are waiting and have not been submitted.
+    :type queued: int
+    :param max_running: Integer that is the maximum number of conversions that run at once.
+    :type max_running: int
+    :return: None
+    :rtype: None
+    """
+
+    gauge('stp_conversions_in_flight', min(pending, max_running))
+    gauge('stp_backlog_files', queued + max(0, pending - max_running))
+
+
+def concurrency_limit(args: argparse.Namespace, controller: [ConcurrencyController, None], demand: int) -> int:
+    """
+    Get the number of conversions that may run at once right now.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param controller: ConcurrencyController that adjusts the limit to the load of the host or None for a fixed limit.
+    :type controller: [ConcurrencyController, None]
+    :param demand: Integer that is the number of conversions that are running or waiting for a slot.
+    :type demand: int
+    :return: Integer that is the current limit of the controller or the fixed limit of the conversion engine.
+    :rtype: int
+    """
+
+    if controller is None:
+        return max_concurrent_conversions(args)
+    return controller.update(demand)
+
+
+def create_conversion_executor(args: argparse.Namespace) -> concurrent.futures.Executor:
+    """
+    Create the concurrent.futures executor that runs the conversions for the conversion engine chosen by the user.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :return: concurrent.futures.ProcessPoolExecutor with a worker per core for the 'process' engine or
+    AsyncConversionExecutor that runs the conversion tools as asyncio subprocesses for the 'asyncio' engine.
+    :rtype: concurrent.futures.Executor
+    """
+
+    if args.engine == 'asyncio':
+        return AsyncConversionExecutor(max_concurrent_conversions(args), stage_limits(args), track_conversion_stage)
+
+    # Forward the metrics of the worker processes to this process if metrics are collected
+    initializer, initargs = worker_initializer()
+    return concurrent.futures.ProcessPoolExecutor(max_workers=args.cores, initializer=initializer, initargs=initargs)
+
+
+def max_concurrent_conversions(args: argparse.Namespace) -> int:
+    """
+    Get the maximum number of conversions that can be in progress at once for the conversion engine chosen by the user.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :return: Integer that is the size of the XML spool for two-stage conversions, max_conversions for the 'asyncio'
+    engine, or the number of cores for the 'process' engine, which is the upper bound of the concurrency controller.
+    :rtype: int
+    """
+
+    limits = stage_limits(args)
+    if limits:
+        return limits['spool']
+    if args.engine == 'asyncio' and args.max_conversions:
+        return args.max_conversions
+    return args.cores
+
+
+def stage_limits(args: argparse.Namespace) -> [dict, None]:
+    """
+    Get the concurrency limits of the StpToolkit and formatconverter stages and the XML spool between them if the user
+    split the conversion into two stages.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :return: Dictionary of stage name to its concurrency limit or None if the conversion is not split into stages.
+    :rtype: [dict, None]
+    """
+
+    if args.engine != 'asyncio' or not (args.stp_workers or args.hdf5_workers):
+        return None
+
+    # Default each stage to the overall concurrency limit and the XML spool to enough .XML files for both stages
+    default_workers = args.max_conversions if args.max_conversions else args.cores
+    stp_workers = args.stp_workers if args.stp_workers else default_workers
+    hdf5_workers = args.hdf5_workers if args.hdf5_workers else default_workers
+    xml_spool = args.xml_spool if args.xml_spool else stp_workers + hdf5_workers
+
+    return {'stptoolkit': stp_workers, 'formatconverter': hdf5_workers, 'spool': max(xml_spool, 1)}
+
+
+def get_converter(args: argparse.Namespace):
+    """
+    Get the conversion function that matches the executor created by create_conversion_executor.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :return: async_converter coroutine function for the 'asyncio' engine or converter function for the 'process'
+    engine, both called with (input_stp_path, filename, offset, args).
+    :rtype: Callable
+    """
+
+    return async_converter if args.engine == 'asyncio' else converter
+
+
+def handle_conversion_result(args: argparse.Namespace, future: concurrent.futures.Future, input_stp_path: str,
+                             counts: collections.Counter, global_start_time: float, total: [int, None] = None,
+                             move_failed: bool = True) -> bool:
+    """
+    Handle the outcome of a finished conversion future job by logging progress, moving the .STP file according to the
+    outcome, and cleaning up the Processing folder.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param future: concurrent.futures.Future of the finished 'converter' job.
+    :type future: concurrent.futures.Future
+    :param input_stp_path: String that is the path to the .STP file in the Input folder.
+    :type input_stp_path: str
+    :param counts: collections.Counter of 'Successful', 'Timeout', and 'Error' conversions that is updated in place.
+    :type counts: collections.Counter
+    :param global_start_time: Float that is the epoch time in seconds when the conversions started.
+    :type global_start_time: float
+    :param total: Integer that is the total number of conversions expected or None if the total is not known.
+    :type total: [int, None]
+    :param move_failed: Boolean that moves the .STP file of a failed conversion to Output\Failed, or leaves it where it
+    is if False, e.g. for a conversion with wave data of a file whose vital signs were converted.
+    :type move_failed: bool
+    :return: True if the conversion was successful, otherwise False.
+    :rtype: bool
+    """
+
+    # Save the filename and basename (filename w/o extension) of the path
+    filename = os.path.basename(input_stp_path)
+    basename = os.path.splitext(filename)[0]
+
+    # Get the conversion time of the conversion job for the file, whose outcome is decided by the job alone
+    try:
+        finish_time = future.result()
+
+    # The file is converted by another node that shares the input folder:
+    except FileClaimed:
+
+        # Print out the log to the console and leave the file to the other node
+        print(f'{progress_message(counts, global_start_time, total)} {basename} is claimed by another node. Skipping.')
+
+    # The conversion job for the file timed-out in the middle of the conversion:
+    except subprocess.TimeoutExpired:
+
+        # Add to the timed-out counter
+        counts['Timeout'] += 1
+        count('stp_conversions_total', outcome='timeout')
+        event('conversion', file=filename, outcome='timeout')
+
+        # Print out the log to the console to keep track of progress
+        print(f'{progress_message(counts, global_start_time, total)} {basename} got stuck. Shutting down thread.')
 
-        # Create global counters for finished, timed-out, and errored-out conversions to log progress
-        done_count, timeout_count, error_count = 0, 0, 0
+        # Forget the progress of the file, give up its lease, and move the .STP file from the Input folder to the
+        # Output\Failed\TimedOut folder if desired
+        if move_failed:
+            forget_state(args, filename)
+            release_file(args, filename)
+            os.renames(input_stp_path, os.path.join(args.output, 'Failed', 'TimedOut', filename))
 
-        # Get a future object as soon as it is completed
-        for future in concurrent.futures.as_completed(futures):
+    # The conversion job for the file faced an error that was not a TimeoutExpired error:
+    except Exception as e:
 
-            # Get the path of the completed future back using the future as the key in the futures dictionary and save
-            # the filename and basename (filename w/o extension) of the path
-            filename = os.path.basename(futures[future])
-            basename = os.path.splitext(filename)[0]
+        # Add to the errored-out counter
+        counts['Error'] += 1
+        count('stp_conversions_total', outcome='error')
+        event('conversion', file=filename, outcome='error', error=str(e))
 
-            # The conversion job for the file faced no errors:
+        # Print out the log to the console to keep track of progress
+        print(f'{progress_message(counts, global_start_time, total)} {basename} got the error "{str(e)}"')
+
+        # Forget the progress of the file, give up its lease, and move the .STP file from the Input folder to the
+        # Output\Failed\ErroredOut folder if desired
+        if move_failed:
+            forget_state(args, filename)
+            release_file(args, filename)
+            os.renames(input_stp_path, os.path.join(args.output, 'Failed', 'ErroredOut', filename))
+
+    # The conversion job for the file faced no errors:
+    else:
+
+        # Add to the done counter and print out the log to the console to keep track of progress
+        counts['Successful'] += 1
+        print(f'{progress_message(counts, global_start_time, total)} {basename} completed in {finish_time}')
+
+        # Record the conversion in the metrics and the conversion history, which cannot change its outcome anymore
+        record_successful_conversion(args, input_stp_path, finish_time)
+
+        # Delete the .STP from the input folder if desired based on the user arguments
+        if args.delete_stp:
             try:
+                os.remove(input_stp_path)
+            except OSError as e:
+                print(f'Could not delete {input_stp_path} after its conversion: "{str(e)}"')
+
+        return True
 
-                # Get the conversion time and add to the done counter
-                finish_time = future.result()
-                done_count += 1
+    # Clean-up the processing folder, regardless of the conversion future job outcome
+    finally:
+        cleanup(basename)
 
-                # Print out the log to the console to keep track of progress
-                print(f'{str(datetime.timedelta(seconds=time.time() - global_start_time))}: '
-                      f'{str(done_count + timeout_count + error_count)}/{str(len(file_tuples))} done '
-                      f'(Successful: {str(done_count)}, Timeout: {str(timeout_count)}, Error: {str(error_count)});'
-                      f' {basename} completed in {finish_time}')
+    return False
 
-                # Delete the .STP from the input folder if desired based on the user arguments
-                if args.delete_stp:
-                    os.remove(futures[future])
 
-            # The conversion job for the file timed-out in the middle of the conversion:
-            except subprocess.TimeoutExpired:
+def record_successful_conversion(args: argparse.Namespace, input_stp_path: str,
+                                 finish_time: datetime.timedelta) -> None:
+    """
+    Record a successful conversion in the metrics, the event log, and the conversion history, logging any error instead
+    of raising it.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param input_stp_path: String that is the path to the .STP file in the Input folder.
+    :type input_stp_path: str
+    :param finish_time: datetime.timedelta for the time that the conversion took.
+    :type finish_time: datetime.timedelta
+    :return: None
+    :rtype: None
+    """
 
-                # Add to the timed-out counter
-                timeout_count += 1
+    filename = os.path.basename(input_stp_path)
+    count('stp_conversions_total', outcome='successful')
 
-                # Print out the log to the console to keep track of progress
-                print(f'{str(datetime.timedelta(seconds=time.time() - global_start_time))}: '
-                      f'{str(done_count + timeout_count + error_count)}/{str(len(file_tuples))} done '
-                      f'(Successful: {str(done_count)}, Timeout: {str(timeout_count)}, Error: {str(error_count)});'
-                      f' {basename} got stuck. Shutting down thread.')
+    try:
+        size = os.path.getsize(input_stp_path)
+        count('stp_input_bytes_total', size)
+        event('conversion', file=filename, outcome='successful', seconds=finish_time.total_seconds(), size=size)
 
-                # Move the .STP file from the Input folder to the Output\Failed\TimedOut folder
-                os.renames(futures[future], os.path.join(args.output, 'Failed', 'TimedOut', filename))
+        # Record the size and duration of the conversion to predict the duration of future conversions
+        conversion_history().add(filename, size, finish_time.total_seconds(), args.system, args.wave_data)
 
-            # The conversion job for the file faced an error that was not a TimeoutExpired error:
-            except Exception as e:
+    except Exception as e:
+        print(f'Could not record the conversion of {filename}: "{str(e)}"')
 
-                # Add to the errored-out counter
-                error_count += 1
 
-                # Print out the log to the console to keep track of progress
-                print(f'{str(datetime.timedelta(seconds=time.time() - global_start_time))}: '
-                      f'{str(done_count + timeout_count + error_count)}/{str(len(file_tuples))} done '
-                      f'(Successful: {str(done_count)}, Timeout: {str(timeout_count)}, Error: {str(error_count)});'
-                      f' {basename} got the error "{str(e)}"')
+def progress_message(counts: collections.Counter, global_start_time: float, total: [int, None] = None) -> str:
+    """
+    Create the progress prefix that is printed to the console whenever a conversion finishes.
+
+    :param counts: collections.Counter of 'Successful', 'Timeout', and 'Error' conversions.
+    :type counts: collections.Counter
+    :param global_start_time: Float that is the epoch time in seconds when the conversions started.
+    :type global_start_time: float
+    :param total: Integer that is the total number of conversions expected or None if the total is not known.
+    :type total: [int, None]
+    :return: String with the elapsed time and the done, successful, timed-out, and errored-out counts.
+    :rtype: str
+    """
 
-                # Move the .STP file from the Input folder to the Output\Failed\ErroredOut folder
-                os.renames(futures[future], os.path.join(args.output, 'Failed', 'ErroredOut', filename))
+    done_count = counts['Successful'] + counts['Timeout'] + counts['Error']
+    done = f'{done_count}/{total}' if total is not None else f'{done_count}'
 
-            # Clean-up the processing folder, regardless of the conversion future job outcome
-            finally:
-                cleanup(basename)
+    return (f'{str(datetime.timedelta(seconds=time.time() - global_start_time))}: {done} done '
+            f'(Successful: {counts["Successful"]}, Timeout: {counts["Timeout"]}, Error: {counts["Error"]});')
 
 
 def converter(input_stp_path: str, filename: str, offset: int, args: argparse.Namespace) -> datetime.timedelta:
@@ -130,90 +384,156 @@ def converter(input_stp_path: str, filename: str, offset: int, args: argparse.Na
     # Save the start time of the process in epoch seconds
     process_start_time = time.time()
 
-    # Run conversion in try-finally loop to guarantee that the conversion time is returned, regardless of errors
-    try:
-
-        # Get the basename (filename w/o extension) from the filename
-        basename = os.path.splitext(filename)[0]
+    # Get the basename (filename w/o extension) from the filename
+    basename = os.path.splitext(filename)[0]
+
+    # Claim the file so no other node that shares the input folder converts it as well
+    claim_file(args, input_stp_path, filename)
+
+    # Resume from the last durable step of an earlier conversion if its outputs are intact, otherwise cleanup the
+    # processing folder to prevent FileExistsError
+    resumed = resume_conversion(args, input_stp_path, filename)
+
+    # Create the paths for the .STP file and converted .XML file in the processing folder
+    processing_stp_path = os.path.join('Processing', filename)
+    processing_xml_path = os.path.join('Processing', basename + '.xml')
+
+    # Stage the .STP file from the scratch folder or the Input folder into the Processing folder
+    if resumed is None:
+        with stage_timer('copy', filename):
+            stage_input_file(args, input_stp_path, filename, processing_stp_path)
+        record_state(args, [filename], 'staged', [processing_stp_path])
+
+    # Get the timeout of each tool for a file of this size and watch the outputs for progress
+    timeout = conversion_timeout(args, filename, os.path.getsize(input_stp_path))
+    monitor = StallMonitor(basename, args.stall_timeout)
+    failed_tool = None
+
+    if resumed != 'xml_done':
+
+        # Stream the .XML file straight into the formatconverter through a named pipe if desired and fall back to the
+        # .XML file for this file if a tool fails
+        if xml_streaming_enabled(args):
+            with stage_timer('stream', filename):
+                failed_tool = stream_xml(args, processing_stp_path, processing_xml_path, offset, timeout, monitor)
+            if failed_tool is None:
+                with stage_timer('move', filename):
+                    move_converted_files(args, basename)
+                record_state(args, [filename], 'hdf5_done', converted_files(args, basename))
+                os.remove(processing_stp_path)
+                return datetime.timedelta(seconds=time.time() - process_start_time)
+
+        # Run the StpToolkit with its parameters while ignoring outputs and killing it once it times out or stalls
+        with stage_timer('stptoolkit', filename):
+            run_monitored_tool(stptoolkit_params(args, processing_stp_path, processing_xml_path), timeout, monitor)
+        record_state(args, [filename], 'xml_done', [processing_xml_path])
 
-        # Cleanup the processing folder to prevent FileExistsError
-        cleanup(basename)
-
-        # Create the paths for the .STP file and converted .XML file in the processing folder
-        processing_stp_path = os.path.join('Processing', filename)
-        processing_xml_path = os.path.join('Processing', basename + '.xml')
-
-        # Copy the .STP file from the Input folder to the Processing folder
-        shutil.copy(input_stp_path, processing_stp_path)
-
-        # Create the path to the StpToolkit.exe in the UniversalFileConverter folder
-        stptoolkit_path = os.path.join('AutoSTPtoHDF5Converter', 'UniversalFileConverter', 'StpToolkit.exe')
+        # Delete the .STP file in the Processing folder
+        os.remove(processing_stp_path)
 
-        # Create a list of parameters for subprocess.run: path to the StpToolkit, path to the .STP file in the
-        # processing folder, -o flag and associated path to save the converted .XML file output, -blnk to remove any
-        # existing patient data from the .STP file, and the type of EHR system used stated by user argument
-        stptoolkit_params = [stptoolkit_path, processing_stp_path, '-o', processing_xml_path, '-blnk',
-                             '-' + args.system]
+    # Convert the .XML file with the native writer if desired, otherwise or if it fails run the formatconverter with its
+    # parameters while ignoring outputs and killing it once it times out or stalls
+    with stage_timer('formatconverter', filename):
+        if not (native_writer_enabled(args) and write_native_hdf5(args, processing_xml_path, offset)):
+            run_monitored_tool(formatconverter_params(args, processing_xml_path, offset), timeout, monitor)
 
-        # If wave_data is False, add the '-xw' parameter to the list of parameters to ignore the wave_data
-        if not args.wave_data:
-            stptoolkit_params.append('-xw')
+    # Move the .HDF5 file(s) from the Processing folder to the Output\Converted folder
+    with stage_timer('move', filename):
+        move_converted_files(args, basename)
+    hdf5_paths = converted_files(args, basename)
+    record_state(args, [filename], 'hdf5_done', hdf5_paths)
 
-        # Run Windows CommandPrompt using subprocess with associated parameters while ignoring outputs and timing out
-        # after the user set timeout
-        subprocess.run(stptoolkit_params, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT, timeout=args.timeout)
+    # Stop streaming for later files if the formatconverter only failed on the named pipe of this file
+    confirm_xml_streaming_rejection(failed_tool, hdf5_paths)
 
-        # Delete the .STP file in the Processing folder
-        os.remove(processing_stp_path)
+    # Delete the .XML file in the Processing folder once the .HDF5 file(s) are recorded, so a crash before can resume
+    # from it
+    os.remove(processing_xml_path)
 
-        # Create the path to the formatconverter.exe in the UniversalFileConverter folder
-        formatconverter_path = os.path.join('AutoSTPtoHDF5Converter', 'UniversalFileConverter', 'formatconverter.exe')
+    return datetime.timedelta(seconds=time.time() - process_start_time)
 
-        # Create a list of parameters for subprocess.run: path to the formatconverter, -t flag and hdf5 to set the
-        # output to a .HDF5 file, -C to skip caching locally, -p and %d%i-_-%s.%t to specify the output .HDF5 naming
-        # structure, --offset and the specific negative offset for the file, and the .XML file in the Processing
-        # folder as the input
-        formatconverter_params = [formatconverter_path, '-t', 'hdf5', '-C', '-p', '%d%i-_-%s.%t',
-                                  '--offset', f'-{offset}', processing_xml_path]
 
-        # If single_hdf5_file is True, add '-n' before the .XML path to create only 1 .HDF5 file per .XML file
-        # instead of creating 1 .HDF5 per day
-        if args.single_hdf5_file:
-            formatconverter_params.insert(-1, '-n')
+def stream_xml(args: argparse.Namespace, processing_stp_path: str, processing_xml_path: str, offset: int,
+               timeout: float, monitor: StallMonitor) -> [str, None]:
+    """
+    Run the StpToolkit and the formatconverter at the same time, connected through a named pipe in place of the .XML
+    file, so the .XML file never touches the disk.
 
-        # Run Windows CommandPrompt using subprocess with associated parameters while ignoring outputs and timing out
-        # after the user set timeout
-        subprocess.run(formatconverter_params, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT,
-                       timeout=args.timeout)
+    If the named pipe cannot be created, streaming is turned off for the rest of the run. If either tool fails, i.e. it
+    exits with an error or no .HDF5 file is created, the partial outputs are removed and the name of the tool is
+    returned so the caller can fall back to the file-based conversion for this file only.
 
-        # Delete the .XML file in the Processing folder
-        os.remove(processing_xml_path)
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param processing_stp_path: String that is the path to the .STP file in the Processing folder.
+    :type processing_stp_path: str
+    :param processing_xml_path: String that is the path where the named pipe should be created.
+    :type processing_xml_path: str
+    :param offset: Integer that is the offset specific to the .STP file retrieved from the patient offset database.
+    :type offset: int
+    :param timeout: Float that is the number of seconds to wait for the tools before they are killed.
+    :type timeout: float
+    :param monitor: StallMonitor of the conversion that kills the tools once they stall.
+    :type monitor: StallMonitor
+    :return: None if the .HDF5 file(s) were created through the named pipe, otherwise the name of what failed.
+    :rtype: [str, None]
+    """
 
-        # Find all of the .HDF5 that were created in the Processing folder with the .STP file's specific basename
-        processing_hdf5_paths = glob.glob(os.path.join('Processing', basename + '-_-*.hdf5'))
+    basename = os.path.splitext(os.path.basename(processing_stp_path))[0]
+    deadline = time.monotonic() + timeout
 
-        # Create the end paths for the .HDF5 files in Output\Converted and move them from the Processing folder to
-        # the Output\Converted folder
-        for processing_hdf5_path in processing_hdf5_paths:
-            hdf5_filename = os.path.basename(processing_hdf5_path)
-            converted_hdf5_path = os.path.join(args.output, 'Converted', hdf5_filename)
-            shutil.move(processing_hdf5_path, converted_hdf5_path)
+    # Without a named pipe there is nothing to stream through, so do not try again for later files
+    try:
+        os.mkfifo(processing_xml_path)
+    except OSError as error:
+        reject_xml_streaming(f'the named pipe could not be created: {error}')
+        return 'mkfifo'
+
+    # Start the reader first so the StpToolkit does not wait long for the other end of the pipe. Both tools run in
+    # their own session so any process they start is killed along with them
+    tools = {}
+    failed_tool = failure = None
+    try:
+        for name, params in [('formatconverter', formatconverter_params(args, processing_xml_path, offset)),
+                             ('StpToolkit', stptoolkit_params(args, processing_stp_path, processing_xml_path))]:
+            tools[name] = subprocess.Popen(params, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT,
+                                           start_new_session=True)
+
+        # Poll every tool on each check so the exit of either tool is seen while the other one still waits on the pipe
+        pipe_released = False
+        while failure is None and None in [tool.poll() for tool in tools.values()]:
+            if time.monotonic() > deadline:
+                raise subprocess.TimeoutExpired(tools['StpToolkit'].args, timeout)
+            if monitor.stalled():
+                raise ConversionStalled(tools['StpToolkit'].args, monitor.stall_timeout)
+            if monitor.preempted():
+                raise ConversionPreempted(f"Command '{tools['StpToolkit'].args}' was preempted")
+            for name, tool in tools.items():
+                if tool.returncode not in (None, 0):
+                    failed_tool, failure = name, f'{name} exited with code {tool.returncode}'
+            if tools['StpToolkit'].returncode == 0 and not pipe_released:
+                release_named_pipe(processing_xml_path)
+                pipe_released = True
+            if tools['formatconverter'].returncode == 0 and tools['StpToolkit'].returncode is None and \
+                    not glob.glob(os.path.join('Processing', glob.escape(basename) + '-_-*.hdf5')):
+                failed_tool, failure = 'formatconverter', 'formatconverter did not create any .HDF5 files'
+            time.sleep(0.1)
+
+        for name, tool in tools.items():
+            if failure is None and tool.returncode not in (None, 0):
+                failed_tool, failure = name, f'{name} exited with code {tool.returncode}'
 
     finally:
-        return datetime.timedelta(seconds=time.time() - process_start_time)
-
+        # Stop any tool that is still running, e.g. the other tool after a failure or both after the timeout
+        for tool in tools.values():
+            terminate_process_tree(tool)
+        os.remove(processing_xml_path)
 
-def cleanup(basename: str) -> None:
-    """
-    Delete leftover intermediate processing files in the Processing folder with a specified basename.
+    if failure is None and not glob.glob(os.path.join('Processing', glob.escape(basename) + '-_-*.hdf5')):
+        failed_tool, failure = 'formatconverter', 'formatconverter did not create any .HDF5 files'
 
-    :param basename: String that is the basename (filename w/o extension) of the .STP file of interest.
-    :type basename: str
-    :return: None
-    :rtype: None
-    """
+    if failure is not None:
+        remove_converted_files(basename)
+        print(f'Streaming {basename}.xml through a named pipe failed ({failure}). Converting the .XML file instead...')
 
-    # Find any leftover processing files in the Processing folder with the specified basename and delete them
-    leftover_files = glob.glob(os.path.join('Processing', basename + '*'))
-    for leftover_file in leftover_files:
-        os.remove(leftover_file)
+    return failed_tool
@@ -6,11 +6,16 @@ Contains the "deidentify_file_names" function.
 
 import argparse
 import datetime
-import glob
 import os
 
 import pandas
 
+from .lease_queue import owned_files
+from .metrics import stage_timer
+from .move_engine import move_files
+from .output_catalog import catalog_output_files
+from .state_journal import record_state
+
 
 def deidentify_file_names(args: argparse.Namespace, files: pandas.DataFrame) -> [list, None]:
     """
@@ -24,14 +29,22 @@ def deidentify_file_names(args: argparse.Namespace, files: pandas.DataFrame) ->
     :rtype: [list, None]
     """
 
+    # Only de-identify the files this node converted if it shares the input folder with other nodes
+    files = owned_files(args, files)
+    if files.empty:
+        return None
+
     # Get the basename from the filenames of the convertable .STP files, which would be the bed and data start in
     # epoch seconds.
     files['BedAndSeconds'] = files['Filename'].str.split('.', expand=True)[0]
 
     print("Getting the converted files...")
 
-    # Get a list of paths for the converted identifiable .HDF5 files in the Output\Converted folder
-    converted_files_list = glob.glob(os.path.join(args.output, 'Converted', '*.hdf5'))
+    # Get a list of paths for the converted identifiable .HDF5 files in the Output\Converted folder with a single
+    # directory listing
+    converted_folder = os.path.join(args.output, 'Converted')
+    converted_files_list = [os.path.join(converted_folder, entry.name) for entry in os.scandir(converted_folder)
+                            if entry.name.endswith('.hdf5') and entry.is_file()]
 
     # If no .HDF5 files are found in the Output\Converted folder, return None as all conversions timed-out and/or failed
     if not converted_files_list:
@@ -43,7 +56,7 @@ def deidentify_file_names(args: argparse.Namespace, files: pandas.DataFrame) ->
     converted_files = pandas.DataFrame(converted_files_list, columns=['StartPath'])
 
     # Extract the Bed, Seconds, and Date from the converted identifiable .HDF5 file
-    converted_files[['Basename', 'Extension']] = converted_files['StartPath'].apply(os.path.basename) \
+    converted_files[['Basename', 'Extension']] = converted_files['StartPath'].map(os.path.basename) \
         .str.split('.', expand=True)
     converted_files[['BedAndSeconds', 'Date']] = converted_files['Basename'].str.split('-_-', expand=True)
     converted_files[['Bed', 'Seconds']] = converted_files['BedAndSeconds'].str.split('-', expand=True)
@@ -59,7 +72,7 @@ def deidentify_file_names(args: argparse.Namespace, files: pandas.DataFrame) ->
 
     # Set [Date] to the number of days from 1970/01/01 to the internally offset data start date and pad it to 5 digits
     converted_files['Date'] = (pandas.to_datetime(converted_files['Date']) - datetime.datetime(1969, 12, 31)).dt.days
-    converted_files['Date'] = converted_files['Date'].apply('{:0>5}'.format)
+    converted_files['Date'] = converted_files['Date'].astype(str).str.zfill(5)
 
     # Set [Seconds] to offset subtracted from the original file start time in epoch seconds
     converted_files['Seconds'] = (converted_files['Seconds'] - converted_files['Offset']).astype(str)
@@ -71,18 +84,30 @@ def deidentify_file_names(args: argparse.Namespace, files: pandas.DataFrame) ->
     else:
         converted_files['Information'] = '_V'
 
-    # Move each converted .HDF5 in the converted .HDF5 dataframe from [StartPath] in Output\Converted to
-    # Output\Success with a 'PatientID\UVA_PatientID_<Days from Offset to file data start
-    # day>_Bed-<Seconds-Offset>_<'_V' or '_VW'>.Extension as sub-folder and filename.
-    converted_files.apply(
-        lambda r: os.renames(r['StartPath'],
-                             os.path.join(args.output, 'Success', r['PatientID'], 'UVA_' + r['PatientID'] + '_'
-                                          + r['Date'] + '_' + r['Bed'] + '-' + r['Seconds'] + r['Information'] + '.' +
-                                          r['Extension'])), axis=1)
+    # Set [EndPath] to Output\Success with a 'PatientID\UVA_PatientID_<Days from Offset to file data start
+    # day>_Bed-<Seconds-Offset>_<'_V' or '_VW'>.Extension as sub-folder and filename, building all the paths at once
+    patient_folders = os.path.join(args.output, 'Success', '') + converted_files['PatientID'] + os.sep
+    converted_files['EndPath'] = (patient_folders + 'UVA_' + converted_files['PatientID'] + '_'
+                                  + converted_files['Date'] + '_' + converted_files['Bed'] + '-'
+                                  + converted_files['Seconds'] + converted_files['Information'] + '.'
+                                  + converted_files['Extension'])
+
+    # Move the converted .HDF5 files from [StartPath] in Output\Converted to [EndPath] in a single batch
+    with stage_timer('rename'):
+        move_files(list(converted_files['StartPath']), list(converted_files['EndPath']), args.move_workers)
+
+    # Record the de-identified .HDF5 files in the output catalog if desired
+    if args.output_catalog:
+        with stage_timer('catalog'):
+            catalog_output_files(args, converted_files)
 
     print("Getting a unique list of completed converted files...")
 
     # Return a unique list of .STP filenames that were converted this cycle, as merged [Filename] will only be not NA
     # if a match to a converted .HDF5(s) was/were found
     unique_completed_stp_files_list = list(converted_files['Filename'].unique())
+
+    # Record that the files were de-identified in the state journal if one is kept
+    record_state(args, unique_completed_stp_files_list, 'renamed')
+
     return unique_completed_stp_files_list
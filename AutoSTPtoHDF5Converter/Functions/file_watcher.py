@@ -0,0 +1,372 @@
+"""
+Author: Ayush Doshi
+
+Contains the "FileWatcher" class that detects when individual .STP files in the input folder are ready to be converted.
+"""
+
+import ctypes
+import ctypes.util
+import fnmatch
+import functools
+import os
+import select
+import struct
+import sys
+import time
+
+from .scan_index import STP_PATTERN, ScanIndex
+
+# File system types that do not report changes made by other hosts through inotify
+NETWORK_FILE_SYSTEMS = {'nfs', 'nfs4', 'cifs', 'smb', 'smb2', 'smb3', 'smbfs', 'afs', 'ncpfs', '9p', 'fuse.sshfs',
+                        'fuse.rclone', 'glusterfs', 'ceph', 'lustre', 'gpfs', 'drvfs'}
+
+# inotify event masks from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+                 IN_DELETE_SELF | IN_MOVE_SELF)
+IN_EVENT_HEADER = struct.Struct('iIII')
+
+
+class FileWatcher:
+    """
+    Track the size and modification time of every .STP file in the input folder individually and release each file as
+    soon as it has not changed for the settle time, instead of sleeping a fixed time between two full searches.
+
+    Changes are picked up through inotify on Linux. On other platforms, on network shares where inotify does not see
+    changes made by other hosts, or when inotify cannot be set up, the input folder is polled instead.
+    """
+
+    def __init__(self, input_folder: str, settle_time: float, engine: str = 'auto', poll_interval: float = 10,
+                 scan_index: [ScanIndex, None] = None) -> None:
+        """
+        :param input_folder: String that is the path to the folder to recursively watch for .STP files.
+        :type input_folder: str
+        :param settle_time: Float that is the number of seconds a file must stay unchanged before it is released.
+        :type settle_time: float
+        :param engine: String that is the watcher engine to use: 'auto', 'inotify', or 'poll'.
+        :type engine: str
+        :param poll_interval: Float that is the number of seconds in between searches of the input folder when polling.
+        :type poll_interval: float
+        :param scan_index: ScanIndex used to search the input folder incrementally or None to walk the whole folder.
+        :type scan_index: [ScanIndex, None]
+        """
+
+        self.input_folder = input_folder
+        self.scan_index = scan_index
+        self.settle_time = settle_time
+        self.poll_interval = poll_interval
+
+        # Dictionary of path to [size, modification time, time of the last observed change, released flag]
+        self.files = {}
+        self.last_scan_time = None
+
+        # inotify file descriptor and dictionaries between watch descriptors and directory paths
+        self.inotify_fd = None
+        self.watch_descriptors = {}
+        self.watched_directories = {}
+
+        if engine == 'inotify' or (engine == 'auto' and inotify_supported(input_folder)):
+            try:
+                self.start_inotify()
+            except OSError as e:
+                if engine == 'inotify':
+                    raise
+                print(f"Could not set up inotify ({str(e)}). Polling the input folder instead...")
+                self.stop_inotify()
+
+        self.engine = 'inotify' if self.inotify_fd is not None else 'poll'
+        print(f"Watching {input_folder} for .STP files using {self.engine} with a {settle_time} second settle time...")
+
+        # Record the files that already exist in the input folder
+        self.scan()
+
+    def poll(self, max_files: [int, None] = None) -> list:
+        """
+        Update the state of the watched files without blocking and release the files that have settled.
+
+        :param max_files: Integer that is the maximum number of files to release or None to release all settled files.
+        Settled files that are not released stay pending and are released by a later call.
+        :type max_files: [int, None]
+        :return: List of (path, size) tuples for the files that are ready to be converted.
+        :rtype: list
+        """
+
+        # Read the pending inotify events, or search the whole input folder again when polling and the interval passed
+        if self.inotify_fd is not None:
+            self.read_inotify_events()
+        elif time.time() - self.last_scan_time >= self.poll_interval:
+            self.scan()
+
+        # Release files that have not changed for the settle time after confirming their size and modification time
+        now = time.time()
+        settled_files = []
+        for path, state in list(self.files.items()):
+            if max_files is not None and len(settled_files) >= max_files:
+                break
+            last_change_time, released = state[2], state[3]
+            if released or now - last_change_time < self.settle_time:
+                continue
+            if self.update(path, now) and self.files[path][2] == last_change_time:
+                self.files[path][3] = True
+                settled_files.append((path, self.files[path][0]))
+
+        return settled_files
+
+    def wait(self, timeout: float, max_files: [int, None] = None) -> list:
+        """
+        Block until at least one file settles or the timeout passes.
+
+        :param timeout: Float that is the maximum number of seconds to wait.
+        :type timeout: float
+        :param max_files: Integer that is the maximum number of files to release or None to release all settled files.
+        :type max_files: [int, None]
+        :return: List of (path, size) tuples for the files that are ready to be converted.
+        :rtype: list
+        """
+
+        deadline = time.time() + timeout
+        while True:
+            settled_files = self.poll(max_files)
+            now = time.time()
+            if settled_files or now >= deadline:
+                return settled_files
+
+            # Sleep until the next file could settle, the next poll is due, or an inotify event arrives
+            pending_times = [state[2] + self.settle_time for state in self.files.values() if not state[3]]
+            wake_time = min(pending_times + [deadline])
+            if self.inotify_fd is None:
+                wake_time = min(wake_time, self.last_scan_time + self.poll_interval)
+                time.sleep(max(0.0, wake_time - now))
+            else:
+                select.select([self.inotify_fd], [], [], max(0.0, wake_time - now))
+
+    def close(self) -> None:
+        """
+        Close the inotify file descriptor if one is open.
+
+        :return: None
+        :rtype: None
+        """
+
+        self.stop_inotify()
+
+    def scan(self) -> None:
+        """
+        Recursively search the input folder and update the state of every .STP file found, forgetting the files that
+        are no longer there.
+
+        :return: None
+        :rtype: None
+        """
+
+        now = time.time()
+        found_paths = set()
+
+        # Use the indexed sizes and modification times if a scan index is used
+        if self.scan_index is not None:
+            for path, size, mtime in self.scan_index.scan():
+                state = self.files.get(path)
+                if state is None or state[0] != size or state[1] != mtime:
+                    self.files[path] = [size, mtime, now, False]
+                found_paths.add(path)
+
+        for directory, _, filenames in os.walk(self.input_folder) if self.scan_index is None else ():
+            for filename in fnmatch.filter(filenames, STP_PATTERN):
+                path = os.path.join(directory, filename)
+                if self.update(path, now):
+                    found_paths.add(path)
+
+        for path in set(self.files) - found_paths:
+            del self.files[path]
+        self.last_scan_time = now
+
+    def update(self, path: str, now: float) -> bool:
+        """
+        Stat a single file and restart its settle time if its size or modification time changed.
+
+        :param path: String that is the path to the file.
+        :type path: str
+        :param now: Float that is the current epoch time in seconds.
+        :type now: float
+        :return: True if the file exists and is being tracked, otherwise False.
+        :rtype: bool
+        """
+
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self.files.pop(path, None)
+            return False
+
+        state = self.files.get(path)
+        if state is None:
+            self.files[path] = [stat.st_size, stat.st_mtime, now, False]
+        elif state[0] != stat.st_size or state[1] != stat.st_mtime:
+            self.files[path] = [stat.st_size, stat.st_mtime, now, False]
+        return True
+
+    def start_inotify(self) -> None:
+        """
+        Create an inotify instance and add a watch to every directory in the input folder.
+
+        :return: None
+        :rtype: None
+        """
+
+        self.inotify_fd = libc().inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.inotify_fd < 0:
+            self.inotify_fd = None
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+        for directory, _, _ in os.walk(self.input_folder):
+            self.add_watch(directory)
+
+    def stop_inotify(self) -> None:
+        """
+        Close the inotify instance, which also removes all of its watches.
+
+        :return: None
+        :rtype: None
+        """
+
+        if self.inotify_fd is not None:
+            os.close(self.inotify_fd)
+        self.inotify_fd = None
+        self.watch_descriptors.clear()
+        self.watched_directories.clear()
+
+    def add_watch(self, directory: str) -> None:
+        """
+        Add an inotify watch to a single directory.
+
+        :param directory: String that is the path to the directory.
+        :type directory: str
+        :return: None
+        :rtype: None
+        """
+
+        watch_descriptor = libc().inotify_add_watch(self.inotify_fd, os.fsencode(directory), IN_WATCH_MASK)
+        if watch_descriptor < 0:
+            raise OSError(ctypes.get_errno(), f'{os.strerror(ctypes.get_errno())}: {directory}')
+        self.watch_descriptors[watch_descriptor] = directory
+        self.watched_directories[directory] = watch_descriptor
+
+    def read_inotify_events(self) -> None:
+        """
+        Read all of the pending inotify events and update the state of the files they refer to.
+
+        :return: None
+        :rtype: None
+        """
+
+        now = time.time()
+        while True:
+            try:
+                buffer = os.read(self.inotify_fd, 64 * 1024)
+            except BlockingIOError:
+                return
+
+            offset = 0
+            while offset < len(buffer):
+                watch_descriptor, mask, _, name_length = IN_EVENT_HEADER.unpack_from(buffer, offset)
+                name = buffer[offset + IN_EVENT_HEADER.size:offset + IN_EVENT_HEADER.size + name_length]
+                offset += IN_EVENT_HEADER.size + name_length
+
+                # The event queue overflowed, so events were lost and the whole input folder must be searched again
+                if mask & IN_Q_OVERFLOW:
+                    self.scan()
+                    continue
+
+                directory = self.watch_descriptors.get(watch_descriptor)
+                if directory is None:
+                    continue
+
+                # The watched directory itself was removed
+                if mask & IN_IGNORED:
+                    del self.watch_descriptors[watch_descriptor]
+                    self.watched_directories.pop(directory, None)
+                    continue
+
+                path = os.path.join(directory, os.fsdecode(name.rstrip(b'\0')))
+
+                # Watch new sub-folders and pick up any files that were created in them before the watch was added
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO) and path not in self.watched_directories:
+                        for sub_directory, _, filenames in os.walk(path):
+                            self.add_watch(sub_directory)
+                            for filename in fnmatch.filter(filenames, STP_PATTERN):
+                                self.update(os.path.join(sub_directory, filename), now)
+                    elif mask & (IN_DELETE | IN_MOVED_FROM):
+                        for tracked_path in [p for p in self.files if p.startswith(path + os.sep)]:
+                            del self.files[tracked_path]
+                    continue
+
+                if fnmatch.fnmatch(os.path.basename(path), STP_PATTERN):
+                    self.update(path, now)
+
+
+def inotify_supported(path: str) -> bool:
+    """
+    Check if inotify is available and reports all changes for the file system that contains the path.
+
+    :param path: String that is the path to check.
+    :type path: str
+    :return: True if inotify can be used for the path, otherwise False.
+    :rtype: bool
+    """
+
+    if not sys.platform.startswith('linux') or not hasattr(libc(), 'inotify_init1'):
+        return False
+
+    return file_system_type(path) not in NETWORK_FILE_SYSTEMS
+
+
+def file_system_type(path: str) -> [str, None]:
+    """
+    Get the type of the file system that contains the path from the mount table.
+
+    :param path: String that is the path to check.
+    :type path: str
+    :return: String that is the file system type or None if it cannot be determined.
+    :rtype: [str, None]
+    """
+
+    path = os.path.realpath(path)
+    best_mount_point, best_type = '', None
+    try:
+        with open('/proc/mounts') as mounts:
+            for line in mounts:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = fields[1].replace('\\040', ' ')
+                if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) and \
+                        len(mount_point) >= len(best_mount_point):
+                    best_mount_point, best_type = mount_point, fields[2]
+    except OSError:
+        return None
+
+    return best_type
+
+
+@functools.lru_cache(maxsize=None)
+def libc() -> ctypes.CDLL:
+    """
+    Load the C library that contains the inotify functions.
+
+    :return: ctypes.CDLL of the C library.
+    :rtype: ctypes.CDLL
+    """
+
+    return ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
@@ -1,37 +1,61 @@
 """
 Author: Ayush Doshi
 
-Contains the "find_files" function.
+Contains the "find_files" function as well as necessary subfunctions.
 """
 
 import argparse
 import datetime
+import fnmatch
 import glob
 import os
-import sqlite3
 import time
 
 import pandas
 
+from .completed_files_store import completed_files_store
+from .conversion_tools import rename_if_exists
+from .file_watcher import FileWatcher
+from .fingerprint import remove_duplicate_files
+from .lease_queue import lease_queue
+from .metrics import stage_timer
+from .scan_index import STP_PATTERN, get_scan_index
 
-def find_files(args: argparse.Namespace) -> pandas.DataFrame:
+
+def find_files(args: argparse.Namespace, watcher: [FileWatcher, None] = None,
+               ready_files: [pandas.DataFrame, None] = None) -> pandas.DataFrame:
     """
     Finds .STP files that are ready to be converted to .HDF5 that have not already been converted before.
 
     :param args: argparse.Namespace that contains the arguments provided by the user.
     :type args: argparse.Namespace
-    :return: pandas.DataFrame that contains [Path, Filename] for the files that are ready to be converted.
+    :param watcher: FileWatcher that releases individual files as soon as they settle or None to compare searches
+    that are retry_filesearch_time apart.
+    :type watcher: [FileWatcher, None]
+    :param ready_files: pandas.DataFrame that contains [Path, Filename, Size] for files that are known to be ready,
+    e.g. skipped files that were moved back to the input folder, which are returned along with the files a single
+    search finds instead of waiting for new files, or None.
+    :type ready_files: [pandas.DataFrame, None]
+    :return: pandas.DataFrame that contains [Path, Filename, Size] for the files that are ready to be converted.
     :rtype: pandas.DataFrame
     """
 
     print("Searching for files...")
 
-    # Recursively find initial .STP files in the input folder and add to Pandas DataFrame
-    initial_files_list = glob.glob(os.path.join(args.input, '**', '*.?tp'), recursive=True)
-    initial_files = pandas.DataFrame(initial_files_list, columns=['Path'])
+    if ready_files is None:
+        ready_files = pandas.DataFrame(columns=['Path', 'Filename', 'Size'])
+
+    # Wait for individual files to settle if a file watcher is used instead of comparing two full searches
+    if watcher is not None:
+        return find_settled_files(args, watcher, ready_files)
 
-    # Get the file size of the found initial .STP files
-    initial_files['Initial Size'] = initial_files['Path'].apply(os.path.getsize)
+    # Do not wait to compare two searches if there are files that are ready already, and only add the files that a
+    # single search finds unmodified for the file search retry time
+    if not ready_files.empty:
+        return add_ready_files(ready_files, find_aged_files(args))
+
+    # Recursively find initial .STP files in the input folder and their file sizes
+    initial_files = scan_input_files(args).rename(columns={'Size': 'Initial Size'})
 
     # Start file searching loop
     while True:
@@ -39,73 +63,308 @@ def find_files(args: argparse.Namespace) -> pandas.DataFrame:
         # Wait the file search retry time provided by user arguments
         time.sleep(args.retry_filesearch_time)
 
-        # Recursively find final .STP files in the input folder and add to Pandas DataFrame
-        final_files_list = glob.glob(os.path.join(args.input, '**', '*.?tp'), recursive=True)
-        final_files = pandas.DataFrame(final_files_list, columns=['Path'])
+        # Recursively find final .STP files in the input folder and their file sizes
+        final_files = scan_input_files(args).rename(columns={'Size': 'Final Size'})
+
+        # Get the files that did not change in size between the initial and final searches
+        no_size_change_files = get_stable_files(initial_files, final_files)
+
+        # Check if any of the files did not change in size
+        if not no_size_change_files.empty:
+
+            # Extract the filename from the path to a new column
+            no_size_change_files['Filename'] = no_size_change_files['Path'].apply(os.path.basename)
+
+            # Move files that were already converted to Output\Skipped\AlreadyDone and keep the rest
+            new_files = remove_completed_files(args, no_size_change_files)
 
-        # Get the file size of the found final .STP files
-        final_files['Final Size'] = final_files['Path'].apply(os.path.getsize)
+            # Check if there are any files that have not already been converted
+            if not new_files.empty:
+                print(f"Found {len(new_files)} new file(s) ready to be converted!")
 
-        # Merge the initial and final DataFrames on [Path] and get the difference between the start and final file sizes
-        merged_files = initial_files.merge(final_files, on='Path')
-        merged_files['Size Change'] = merged_files['Final Size'] - merged_files['Initial Size']
+                # Return the [Path, Filename, Size] columns of the .STP files that have not already been converted
+                return new_files.rename(columns={'Final Size': 'Size'}).loc[:, ['Path', 'Filename', 'Size']]
 
-        # Get indices where the size change is 0, suggesting that the file transfer for the file has finished
-        no_size_change_files_boolean = merged_files['Size Change'] == 0
+        # Create a datetime object from epoch and add filesearch retry time
+        d = datetime.datetime(1, 1, 1) + datetime.timedelta(seconds=args.retry_filesearch_time)
+
+        print(f"No new files were found that are ready to be converted. Will try again in: "
+              f"{d.day-1} DAYS; {d.hour} HOURS; {d.minute} MIN; {d.second} SEC;")
+
+        # Set the initial files dataframe as the final files dataframe and restart the loop to get a new final files
+        # DataFrame and check for any new changes
+        initial_files = final_files.rename(columns={'Final Size': 'Initial Size'})
+
+
+def find_settled_files(args: argparse.Namespace, watcher: FileWatcher,
+                       ready_files: pandas.DataFrame) -> pandas.DataFrame:
+    """
+    Wait for .STP files to be released by the file watcher as soon as they settle and return the ones that have not
+    already been converted before.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param watcher: FileWatcher that releases individual files as soon as they settle.
+    :type watcher: FileWatcher
+    :param ready_files: pandas.DataFrame that contains [Path, Filename, Size] for files that are known to be ready,
+    which are returned along with the files that settled already instead of waiting for more files to settle.
+    :type ready_files: pandas.DataFrame
+    :return: pandas.DataFrame that contains [Path, Filename, Size] for the files that are ready to be converted.
+    :rtype: pandas.DataFrame
+    """
+
+    while True:
 
-        # Check if any of the size change booleans are True
-        if no_size_change_files_boolean.any():
+        # Wait up to the file search retry time for at least one file to settle, or only take the files that settled
+        # already if there are files that are ready already
+        if ready_files.empty:
+            settled_files = pandas.DataFrame(watcher.wait(args.retry_filesearch_time), columns=['Path', 'Size'])
+        else:
+            settled_files = pandas.DataFrame(watcher.poll(), columns=['Path', 'Size'])
 
-            # Select rows where the file change is 0 and save to a new DataFrame
-            no_size_change_files = merged_files.loc[no_size_change_files_boolean]
+        if not settled_files.empty:
 
             # Extract the filename from the path to a new column
-            no_size_change_files['Filename'] = no_size_change_files['Path'].apply(os.path.basename)
+            settled_files['Filename'] = settled_files['Path'].apply(os.path.basename)
 
-            # Pull the CompletedFiles table from the CompletedFiles database into a Pandas DataFrame
-            conn = sqlite3.connect(os.path.join('AutoSTPtoHDF5Converter', 'CompletedFiles.db'))
-            completed_files = pandas.read_sql_query('SELECT CompletedFiles from CompletedFiles', conn)
-            conn.close()
+            # Move files that were already converted to Output\Skipped\AlreadyDone and keep the rest
+            new_files = remove_completed_files(args, settled_files)
 
-            # Merge the found files that have not changed in size to the completed files dataframe using the filename
-            no_size_change_files = no_size_change_files.merge(completed_files, how='left', left_on='Filename',
-                                                              right_on='CompletedFiles')
+            if not new_files.empty:
+                print(f"Found {len(new_files)} new file(s) ready to be converted!")
+                return add_ready_files(ready_files, new_files.loc[:, ['Path', 'Filename', 'Size']])
 
-            # Get indices where the [CompletedFiles] column is not NA, suggesting that the filename was present in
-            # the CompletedFiles database and has already been converted.
-            already_completed_files_boolean = no_size_change_files['CompletedFiles'].notna()
+        if not ready_files.empty:
+            return ready_files
 
-            # Check if there are any files that have already been converted (i.e. at least 1 True in the completed files
-            # boolean)
-            if already_completed_files_boolean.any():
-                print(f"Found {already_completed_files_boolean.sum()} file(s) that were already converted. "
-                      f"Moving it/them to the skipped output folder...")
+        print("No new files were found that are ready to be converted. Still watching...")
 
-                # Select rows which point to .STP files that have already been converted
-                already_completed_files = no_size_change_files.loc[already_completed_files_boolean]
 
-                # Move the already converted files from the Input folder to the Output\Skipped\AlreadyDone folder
-                [os.renames(path, os.path.join(args.output, 'Skipped', 'AlreadyDone', filename))
-                 for path, filename
-                 in zip(already_completed_files['Path'], already_completed_files['Filename'])]
+def find_aged_files(args: argparse.Namespace) -> pandas.DataFrame:
+    """
+    Search the input folder once and get the files that have not been modified for retry_filesearch_time and have not
+    already been converted before, since a single search cannot compare file sizes.
 
-            # Check if there are any files that have not already been converted (i.e. at least 1 False in the completed
-            # files boolean)
-            if not already_completed_files_boolean.all():
-                print(f"Found {(~already_completed_files_boolean).sum()} new file(s) ready to be converted!")
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :return: pandas.DataFrame that contains [Path, Filename, Size] for the files that are ready to be converted.
+    :rtype: pandas.DataFrame
+    """
 
-                # Select rows which point to .STP files that have not already been converted and return the
-                # [Path, Filename] columns
-                new_files = no_size_change_files.loc[~already_completed_files_boolean]
-                return new_files.loc[:, ['Path', 'Filename']]
+    files = scan_input_files(args)
 
-        # Create a datetime object from epoch and add filesearch retry time
-        d = datetime.datetime(1, 1, 1) + datetime.timedelta(seconds=args.retry_filesearch_time)
+    # Keep the files that were not modified for the file search retry time, treating files that were moved or deleted
+    # since the search as just modified
+    now = time.time()
+    modified = files['Path'].map(lambda path: os.path.getmtime(path) if os.path.exists(path) else now)
+    aged_files = files.loc[now - modified >= args.retry_filesearch_time].copy()
+    if aged_files.empty:
+        return pandas.DataFrame(columns=['Path', 'Filename', 'Size'])
 
-        print(f"No new files were found that are ready to be converted. Will try again in: "
-              f"{d.day-1} DAYS; {d.hour} HOURS; {d.minute} MIN; {d.second} SEC;")
+    # Move files that were already converted to Output\Skipped\AlreadyDone and keep the rest
+    aged_files['Filename'] = aged_files['Path'].map(os.path.basename)
+    new_files = remove_completed_files(args, aged_files)
+    if not new_files.empty:
+        print(f"Found {len(new_files)} new file(s) ready to be converted!")
 
-        # Set the initial files dataframe as the final files dataframe and restart the loop to get a new final files
-        # DataFrame and check for any new changes
-        initial_files = final_files.copy()
-        initial_files.rename(columns={'Final Size': 'Initial Size'}, inplace=True)
+    return new_files.loc[:, ['Path', 'Filename', 'Size']]
+
+
+def add_ready_files(ready_files: pandas.DataFrame, new_files: pandas.DataFrame) -> pandas.DataFrame:
+    """
+    Add the files that are known to be ready to the files a search found, keeping every path once.
+
+    :param ready_files: pandas.DataFrame that contains [Path, Filename, Size] for the files that are known to be ready.
+    :type ready_files: pandas.DataFrame
+    :param new_files: pandas.DataFrame that contains [Path, Filename, Size] for the files the search found.
+    :type new_files: pandas.DataFrame
+    :return: pandas.DataFrame that contains [Path, Filename, Size] for all of the files.
+    :rtype: pandas.DataFrame
+    """
+
+    if ready_files.empty:
+        return new_files
+    if new_files.empty:
+        return ready_files
+
+    return pandas.concat([ready_files, new_files], ignore_index=True).drop_duplicates(subset=['Path'])
+
+
+def scan_input_files(args: argparse.Namespace) -> pandas.DataFrame:
+    """
+    Recursively find the .STP files in the input folder along with their current file sizes.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :return: pandas.DataFrame that contains [Path, Size] for every .STP file in the input folder.
+    :rtype: pandas.DataFrame
+    """
+
+    with stage_timer('search'):
+
+        # Use the persistent scan index to only search the directories that changed if desired based on the user
+        # arguments
+        if args.scan_index:
+            scan_index = get_scan_index(args.scan_index, args.input, args.restat_window)
+            files = pandas.DataFrame(scan_index.scan(), columns=['Path', 'Size', 'Mtime'])
+            return files.loc[:, ['Path', 'Size']]
+
+        # Recursively find .STP files in the input folder and add to Pandas DataFrame
+        files_list = glob.glob(os.path.join(args.input, '**', '*.?tp'), recursive=True)
+        files = pandas.DataFrame(files_list, columns=['Path'])
+
+        # Get the file size of the found .STP files
+        files['Size'] = files['Path'].apply(os.path.getsize)
+
+        return files
+
+
+def walk_input_files(input_folder: str):
+    """
+    Recursively walk the input folder one directory at a time, so only the directories that are left to walk are kept
+    in memory instead of every path.
+
+    :param input_folder: String that is the path to the input folder.
+    :type input_folder: str
+    :return: Generator of (path, size, modification time) tuples for every .STP file in the input folder.
+    :rtype: Generator[tuple]
+    """
+
+    stack = [input_folder]
+    while stack:
+        directory = stack.pop()
+        try:
+            entries = os.scandir(directory)
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            continue
+
+        with entries:
+            for entry in entries:
+
+                # Skip hidden entries the way the recursive glob does
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    if entry.is_dir():
+                        stack.append(entry.path)
+                    elif fnmatch.fnmatch(entry.name, STP_PATTERN):
+                        stat = entry.stat()
+                        yield entry.path, stat.st_size, stat.st_mtime
+
+                # The entry was moved or deleted while the folder was walked
+                except FileNotFoundError:
+                    continue
+
+
+def find_file_chunks(args: argparse.Namespace, chunk_size: int):
+    """
+    Stream the .STP files that are ready to be converted and have not already been converted before in chunks while the
+    input folder is still being walked. Since a single walk cannot compare two searches, files are ready once they have
+    not been modified for retry_filesearch_time.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param chunk_size: Integer that is the maximum number of ready files that are checked and yielded at once.
+    :type chunk_size: int
+    :return: Generator of pandas.DataFrame that contains [Path, Filename, Size] for the new files of each chunk.
+    :rtype: Generator[pandas.DataFrame]
+    """
+
+    chunk = []
+    walk = walk_input_files(args.input)
+    while True:
+
+        # Collect the next chunk of ready files, timing only the walk and not the conversions in between
+        with stage_timer('search'):
+            now = time.time()
+            for path, size, mtime in walk:
+                if now - mtime >= args.retry_filesearch_time:
+                    chunk.append((path, size))
+                    if len(chunk) >= chunk_size:
+                        break
+
+        if not chunk:
+            return
+
+        # Move files that were already converted to Output\Skipped\AlreadyDone and keep the rest
+        files = pandas.DataFrame(chunk, columns=['Path', 'Size'])
+        files['Filename'] = files['Path'].map(os.path.basename)
+        new_files = remove_completed_files(args, files)
+        chunk = []
+
+        if not new_files.empty:
+            yield new_files.loc[:, ['Path', 'Filename', 'Size']]
+
+
+def get_stable_files(initial_files: pandas.DataFrame, final_files: pandas.DataFrame) -> pandas.DataFrame:
+    """
+    Get the files that were present in both searches and did not change in size, suggesting that their file transfer
+    has finished.
+
+    :param initial_files: pandas.DataFrame that contains [Path, Initial Size] from the earlier search.
+    :type initial_files: pandas.DataFrame
+    :param final_files: pandas.DataFrame that contains [Path, Final Size] from the later search.
+    :type final_files: pandas.DataFrame
+    :return: pandas.DataFrame that contains [Path, Initial Size, Final Size, Size Change] for the stable files.
+    :rtype: pandas.DataFrame
+    """
+
+    # Merge the initial and final DataFrames on [Path] and get the difference between the start and final file sizes
+    merged_files = initial_files.merge(final_files, on='Path')
+    merged_files['Size Change'] = merged_files['Final Size'] - merged_files['Initial Size']
+
+    # Select rows where the size change is 0 and save to a new DataFrame
+    return merged_files.loc[merged_files['Size Change'] == 0].copy()
+
+
+def remove_completed_files(args: argparse.Namespace, files: pandas.DataFrame) -> pandas.DataFrame:
+    """
+    Move the files that were already converted before to the Output\Skipped\AlreadyDone folder, and the files whose
+    content was converted before under another name to the Output\Skipped\Duplicate folder if desired, and return the
+    rest.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param files: pandas.DataFrame that contains at least [Path, Filename] for the files that are ready to be converted.
+    :type files: pandas.DataFrame
+    :return: pandas.DataFrame of the rows of files that have not already been converted.
+    :rtype: pandas.DataFrame
+    """
+
+    # Look up only the filenames of the found files in the CompletedFiles database
+    completed_files = completed_files_store().filter_completed(files['Filename'])
+
+    # If this node shares the input folder with other nodes, files committed by any node count as converted and files
+    # that another node is converting are left to it
+    queue = lease_queue(args)
+    if queue is not None:
+        committed_files, leased_files = queue.unavailable(set(files['Filename']) - completed_files)
+        completed_files |= committed_files
+        files = files.loc[~files['Filename'].isin(leased_files)]
+
+    # Get indices where the filename was present in the CompletedFiles database and has already been converted
+    already_completed_files_boolean = files['Filename'].isin(completed_files)
+
+    # Check if there are any files that have already been converted (i.e. at least 1 True in the completed files
+    # boolean)
+    if already_completed_files_boolean.any():
+        print(f"Found {already_completed_files_boolean.sum()} file(s) that were already converted. "
+              f"Moving it/them to the skipped output folder...")
+
+        # Select rows which point to .STP files that have already been converted
+        already_completed_files = files.loc[already_completed_files_boolean]
+
+        # Move the already converted files from the Input folder to the Output\Skipped\AlreadyDone folder
+        [rename_if_exists(path, os.path.join(args.output, 'Skipped', 'AlreadyDone', filename))
+         for path, filename
+         in zip(already_completed_files['Path'], already_completed_files['Filename'])]
+
+    # Select rows which point to .STP files that have not already been converted
+    new_files = files.loc[~already_completed_files_boolean]
+
+    # Move files whose content was already converted under another name or folder to Output\Skipped\Duplicate if
+    # desired based on the user arguments
+    if args.dedup:
+        new_files = remove_duplicate_files(args, new_files)
+
+    return new_files
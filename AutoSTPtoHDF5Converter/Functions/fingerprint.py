@@ -0,0 +1,224 @@
+"""
+Author: Ayush Doshi
+
+Contains the functions that fingerprint .STP files by their content and move the files whose content was already
+converted under another name or folder to the Output\Skipped\Duplicate folder.
+"""
+
+import argparse
+import concurrent.futures
+import hashlib
+import mmap
+import os
+
+import pandas
+
+from .completed_files_store import completed_files_store
+from .conversion_tools import rename_if_exists
+from .metrics import count, event, stage_timer
+
+# Number of bytes hashed at the start and at the end of every file, where the headers and the last records are
+HEAD_BYTES = 1024 * 1024
+TAIL_BYTES = 1024 * 1024
+
+# Number and size of the blocks sampled evenly from the rest of the file
+SAMPLE_BLOCKS = 16
+SAMPLE_BLOCK_BYTES = 64 * 1024
+
+# Number of bytes hashed at once by a full hash, so a multi-GB file is never mapped into the hash at once
+HASH_CHUNK_BYTES = 16 * 1024 * 1024
+
+
+def sample_hash(path: str) -> tuple:
+    """
+    Hash the head, the tail, and evenly spaced blocks of a file through a memory map, which reads a few MB of any file
+    no matter its size. Files that are not larger than the sampled bytes are hashed in full.
+
+    :param path: String that is the path to the file.
+    :type path: str
+    :return: Tuple of the size of the file and the hex digest of the sampled bytes.
+    :rtype: tuple
+    """
+
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if not size:
+            return size, digest.hexdigest()
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if size <= HEAD_BYTES + TAIL_BYTES + SAMPLE_BLOCKS * SAMPLE_BLOCK_BYTES:
+                digest.update(mapped)
+            else:
+                digest.update(mapped[:HEAD_BYTES])
+                step = (size - HEAD_BYTES - TAIL_BYTES) // SAMPLE_BLOCKS
+                for block in range(SAMPLE_BLOCKS):
+                    start = HEAD_BYTES + block * step
+                    digest.update(mapped[start:start + SAMPLE_BLOCK_BYTES])
+                digest.update(mapped[size - TAIL_BYTES:])
+
+    return size, digest.hexdigest()
+
+
+def full_hash(path: str) -> str:
+    """
+    Hash every byte of a file through a memory map, a chunk at a time.
+
+    :param path: String that is the path to the file.
+    :type path: str
+    :return: String that is the hex digest of the file.
+    :rtype: str
+    """
+
+    digest = hashlib.blake2b(digest_size=32)
+    with open(path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if size:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for start in range(0, size, HASH_CHUNK_BYTES):
+                    digest.update(mapped[start:start + HASH_CHUNK_BYTES])
+
+    return digest.hexdigest()
+
+
+def hash_files(hash_function, paths: list, workers: int) -> list:
+    """
+    Hash files in parallel threads, since hashlib releases the GIL while it hashes and reads through the memory map.
+
+    :param hash_function: Function that hashes a single file, i.e. sample_hash or full_hash.
+    :type hash_function: Callable
+    :param paths: List of the paths to the files.
+    :type paths: list
+    :param workers: Integer that is the maximum number of files hashed at once.
+    :type workers: int
+    :return: List of the hashes of the files in the order of the paths, with None for files that could not be read.
+    :rtype: list
+    """
+
+    def safe_hash(path: str):
+        try:
+            return hash_function(path)
+        except (OSError, ValueError) as e:
+            print(f"Could not fingerprint {path}: {e}")
+            return None
+
+    if len(paths) <= 1:
+        return [safe_hash(path) for path in paths]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(safe_hash, paths))
+
+
+def original_full_hash(args: argparse.Namespace, filename: str, full: [str, None], path: [str, None]) -> [str, None]:
+    """
+    Get the full hash of a converted file, hashing it and storing the hash next to its completion record if only its
+    sample hash is known and it can still be found in the Input folder or the Output\Skipped\AlreadyDone folder.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param filename: String that is the filename of the converted .STP file.
+    :type filename: str
+    :param full: String that is the stored full hash of the converted file or None if it was never needed.
+    :type full: [str, None]
+    :param path: String that is the path the converted file was fingerprinted at or None.
+    :type path: [str, None]
+    :return: String that is the full hash of the converted file or None if it cannot be found anymore.
+    :rtype: [str, None]
+    """
+
+    if full is not None:
+        return full
+
+    for candidate_path in [path, os.path.join(args.output, 'Skipped', 'AlreadyDone', filename)]:
+        if candidate_path and os.path.isfile(candidate_path):
+            full = hash_files(full_hash, [candidate_path], 1)[0]
+            if full is not None:
+                completed_files_store().set_full_hash(filename, full)
+                return full
+
+    return None
+
+
+def remove_duplicate_files(args: argparse.Namespace, files: pandas.DataFrame) -> pandas.DataFrame:
+    """
+    Fingerprint new files by their size and sampled content and move the files that are byte-identical to a converted
+    file with another name or folder to the Output\Skipped\Duplicate folder. A matching sample is only a candidate; a
+    file is a duplicate once its full hash matches the full hash of the converted file. Files whose fingerprint matches
+    another file that was found earlier and is still being converted are left in the Input folder for a later pass,
+    when the other file is either converted or gone.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param files: pandas.DataFrame that contains at least [Path, Filename] for the files that have not been converted.
+    :type files: pandas.DataFrame
+    :return: pandas.DataFrame of the rows of files that are neither duplicates nor deferred.
+    :rtype: pandas.DataFrame
+    """
+
+    if files.empty:
+        return files
+
+    store = completed_files_store()
+    batch = set(files['Filename'])
+
+    with stage_timer('dedup'):
+
+        # Sample hash the files that were not fingerprinted at their current size yet
+        known = {filename: (size, sample) for filename, (path, size, sample, _)
+                 in store.pending_fingerprints.items() if os.path.isfile(path) and os.path.getsize(path) == size}
+        unknown = files.loc[~files['Filename'].isin(known)]
+        if not unknown.empty:
+            print(f"Fingerprinting {len(unknown)} new file(s) to check for duplicates of converted files...")
+        for path, filename, fingerprint in zip(unknown['Path'], unknown['Filename'],
+                                               hash_files(sample_hash, list(unknown['Path']), args.dedup_workers)):
+            if fingerprint is not None:
+                known[filename] = fingerprint
+                store.pending_fingerprints[filename] = (path, fingerprint[0], fingerprint[1], None)
+
+        # Defer the files whose fingerprint matches another file that is still waiting for its completion record, or an
+        # earlier file of this search
+        deferred = set()
+        pending = {}
+        for filename, (path, size, sample, _) in store.pending_fingerprints.items():
+            if filename not in batch and os.path.isfile(path):
+                pending[(size, sample)] = filename
+        for filename in files['Filename']:
+            if filename in known:
+                if known[filename] in pending:
+                    deferred.add(filename)
+                else:
+                    pending[known[filename]] = filename
+
+        # Look up the completion records with the same fingerprint and confirm the matches with full hashes
+        records = store.find_fingerprints({fingerprint for filename, fingerprint in known.items()
+                                           if filename in batch and filename not in deferred})
+        duplicates = {}
+        candidates = files.loc[files['Filename'].map(lambda name: name in known and name not in deferred
+                                                     and known[name] in records)]
+        for path, filename, full in zip(candidates['Path'], candidates['Filename'],
+                                        hash_files(full_hash, list(candidates['Path']), args.dedup_workers)):
+            if full is None:
+                continue
+            store.pending_fingerprints[filename] = store.pending_fingerprints[filename][:3] + (full,)
+            for original_filename, original_full, original_path in records[known[filename]]:
+                if original_filename != filename and \
+                        original_full_hash(args, original_filename, original_full, original_path) == full:
+                    duplicates[filename] = original_filename
+                    break
+
+    if deferred:
+        print(f"Found {len(deferred)} file(s) with the same content as a file that is still being converted. Leaving "
+              f"it/them for a later pass...")
+
+    # Move the duplicates from the Input folder to the Output\Skipped\Duplicate folder
+    if duplicates:
+        print(f"Found {len(duplicates)} file(s) that are duplicates of converted files. Moving it/them to the skipped "
+              f"output folder...")
+        for path, filename in zip(files['Path'], files['Filename']):
+            if filename in duplicates:
+                print(f"{filename} is a duplicate of {duplicates[filename]}")
+                event('duplicate', file=filename, original=duplicates[filename])
+                store.pending_fingerprints.pop(filename, None)
+                rename_if_exists(path, os.path.join(args.output, 'Skipped', 'Duplicate', filename))
+        count('stp_duplicate_files_total', len(duplicates))
+
+    return files.loc[~files['Filename'].isin(deferred | set(duplicates))]
@@ -0,0 +1,208 @@
+"""
+Author: Ayush Doshi
+
+Contains the "StallMonitor" class that detects conversions that stopped making progress and the per-file timeouts that
+are calibrated from the conversion history.
+"""
+
+import argparse
+import glob
+import os
+import subprocess
+import sys
+import time
+
+import pandas
+
+from .conversion_history import ConversionHistory, conversion_history
+from .conversion_tools import terminate_process_tree
+
+# Number of seconds in between checks of a running tool for progress or its timeout
+CHECK_INTERVAL = 5
+
+# Suffix of the marker file in the Processing folder that asks a running conversion to stop so its slot is freed
+PREEMPT_SUFFIX = '.preempt'
+
+
+class ConversionStalled(subprocess.TimeoutExpired):
+    """
+    Raised when the outputs of a conversion tool did not grow for the stall timeout. It is a subprocess.TimeoutExpired
+    so stalled conversions are handled like timed-out conversions.
+    """
+
+    def __str__(self) -> str:
+        return f"Command '{self.cmd}' made no progress for {self.timeout} seconds"
+
+
+class ConversionPreempted(Exception):
+    """
+    Raised when a background conversion is preempted to free its conversion slot for higher priority work. The partial
+    outputs are deleted the next time the file is converted.
+    """
+
+
+def preempt_conversion(basename: str) -> None:
+    """
+    Ask the running conversion of a file to stop at its next check by creating a marker file in the Processing folder.
+
+    :param basename: String that is the basename (filename w/o extension) of the .STP file being converted.
+    :type basename: str
+    :return: None
+    :rtype: None
+    """
+
+    open(os.path.join('Processing', basename + PREEMPT_SUFFIX), 'a').close()
+
+
+class StallMonitor:
+    """
+    Watches the .XML and .HDF5 outputs of a single conversion in the Processing folder and reports the conversion as
+    stalled once their sizes and modification times did not change for stall_timeout seconds.
+    """
+
+    def __init__(self, basename: str, stall_timeout: [float, None]) -> None:
+        """
+        :param basename: String that is the basename (filename w/o extension) of the .STP file being converted.
+        :type basename: str
+        :param stall_timeout: Float that is the number of seconds without progress before the conversion is stalled or
+        None to never report a stall.
+        :type stall_timeout: [float, None]
+        """
+
+        self.basename = basename
+        self.stall_timeout = stall_timeout
+        self.last_progress = None
+        self.last_progress_time = time.monotonic()
+
+    def progress(self) -> tuple:
+        """
+        Get the sizes and modification times of the conversion outputs that currently exist in the Processing folder.
+
+        :return: Tuple of (path, size, modification time) for every output.
+        :rtype: tuple
+        """
+
+        progress = []
+        for path in sorted(glob.glob(os.path.join('Processing', glob.escape(self.basename) + '.xml')) +
+                           glob.glob(os.path.join('Processing', glob.escape(self.basename) + '-_-*.hdf5'))):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            progress.append((path, stat.st_size, stat.st_mtime_ns))
+
+        return tuple(progress)
+
+    def stalled(self) -> bool:
+        """
+        Check if the conversion made no progress for the stall timeout since it was last checked or started.
+
+        :return: True if the conversion is stalled, otherwise False.
+        :rtype: bool
+        """
+
+        if not self.stall_timeout:
+            return False
+
+        now = time.monotonic()
+        progress = self.progress()
+        if progress != self.last_progress:
+            self.last_progress = progress
+            self.last_progress_time = now
+
+        return now - self.last_progress_time > self.stall_timeout
+
+    def preempted(self) -> bool:
+        """
+        Check if the conversion was asked to stop to free its conversion slot.
+
+        :return: True if the preemption marker of the conversion exists, otherwise False.
+        :rtype: bool
+        """
+
+        return os.path.exists(os.path.join('Processing', self.basename + PREEMPT_SUFFIX))
+
+
+def conversion_timeout(args: argparse.Namespace, filename: str, size: int) -> float:
+    """
+    Get the timeout of a single conversion tool run, which is timeout_factor times the duration predicted from the
+    conversion history for a file of this size, system, and wave data setting, bounded by min_timeout and timeout.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param filename: String that is the filename of the .STP file.
+    :type filename: str
+    :param size: Integer that is the size of the .STP file in bytes.
+    :type size: int
+    :return: Float that is the number of seconds to wait for the tool before it is killed.
+    :rtype: float
+    """
+
+    return float(conversion_timeouts(args, pandas.DataFrame({'Filename': [filename], 'Size': [size]})).iloc[0])
+
+
+def conversion_timeouts(args: argparse.Namespace, files: pandas.DataFrame,
+                        history: [ConversionHistory, None] = None) -> pandas.Series:
+    """
+    Get the timeouts of the conversion tool runs of many files at once the way conversion_timeout does for one file.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param files: pandas.DataFrame that contains at least [Filename, Size] for the .STP files.
+    :type files: pandas.DataFrame
+    :param history: ConversionHistory to predict durations from or None to use the default ConversionHistory database.
+    :type history: [ConversionHistory, None]
+    :return: pandas.Series of the number of seconds to wait for each tool run with the index of files.
+    :rtype: pandas.Series
+    """
+
+    if not args.timeout_factor:
+        return pandas.Series(float(args.timeout), index=files.index)
+
+    if history is None:
+        history = conversion_history()
+    predicted = history.predict(files, args.system, args.wave_data)
+    if predicted is None:
+        return pandas.Series(float(args.timeout), index=files.index)
+
+    return (args.timeout_factor * predicted.astype(float)).clip(lower=args.min_timeout).clip(upper=args.timeout)
+
+
+def run_monitored_tool(params: list, timeout: float, monitor: [StallMonitor, None] = None) -> int:
+    """
+    Run a conversion tool in its own process group while ignoring outputs, killing the whole process tree if it times
+    out or stalls.
+
+    :param params: List of the executable and its parameters.
+    :type params: list
+    :param timeout: Float that is the number of seconds to wait for the tool before it is killed.
+    :type timeout: float
+    :param monitor: StallMonitor of the conversion or None to only use the timeout.
+    :type monitor: [StallMonitor, None]
+    :return: Integer that is the return code of the tool.
+    :rtype: int
+    """
+
+    deadline = time.monotonic() + timeout
+
+    # Start the tool in a new process group/session so that it and any processes it starts can be killed together
+    if sys.platform == 'win32':
+        process = subprocess.Popen(params, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT,
+                                   creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
+    else:
+        process = subprocess.Popen(params, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT,
+                                   start_new_session=True)
+
+    try:
+        while True:
+            try:
+                return process.wait(timeout=max(0.0, min(deadline - time.monotonic(), CHECK_INTERVAL)))
+            except subprocess.TimeoutExpired:
+                if time.monotonic() >= deadline:
+                    raise subprocess.TimeoutExpired(params, timeout)
+                if monitor is not None and monitor.stalled():
+                    raise ConversionStalled(params, monitor.stall_timeout)
+                if monitor is not None and monitor.preempted():
+                    raise ConversionPreempted(f"Command '{params}' was preempted")
+    finally:
+        terminate_process_tree(process)
@@ -0,0 +1,331 @@
+"""
+Author: Ayush Doshi
+
+Contains the "LeaseQueue" class that coordinates several AutoSTPtoHDF5Converter nodes that share an input folder, so
+every .STP file is converted by a single node and committed exactly once.
+"""
+
+import argparse
+import functools
+import os
+import sqlite3
+import threading
+import time
+
+import pandas
+
+from .completed_files_store import MAX_LOOKUP_PARAMETERS
+from .conversion_tools import converted_files
+
+
+class FileClaimed(Exception):
+    """
+    Raised when an .STP file is being converted or was converted by another node.
+    """
+
+
+class LeaseQueue:
+    """
+    Time-limited leases on .STP files in a SQLite database on the shared volume.
+
+    A node claims a file right before converting it and holds the lease until the file is committed, renewing the
+    leases of all of its files with a heartbeat. The lease of a node that died expires and the file is reclaimed by the
+    next node that tries to convert it. A file is only committed by the node that holds its lease, after which it is
+    never claimed again. The database uses the default rollback journal instead of write-ahead logging, since
+    write-ahead logging does not work on network file systems, and leases are compared against the wall clock, so the
+    clocks of the nodes have to be synchronized, e.g. with NTP.
+    """
+
+    def __init__(self, database_path: str, node_id: str, lease_duration: int) -> None:
+        """
+        :param database_path: String that is the path to the LeaseQueue SQLite database on the shared volume.
+        :type database_path: str
+        :param node_id: String that identifies this node.
+        :type node_id: str
+        :param lease_duration: Integer that is the number of seconds a lease lasts without a heartbeat.
+        :type lease_duration: int
+        """
+
+        self.database_path = database_path
+        self.node_id = node_id
+        self.lease_duration = lease_duration
+        self.lock = threading.Lock()
+
+        # Manage transactions explicitly so claims take the write lock before they read, and wait for the locks of
+        # other nodes instead of failing
+        self.conn = sqlite3.connect(database_path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS "Leases" ("Filename" TEXT, "Owner" TEXT, "State" TEXT, '
+                          '"Expires" REAL, "Attempts" INTEGER, PRIMARY KEY("Filename"))')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS "LeasesOwner" ON "Leases" ("Owner", "State")')
+
+    def claim(self, filename: str) -> [bool, None]:
+        """
+        Take the lease of a file that is not leased, whose lease expired, or that this node holds already.
+
+        :param filename: String that is the filename of the .STP file.
+        :type filename: str
+        :return: True if the lease was reclaimed from another node, False if it was taken otherwise, or None if the file
+        is leased by or was committed by another node.
+        :rtype: [bool, None]
+        """
+
+        now = time.time()
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.conn.execute('SELECT Owner, State, Expires, Attempts FROM Leases WHERE Filename = ?',
+                                        (filename,)).fetchone()
+                if row is not None and (row[1] == 'done' or (row[0] != self.node_id and row[2] > now)):
+                    self.conn.execute('ROLLBACK')
+                    return None
+                self.conn.execute('INSERT OR REPLACE INTO Leases (Filename, Owner, State, Expires, Attempts) VALUES '
+                                  '(?, ?, \'leased\', ?, ?)', (filename, self.node_id, now + self.lease_duration,
+                                                               1 if row is None else row[3] + 1))
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+
+        return row is not None and row[0] != self.node_id
+
+    def renew(self) -> int:
+        """
+        Extend the leases of every file this node holds.
+
+        :return: Integer that is the number of leases that were extended.
+        :rtype: int
+        """
+
+        with self.lock:
+            return self.conn.execute('UPDATE Leases SET Expires = ? WHERE Owner = ? AND State = \'leased\'',
+                                     (time.time() + self.lease_duration, self.node_id)).rowcount
+
+    def owned(self, filenames) -> set:
+        """
+        Get the files out of the candidates whose lease this node holds.
+
+        :param filenames: Iterable of .STP filenames.
+        :type filenames: Iterable[str]
+        :return: Set of the filenames that are leased by this node.
+        :rtype: set
+        """
+
+        return {filename for filename, owner, state, _ in self.lookup(filenames)
+                if owner == self.node_id and state == 'leased'}
+
+    def unavailable(self, filenames) -> tuple:
+        """
+        Get the files out of the candidates that were committed or that another node holds a valid lease on.
+
+        :param filenames: Iterable of .STP filenames.
+        :type filenames: Iterable[str]
+        :return: Tuple of the set of committed filenames and the set of filenames leased by other nodes.
+        :rtype: tuple
+        """
+
+        now = time.time()
+        committed, leased = set(), set()
+        for filename, owner, state, expires in self.lookup(filenames):
+            if state == 'done':
+                committed.add(filename)
+            elif owner != self.node_id and expires > now:
+                leased.add(filename)
+
+        return committed, leased
+
+    def lookup(self, filenames) -> list:
+        """
+        Get the leases of the candidates a batch of query parameters at a time, so the database on the shared volume is
+        queried once per batch instead of once per file.
+
+        :param filenames: Iterable of .STP filenames.
+        :type filenames: Iterable[str]
+        :return: List of (filename, owner, state, expiry time) tuples of the candidates that have a lease.
+        :rtype: list
+        """
+
+        filenames = list(set(filenames))
+        rows = []
+        with self.lock:
+            for start in range(0, len(filenames), MAX_LOOKUP_PARAMETERS):
+                batch = filenames[start:start + MAX_LOOKUP_PARAMETERS]
+                rows.extend(self.conn.execute(
+                    f'SELECT Filename, Owner, State, Expires FROM Leases WHERE Filename IN '
+                    f'({", ".join("?" * len(batch))})', batch))
+
+        return rows
+
+    def release(self, filenames: list) -> None:
+        """
+        Give up the leases this node holds on files, e.g. after their conversion failed and they were moved out of the
+        Input folder.
+
+        :param filenames: List of .STP filenames.
+        :type filenames: list
+        :return: None
+        :rtype: None
+        """
+
+        with self.lock:
+            self.conn.executemany('DELETE FROM Leases WHERE Filename = ? AND Owner = ? AND State = \'leased\'',
+                                  ((filename, self.node_id) for filename in filenames))
+
+    def commit(self, filenames: list) -> list:
+        """
+        Mark files this node holds the lease on as committed so they are never claimed again.
+
+        :param filenames: List of .STP filenames.
+        :type filenames: list
+        :return: List of the filenames that were committed by this call.
+        :rtype: list
+        """
+
+        committed = []
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                for filename in filenames:
+                    if self.conn.execute('UPDATE Leases SET State = \'done\' WHERE Filename = ? AND Owner = ? AND '
+                                         'State = \'leased\'', (filename, self.node_id)).rowcount:
+                        committed.append(filename)
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+
+        return committed
+
+
+@functools.lru_cache(maxsize=None)
+def get_lease_queue(database_path: str, node_id: str, lease_duration: int, pid: int) -> LeaseQueue:
+    """
+    Get the lease queue for the database, opening it only once per process. The process ID is part of the cache key so
+    a forked worker never uses the connection of its parent.
+
+    :param database_path: String that is the path to the LeaseQueue SQLite database on the shared volume.
+    :type database_path: str
+    :param node_id: String that identifies this node.
+    :type node_id: str
+    :param lease_duration: Integer that is the number of seconds a lease lasts without a heartbeat.
+    :type lease_duration: int
+    :param pid: Integer that is the ID of the current process.
+    :type pid: int
+    :return: LeaseQueue for the database.
+    :rtype: LeaseQueue
+    """
+
+    return LeaseQueue(database_path, node_id, lease_duration)
+
+
+def lease_queue(args: argparse.Namespace) -> [LeaseQueue, None]:
+    """
+    Get the lease queue of this process if desired based on the user arguments.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :return: LeaseQueue or None if this node does not share its input folder with other nodes.
+    :rtype: [LeaseQueue, None]
+    """
+
+    if not args.lease_queue:
+        return None
+
+    return get_lease_queue(args.lease_queue, args.node_id, args.lease_duration, os.getpid())
+
+
+def start_lease_heartbeat(args: argparse.Namespace) -> None:
+    """
+    Renew the leases of this node from a background thread every third of the lease duration if desired based on the
+    user arguments, so the leases only expire if the node stops.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :return: None
+    :rtype: None
+    """
+
+    if not args.lease_queue:
+        return
+
+    def heartbeat() -> None:
+        while True:
+            time.sleep(args.lease_duration / 3)
+            try:
+                lease_queue(args).renew()
+            except sqlite3.Error as e:
+                print(f"Could not renew the leases of node {args.node_id}: {e}")
+
+    threading.Thread(target=heartbeat, name='LeaseHeartbeat', daemon=True).start()
+    print(f"Sharing the input folder as node {args.node_id} through {args.lease_queue}")
+
+
+def claim_file(args: argparse.Namespace, input_stp_path: str, filename: str) -> None:
+    """
+    Claim an .STP file before converting it if this node shares its input folder with other nodes, deleting the .HDF5
+    file(s) that a node that died left in Output\Converted if the lease was reclaimed from it.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param input_stp_path: String that is the path to the .STP file in the Input folder.
+    :type input_stp_path: str
+    :param filename: String that is the filename of the .STP file.
+    :type filename: str
+    :return: None
+    :rtype: None
+    :raises FileClaimed: If the file is leased by or was committed by another node, or another node moved it out of the
+    Input folder after it failed.
+    """
+
+    queue = lease_queue(args)
+    if queue is None:
+        return
+
+    reclaimed = queue.claim(filename)
+    if reclaimed is None:
+        raise FileClaimed(f'{filename} is claimed by another node')
+
+    # Give the lease back if another node moved the file to a failed folder and released it before this node claimed it
+    if not os.path.exists(input_stp_path):
+        queue.release([filename])
+        raise FileClaimed(f'{filename} was moved out of the Input folder by another node')
+
+    if reclaimed:
+        for converted_hdf5_path in converted_files(args, os.path.splitext(filename)[0]):
+            os.remove(converted_hdf5_path)
+
+
+def release_file(args: argparse.Namespace, filename: str) -> None:
+    """
+    Give up the lease on an .STP file if this node shares its input folder with other nodes.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param filename: String that is the filename of the .STP file.
+    :type filename: str
+    :return: None
+    :rtype: None
+    """
+
+    queue = lease_queue(args)
+    if queue is not None:
+        queue.release([filename])
+
+
+def owned_files(args: argparse.Namespace, files: pandas.DataFrame) -> pandas.DataFrame:
+    """
+    Keep only the files whose lease this node holds if it shares its input folder with other nodes, so the .HDF5 files
+    that other nodes converted into the shared Output\Converted folder are left to them.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param files: pandas.DataFrame that contains at least [Filename].
+    :type files: pandas.DataFrame
+    :return: pandas.DataFrame of the rows of files that this node may de-identify.
+    :rtype: pandas.DataFrame
+    """
+
+    queue = lease_queue(args)
+    if queue is None:
+        return files
+
+    return files.loc[files['Filename'].isin(queue.owned(files['Filename']))].copy()
@@ -6,10 +6,14 @@ Contains the "merge_files_w_patient_info" function.
 
 import argparse
 import os
-import sqlite3
 
 import pandas
 
+from .conversion_tools import rename_if_exists
+from .patient_offset_resolver import get_patient_offset_resolver
+from .pending_offsets import get_pending_offsets_index
+from .state_journal import state_journal
+
 
 def merge_files_w_patient_info(args: argparse.Namespace, files: pandas.DataFrame) -> pandas.DataFrame:
     """
@@ -17,21 +21,16 @@ def merge_files_w_patient_info(args: argparse.Namespace, files: pandas.DataFrame
 
     :param args: argparse.Namespace that contains the arguments provided by the user.
     :type args: argparse.Namespace
-    :param files: pandas.DataFrame that contains [Path, Filename] for the files that are ready to be converted.
+    :param files: pandas.DataFrame that contains [Path, Filename, Size] for the files that are ready to be converted.
     :type files: pandas.DataFrame
-    :return: pandas.DataFrame that contains [Path, Filename, PatientID, Offset] for the convertable files.
+    :return: pandas.DataFrame that contains [Path, Filename, Size, PatientID, Offset] for the convertable files.
     :rtype: pandas.DataFrame
     """
 
     print("Pulling patient information for the found files...")
 
-    # Pull the PatientOffset table from the patient offset SQLite database into a Pandas dataframe
-    conn = sqlite3.connect(args.database)
-    patient_info = pandas.read_sql_query('SELECT * from PatientOffset', conn)
-    conn.close()
-
-    # Rename the [STPFile] column to [Filename] column
-    patient_info.rename(columns={'STPFile': 'Filename'}, inplace=True)
+    # Look up only the filenames of the found files in the patient offset SQLite database
+    patient_info = get_patient_offset_resolver(args.database).resolve(files['Filename'])
 
     # Merge the dataframe that contains files that are ready to be converted with the patient offset DataFrame
     files_w_patient_info = files.merge(patient_info, how='left', on='Filename')
@@ -50,14 +49,23 @@ def merge_files_w_patient_info(args: argparse.Namespace, files: pandas.DataFrame
 
         # Move the files that do not have patient offset information in the patient offset database from the Input
         # folder to the Output\Skipped\NotInPatientDatabase folder
-        [os.renames(path, os.path.join(args.output, 'Skipped', 'NotInPatientDatabase', filename))
+        [rename_if_exists(path, os.path.join(args.output, 'Skipped', 'NotInPatientDatabase', filename))
          for path, filename
          in zip(not_in_patient_database_files['Path'], not_in_patient_database_files['Filename'])]
 
+        # Index the skipped files by their filename, so a patient offset update only requeues the files it covers
+        get_pending_offsets_index(args.output).add(zip(not_in_patient_database_files['Filename'],
+                                                       not_in_patient_database_files['Size'].astype(int).tolist()))
+
     # Select rows where the offset is not NA and save to a new DataFrame
     files_w_patient_info = files_w_patient_info.loc[~not_in_patient_database_boolean]
 
     # Change the dtype of the PatientID and Offset to int64
     files_w_patient_info = files_w_patient_info.astype({'PatientID': 'int64', 'Offset': 'int64'})
 
+    # Record the convertable files in the state journal if one is kept
+    journal = state_journal(args)
+    if journal is not None and not files_w_patient_info.empty:
+        journal.discover(files_w_patient_info)
+
     return files_w_patient_info
@@ -0,0 +1,399 @@
+"""
+Author: Ayush Doshi
+
+Contains the "Metrics" registry that keeps counters, gauges, and latency histograms of the conversions and exposes them
+in the Prometheus text format over a local HTTP endpoint and as a JSON-lines event log.
+"""
+
+import argparse
+import bisect
+import contextlib
+import http.server
+import json
+import multiprocessing
+import threading
+import time
+
+# Type and help text of every metric that is exposed
+METRIC_DEFINITIONS = {
+    'stp_conversions_total': ('counter', 'Number of finished conversions by outcome.'),
+    'stp_stage_duration_seconds': ('histogram', 'Time spent in each stage of the conversion cycle.'),
+    'stp_input_bytes_total': ('counter', 'Bytes of .STP files that were converted successfully.'),
+    'hdf5_output_bytes_total': ('counter', 'Bytes of .HDF5 files that were produced.'),
+    'stp_backlog_files': ('gauge', 'Number of files that are ready and waiting to be converted.'),
+    'stp_conversions_in_flight': ('gauge', 'Number of conversions that are running.'),
+    'stp_conversions_in_stage': ('gauge', 'Number of asyncio conversions in each stage of the conversion cycle.'),
+    'stp_concurrency_limit': ('gauge', 'Number of conversions that may run at once.'),
+    'stp_duplicate_files_total': ('counter', 'Number of files skipped as byte-identical to a converted file.'),
+    'stp_wave_backlog_files': ('gauge', 'Number of files waiting for their conversion with wave data.'),
+    'stp_preemptions_total': ('counter', 'Number of conversions with wave data preempted for waiting files.'),
+    'stp_backfill_remaining_bytes': ('gauge', 'Bytes of the files found by the backfill that are not finished yet.'),
+}
+
+# Upper bounds in seconds of the buckets of the stage duration histograms, from sub-second renames to 10 hour timeouts
+DURATION_BUCKETS = (0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200, 14400, 36000)
+
+# Metrics registry of this process, which is None if metrics are not collected, and the queue that forwards metrics
+# from ProcessPoolExecutor workers to the registry of the main process
+METRICS = None
+WORKER_QUEUE = None
+
+# Stage of every asyncio conversion in progress by the filename of its .STP file
+CONVERSION_STAGES = {}
+
+
+class Metrics:
+    """
+    Thread-safe registry of counters, gauges, and histograms that are identified by their name and labels, with an
+    optional JSON-lines event log.
+
+    Recording a metric only takes a lock and a dictionary update, so the registry can stay on in production; the
+    Prometheus text is only rendered when the endpoint is scraped.
+    """
+
+    def __init__(self, event_log_path: [str, None] = None) -> None:
+        """
+        :param event_log_path: String that is the path to the JSON-lines event log to append to or None for no log.
+        :type event_log_path: [str, None]
+        """
+
+        self.lock = threading.Lock()
+        self.values = {}
+        self.histograms = {}
+        self.event_log = open(event_log_path, 'a', buffering=1) if event_log_path else None
+
+    def inc(self, name: str, value: float = 1, labels: tuple = ()) -> None:
+        """
+        Increase a counter.
+
+        :param name: String that is the name of the counter.
+        :type name: str
+        :param value: Float to add to the counter.
+        :type value: float
+        :param labels: Tuple of (label, value) pairs.
+        :type labels: tuple
+        :return: None
+        :rtype: None
+        """
+
+        with self.lock:
+            self.values[(name, labels)] = self.values.get((name, labels), 0) + value
+
+    def set(self, name: str, value: float, labels: tuple = ()) -> None:
+        """
+        Set a gauge.
+
+        :param name: String that is the name of the gauge.
+        :type name: str
+        :param value: Float that is the new value of the gauge.
+        :type value: float
+        :param labels: Tuple of (label, value) pairs.
+        :type labels: tuple
+        :return: None
+        :rtype: None
+        """
+
+        with self.lock:
+            self.values[(name, labels)] = value
+
+    def observe(self, name: str, value: float, labels: tuple = ()) -> None:
+        """
+        Add an observation to a histogram.
+
+        :param name: String that is the name of the histogram.
+        :type name: str
+        :param value: Float that is the observed value.
+        :type value: float
+        :param labels: Tuple of (label, value) pairs.
+        :type labels: tuple
+        :return: None
+        :rtype: None
+        """
+
+        with self.lock:
+            histogram = self.histograms.setdefault((name, labels), [[0] * len(DURATION_BUCKETS), 0, 0.0])
+            bucket = bisect.bisect_left(DURATION_BUCKETS, value)
+            if bucket < len(DURATION_BUCKETS):
+                histogram[0][bucket] += 1
+            histogram[1] += 1
+            histogram[2] += value
+
+    def event(self, event: str, fields: dict) -> None:
+        """
+        Append an event to the JSON-lines event log if there is one.
+
+        :param event: String that is the type of the event.
+        :type event: str
+        :param fields: Dictionary of the fields of the event.
+        :type fields: dict
+        :return: None
+        :rtype: None
+        """
+
+        if self.event_log is None:
+            return
+
+        line = json.dumps({'time': time.time(), 'event': event, **fields})
+        with self.lock:
+            self.event_log.write(line + '\n')
+
+    def render(self) -> str:
+        """
+        Render every metric in the Prometheus text exposition format.
+
+        :return: String of the metrics in the Prometheus text format.
+        :rtype: str
+        """
+
+        with self.lock:
+            values = dict(self.values)
+            histograms = {key: (list(buckets), count, total) for key, (buckets, count, total)
+                          in self.histograms.items()}
+
+        lines = []
+        for name, (metric_type, help_text) in METRIC_DEFINITIONS.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for (metric_name, labels), value in sorted(values.items()):
+                if metric_name == name:
+                    lines.append(f'{name}{format_labels(labels)} {value}')
+            for (metric_name, labels), (buckets, count, total) in sorted(histograms.items()):
+                if metric_name != name:
+                    continue
+                cumulative = 0
+                for upper_bound, bucket_count in zip(DURATION_BUCKETS, buckets):
+                    cumulative += bucket_count
+                    lines.append(f'{name}_bucket{format_labels(labels + (("le", str(upper_bound)),))} {cumulative}')
+                lines.append(f'{name}_bucket{format_labels(labels + (("le", "+Inf"),))} {count}')
+                lines.append(f'{name}_sum{format_labels(labels)} {total}')
+                lines.append(f'{name}_count{format_labels(labels)} {count}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels: tuple) -> str:
+    """
+    Format the labels of a metric for the Prometheus text format.
+
+    :param labels: Tuple of (label, value) pairs.
+    :type labels: tuple
+    :return: String of the labels in braces or an empty string if there are none.
+    :rtype: str
+    """
+
+    if not labels:
+        return ''
+
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{label}="{value}"' for (label, _), value in zip(labels, escaped)) + '}'
+
+
+def start_metrics(args: argparse.Namespace) -> None:
+    """
+    Start collecting metrics in this process if desired based on the user arguments and serve them on a local HTTP
+    endpoint from a background thread.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :return: None
+    :rtype: None
+    """
+
+    global METRICS
+
+    if not args.metrics_port and not args.event_log:
+        return
+
+    METRICS = Metrics(args.event_log)
+
+    if args.metrics_port:
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', args.metrics_port), MetricsRequestHandler)
+        threading.Thread(target=server.serve_forever, name='MetricsServer', daemon=True).start()
+        print(f"Serving metrics on http://127.0.0.1:{args.metrics_port}/metrics")
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves the metrics of this process in the Prometheus text format on /metrics.
+    """
+
+    def do_GET(self) -> None:
+        if self.path.split('?')[0] != '/metrics' or METRICS is None:
+            self.send_error(404)
+            return
+
+        body = METRICS.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        # Do not print a line to the console for every scrape
+        pass
+
+
+def worker_initializer() -> tuple:
+    """
+    Get the initializer and its arguments for ProcessPoolExecutor workers so that their metrics are forwarded to the
+    registry of this process, starting the thread that receives them on first use.
+
+    :return: Tuple of the initializer function and its arguments or (None, ()) if metrics are not collected.
+    :rtype: tuple
+    """
+
+    global WORKER_QUEUE
+
+    if METRICS is None:
+        return None, ()
+
+    if WORKER_QUEUE is None:
+        WORKER_QUEUE = multiprocessing.Queue()
+        threading.Thread(target=receive_worker_metrics, args=(WORKER_QUEUE,), name='WorkerMetrics',
+                         daemon=True).start()
+
+    return connect_worker, (WORKER_QUEUE,)
+
+
+def connect_worker(queue: multiprocessing.Queue) -> None:
+    """
+    Initializer of ProcessPoolExecutor workers that forwards their metrics through the queue.
+
+    :param queue: multiprocessing.Queue that the main process receives metrics from.
+    :type queue: multiprocessing.Queue
+    :return: None
+    :rtype: None
+    """
+
+    global METRICS
+
+    METRICS = WorkerMetrics(queue)
+
+
+class WorkerMetrics:
+    """
+    Stand-in for the Metrics registry in ProcessPoolExecutor workers that forwards every call to the main process.
+    """
+
+    def __init__(self, queue: multiprocessing.Queue) -> None:
+        """
+        :param queue: multiprocessing.Queue that the main process receives metrics from.
+        :type queue: multiprocessing.Queue
+        """
+
+        self.queue = queue
+
+    def __getattr__(self, method: str):
+        return lambda *args: self.queue.put((method, args))
+
+
+def receive_worker_metrics(queue: multiprocessing.Queue) -> None:
+    """
+    Record the metrics forwarded by ProcessPoolExecutor workers in the registry of this process.
+
+    :param queue: multiprocessing.Queue that the workers forward metrics through.
+    :type queue: multiprocessing.Queue
+    :return: None
+    :rtype: None
+    """
+
+    while True:
+        method, args = queue.get()
+        getattr(METRICS, method)(*args)
+
+
+def count(name: str, value: float = 1, **labels) -> None:
+    """
+    Increase a counter if metrics are collected.
+
+    :param name: String that is the name of the counter.
+    :type name: str
+    :param value: Float to add to the counter.
+    :type value: float
+    :return: None
+    :rtype: None
+    """
+
+    if METRICS is not None:
+        METRICS.inc(name, value, tuple(sorted(labels.items())))
+
+
+def gauge(name: str, value: float, **labels) -> None:
+    """
+    Set a gauge if metrics are collected.
+
+    :param name: String that is the name of the gauge.
+    :type name: str
+    :param value: Float that is the new value of the gauge.
+    :type value: float
+    :return: None
+    :rtype: None
+    """
+
+    if METRICS is not None:
+        METRICS.set(name, value, tuple(sorted(labels.items())))
+
+
+def event(event_type: str, **fields) -> None:
+    """
+    Append an event to the JSON-lines event log if metrics are collected.
+
+    :param event_type: String that is the type of the event.
+    :type event_type: str
+    :return: None
+    :rtype: None
+    """
+
+    if METRICS is not None:
+        METRICS.event(event_type, fields)
+
+
+def track_conversion_stage(filename: str, stage: str) -> None:
+    """
+    Progress callback of the asyncio engine that keeps the gauge of the conversions in each stage up to date if metrics
+    are collected. It is only called from the event loop of the AsyncConversionExecutor, so it needs no lock.
+
+    :param filename: String that is the filename of the .STP file.
+    :type filename: str
+    :param stage: String that is the stage the conversion entered, where 'done' and 'failed' end the conversion.
+    :type stage: str
+    :return: None
+    :rtype: None
+    """
+
+    if METRICS is None:
+        return
+
+    previous_stage = CONVERSION_STAGES.pop(filename, None)
+    if stage not in ('done', 'failed'):
+        CONVERSION_STAGES[filename] = stage
+
+    for changed_stage in {previous_stage, stage} - {None, 'done', 'failed'}:
+        METRICS.set('stp_conversions_in_stage', list(CONVERSION_STAGES.values()).count(changed_stage),
+                    (('stage', changed_stage),))
+
+
+@contextlib.contextmanager
+def stage_timer(stage: str, filename: [str, None] = None):
+    """
+    Time a stage of the conversion cycle, e.g. 'copy', 'stptoolkit', 'formatconverter', 'rename', or 'db_update', into
+    the stage duration histogram and the event log.
+
+    :param stage: String that is the name of the stage.
+    :type stage: str
+    :param filename: String that is the filename of the .STP file the stage works on or None for stages of a batch.
+    :type filename: [str, None]
+    """
+
+    if METRICS is None:
+        yield
+        return
+
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start_time
+        METRICS.observe('stp_stage_duration_seconds', seconds, (('stage', stage),))
+        METRICS.event('stage', {'stage': stage, 'file': filename, 'seconds': round(seconds, 6)})
@@ -0,0 +1,355 @@
+"""
+Author: Ayush Doshi
+
+Contains the native .XML to .HDF5 writer that can be used instead of the formatconverter.
+
+The StpToolkit .XML file is stream-parsed with bounded memory. The writer understands the following elements and
+ignores everything else:
+
+<VitalSigns CollectionTimeUTC="2017-01-02T10:00:00">    (or CollectionTime/Time; ISO 8601 or MM/DD/YYYY HH:MM:SS)
+  <VitalSign><Par>HR</Par><Value UOM="Bpm">80</Value></VitalSign>
+</VitalSigns>
+<Waveforms CollectionTimeUTC="2017-01-02T10:00:00">
+  <WaveformData Channel="II" UOM="mV" SampleRate="240">1,2,3,...</WaveformData>
+</Waveforms>
+
+Every vital sign and waveform is written to its own chunked, compressed /VitalSigns/<Par> or /Waveforms/<Channel> group
+with 'data' and 'time' datasets. Times are stored in epoch milliseconds with the de-identification offset applied in
+NumPy, and the data is split into one .HDF5 file per offset day named like the formatconverter's %d%i-_-%s.%t pattern.
+"""
+
+import argparse
+import datetime
+import glob
+import os
+import xml.etree.ElementTree
+
+try:
+    import h5py
+    import numpy
+except ImportError:
+    h5py = None
+    numpy = None
+
+# h5py and NumPy are only needed by the native writer, so they are optional
+NATIVE_WRITER_AVAILABLE = h5py is not None
+
+# Number of values buffered per signal before they are written to the .HDF5 file(s), which bounds the memory used
+FLUSH_SIZE = 65536
+
+# Chunk size of the .HDF5 datasets and the gzip compression level
+CHUNK_SIZE = 16384
+COMPRESSION_LEVEL = 4
+
+MILLISECONDS_PER_DAY = 24 * 60 * 60 * 1000
+
+# Elements that hold a single record of vital signs or waveforms
+RECORD_TAGS = ('VitalSigns', 'Waveforms')
+
+
+def native_writer_enabled(args: argparse.Namespace) -> bool:
+    """
+    Check if the native writer should be used instead of the formatconverter.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :return: True if the native writer should be used, otherwise False.
+    :rtype: bool
+    """
+
+    return args.hdf5_writer == 'native' and NATIVE_WRITER_AVAILABLE
+
+
+def write_native_hdf5(args: argparse.Namespace, processing_xml_path: str, offset: int) -> bool:
+    """
+    Convert an .XML file in the Processing folder to de-identified .HDF5 file(s) with the native writer, removing any
+    partial .HDF5 files if the .XML file could not be converted so the caller can fall back to the formatconverter.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param processing_xml_path: String that is the path to the .XML file in the Processing folder.
+    :type processing_xml_path: str
+    :param offset: Integer that is the offset specific to the .STP file retrieved from the patient offset database.
+    :type offset: int
+    :return: True if the .HDF5 file(s) were created, otherwise False.
+    :rtype: bool
+    """
+
+    basename = os.path.splitext(os.path.basename(processing_xml_path))[0]
+    try:
+        with DailyHdf5Writer(os.path.dirname(processing_xml_path), basename, offset, args.single_hdf5_file) as writer:
+            parse_stp_xml(processing_xml_path, writer)
+        if writer.records:
+            return True
+        reason = 'no vital signs or waveforms were found'
+    except (xml.etree.ElementTree.ParseError, ValueError, OSError) as e:
+        reason = str(e)
+
+    for processing_hdf5_path in glob.glob(os.path.join(os.path.dirname(processing_xml_path),
+                                                     glob.escape(basename) + '-_-*.hdf5')):
+        os.remove(processing_hdf5_path)
+    print(f"The native writer could not convert {basename} ({reason}). Falling back to the formatconverter...")
+    return False
+
+
+def parse_stp_xml(xml_path: str, writer) -> None:
+    """
+    Stream-parse a StpToolkit .XML file and add every vital sign and waveform record to the writer, removing parsed
+    elements from the tree so memory stays bounded regardless of the size of the file.
+
+    :param xml_path: String that is the path to the .XML file.
+    :type xml_path: str
+    :param writer: DailyHdf5Writer that the records are added to.
+    :type writer: DailyHdf5Writer
+    :return: None
+    :rtype: None
+    """
+
+    parents = []
+    open_records = 0
+    for parse_event, element in xml.etree.ElementTree.iterparse(xml_path, events=('start', 'end')):
+        if parse_event == 'start':
+            parents.append(element)
+            open_records += element.tag in RECORD_TAGS
+            continue
+
+        parents.pop()
+        open_records -= element.tag in RECORD_TAGS
+        if element.tag == 'VitalSigns':
+            time = parse_time(element)
+            for vital_sign in element.iter('VitalSign'):
+                value = vital_sign.find('Value')
+                name = vital_sign.findtext('Par')
+                if name and value is not None:
+                    writer.add('VitalSigns', name, time, parse_number(value.text), value.get('UOM'))
+        elif element.tag == 'Waveforms':
+            time = parse_time(element)
+            for waveform in element.iter('WaveformData'):
+                name = waveform.get('Channel') or waveform.get('Label')
+                if name and waveform.text:
+                    writer.add('Waveforms', name, time, numpy.fromstring(waveform.text, dtype=numpy.float64, sep=','),
+                               waveform.get('UOM'), waveform.get('SampleRate'))
+        elif open_records:
+            continue
+
+        # Drop the parsed element from its parent so the tree never grows
+        if parents:
+            parents[-1].remove(element)
+
+
+def parse_time(element: xml.etree.ElementTree.Element) -> int:
+    """
+    Get the collection time of a record in epoch milliseconds.
+
+    :param element: xml.etree.ElementTree.Element of the VitalSigns or Waveforms record.
+    :type element: xml.etree.ElementTree.Element
+    :return: Integer that is the collection time in epoch milliseconds.
+    :rtype: int
+    """
+
+    text = element.get('CollectionTimeUTC') or element.get('CollectionTime') or element.get('Time')
+    if text is None:
+        raise ValueError(f'{element.tag} record without a collection time')
+
+    text = text.strip()
+    if text.isdigit():
+        return int(text) * 1000
+    try:
+        time = datetime.datetime.fromisoformat(text.replace('Z', '+00:00'))
+    except ValueError:
+        time = datetime.datetime.strptime(text, '%m/%d/%Y %H:%M:%S')
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=datetime.timezone.utc)
+
+    return int(time.timestamp() * 1000)
+
+
+def parse_number(text: [str, None]) -> float:
+    """
+    Get the value of a vital sign, which is NaN if it is missing or not a number, e.g. '---'.
+
+    :param text: String that is the text of the value or None.
+    :type text: [str, None]
+    :return: Float that is the value.
+    :rtype: float
+    """
+
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+class DailyHdf5Writer:
+    """
+    Buffers the records of every signal and appends them to one .HDF5 file per offset day, or a single .HDF5 file, in
+    the Processing folder.
+
+    Buffers are flushed every FLUSH_SIZE values, so memory use depends on the number of signals but not on the size of
+    the .XML file. The offset is applied to whole buffers of times at once and the days are split with NumPy.
+    """
+
+    def __init__(self, folder: str, basename: str, offset: int, single_file: bool) -> None:
+        """
+        :param folder: String that is the path to the folder to create the .HDF5 file(s) in.
+        :type folder: str
+        :param basename: String that is the basename (filename w/o extension) of the .STP file.
+        :type basename: str
+        :param offset: Integer that is the de-identification offset in seconds that is subtracted from every time.
+        :type offset: int
+        :param single_file: Boolean that is True to create a single .HDF5 file instead of one per day.
+        :type single_file: bool
+        """
+
+        self.folder = folder
+        self.basename = basename
+        self.offset_milliseconds = offset * 1000
+        self.single_file = single_file
+        self.records = 0
+
+        # Dictionary of (group, name) to the buffered times, points per record, values, and attributes of the signal
+        self.buffers = {}
+
+        # Dictionary of offset day (or None for a single file) to the open h5py.File
+        self.files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        try:
+            if exc_info[0] is None:
+                for key in list(self.buffers):
+                    self.flush(key)
+        finally:
+            for hdf5_file in self.files.values():
+                hdf5_file.close()
+
+    def add(self, group: str, name: str, time: int, values, unit: [str, None] = None,
+            sample_rate: [str, None] = None) -> None:
+        """
+        Add a record of a signal.
+
+        :param group: String that is the group of the signal, i.e. 'VitalSigns' or 'Waveforms'.
+        :type group: str
+        :param name: String that is the name of the signal.
+        :type name: str
+        :param time: Integer that is the identifiable collection time of the record in epoch milliseconds.
+        :type time: int
+        :param values: Float that is the value of a vital sign or numpy.ndarray of the samples of a waveform.
+        :type values: [float, numpy.ndarray]
+        :param unit: String that is the unit of measure of the signal or None.
+        :type unit: [str, None]
+        :param sample_rate: String that is the sample rate of the waveform or None.
+        :type sample_rate: [str, None]
+        :return: None
+        :rtype: None
+        """
+
+        key = (group, name)
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            buffer = self.buffers[key] = {'times': [], 'points': [], 'values': [], 'size': 0,
+                                          'attributes': {'Unit of Measure': unit or '', 'Sample Rate': sample_rate}}
+        points = len(values) if group == 'Waveforms' else 1
+        buffer['times'].append(time)
+        buffer['points'].append(points)
+        buffer['values'].append(values)
+        buffer['size'] += points
+        self.records += 1
+
+        if buffer['size'] >= FLUSH_SIZE:
+            self.flush(key)
+
+    def flush(self, key: tuple) -> None:
+        """
+        Append the buffered records of a signal to the .HDF5 file(s) of their offset days.
+
+        :param key: Tuple of the group and name of the signal.
+        :type key: tuple
+        :return: None
+        :rtype: None
+        """
+
+        buffer = self.buffers[key]
+        if not buffer['times']:
+            return
+
+        # Apply the offset to every time at once and find the offset day of every record and value
+        times = numpy.asarray(buffer['times'], dtype=numpy.int64) - self.offset_milliseconds
+        points = numpy.asarray(buffer['points'], dtype=numpy.int64)
+        if key[0] == 'Waveforms':
+            values = numpy.concatenate(buffer['values']).astype(numpy.float32)
+        else:
+            values = numpy.asarray(buffer['values'], dtype=numpy.float32)
+        record_days = times // MILLISECONDS_PER_DAY
+        value_days = numpy.repeat(record_days, points)
+
+        for day in ([None] if self.single_file else numpy.unique(record_days)):
+            if day is None:
+                record_mask = slice(None)
+                value_mask = slice(None)
+            else:
+                record_mask = record_days == day
+                value_mask = value_days == day
+            hdf5_file = self.file_for(day, int(times.min()) if day is None else int(day) * MILLISECONDS_PER_DAY)
+            group = hdf5_file.require_group(f'{key[0]}/{key[1]}')
+            append(group, 'time', times[record_mask], buffer['attributes'])
+            append(group, 'data', values[value_mask], buffer['attributes'])
+            if key[0] == 'Waveforms':
+                append(group, 'points', points[record_mask], buffer['attributes'])
+
+        buffer.update(times=[], points=[], values=[], size=0)
+
+    def file_for(self, day: [int, None], start_time: int) -> 'h5py.File':
+        """
+        Get the open .HDF5 file of an offset day, creating it with the formatconverter naming on first use.
+
+        :param day: Integer that is the number of offset days since 1970/01/01 or None for a single file.
+        :type day: [int, None]
+        :param start_time: Integer that is the offset time in epoch milliseconds whose date names the file.
+        :type start_time: int
+        :return: h5py.File of the day.
+        :rtype: h5py.File
+        """
+
+        hdf5_file = self.files.get(day)
+        if hdf5_file is None:
+            date = datetime.datetime(1970, 1, 1) + datetime.timedelta(milliseconds=start_time)
+            path = os.path.join(self.folder, f'{self.basename}-_-{date:%Y-%m-%d}.hdf5')
+            hdf5_file = self.files[day] = h5py.File(path, 'w')
+            hdf5_file.attrs['Source Reader'] = 'AutoSTPtoHDF5Converter native writer'
+            hdf5_file.attrs['Timezone'] = 'UTC'
+        return hdf5_file
+
+
+def append(group: 'h5py.Group', name: str, data, attributes: dict) -> None:
+    """
+    Append data to a chunked, compressed, resizable dataset of a group, creating it on first use.
+
+    :param group: h5py.Group of the signal.
+    :type group: h5py.Group
+    :param name: String that is the name of the dataset.
+    :type name: str
+    :param data: numpy.ndarray of the data to append.
+    :type data: numpy.ndarray
+    :param attributes: Dictionary of the attributes of the signal that are added to a new 'data' dataset.
+    :type attributes: dict
+    :return: None
+    :rtype: None
+    """
+
+    if name not in group:
+        dataset = group.create_dataset(name, shape=(0,), maxshape=(None,), dtype=data.dtype, chunks=(CHUNK_SIZE,),
+                                       compression='gzip', compression_opts=COMPRESSION_LEVEL, shuffle=True)
+        if name == 'data':
+            for attribute, value in attributes.items():
+                if value is not None:
+                    dataset.attrs[attribute] = value
+
+    if not len(data):
+        return
+
+    dataset = group[name]
+    dataset.resize((dataset.shape[0] + len(data),))
+    dataset[-len(data):] = data
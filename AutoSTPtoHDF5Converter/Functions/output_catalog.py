@@ -0,0 +1,252 @@
+"""
+Author: Ayush Doshi
+
+Contains the "OutputCatalog" class that records every de-identified .HDF5 file moved to Output\Success, and the
+per-patient virtual .HDF5 files that stitch the daily .HDF5 files of a patient together.
+"""
+
+import argparse
+import functools
+import os
+import sqlite3
+
+import pandas
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+# h5py is only needed to read the time range and channels of the .HDF5 files and to create virtual datasets, so it is
+# optional
+VIRTUAL_DATASETS_AVAILABLE = h5py is not None
+
+# Groups of the .HDF5 files whose sub-groups are the channels
+CHANNEL_GROUPS = ('VitalSigns', 'Waveforms')
+
+
+class OutputCatalog:
+    """
+    Records the patient, bed, de-identified time range, channels, and size of every de-identified .HDF5 file, so the
+    files of a patient or of a time range can be found with a query instead of walking Output\Success and opening every
+    daily .HDF5 file.
+
+    The OutputFiles table has a row per .HDF5 file and the OutputChannels table a row per channel of a .HDF5 file with
+    its number of samples. Start and End are in the unit of the time datasets of the .HDF5 files, e.g. epoch
+    milliseconds, or the de-identified start of the .STP file in epoch milliseconds if the time range cannot be read.
+    """
+
+    def __init__(self, database_path: str) -> None:
+        """
+        :param database_path: String that is the path to the OutputCatalog SQLite database.
+        :type database_path: str
+        """
+
+        self.database_path = database_path
+
+        # Use write-ahead logging so researchers can query the catalog while new files are added
+        self.conn = sqlite3.connect(database_path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS "OutputFiles" ("Path" TEXT, "PatientID" TEXT, "Bed" TEXT, '
+                          '"STPFile" TEXT, "Start" INTEGER, "End" INTEGER, "Size" INTEGER, "WaveData" INTEGER, '
+                          'PRIMARY KEY("Path"))')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS "OutputFilesPatientStart" ON "OutputFiles" ("PatientID", '
+                          '"Start")')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS "OutputChannels" ("Path" TEXT, "Channel" TEXT, '
+                          '"Samples" INTEGER, PRIMARY KEY("Path", "Channel"))')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS "OutputChannelsChannel" ON "OutputChannels" ("Channel")')
+        self.conn.commit()
+
+    def add(self, files: list) -> None:
+        """
+        Record de-identified .HDF5 files in a single transaction, replacing earlier records of the same paths.
+
+        :param files: List of dictionaries that contain the Path, PatientID, Bed, STPFile, Start, End, Size, WaveData,
+        and Channels, which is a dictionary of channel to number of samples, of the de-identified .HDF5 files.
+        :type files: list
+        :return: None
+        :rtype: None
+        """
+
+        with self.conn:
+            self.conn.executemany('DELETE FROM OutputChannels WHERE Path = ?', ((file['Path'],) for file in files))
+            self.conn.executemany('INSERT OR REPLACE INTO OutputFiles (Path, PatientID, Bed, STPFile, Start, End, '
+                                  'Size, WaveData) VALUES (:Path, :PatientID, :Bed, :STPFile, :Start, :End, :Size, '
+                                  ':WaveData)', files)
+            self.conn.executemany('INSERT INTO OutputChannels (Path, Channel, Samples) VALUES (?, ?, ?)',
+                                  ((file['Path'], channel, samples) for file in files
+                                   for channel, samples in file['Channels'].items()))
+
+    def patient_files(self, patient_id: str) -> list:
+        """
+        Get the paths of the recorded .HDF5 files of a patient in the order of their start.
+
+        :param patient_id: String that is the patient ID.
+        :type patient_id: str
+        :return: List of the paths of the .HDF5 files of the patient that still exist.
+        :rtype: list
+        """
+
+        return [path for (path,) in self.conn.execute('SELECT Path FROM OutputFiles WHERE PatientID = ? '
+                                                      'ORDER BY Start, Path', (patient_id,)) if os.path.exists(path)]
+
+    def close(self) -> None:
+        """
+        Close the connection to the OutputCatalog database.
+
+        :return: None
+        :rtype: None
+        """
+
+        self.conn.close()
+
+
+@functools.lru_cache(maxsize=None)
+def get_output_catalog(database_path: str) -> OutputCatalog:
+    """
+    Get the output catalog for the database, opening it only once per process.
+
+    :param database_path: String that is the path to the OutputCatalog SQLite database.
+    :type database_path: str
+    :return: OutputCatalog for the database.
+    :rtype: OutputCatalog
+    """
+
+    return OutputCatalog(database_path)
+
+
+def describe_hdf5(hdf5_path: str) -> tuple:
+    """
+    Read the time range and the channels of an .HDF5 file, only touching the first and last element of every time
+    dataset.
+
+    :param hdf5_path: String that is the path to the .HDF5 file.
+    :type hdf5_path: str
+    :return: Tuple of the start and end time, which are None if they cannot be read, and a dictionary of channel to
+    number of samples.
+    :rtype: tuple
+    """
+
+    if h5py is None:
+        return None, None, {}
+
+    starts, ends, channels = [], [], {}
+    try:
+        with h5py.File(hdf5_path, 'r') as hdf5_file:
+            for group_name in CHANNEL_GROUPS:
+                group = hdf5_file.get(group_name)
+                if not isinstance(group, h5py.Group):
+                    continue
+                for channel_name, channel in group.items():
+                    if not isinstance(channel, h5py.Group):
+                        continue
+                    data = channel.get('data')
+                    channels[f'{group_name}/{channel_name}'] = data.shape[0] if isinstance(data, h5py.Dataset) else 0
+                    time = channel.get('time')
+                    if isinstance(time, h5py.Dataset) and time.shape and time.shape[0]:
+                        starts.append(int(time[0]))
+                        ends.append(int(time[-1]))
+    except OSError:
+        return None, None, {}
+
+    return (min(starts) if starts else None), (max(ends) if ends else None), channels
+
+
+def catalog_output_files(args: argparse.Namespace, files: pandas.DataFrame) -> None:
+    """
+    Record the de-identified .HDF5 files of this cycle in the output catalog and rebuild the virtual .HDF5 file of every
+    patient that got new files if desired.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param files: pandas.DataFrame that contains [EndPath, PatientID, Bed, Filename, Seconds] for the de-identified
+    .HDF5 files.
+    :type files: pandas.DataFrame
+    :return: None
+    :rtype: None
+    """
+
+    print("Cataloging the de-identified files...")
+
+    # Read the time range, channels, and size of every de-identified .HDF5 file and fall back to the de-identified
+    # start of the .STP file for the start
+    catalog_files = []
+    for file in files.loc[:, ['EndPath', 'PatientID', 'Bed', 'Filename', 'Seconds']].to_dict('records'):
+        start, end, channels = describe_hdf5(file['EndPath'])
+        if start is None:
+            start = int(file['Seconds']) * 1000
+        catalog_files.append({'Path': file['EndPath'], 'PatientID': file['PatientID'], 'Bed': file['Bed'],
+                              'STPFile': file['Filename'], 'Start': start, 'End': end,
+                              'Size': os.path.getsize(file['EndPath']), 'WaveData': int(args.wave_data),
+                              'Channels': channels})
+
+    catalog = get_output_catalog(args.output_catalog)
+    catalog.add(catalog_files)
+
+    # Stitch the daily .HDF5 files of every patient with new files together
+    if args.virtual_datasets:
+        for patient_id in dict.fromkeys(file['PatientID'] for file in catalog_files):
+            build_virtual_datasets(os.path.join(args.output, 'Success', patient_id), patient_id,
+                                   catalog.patient_files(patient_id))
+
+
+def build_virtual_datasets(patient_folder: str, patient_id: str, hdf5_paths: list) -> None:
+    """
+    Create the virtual .HDF5 file of a patient, whose datasets concatenate the datasets of the same channel in the
+    de-identified .HDF5 files of the patient without copying them, so a time range of the patient can be read from a
+    single file that only reads the chunks it needs.
+
+    :param patient_folder: String that is the path to the Output\Success folder of the patient.
+    :type patient_folder: str
+    :param patient_id: String that is the patient ID.
+    :type patient_id: str
+    :param hdf5_paths: List of the paths of the .HDF5 files of the patient in the order of their start.
+    :type hdf5_paths: list
+    :return: None
+    :rtype: None
+    """
+
+    # Collect the shape and dtype of every dataset of every channel in every file of the patient
+    sources = {}
+    for hdf5_path in hdf5_paths:
+        try:
+            with h5py.File(hdf5_path, 'r') as hdf5_file:
+                for group_name in CHANNEL_GROUPS:
+                    group = hdf5_file.get(group_name)
+                    if not isinstance(group, h5py.Group):
+                        continue
+                    for channel_name, channel in group.items():
+                        if not isinstance(channel, h5py.Group):
+                            continue
+                        for dataset_name, dataset in channel.items():
+                            if isinstance(dataset, h5py.Dataset) and dataset.shape:
+                                sources.setdefault(f'{group_name}/{channel_name}/{dataset_name}', []).append(
+                                    (os.path.basename(hdf5_path), dataset.shape, dataset.dtype))
+        except OSError:
+            print(f"Could not read {hdf5_path} for the virtual datasets of patient {patient_id}. Skipping it...")
+
+    if not sources:
+        return
+
+    # Write the virtual .HDF5 file next to the files it refers to by relative paths and replace the old one at once, so
+    # readers never see a partial file
+    virtual_path = os.path.join(patient_folder, f'UVA_{patient_id}_virtual.hdf5')
+    with h5py.File(virtual_path + '.tmp', 'w') as virtual_file:
+        for dataset_path, dataset_sources in sources.items():
+
+            # Only concatenate the files whose dataset has the same trailing shape as the first one
+            trailing_shape = dataset_sources[0][1][1:]
+            dataset_sources = [source for source in dataset_sources if source[1][1:] == trailing_shape]
+            layout = h5py.VirtualLayout(shape=(sum(shape[0] for _, shape, _ in dataset_sources),) + trailing_shape,
+                                        dtype=dataset_sources[0][2])
+            position = 0
+            for filename, shape, dtype in dataset_sources:
+                layout[position:position + shape[0]] = h5py.VirtualSource(filename, dataset_path, shape=shape,
+                                                                          dtype=dtype)
+                position += shape[0]
+            virtual_file.create_virtual_dataset(dataset_path, layout)
+
+        virtual_file.attrs['Source Files'] = [filename for filename in dict.fromkeys(
+            source[0] for dataset_sources in sources.values() for source in dataset_sources)]
+    os.replace(virtual_path + '.tmp', virtual_path)
@@ -0,0 +1,95 @@
+"""
+Author: Ayush Doshi
+
+Contains the "PatientOffsetResolver" class that looks up the PatientID and Offset of .STP files.
+"""
+
+import functools
+import sqlite3
+
+import pandas
+
+# Maximum number of filenames to look up with a single IN (...) query, which stays below the default SQLite limit on
+# the number of query parameters
+MAX_LOOKUP_PARAMETERS = 900
+
+
+class PatientOffsetResolver:
+    """
+    Keyed access to the PatientOffset table that only looks up the candidate filenames instead of reading the whole
+    table on every pass.
+
+    Results, including filenames that are not in the table, are cached in-process. The cache is cleared whenever
+    'PRAGMA data_version' shows that another connection, e.g. update_patient_database, committed a change to the
+    patient offset database.
+    """
+
+    def __init__(self, database_path: str) -> None:
+        """
+        :param database_path: String that is the path to the patient offset SQLite database.
+        :type database_path: str
+        """
+
+        self.database_path = database_path
+        self.conn = sqlite3.connect(database_path)
+        self.data_version = None
+
+        # Dictionary of filename to (PatientID, Offset) or None if the filename is not in the PatientOffset table
+        self.cache = {}
+
+    def resolve(self, filenames) -> pandas.DataFrame:
+        """
+        Get the PatientID and Offset of the .STP files that are in the PatientOffset table.
+
+        :param filenames: Iterable of .STP filenames to look up.
+        :type filenames: Iterable[str]
+        :return: pandas.DataFrame that contains [Filename, PatientID, Offset] for the filenames that were found.
+        :rtype: pandas.DataFrame
+        """
+
+        filenames = set(filenames)
+
+        # Clear the cache if the patient offset database changed since the last lookup
+        data_version = self.conn.execute('PRAGMA data_version').fetchone()[0]
+        if data_version != self.data_version:
+            self.cache.clear()
+            self.data_version = data_version
+
+        # Look up the filenames that are not cached yet in chunks against the STPFile key
+        unknown = [filename for filename in filenames if filename not in self.cache]
+        for i in range(0, len(unknown), MAX_LOOKUP_PARAMETERS):
+            chunk = unknown[i:i + MAX_LOOKUP_PARAMETERS]
+            self.cache.update(dict.fromkeys(chunk))
+            query = ('SELECT STPFile, PatientID, Offset FROM PatientOffset '
+                     f'WHERE STPFile IN ({", ".join("?" * len(chunk))})')
+            self.cache.update((filename, (patient_id, offset))
+                              for filename, patient_id, offset in self.conn.execute(query, chunk))
+
+        return pandas.DataFrame([(filename, *self.cache[filename]) for filename in filenames
+                                 if self.cache[filename] is not None],
+                                columns=['Filename', 'PatientID', 'Offset'])
+
+    def close(self) -> None:
+        """
+        Close the connection to the patient offset database.
+
+        :return: None
+        :rtype: None
+        """
+
+        self.conn.close()
+
+
+@functools.lru_cache(maxsize=None)
+def get_patient_offset_resolver(database_path: str) -> PatientOffsetResolver:
+    """
+    Get the patient offset resolver for the database, opening it only once per process so its cache stays warm across
+    passes.
+
+    :param database_path: String that is the path to the patient offset SQLite database.
+    :type database_path: str
+    :return: PatientOffsetResolver for the database.
+    :rtype: PatientOffsetResolver
+    """
+
+    return PatientOffsetResolver(database_path)
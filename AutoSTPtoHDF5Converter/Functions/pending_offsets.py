@@ -0,0 +1,136 @@
+"""
+Author: Ayush Doshi
+
+Contains the "PendingOffsetsIndex" class that keeps the .STP files that were skipped for missing patient information
+keyed by their filename, so an update of the patient offset database only requeues the files it has information for.
+"""
+
+import fnmatch
+import functools
+import os
+import sqlite3
+import time
+
+from .scan_index import STP_PATTERN
+
+# Path to the PendingOffsets database relative to the folder the AutoSTPtoHDF5Converter is run from
+PENDING_OFFSETS_DATABASE = os.path.join('AutoSTPtoHDF5Converter', 'PendingOffsets.db')
+
+# Maximum number of filenames to look up with a single IN (...) query, which stays below the default SQLite limit on
+# the number of query parameters
+MAX_LOOKUP_PARAMETERS = 900
+
+
+class PendingOffsetsIndex:
+    """
+    Keyed index of the .STP files in the Output\\Skipped\\NotInPatientDatabase folder with their sizes.
+
+    The index is reconciled with the folder once per process, which picks up files that were skipped before the index
+    existed or moved in by hand and forgets files that were removed, and is kept up to date as files are skipped and
+    requeued after that.
+    """
+
+    def __init__(self, database_path: str, skipped_folder: str) -> None:
+        """
+        :param database_path: String that is the path to the PendingOffsets SQLite database.
+        :type database_path: str
+        :param skipped_folder: String that is the path to the Output\\Skipped\\NotInPatientDatabase folder.
+        :type skipped_folder: str
+        """
+
+        self.skipped_folder = skipped_folder
+        self.reconciled = False
+
+        self.conn = sqlite3.connect(database_path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS "PendingOffsets" ("STPFile" TEXT PRIMARY KEY, "Size" INTEGER, '
+                          '"Skipped" REAL)')
+        self.conn.commit()
+
+    def add(self, files) -> None:
+        """
+        Record files that were moved to the skipped folder.
+
+        :param files: Iterable of (filename, size) tuples of the skipped .STP files.
+        :type files: Iterable[tuple]
+        :return: None
+        :rtype: None
+        """
+
+        now = time.time()
+        self.conn.executemany('INSERT OR REPLACE INTO PendingOffsets VALUES (?, ?, ?)',
+                              ((filename, size, now) for filename, size in files))
+        self.conn.commit()
+
+    def remove(self, filenames: list) -> None:
+        """
+        Forget files that were moved out of the skipped folder.
+
+        :param filenames: List of the filenames of the .STP files.
+        :type filenames: list
+        :return: None
+        :rtype: None
+        """
+
+        self.conn.executemany('DELETE FROM PendingOffsets WHERE STPFile = ?', ((filename,) for filename in filenames))
+        self.conn.commit()
+
+    def reconcile(self) -> None:
+        """
+        Make the index match the skipped folder with a single listing of the folder.
+
+        :return: None
+        :rtype: None
+        """
+
+        skipped_files = {}
+        if os.path.isdir(self.skipped_folder):
+            with os.scandir(self.skipped_folder) as entries:
+                for entry in entries:
+                    if entry.is_file() and fnmatch.fnmatch(entry.name, STP_PATTERN):
+                        skipped_files[entry.name] = entry.stat().st_size
+
+        indexed_files = {row[0] for row in self.conn.execute('SELECT STPFile FROM PendingOffsets')}
+        self.add((filename, size) for filename, size in skipped_files.items() if filename not in indexed_files)
+        self.remove([filename for filename in indexed_files if filename not in skipped_files])
+        self.reconciled = True
+
+    def match(self, filenames) -> dict:
+        """
+        Get the skipped files out of the candidates, e.g. the STPFile column of a patient offset update.
+
+        :param filenames: Iterable of .STP filenames to look up.
+        :type filenames: Iterable[str]
+        :return: Dictionary of the filename to the size of every candidate that is in the skipped folder.
+        :rtype: dict
+        """
+
+        if not self.reconciled:
+            self.reconcile()
+
+        # Look up the candidates in chunks against the STPFile key
+        candidates = list(set(filenames))
+        matches = {}
+        for i in range(0, len(candidates), MAX_LOOKUP_PARAMETERS):
+            chunk = candidates[i:i + MAX_LOOKUP_PARAMETERS]
+            matches.update(self.conn.execute(
+                f'SELECT STPFile, Size FROM PendingOffsets WHERE STPFile IN ({", ".join("?" * len(chunk))})', chunk))
+
+        return matches
+
+
+@functools.lru_cache(maxsize=None)
+def get_pending_offsets_index(output_folder: str,
+                              database_path: str = PENDING_OFFSETS_DATABASE) -> PendingOffsetsIndex:
+    """
+    Get the index of the files skipped for missing patient information, opening it only once per process.
+
+    :param output_folder: String that is the path to the output folder.
+    :type output_folder: str
+    :param database_path: String that is the path to the PendingOffsets SQLite database.
+    :type database_path: str
+    :return: PendingOffsetsIndex of the Output\\Skipped\\NotInPatientDatabase folder.
+    :rtype: PendingOffsetsIndex
+    """
+
+    return PendingOffsetsIndex(database_path, os.path.join(output_folder, 'Skipped', 'NotInPatientDatabase'))
@@ -0,0 +1,385 @@
+"""
+Author: Ayush Doshi
+
+Contains the "run_pipeline" function as well as necessary subfunctions.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import os
+import time
+
+import pandas
+
+from .concurrency_controller import create_concurrency_controller
+from .conversion_tools import cleanup
+from .convert_files import concurrency_limit, create_conversion_executor, get_converter, handle_conversion_result, \
+    max_concurrent_conversions, update_queue_gauges
+from .deidentify_file_names import deidentify_file_names
+from .file_watcher import FileWatcher
+from .find_files import get_stable_files, remove_completed_files, scan_input_files
+from .job_monitor import CHECK_INTERVAL, ConversionPreempted, preempt_conversion
+from .lease_queue import FileClaimed
+from .merge_files_w_patient_info import merge_files_w_patient_info
+from .metrics import count
+from .scheduling import order_work_queue
+from .staging import Prefetcher, create_prefetcher
+from .update_completed_files_database import update_completed_files_database
+from .update_patient_database import update_patient_database
+from .wave_backlog import get_wave_backlog, locate_wave_file, tier_args
+
+
+def run_pipeline(args: argparse.Namespace, watcher: [FileWatcher, None] = None) -> None:
+    """
+    Continuously find, convert, de-identify, and record .STP files as a streaming pipeline. Unlike the batch cycle,
+    file searches keep feeding a bounded work queue while conversions are running, and each file is de-identified,
+    moved to Output\Success, and added to the CompletedFiles database as soon as its own conversion finishes.
+
+    With tiered, every file is first converted without wave data and then queued in the WaveBacklog, whose conversions
+    with wave data only get the conversion slots that no waiting file needs and are preempted once files wait again.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param watcher: FileWatcher that releases individual files as soon as they settle or None to compare searches
+    that are retry_filesearch_time apart.
+    :type watcher: [FileWatcher, None]
+    :return: None
+    :rtype: None
+    """
+
+    # Default the size of the work queue to twice the number of cores so there is always a file ready to start
+    queue_size = args.queue_size if args.queue_size else 2 * args.cores
+
+    # Create the pending files that are ready to be converted but do not fit into the work queue yet, the work queue of
+    # files that are ready to be converted, a dictionary of running conversion future jobs to their file information,
+    # and a set of the paths that are either pending, queued, or running
+    pending_files = collections.deque()
+    work_queue = collections.deque()
+    running = {}
+    claimed_paths = set()
+
+    # Convert the vital signs of every file first and its wave data in the background if desired based on the user
+    # arguments, keeping the files that wait for their wave data from being found again
+    vitals_args = tier_args(args, False) if args.tiered else args
+    wave_args = tier_args(args, True) if args.tiered else None
+    if args.tiered:
+        claimed_paths.update(file['Path'] for file in get_wave_backlog().take(len(get_wave_backlog()), set()))
+
+    # Keep the results of the previous file search to check for files that did not change in size
+    previous_files = None
+    last_search_time = None
+
+    # Stage the queued files into the scratch folder ahead of their conversions if desired based on the user arguments
+    prefetcher = create_prefetcher(args)
+
+    # Adjust the number of concurrent conversions to the load of the host if desired based on the user arguments
+    controller = create_concurrency_controller(args, max_concurrent_conversions(args))
+
+    # Create a concurrent.futures executor for the conversion engine that lives for the whole pipeline
+    with create_conversion_executor(args) as executor:
+
+        # Save the start time of the pipeline and create a counter of the conversion outcomes to log progress
+        global_start_time = time.time()
+        counts = collections.Counter()
+
+        print("Starting conversion pipeline...")
+
+        while True:
+
+            # Search for new files if the file search retry time has passed since the last search
+            if last_search_time is None or time.time() - last_search_time >= args.retry_filesearch_time:
+
+                # Check for patient database update .CSV and queue the skipped files whose patient information arrived
+                # right away, since they were already stable when they were skipped
+                if args.database_update:
+                    requeued_files = update_patient_database(args)
+                    if not requeued_files.empty:
+                        queue_files(args, requeued_files, pending_files, claimed_paths)
+
+                # Without a file watcher, files are ready once their size did not change since the previous search
+                if watcher is None:
+                    previous_files, stable_files = search_for_files(args, previous_files)
+                    queue_files(args, stable_files, pending_files, claimed_paths)
+                last_search_time = time.time()
+
+            # With a file watcher, queue the files that settled since the last check
+            if watcher is not None and len(pending_files) + len(work_queue) < queue_size:
+                settled_files = pandas.DataFrame(watcher.poll(queue_size - len(pending_files) - len(work_queue)),
+                                                 columns=['Path', 'Size'])
+                queue_files(args, settled_files, pending_files, claimed_paths)
+
+            # Refill the work queue from the pending files, which happens every time a conversion finishes, and submit
+            # files from the work queue until every conversion slot is in use
+            top_up_work_queue(args, pending_files, work_queue, queue_size, prefetcher)
+            max_running = concurrency_limit(args, controller, len(running) + len(work_queue) + len(pending_files))
+            while work_queue and len(running) < max_running:
+                file = work_queue.popleft()
+                future = executor.submit(get_converter(args), file['Path'], file['Filename'], file['Offset'],
+                                         vitals_args)
+                running[future] = file
+
+            # Preempt conversions with wave data while files wait for a slot and give the idle slots to them otherwise
+            if args.tiered:
+                schedule_wave_conversions(wave_args, executor, running, work_queue, max_running, claimed_paths)
+            update_queue_gauges(len(running), len(work_queue) + len(pending_files), max_running)
+
+            # Wait until a conversion finishes, the next file search is due, the file watcher should be checked, or the
+            # controller samples the host again
+            wait_time = max(0.0, args.retry_filesearch_time - (time.time() - last_search_time))
+            if watcher is not None:
+                wait_time = min(wait_time, watcher.poll_interval)
+            if controller is not None:
+                wait_time = min(wait_time, controller.interval)
+            if any(file.get('Preempted') for file in running.values()):
+                wait_time = min(wait_time, CHECK_INTERVAL)
+            if not running:
+                time.sleep(wait_time)
+                continue
+            done, _ = concurrent.futures.wait(running, timeout=wait_time,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+
+            # De-identify and record each finished file on its own without waiting for the rest, keeping the paths of
+            # preempted files claimed since they stay queued in the WaveBacklog
+            for future in done:
+                file = running.pop(future)
+                if prefetcher is not None:
+                    prefetcher.release(file['Filename'])
+                if file.get('Wave'):
+                    if finish_wave_conversion(wave_args, future, file, counts, global_start_time):
+                        claimed_paths.discard(file['Path'])
+                    continue
+                claimed_paths.discard(file['Path'])
+                if handle_conversion_result(vitals_args, future, file['Path'], counts, global_start_time):
+                    finish_file(vitals_args, file)
+
+                    # Queue the file for its conversion with wave data and keep it in the Input folder until then
+                    if args.tiered:
+                        get_wave_backlog().add(file)
+                        claimed_paths.add(file['Path'])
+
+            if done:
+                update_queue_gauges(len(running), len(work_queue) + len(pending_files), max_running)
+                print(f"{len(running)} conversion(s) running and {len(work_queue) + len(pending_files)} file(s) "
+                      f"queued...")
+
+
+def schedule_wave_conversions(args: argparse.Namespace, executor: concurrent.futures.Executor, running: dict,
+                              work_queue: collections.deque, max_running: int, claimed_paths: set) -> None:
+    """
+    Preempt the most recently started conversions with wave data, which lose the least work, until every file in the
+    work queue has a conversion slot to go to, or start the oldest files of the WaveBacklog in the slots that no file in
+    the work queue needs.
+
+    :param args: argparse.Namespace that contains the arguments of the wave data tier.
+    :type args: argparse.Namespace
+    :param executor: concurrent.futures.Executor of the conversion engine.
+    :type executor: concurrent.futures.Executor
+    :param running: Dictionary of running conversion future jobs to their file information, which is updated in place.
+    :type running: dict
+    :param work_queue: collections.deque of files that are waiting to be converted.
+    :type work_queue: collections.deque
+    :param max_running: Integer that is the number of conversions that may run at once.
+    :type max_running: int
+    :param claimed_paths: Set of paths that are queued or being converted, which is updated in place.
+    :type claimed_paths: set
+    :return: None
+    :rtype: None
+    """
+
+    wave_files = [file for file in running.values() if file.get('Wave')]
+
+    # Ask the conversions to stop again on every check, since a conversion deletes its leftovers in the Processing
+    # folder when it starts
+    preempting = sum(1 for file in wave_files if file.get('Preempted'))
+    for file in reversed(wave_files):
+        if not file.get('Preempted') and preempting < len(work_queue):
+            print(f"Preempting the conversion with wave data of {file['Filename']} for waiting files...")
+            file['Preempted'] = True
+            preempting += 1
+        if file.get('Preempted'):
+            preempt_conversion(os.path.splitext(file['Filename'])[0])
+
+    if work_queue or len(running) >= max_running:
+        return
+
+    # Start the oldest queued files that can still be found, dropping the ones that were moved or deleted since
+    backlog = get_wave_backlog()
+    for file in backlog.take(max_running - len(running), {file['Filename'] for file in wave_files}):
+        path = locate_wave_file(args, file)
+        if path is None:
+            print(f"{file['Filename']} cannot be found anymore. Dropping its conversion with wave data.")
+            backlog.remove(file['Filename'])
+            continue
+
+        file.update(Path=path, Wave=True)
+        claimed_paths.add(path)
+        running[executor.submit(get_converter(args), path, file['Filename'], file['Offset'], args)] = file
+
+
+def finish_wave_conversion(args: argparse.Namespace, future: concurrent.futures.Future, file: dict,
+                           counts: collections.Counter, global_start_time: float) -> bool:
+    """
+    Handle the outcome of a conversion with wave data, leaving preempted files in the WaveBacklog to be started over
+    and failed files where they are, since their vital signs were converted.
+
+    :param args: argparse.Namespace that contains the arguments of the wave data tier.
+    :type args: argparse.Namespace
+    :param future: concurrent.futures.Future of the conversion.
+    :type future: concurrent.futures.Future
+    :param file: Dictionary that contains the Path, Filename, Size, PatientID, and Offset of the .STP file.
+    :type file: dict
+    :param counts: collections.Counter of the conversion outcomes that is updated in place.
+    :type counts: collections.Counter
+    :param global_start_time: Float that is the epoch time in seconds when the conversions started.
+    :type global_start_time: float
+    :return: Boolean that is True if the file left the WaveBacklog and False if it was preempted and stays queued.
+    :rtype: bool
+    """
+
+    # Delete the partial outputs and the preemption marker of a preempted conversion right away instead of when it is
+    # started over, as well as the marker of a conversion that finished before it noticed it
+    if file.get('Preempted'):
+        cleanup(os.path.splitext(file['Filename'])[0])
+    if isinstance(future.exception(), ConversionPreempted):
+        count('stp_preemptions_total')
+        print(f"{file['Filename']} was preempted and stays queued for its conversion with wave data.")
+        return False
+
+    # Only mark the file as failed in the WaveBacklog, so it is not started again, instead of moving the .STP file to
+    # Output\Failed
+    backlog = get_wave_backlog()
+    if handle_conversion_result(args, future, file['Path'], counts, global_start_time, move_failed=False):
+        backlog.remove(file['Filename'])
+        finish_file(args, file)
+    elif isinstance(future.exception(), FileClaimed):
+        backlog.remove(file['Filename'])
+    else:
+        backlog.fail(file['Filename'])
+        print(f"The conversion with wave data of {file['Filename']} failed. It stays in "
+              f"{os.path.dirname(file['Path'])} and is marked as failed in the WaveBacklog.")
+
+    return True
+
+
+def search_for_files(args: argparse.Namespace, previous_files: [pandas.DataFrame, None]) -> tuple:
+    """
+    Search the input folder once and get the files that did not change in size since the previous search.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param previous_files: pandas.DataFrame that contains [Path, Size] from the previous search or None.
+    :type previous_files: [pandas.DataFrame, None]
+    :return: Tuple of pandas.DataFrame that contains [Path, Size] from this search and pandas.DataFrame that contains
+    [Path, Size] for the files that did not change in size.
+    :rtype: tuple
+    """
+
+    # Recursively find the .STP files in the input folder and their file sizes
+    current_files = scan_input_files(args)
+
+    # Nothing can be considered stable on the first search
+    if previous_files is None:
+        return current_files, pandas.DataFrame(columns=['Path', 'Size'])
+
+    # Get the files that did not change in size since the previous search
+    stable_files = get_stable_files(previous_files.rename(columns={'Size': 'Initial Size'}),
+                                    current_files.rename(columns={'Size': 'Final Size'}))
+    stable_files = stable_files.rename(columns={'Final Size': 'Size'}).loc[:, ['Path', 'Size']]
+
+    return current_files, stable_files
+
+
+def queue_files(args: argparse.Namespace, files: pandas.DataFrame, pending_files: collections.deque,
+                claimed_paths: set) -> None:
+    """
+    Add the files that are ready to be converted, have not already been converted, and have patient information to the
+    pending files, which are moved to the work queue by top_up_work_queue as it has space.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param files: pandas.DataFrame that contains [Path, Size] for the files that are ready to be converted.
+    :type files: pandas.DataFrame
+    :param pending_files: collections.deque of files that wait for space in the work queue, which is updated in place.
+    :type pending_files: collections.deque
+    :param claimed_paths: Set of paths that are pending, queued, or being converted, which is updated in place.
+    :type claimed_paths: set
+    :return: None
+    :rtype: None
+    """
+
+    # Skip files that are already pending, queued, or running
+    files = files.loc[~files['Path'].isin(claimed_paths)]
+    if files.empty:
+        return
+
+    # Move files that were already converted or do not have patient information to the skipped output folders
+    files = files.assign(Filename=files['Path'].apply(os.path.basename))
+    new_files = merge_files_w_patient_info(args, remove_completed_files(args, files))
+
+    if not new_files.empty:
+        print(f"Found {len(new_files)} new file(s) ready to be converted!")
+
+    # Add the new files to the pending files and keep them in the order of the scheduling policy
+    for file in new_files.loc[:, ['Path', 'Filename', 'Size', 'PatientID', 'Offset']].to_dict('records'):
+        pending_files.append(file)
+        claimed_paths.add(file['Path'])
+    order_work_queue(args, pending_files)
+
+
+def top_up_work_queue(args: argparse.Namespace, pending_files: collections.deque, work_queue: collections.deque,
+                      queue_size: int, prefetcher: [Prefetcher, None] = None) -> None:
+    """
+    Move the first pending files into the work queue until it is full.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param pending_files: collections.deque of files that wait for space in the work queue, which is updated in place.
+    :type pending_files: collections.deque
+    :param work_queue: collections.deque of files that are waiting to be converted, which is updated in place.
+    :type work_queue: collections.deque
+    :param queue_size: Integer that is the maximum number of files that can wait in the work queue.
+    :type queue_size: int
+    :param prefetcher: Prefetcher that stages the queued files into the scratch folder or None.
+    :type prefetcher: [Prefetcher, None]
+    :return: None
+    :rtype: None
+    """
+
+    new_files = []
+    while pending_files and len(work_queue) + len(new_files) < queue_size:
+        new_files.append(pending_files.popleft())
+    if not new_files:
+        return
+
+    # Add the files to the work queue and keep the work queue in the order of the scheduling policy
+    work_queue.extend(new_files)
+    order_work_queue(args, work_queue)
+
+    # Stage the new files into the scratch folder ahead of their conversions
+    if prefetcher is not None:
+        prefetcher.add([(file['Path'], file['Filename'], file['Size']) for file in new_files])
+
+
+def finish_file(args: argparse.Namespace, file: dict) -> None:
+    """
+    De-identify the converted .HDF5 file(s) of a single .STP file, move them to Output\Success, and add the .STP file to
+    the CompletedFiles database.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param file: Dictionary that contains the Path, Filename, Size, PatientID, and Offset of the converted .STP file.
+    :type file: dict
+    :return: None
+    :rtype: None
+    """
+
+    # De-identify the names of the .HDF5 file(s) that belong to this .STP file and move them to Output\Success
+    unique_completed_files_list = deidentify_file_names(args, pandas.DataFrame([file]))
+
+    # If no .HDF5 files were found for the .STP file, there is nothing to record
+    if not unique_completed_files_list:
+        return
+
+    # Update the completed files database
+    update_completed_files_database(args, unique_completed_files_list)
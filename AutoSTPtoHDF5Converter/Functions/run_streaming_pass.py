@@ -0,0 +1,179 @@
+"""
+Author: Ayush Doshi
+
+Contains the "run_streaming_pass" function as well as necessary subfunctions.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import itertools
+import os
+import time
+
+import pandas
+
+from .concurrency_controller import create_concurrency_controller
+from .convert_files import concurrency_limit, create_conversion_executor, get_converter, handle_conversion_result, \
+    max_concurrent_conversions, update_queue_gauges
+from .deidentify_file_names import deidentify_file_names
+from .find_files import find_file_chunks
+from .merge_files_w_patient_info import merge_files_w_patient_info
+from .scheduling import order_files
+from .staging import create_prefetcher
+from .update_completed_files_database import update_completed_files_database
+
+
+def run_streaming_pass(args: argparse.Namespace, ready_files: [pandas.DataFrame, None] = None) -> int:
+    """
+    Run a single pass over the input folder as a stream of chunks: the first chunk of ready files is converted while the
+    rest of the input folder is still being walked, and each chunk is de-identified and recorded as soon as all of its
+    conversions finished. At most chunk_size files beyond the running conversions are held in memory, no matter how many
+    files are in the input folder.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param ready_files: pandas.DataFrame that contains [Path, Filename, Size] for files that are known to be ready,
+    e.g. skipped files that were moved back to the input folder, which are converted as the first chunk, or None.
+    :type ready_files: [pandas.DataFrame, None]
+    :return: Integer that is the number of files that were submitted for conversion.
+    :rtype: int
+    """
+
+    print("Searching for files and converting them as they are found...")
+
+    file_chunks = find_file_chunks(args, args.chunk_size)
+
+    # Convert the files that are known to be ready first and leave them out of the chunks the walk finds
+    if ready_files is not None and not ready_files.empty:
+        ready_paths = set(ready_files['Path'])
+        new_chunks = (files.loc[~files['Path'].isin(ready_paths)] for files in file_chunks)
+        file_chunks = itertools.chain([ready_files], (files for files in new_chunks if not files.empty))
+
+    # Associate every chunk of new files to Patient ID and Offset for de-identification, lazily as the chunks are needed
+    chunks = (merge_files_w_patient_info(args, files) for files in file_chunks)
+
+    return convert_chunks(args, chunks)
+
+
+def convert_chunks(args: argparse.Namespace, chunks, finish=None) -> int:
+    """
+    Convert a stream of chunks of files, taking the next chunk only while fewer than a chunk of files wait behind the
+    running conversions, and finish every chunk as soon as all of its conversions finished.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param chunks: Iterable of pandas.DataFrame that contains [Path, Filename, Size, PatientID, Offset] for the files of
+    each chunk, which is only advanced when the next chunk is needed.
+    :type chunks: Iterable[pandas.DataFrame]
+    :param finish: Function that is called with args and the files of every chunk once all of its conversions finished
+    or None to de-identify and record them with finish_chunk.
+    :type finish: [Callable, None]
+    :return: Integer that is the number of files that were submitted for conversion.
+    :rtype: int
+    """
+
+    if finish is None:
+        finish = finish_chunk
+    chunks = iter(chunks)
+
+    # Create a queue of the files of the taken chunks that were not submitted yet, a dictionary of running conversion
+    # future jobs to the number of their chunk and the path of their file, and a dictionary of the number of every
+    # unfinished chunk to its files and the number of its unfinished conversions
+    queued_files = collections.deque()
+    running = {}
+    unfinished_chunks = {}
+    submitted = 0
+
+    # Stage the files into the scratch folder ahead of their conversions if desired based on the user arguments
+    prefetcher = create_prefetcher(args)
+
+    # Adjust the number of concurrent conversions to the load of the host if desired based on the user arguments
+    controller = create_concurrency_controller(args, max_concurrent_conversions(args))
+
+    with create_conversion_executor(args) as executor:
+
+        # Save the start time of the pass and create a counter of the conversion outcomes to log progress
+        global_start_time = time.time()
+        counts = collections.Counter()
+
+        chunk_number = 0
+        walking = True
+        while walking or queued_files or running:
+            max_running = concurrency_limit(args, controller, len(running) + len(queued_files))
+
+            # Take the next chunk while fewer than a chunk of files wait behind the running conversions, so the walk
+            # never gets far ahead of the conversions
+            while walking and len(running) + len(queued_files) < max_running + args.chunk_size:
+                files = next(chunks, None)
+                if files is None:
+                    walking = False
+                    break
+                if files.empty:
+                    continue
+
+                print(f"Found {len(files)} new file(s) ready to be converted!")
+
+                # Queue the files of the chunk in the order of the scheduling policy chosen by the user
+                chunk_number += 1
+                files = order_files(args, files)
+                unfinished_chunks[chunk_number] = [files, len(files)]
+                if prefetcher is not None:
+                    prefetcher.add(list(files.loc[:, ['Path', 'Filename', 'Size']].itertuples(index=False, name=None)))
+                queued_files.extend((chunk_number, path, filename, offset) for path, filename, offset
+                                    in files.loc[:, ['Path', 'Filename', 'Offset']].itertuples(index=False, name=None))
+                submitted += len(files)
+
+            # Submit queued files until every conversion slot is in use
+            while queued_files and len(running) < max_running:
+                number, path, filename, offset = queued_files.popleft()
+                future = executor.submit(get_converter(args), path, filename, offset, args)
+                running[future] = (number, path)
+            update_queue_gauges(len(running), len(queued_files), max_running)
+
+            if not running:
+                continue
+
+            # Wait until a conversion finishes, or until the controller samples the host again, and handle its outcome
+            done, _ = concurrent.futures.wait(running, timeout=controller.interval if controller else None,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                number, path = running.pop(future)
+                handle_conversion_result(args, future, path, counts, global_start_time)
+                if prefetcher is not None:
+                    prefetcher.release(os.path.basename(path))
+
+                # De-identify and record the chunk once all of its conversions finished
+                unfinished_chunks[number][1] -= 1
+                if not unfinished_chunks[number][1]:
+                    finish(args, unfinished_chunks.pop(number)[0])
+
+    # Delete the staged files that were not taken
+    if prefetcher is not None:
+        prefetcher.close()
+
+    return submitted
+
+
+def finish_chunk(args: argparse.Namespace, files: pandas.DataFrame) -> None:
+    """
+    De-identify the converted .HDF5 files of a chunk of .STP files, move them to Output\Success, and add the .STP files
+    to the CompletedFiles database.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param files: pandas.DataFrame that contains [Path, Filename, Size, PatientID, Offset] for the files of the chunk.
+    :type files: pandas.DataFrame
+    :return: None
+    :rtype: None
+    """
+
+    # De-identify the names of the .HDF5 files that belong to the chunk and move them to Output\Success
+    unique_completed_files_list = deidentify_file_names(args, files)
+
+    # If no .HDF5 files were found for the chunk, e.g. because all of its conversions failed, there is nothing to record
+    if not unique_completed_files_list:
+        return
+
+    # Update the completed files database
+    update_completed_files_database(args, unique_completed_files_list)
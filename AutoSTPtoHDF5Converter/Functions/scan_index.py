@@ -0,0 +1,266 @@
+"""
+Author: Ayush Doshi
+
+Contains the "ScanIndex" class that incrementally searches huge input folders for .STP files.
+"""
+
+import fnmatch
+import functools
+import os
+import sqlite3
+import time
+
+# Pattern of the .STP files to search for, which matches the pattern used by the recursive glob in find_files
+STP_PATTERN = '*.?tp'
+
+# Number of seconds in which a directory modification time is considered too recent to trust, as changes made within
+# the resolution of the file system timestamps would not change the modification time again
+MTIME_RESOLUTION = 2
+
+
+class ScanIndex:
+    """
+    Persistent index of the directories and .STP files in the input folder that makes repeated recursive searches
+    incremental.
+
+    A directory is only listed again when its modification time changed, which happens whenever a file or sub-folder is
+    created, removed, or renamed in it. Every directory is still checked with a single stat, as changes to a sub-folder
+    do not change the modification time of its parent. Files in unchanged directories are only stat'ed again while their
+    last known modification time is within the restat window, i.e. while they may still be being copied; the rest reuse
+    their indexed size and modification time.
+    """
+
+    def __init__(self, index_path: str, input_folder: str, restat_window: float = 60 * 60) -> None:
+        """
+        :param index_path: String that is the path to the SQLite database that stores the index.
+        :type index_path: str
+        :param input_folder: String that is the path to the folder to recursively search for .STP files, which is not
+        normalized so the found paths match the paths that are joined from it elsewhere.
+        :type input_folder: str
+        :param restat_window: Float that is the number of seconds since their last modification during which files in
+        unchanged directories are still stat'ed again.
+        :type restat_window: float
+        """
+
+        self.index_path = index_path
+        self.input_folder = input_folder.rstrip(os.sep + (os.altsep or '')) or input_folder
+        self.restat_window = restat_window
+
+        # Dictionary of directory path to its modification time and dictionary of directory path to a dictionary of
+        # filename to (size, modification time) for the .STP files in it
+        self.directory_mtimes = {}
+        self.directory_files = {}
+
+        # Dictionary of directory path to a set of its sub-folder paths
+        self.sub_directories = {}
+
+        conn = self.connect()
+        conn.execute('CREATE TABLE IF NOT EXISTS Directories (Path TEXT PRIMARY KEY, Parent TEXT, Mtime REAL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS Files (Path TEXT PRIMARY KEY, Directory TEXT, Size INTEGER, '
+                     'Mtime REAL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS FilesDirectory ON Files (Directory)')
+        conn.commit()
+
+        # Load the index of the previous run into memory
+        for path, parent, mtime in conn.execute('SELECT Path, Parent, Mtime FROM Directories'):
+            self.directory_mtimes[path] = mtime
+            self.directory_files[path] = {}
+            self.sub_directories.setdefault(path, set())
+            if parent is not None:
+                self.sub_directories.setdefault(parent, set()).add(path)
+        for path, directory, size, mtime in conn.execute('SELECT Path, Directory, Size, Mtime FROM Files'):
+            self.directory_files.setdefault(directory, {})[os.path.basename(path)] = (size, mtime)
+        conn.close()
+
+    def scan(self, full: bool = False) -> list:
+        """
+        Recursively search the input folder for .STP files, only listing directories that changed since the previous
+        scan, and save the changes to the index.
+
+        :param full: Boolean that forces every directory to be listed and every file to be stat'ed again.
+        :type full: bool
+        :return: List of (path, size, modification time) tuples for every .STP file in the input folder.
+        :rtype: list
+        """
+
+        now = time.time()
+        found_files = []
+        changed_directories = []
+        found_directories = set()
+
+        # Walk the tree from the input folder using the indexed sub-folders of unchanged directories
+        stack = [self.input_folder]
+        while stack:
+            directory = stack.pop()
+            try:
+                directory_mtime = os.stat(directory).st_mtime
+            except (FileNotFoundError, NotADirectoryError, PermissionError):
+                continue
+
+            indexed_mtime = self.directory_mtimes.get(directory)
+            if full or indexed_mtime != directory_mtime or now - directory_mtime < MTIME_RESOLUTION:
+
+                # Skip directories that cannot be listed the way the recursive glob does, and forget them so they are
+                # listed again on the next scan
+                try:
+                    files = self.list_directory(directory)
+                except (FileNotFoundError, NotADirectoryError, PermissionError):
+                    continue
+                changed_directories.append(directory)
+                self.directory_mtimes[directory] = directory_mtime
+            else:
+                files = self.restat_files(directory, now)
+                if files is not self.directory_files[directory]:
+                    changed_directories.append(directory)
+
+            found_directories.add(directory)
+            self.directory_files[directory] = files
+            stack.extend(self.sub_directories.get(directory, ()))
+            found_files.extend((os.path.join(directory, filename), size, mtime)
+                               for filename, (size, mtime) in files.items())
+
+        # Forget directories that no longer exist
+        removed_directories = set(self.directory_mtimes) - found_directories
+        for directory in removed_directories:
+            del self.directory_mtimes[directory]
+            self.directory_files.pop(directory, None)
+            self.sub_directories.pop(directory, None)
+        for sub_directories in self.sub_directories.values():
+            sub_directories -= removed_directories
+
+        self.save(changed_directories, removed_directories)
+
+        return found_files
+
+    def list_directory(self, directory: str) -> dict:
+        """
+        List a single directory, record its sub-folders, and stat the .STP files that are new or may have changed.
+        Raises the OSError of os.scandir if the directory cannot be listed.
+
+        :param directory: String that is the path to the directory.
+        :type directory: str
+        :return: Dictionary of filename to (size, modification time) for the .STP files in the directory.
+        :rtype: dict
+        """
+
+        now = time.time()
+        indexed_files = self.directory_files.get(directory, {})
+        files = {}
+        sub_directories = set()
+
+        with os.scandir(directory) as entries:
+            for entry in entries:
+
+                # Skip hidden entries the way the recursive glob does
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        sub_directories.add(entry.path)
+                    elif fnmatch.fnmatch(entry.name, STP_PATTERN):
+                        indexed = indexed_files.get(entry.name)
+                        if indexed is not None and now - indexed[1] >= self.restat_window:
+                            files[entry.name] = indexed
+                        else:
+                            stat = entry.stat()
+                            files[entry.name] = (stat.st_size, stat.st_mtime)
+                except FileNotFoundError:
+                    continue
+
+        self.sub_directories[directory] = sub_directories
+        return files
+
+    def restat_files(self, directory: str, now: float) -> dict:
+        """
+        Stat the indexed .STP files of an unchanged directory that were modified within the restat window.
+
+        :param directory: String that is the path to the directory.
+        :type directory: str
+        :param now: Float that is the current epoch time in seconds.
+        :type now: float
+        :return: Dictionary of filename to (size, modification time), which is the indexed dictionary itself if nothing
+        changed.
+        :rtype: dict
+        """
+
+        indexed_files = self.directory_files[directory]
+        files = None
+        for filename, (size, mtime) in indexed_files.items():
+            if now - mtime >= self.restat_window:
+                continue
+            try:
+                stat = os.stat(os.path.join(directory, filename))
+                current = (stat.st_size, stat.st_mtime)
+            except FileNotFoundError:
+                current = None
+            if current != (size, mtime):
+                if files is None:
+                    files = dict(indexed_files)
+                if current is None:
+                    del files[filename]
+                else:
+                    files[filename] = current
+
+        return indexed_files if files is None else files
+
+    def save(self, changed_directories: list, removed_directories: set) -> None:
+        """
+        Write the changed and removed directories to the index in a single transaction.
+
+        :param changed_directories: List of paths to the directories whose entries changed.
+        :type changed_directories: list
+        :param removed_directories: Set of paths to the directories that no longer exist.
+        :type removed_directories: set
+        :return: None
+        :rtype: None
+        """
+
+        if not changed_directories and not removed_directories:
+            return
+
+        conn = self.connect()
+        with conn:
+            stale_directories = [(directory,) for directory in list(removed_directories) + changed_directories]
+            conn.executemany('DELETE FROM Directories WHERE Path = ?', stale_directories)
+            conn.executemany('DELETE FROM Files WHERE Directory = ?', stale_directories)
+            conn.executemany('INSERT INTO Directories VALUES (?, ?, ?)',
+                             [(directory,
+                               None if directory == self.input_folder else os.path.dirname(directory),
+                               self.directory_mtimes[directory])
+                              for directory in changed_directories])
+            conn.executemany('INSERT INTO Files VALUES (?, ?, ?, ?)',
+                             [(os.path.join(directory, filename), directory, size, mtime)
+                              for directory in changed_directories
+                              for filename, (size, mtime) in self.directory_files[directory].items()])
+        conn.close()
+
+    def connect(self) -> sqlite3.Connection:
+        """
+        Open a connection to the index database.
+
+        :return: sqlite3.Connection to the index database.
+        :rtype: sqlite3.Connection
+        """
+
+        conn = sqlite3.connect(self.index_path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+
+@functools.lru_cache(maxsize=None)
+def get_scan_index(index_path: str, input_folder: str, restat_window: float) -> ScanIndex:
+    """
+    Get the scan index for the index database and input folder, loading it only once per process.
+
+    :param index_path: String that is the path to the SQLite database that stores the index.
+    :type index_path: str
+    :param input_folder: String that is the path to the folder to recursively search for .STP files.
+    :type input_folder: str
+    :param restat_window: Float that is the number of seconds since their last modification during which files in
+    unchanged directories are still stat'ed again.
+    :type restat_window: float
+    :return: ScanIndex for the input folder.
+    :rtype: ScanIndex
+    """
+
+    return ScanIndex(index_path, input_folder, restat_window)
@@ -0,0 +1,85 @@
+"""
+Author: Ayush Doshi
+
+Contains the scheduling policies that decide in which order the files that are ready to be converted are started.
+"""
+
+import argparse
+import collections
+
+import pandas
+
+from .conversion_history import ConversionHistory, conversion_history
+
+# Scheduling policies: fifo starts files in the order they were found, lpt starts the longest conversions first to
+# minimize the makespan of a batch, and spt starts the shortest conversions first to minimize the mean latency
+SCHEDULING_POLICIES = ('fifo', 'lpt', 'spt')
+
+
+def order_files(args: argparse.Namespace, files: pandas.DataFrame,
+                history: [ConversionHistory, None] = None) -> pandas.DataFrame:
+    """
+    Order the files that are ready to be converted according to the scheduling policy chosen by the user, using the
+    predicted conversion duration when there is enough conversion history and the file size otherwise.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param files: pandas.DataFrame that contains at least [Filename, Size] for the files that are ready to be converted.
+    :type files: pandas.DataFrame
+    :param history: ConversionHistory to predict durations from or None to use the default ConversionHistory database.
+    :type history: [ConversionHistory, None]
+    :return: pandas.DataFrame of the rows of files in the order they should be started.
+    :rtype: pandas.DataFrame
+    """
+
+    if args.schedule == 'fifo' or files.empty or 'Size' not in files:
+        return files
+
+    # Use a stable sort so files with the same prediction keep the order they were found in
+    order = scheduling_keys(args, files, history).sort_values(ascending=args.schedule == 'spt', kind='mergesort').index
+    return files.loc[order]
+
+
+def scheduling_keys(args: argparse.Namespace, files: pandas.DataFrame,
+                    history: [ConversionHistory, None] = None) -> pandas.Series:
+    """
+    Get the values the lpt and spt policies order the files by, which are the predicted conversion durations when there
+    is enough conversion history and the file sizes otherwise.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param files: pandas.DataFrame that contains at least [Filename, Size] for the files to order.
+    :type files: pandas.DataFrame
+    :param history: ConversionHistory to predict durations from or None to use the default ConversionHistory database.
+    :type history: [ConversionHistory, None]
+    :return: pandas.Series of floats with the index of files.
+    :rtype: pandas.Series
+    """
+
+    if history is None:
+        history = conversion_history()
+    predicted = history.predict(files, args.system, args.wave_data)
+    if predicted is None:
+        predicted = files['Size']
+
+    return predicted.astype(float)
+
+
+def order_work_queue(args: argparse.Namespace, work_queue: collections.deque) -> None:
+    """
+    Reorder the files waiting in the work queue of the pipeline according to the scheduling policy chosen by the user.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param work_queue: collections.deque of file dictionaries that is reordered in place.
+    :type work_queue: collections.deque
+    :return: None
+    :rtype: None
+    """
+
+    if args.schedule == 'fifo' or len(work_queue) < 2:
+        return
+
+    ordered_files = order_files(args, pandas.DataFrame(list(work_queue)))
+    work_queue.clear()
+    work_queue.extend(ordered_files.to_dict('records'))
@@ -0,0 +1,344 @@
+"""
+Author: Ayush Doshi
+
+Contains the "Prefetcher" class that stages the next queued .STP files into a local scratch folder ahead of their
+conversions, and the functions that stage an .STP file into the Processing folder without copying its bytes whenever
+the file system allows it.
+"""
+
+import argparse
+import collections
+import errno
+import fnmatch
+import os
+import shutil
+import threading
+
+from .scan_index import STP_PATTERN
+from .metrics import count, gauge
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl request from <linux/fs.h> that makes the destination file share the blocks of the source file on file systems
+# with copy-on-write, e.g. Btrfs and XFS
+FICLONE = 0x40049409
+
+# Number of bytes copied at once by copy_file_range
+CHUNK_SIZE = 16 * 1024 * 1024
+
+# Seconds the prefetcher waits before it checks again whether staged files were taken by their conversions
+POLL_INTERVAL = 0.5
+
+# Errors of the fast paths that mean the file system or the pair of volumes does not support them
+UNSUPPORTED_ERRORS = {errno.EXDEV, errno.EPERM, errno.EACCES, errno.ENOTSUP, errno.EOPNOTSUPP, errno.ENOSYS,
+                      errno.EINVAL, errno.ENOTTY, errno.EBADF, errno.EMLINK}
+
+
+def stage_file(source_path: str, destination_path: str) -> str:
+    """
+    Make destination_path a copy of source_path through the cheapest way the file systems allow: a hard link on the
+    same volume, a reflink on a copy-on-write file system, copy_file_range, which copies inside the kernel or on the
+    server of a network file system, and a regular copy otherwise.
+
+    :param source_path: String that is the path to the file to stage.
+    :type source_path: str
+    :param destination_path: String that is the path of the copy, which must not exist.
+    :type destination_path: str
+    :return: String that is the method that staged the file: 'hardlink', 'reflink', 'copy_file_range', or 'copy'.
+    :rtype: str
+    """
+
+    # Link the file if it is on the same volume, since the conversion tools only read the .STP file
+    try:
+        os.link(source_path, destination_path)
+        method = 'hardlink'
+    except OSError as e:
+        if e.errno not in UNSUPPORTED_ERRORS:
+            raise
+        method = copy_file(source_path, destination_path)
+
+    count('stp_staged_files_total', method=method)
+    return method
+
+
+def copy_file(source_path: str, destination_path: str) -> str:
+    """
+    Copy a file with a reflink or copy_file_range if possible and with a regular copy otherwise.
+
+    :param source_path: String that is the path to the file to copy.
+    :type source_path: str
+    :param destination_path: String that is the path of the copy.
+    :type destination_path: str
+    :return: String that is the method that copied the file: 'reflink', 'copy_file_range', or 'copy'.
+    :rtype: str
+    """
+
+    with open(source_path, 'rb') as source_file, open(destination_path, 'wb') as destination_file:
+        method = None
+
+        # Share the blocks of the source file on copy-on-write file systems
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+                method = 'reflink'
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRORS:
+                    raise
+
+        # Copy inside the kernel, or on the server for network file systems that support server-side copies
+        if method is None and hasattr(os, 'copy_file_range'):
+            try:
+                while os.copy_file_range(source_file.fileno(), destination_file.fileno(), CHUNK_SIZE):
+                    pass
+                method = 'copy_file_range'
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRORS:
+                    raise
+
+    # Fall back to the regular copy, which still uses the fastest copy the platform offers between the two folders
+    if method is None:
+        shutil.copyfile(source_path, destination_path)
+        method = 'copy'
+
+    shutil.copymode(source_path, destination_path)
+    return method
+
+
+def stage_input_file(args: argparse.Namespace, input_stp_path: str, filename: str, processing_stp_path: str) -> None:
+    """
+    Stage an .STP file into the Processing folder, taking the copy the prefetcher staged in the scratch folder if it is
+    ready and staging it from the Input folder otherwise.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param input_stp_path: String that is the path to the .STP file in the Input folder.
+    :type input_stp_path: str
+    :param filename: String that is the filename of the .STP file.
+    :type filename: str
+    :param processing_stp_path: String that is the path to stage the .STP file to in the Processing folder.
+    :type processing_stp_path: str
+    :return: None
+    :rtype: None
+    """
+
+    if args.scratch:
+        scratch_stp_path = os.path.join(args.scratch, filename)
+        try:
+            if os.path.getsize(scratch_stp_path) == os.path.getsize(input_stp_path):
+
+                # Take the staged copy with a rename if the scratch folder is on the same volume as the Processing
+                # folder and stage it from the fast scratch folder otherwise
+                try:
+                    os.replace(scratch_stp_path, processing_stp_path)
+                    count('stp_staged_files_total', method='prefetched')
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        raise
+                    stage_file(scratch_stp_path, processing_stp_path)
+                    os.remove(scratch_stp_path)
+                return
+
+        # The file was not prefetched or the prefetcher released it in the meantime
+        except FileNotFoundError:
+            pass
+
+    stage_file(input_stp_path, processing_stp_path)
+
+
+class Prefetcher:
+    """
+    Stages the next queued .STP files into a scratch folder, e.g. on a local SSD or tmpfs, from a background thread, so
+    the conversions take them from there instead of reading them from the input share on their own critical path.
+
+    At most max_files staged files and max_bytes staged bytes wait in the scratch folder at once. A staged file counts
+    against both limits until its conversion takes it or it is released when its conversion finished, and files larger
+    than max_bytes are never staged. Files are staged under a .part name and renamed once complete, so a conversion
+    never takes a partial file.
+    """
+
+    def __init__(self, scratch_folder: str, max_files: int, max_bytes: int) -> None:
+        """
+        :param scratch_folder: String that is the path to the scratch folder.
+        :type scratch_folder: str
+        :param max_files: Integer that is the maximum number of staged files waiting at once.
+        :type max_files: int
+        :param max_bytes: Integer that is the maximum number of bytes of staged files waiting at once.
+        :type max_bytes: int
+        """
+
+        self.scratch_folder = scratch_folder
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.queue = collections.deque()
+        self.staged = {}
+        self.released = set()
+        self.staging = None
+        self.closed = False
+        self.condition = threading.Condition()
+
+        # Remove the staged files left behind by an earlier run, which may be partial
+        os.makedirs(scratch_folder, exist_ok=True)
+        for entry in os.scandir(scratch_folder):
+            if entry.is_file() and (fnmatch.fnmatch(entry.name, STP_PATTERN) or entry.name.endswith('.part')):
+                os.remove(entry.path)
+
+        self.thread = threading.Thread(target=self.run, name='Prefetcher', daemon=True)
+        self.thread.start()
+
+    def add(self, files: list) -> None:
+        """
+        Queue files to be staged in the order their conversions will start.
+
+        :param files: List of (path, filename, size) tuples of .STP files in the Input folder.
+        :type files: list
+        :return: None
+        :rtype: None
+        """
+
+        with self.condition:
+            self.queue.extend(files)
+            self.condition.notify_all()
+
+    def release(self, filename: str) -> None:
+        """
+        Forget a file once its conversion finished, deleting its staged copy if the conversion did not take it, e.g.
+        because it resumed from a later step or was converted by another node.
+
+        :param filename: String that is the filename of the .STP file.
+        :type filename: str
+        :return: None
+        :rtype: None
+        """
+
+        with self.condition:
+            if self.staged.pop(filename, None) is not None:
+                remove_if_exists(os.path.join(self.scratch_folder, filename))
+            elif filename == self.staging or any(file[1] == filename for file in self.queue):
+                self.released.add(filename)
+            self.condition.notify_all()
+
+    def close(self) -> None:
+        """
+        Stop staging files and delete every staged file that was not taken.
+
+        :return: None
+        :rtype: None
+        """
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+
+        for filename in self.staged:
+            remove_if_exists(os.path.join(self.scratch_folder, filename))
+        self.staged.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def run(self) -> None:
+        """
+        Stage the queued files one after another whenever they fit into the limits.
+
+        :return: None
+        :rtype: None
+        """
+
+        while True:
+            with self.condition:
+
+                # Wait for a file that fits into the limits once the staged files that were taken are forgotten
+                while not self.closed:
+                    self.forget_taken_files()
+
+                    # Skip the files whose conversions finished already and the files that never fit into the limits
+                    if self.queue and (self.queue[0][1] in self.released or self.queue[0][2] > self.max_bytes):
+                        self.released.discard(self.queue.popleft()[1])
+                        continue
+                    if self.queue and len(self.staged) < self.max_files and \
+                            sum(self.staged.values()) + self.queue[0][2] <= self.max_bytes:
+                        break
+                    self.condition.wait(POLL_INTERVAL)
+                if self.closed:
+                    return
+                path, filename, size = self.queue.popleft()
+                self.staging = filename
+
+            # Stage the file under a temporary name without holding the lock
+            scratch_stp_path = os.path.join(self.scratch_folder, filename)
+            try:
+                remove_if_exists(scratch_stp_path + '.part')
+                method = stage_file(path, scratch_stp_path + '.part')
+                os.replace(scratch_stp_path + '.part', scratch_stp_path)
+            except OSError as e:
+                remove_if_exists(scratch_stp_path + '.part')
+                print(f"Could not prefetch {filename}: {e}")
+                with self.condition:
+                    self.staging = None
+                    self.released.discard(filename)
+                continue
+
+            # Delete the staged file right away if the conversion finished while it was staged
+            with self.condition:
+                self.staging = None
+                if filename in self.released:
+                    self.released.discard(filename)
+                    remove_if_exists(scratch_stp_path)
+                else:
+                    self.staged[filename] = size
+                gauge('stp_prefetched_files', len(self.staged))
+                gauge('stp_prefetched_bytes', sum(self.staged.values()))
+            print(f"Prefetched {filename} to the scratch folder with {method}")
+
+    def forget_taken_files(self) -> None:
+        """
+        Forget the staged files that their conversions took from the scratch folder, which frees their space in the
+        limits. Must be called with the lock held.
+
+        :return: None
+        :rtype: None
+        """
+
+        for filename in [filename for filename in self.staged
+                         if not os.path.exists(os.path.join(self.scratch_folder, filename))]:
+            del self.staged[filename]
+
+
+def remove_if_exists(path: str) -> None:
+    """
+    Delete a file unless it is already gone.
+
+    :param path: String that is the path to the file.
+    :type path: str
+    :return: None
+    :rtype: None
+    """
+
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def create_prefetcher(args: argparse.Namespace) -> [Prefetcher, None]:
+    """
+    Create a prefetcher for the scratch folder if desired based on the user arguments.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :return: Prefetcher or None if files are not prefetched.
+    :rtype: [Prefetcher, None]
+    """
+
+    if not args.scratch:
+        return None
+
+    max_files = args.prefetch_files if args.prefetch_files else 2 * args.cores
+    return Prefetcher(args.scratch, max_files, int(args.prefetch_gb * 1024 ** 3))
@@ -0,0 +1,389 @@
+"""
+Author: Ayush Doshi
+
+Contains the "StateJournal" class that durably records how far the conversion of every .STP file got, and the functions
+that resume files from their last durable step after a crash or restart.
+"""
+
+import argparse
+import functools
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import pandas
+
+from .conversion_tools import cleanup, converted_files, remove_converted_files
+
+# States of a file in the order they are reached: found with patient information, copied to the Processing folder,
+# converted to an .XML file, converted to .HDF5 file(s) in Output\Converted, de-identified and moved to Output\Success,
+# and added to the CompletedFiles database
+STATES = ('discovered', 'staged', 'xml_done', 'hdf5_done', 'renamed', 'committed')
+
+# Columns of the conversion options that a file was converted with and the arguments they come from
+FLAG_COLUMNS = {'WaveData': 'wave_data', 'SingleHdf5File': 'single_hdf5_file'}
+
+
+class StateJournal:
+    """
+    Durable per-file record of the last conversion step that finished, with the paths and sizes of its outputs so they
+    can be verified before a step is skipped, and the conversion options the outputs were created with.
+
+    The journal is a SQLite database with full synchronous commits in write-ahead logging mode, and every output is
+    flushed to disk before the step that created it is recorded, so a recorded step survives a crash or power loss.
+    Every process opens its own connection, since worker processes record the steps of their own conversions.
+    """
+
+    def __init__(self, database_path: str) -> None:
+        """
+        :param database_path: String that is the path to the StateJournal SQLite database.
+        :type database_path: str
+        """
+
+        self.database_path = database_path
+        self.lock = threading.Lock()
+
+        # Wait for the locks of other processes instead of failing, since every worker records its own conversions
+        self.conn = sqlite3.connect(database_path, timeout=60, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=FULL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS "FileStates" ("Filename" TEXT, "Path" TEXT, "PatientID" TEXT, '
+                          '"Offset" INTEGER, "State" TEXT, "Outputs" TEXT, "Updated" REAL, "WaveData" INTEGER, '
+                          '"SingleHdf5File" INTEGER, PRIMARY KEY("Filename"))')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS "FileStatesState" ON "FileStates" ("State")')
+
+        # Add the columns of the conversion options to journals created before they were recorded, whose files keep
+        # unknown options
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info("FileStates")')}
+        for column in FLAG_COLUMNS:
+            if column not in columns:
+                self.conn.execute(f'ALTER TABLE "FileStates" ADD COLUMN "{column}" INTEGER')
+        self.conn.commit()
+
+    def discover(self, files: pandas.DataFrame) -> None:
+        """
+        Record files that were found with patient information, keeping the state of files that got further before.
+
+        :param files: pandas.DataFrame that contains [Path, Filename, PatientID, Offset] for the convertable files.
+        :type files: pandas.DataFrame
+        :return: None
+        :rtype: None
+        """
+
+        now = time.time()
+        rows = [(filename, path, str(patient_id), int(offset), now) for path, filename, patient_id, offset
+                in files.loc[:, ['Path', 'Filename', 'PatientID', 'Offset']].itertuples(index=False, name=None)]
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO FileStates (Filename, Path, PatientID, Offset, State, '
+                                  'Updated) VALUES (?, ?, ?, ?, \'discovered\', ?)', rows)
+            self.conn.executemany('UPDATE FileStates SET Path = ?, PatientID = ?, Offset = ? WHERE Filename = ?',
+                                  ((path, patient_id, offset, filename) for filename, path, patient_id, offset, _
+                                   in rows))
+
+    def record(self, filenames: list, state: str, outputs: [dict, None] = None, flags: [dict, None] = None) -> None:
+        """
+        Record that files reached a state.
+
+        :param filenames: List of .STP filenames that reached the state.
+        :type filenames: list
+        :param state: String that is one of STATES.
+        :type state: str
+        :param outputs: Dictionary of path to size of the outputs of the state or None if it has none to verify.
+        :type outputs: [dict, None]
+        :param flags: Dictionary of FLAG_COLUMNS to the conversion options the outputs were created with or None to
+        keep the recorded options.
+        :type flags: [dict, None]
+        :return: None
+        :rtype: None
+        """
+
+        flags = flags if flags is not None else {}
+        with self.lock, self.conn:
+            self.conn.executemany('UPDATE FileStates SET State = ?, Outputs = ?, Updated = ?, '
+                                  'WaveData = COALESCE(?, WaveData), SingleHdf5File = COALESCE(?, SingleHdf5File) '
+                                  'WHERE Filename = ?',
+                                  ((state, json.dumps(outputs) if outputs is not None else None, time.time(),
+                                    flags.get('WaveData'), flags.get('SingleHdf5File'), filename)
+                                   for filename in filenames))
+
+    def get(self, filename: str) -> [dict, None]:
+        """
+        Get the recorded state of a file.
+
+        :param filename: String that is the filename of the .STP file.
+        :type filename: str
+        :return: Dictionary of the Filename, Path, PatientID, Offset, State, Outputs, WaveData, and SingleHdf5File of
+        the file, where the options are None if they are unknown, or None if it is not in the journal.
+        :rtype: [dict, None]
+        """
+
+        with self.lock:
+            row = self.conn.execute('SELECT Filename, Path, PatientID, Offset, State, Outputs, WaveData, '
+                                    'SingleHdf5File FROM FileStates WHERE Filename = ?', (filename,)).fetchone()
+
+        if row is None:
+            return None
+        return dict(zip(['Filename', 'Path', 'PatientID', 'Offset', 'State', 'Outputs', 'WaveData', 'SingleHdf5File'],
+                        row[:5] + (json.loads(row[5]) if row[5] else {},) +
+                        tuple(bool(flag) if flag is not None else None for flag in row[6:])))
+
+    def unfinished(self) -> list:
+        """
+        Get every file that was not added to the CompletedFiles database.
+
+        :return: List of dictionaries of the Filename, Path, PatientID, Offset, State, Outputs, WaveData, and
+        SingleHdf5File of the files.
+        :rtype: list
+        """
+
+        with self.lock:
+            filenames = [row[0] for row in self.conn.execute(
+                'SELECT Filename FROM FileStates WHERE State != \'committed\'')]
+        return [self.get(filename) for filename in filenames]
+
+    def forget(self, filenames: list) -> None:
+        """
+        Remove files from the journal, e.g. after they failed and were moved out of the Input folder.
+
+        :param filenames: List of .STP filenames to remove.
+        :type filenames: list
+        :return: None
+        :rtype: None
+        """
+
+        with self.lock, self.conn:
+            self.conn.executemany('DELETE FROM FileStates WHERE Filename = ?', ((filename,) for filename in filenames))
+
+
+@functools.lru_cache(maxsize=None)
+def get_state_journal(database_path: str, pid: int) -> StateJournal:
+    """
+    Get the state journal for the database, opening it only once per process. The process ID is part of the cache key
+    so a forked worker never uses the connection of its parent.
+
+    :param database_path: String that is the path to the StateJournal SQLite database.
+    :type database_path: str
+    :param pid: Integer that is the ID of the current process.
+    :type pid: int
+    :return: StateJournal for the database.
+    :rtype: StateJournal
+    """
+
+    return StateJournal(database_path)
+
+
+def state_journal(args: argparse.Namespace) -> [StateJournal, None]:
+    """
+    Get the state journal of this process if desired based on the user arguments.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :return: StateJournal or None if no state journal is kept.
+    :rtype: [StateJournal, None]
+    """
+
+    return get_state_journal(args.state_journal, os.getpid()) if args.state_journal else None
+
+
+def record_state(args: argparse.Namespace, filenames: list, state: str, output_paths: [list, None] = None) -> None:
+    """
+    Flush the outputs of a step to disk and record that files reached the state, if a state journal is kept.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param filenames: List of .STP filenames that reached the state.
+    :type filenames: list
+    :param state: String that is one of STATES.
+    :type state: str
+    :param output_paths: List of the paths of the outputs of the step to verify before it is skipped or None.
+    :type output_paths: [list, None]
+    :return: None
+    :rtype: None
+    """
+
+    journal = state_journal(args)
+    if journal is None:
+        return
+
+    outputs = None
+    if output_paths is not None:
+        outputs = {}
+        for output_path in output_paths:
+
+            # Outputs that cannot be opened for writing, e.g. hard links to a read-only .STP file in the Input folder,
+            # are as durable as the file they link to
+            try:
+                with open(output_path, 'rb+') as output_file:
+                    os.fsync(output_file.fileno())
+            except PermissionError:
+                pass
+            outputs[output_path] = os.path.getsize(output_path)
+
+    journal.record(filenames, state, outputs, {column: bool(getattr(args, argument))
+                                               for column, argument in FLAG_COLUMNS.items()})
+
+
+def forget_state(args: argparse.Namespace, filename: str) -> None:
+    """
+    Remove a file from the state journal if one is kept, e.g. after its conversion failed.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param filename: String that is the filename of the .STP file.
+    :type filename: str
+    :return: None
+    :rtype: None
+    """
+
+    journal = state_journal(args)
+    if journal is not None:
+        journal.forget([filename])
+
+
+def entry_args(args: argparse.Namespace, entry: dict) -> argparse.Namespace:
+    """
+    Get the arguments with the conversion options that the outputs of a journal entry were created with, keeping the
+    options that are unknown, e.g. for entries recorded before the options were.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param entry: Dictionary of a file in the journal.
+    :type entry: dict
+    :return: argparse.Namespace of the arguments with the recorded conversion options.
+    :rtype: argparse.Namespace
+    """
+
+    return argparse.Namespace(**{**vars(args), **{argument: entry[column] for column, argument in FLAG_COLUMNS.items()
+                                                  if entry[column] is not None}})
+
+
+def outputs_intact(outputs: dict) -> bool:
+    """
+    Verify that the recorded outputs of a step still exist with the recorded sizes.
+
+    :param outputs: Dictionary of path to size of the outputs.
+    :type outputs: dict
+    :return: True if there are outputs and all of them are intact, otherwise False.
+    :rtype: bool
+    """
+
+    return bool(outputs) and all(os.path.isfile(path) and os.path.getsize(path) == size
+                                 for path, size in outputs.items())
+
+
+def resume_conversion(args: argparse.Namespace, input_stp_path: str, filename: str) -> [str, None]:
+    """
+    Find the last durable step of an earlier conversion of a file whose outputs in the Processing folder are intact, and
+    delete every other leftover of it. Without a state journal, all leftovers are deleted.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param input_stp_path: String that is the path to the .STP file in the Input folder.
+    :type input_stp_path: str
+    :param filename: String that is the filename of the .STP file.
+    :type filename: str
+    :return: 'staged' if the .STP file in the Processing folder can be converted, 'xml_done' if the .XML file in the
+    Processing folder can be converted, or None to start over.
+    :rtype: [str, None]
+    """
+
+    basename = os.path.splitext(filename)[0]
+    processing_stp_path = os.path.join('Processing', filename)
+    processing_xml_path = os.path.join('Processing', basename + '.xml')
+
+    journal = state_journal(args)
+    entry = journal.get(filename) if journal is not None else None
+    if entry is not None and outputs_intact(entry['Outputs']):
+
+        # Resume from the copied .STP file if it is the same size as the one in the Input folder, deleting any partial
+        # .XML and .HDF5 files
+        if entry['State'] == 'staged' and os.path.getsize(input_stp_path) == entry['Outputs'].get(processing_stp_path):
+            if os.path.exists(processing_xml_path):
+                os.remove(processing_xml_path)
+            remove_converted_files(basename)
+            print(f"Resuming {basename} from its copy in the Processing folder...")
+            return 'staged'
+
+        # Resume from the .XML file if it was created with the current conversion options, deleting the copied .STP
+        # file and any partial .HDF5 files, including .HDF5 files that were partially moved to Output\Converted
+        if entry['State'] == 'xml_done' and processing_xml_path in entry['Outputs'] and \
+                vars(entry_args(args, entry)) == vars(args):
+            if os.path.exists(processing_stp_path):
+                os.remove(processing_stp_path)
+            remove_converted_files(basename)
+            for converted_hdf5_path in converted_files(args, basename):
+                os.remove(converted_hdf5_path)
+            print(f"Resuming {basename} from its .XML file in the Processing folder...")
+            return 'xml_done'
+
+    cleanup(basename)
+    return None
+
+
+def entry_flags(entry: dict) -> tuple:
+    """
+    Get the recorded conversion options of a journal entry in a form that can be sorted and grouped by.
+
+    :param entry: Dictionary of a file in the journal.
+    :type entry: dict
+    :return: Tuple of the string of every recorded conversion option, which is '' if it is unknown.
+    :rtype: tuple
+    """
+
+    return tuple(str(entry[column]) if entry[column] is not None else '' for column in FLAG_COLUMNS)
+
+
+def resume_journal(args: argparse.Namespace) -> None:
+    """
+    Finish the files whose .HDF5 file(s) were created before a crash or restart: de-identify the .HDF5 file(s) left in
+    Output\Converted and add the files to the CompletedFiles database. Files that were staged or converted to an .XML
+    file are resumed by their next conversion, and files that no longer have an .STP file in the Input folder to resume
+    from are forgotten.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :return: None
+    :rtype: None
+    """
+
+    # Import here, since de-identifying and recording files records their states in the journal
+    from .deidentify_file_names import deidentify_file_names
+    from .update_completed_files_database import update_completed_files_database
+
+    journal = state_journal(args)
+    if journal is None:
+        return
+
+    entries = journal.unfinished()
+    by_state = {state: [entry for entry in entries if entry['State'] == state] for state in STATES}
+    print(f"Resuming from the state journal: {', '.join(f'{len(by_state[state])} {state}' for state in STATES[:-1])}")
+
+    # Forget found files, since nothing durable was done for them, and staged or converted files whose .STP file is
+    # gone from the Input folder, e.g. because it was moved to a failed folder
+    forgotten = by_state['discovered'] + [entry for entry in by_state['staged'] + by_state['xml_done']
+                                          if not os.path.isfile(entry['Path'])]
+    for entry in forgotten:
+        cleanup(os.path.splitext(entry['Filename'])[0])
+    journal.forget([entry['Filename'] for entry in forgotten])
+
+    # De-identify the .HDF5 file(s) that are still in Output\Converted, some of which may have been moved to
+    # Output\Success already, after removing the leftover .XML file. Files are de-identified with the conversion options
+    # they were converted with, which may differ from the options of this run
+    hdf5_done = by_state['hdf5_done']
+    for entry in hdf5_done:
+        cleanup(os.path.splitext(entry['Filename'])[0])
+    for _, group in itertools.groupby(sorted(hdf5_done, key=entry_flags), key=entry_flags):
+        group = list(group)
+        group_args = entry_args(args, group[0])
+        files = pandas.DataFrame(group).loc[:, ['Path', 'Filename', 'PatientID', 'Offset']]
+        files = files.astype({'PatientID': 'int64', 'Offset': 'int64'})
+        deidentify_file_names(group_args, files)
+        record_state(group_args, [entry['Filename'] for entry in group], 'renamed')
+
+    # Add the de-identified files to the CompletedFiles database
+    renamed = [entry['Filename'] for entry in hdf5_done + by_state['renamed']]
+    if renamed:
+        update_completed_files_database(args, renamed)
@@ -4,28 +4,38 @@ Author: Ayush Doshi
 Contains the "update_completed_files_database" function.
 """
 
-import os
-import sqlite3
+import argparse
 
-import pandas
+from .completed_files_store import completed_files_store
+from .lease_queue import lease_queue
+from .metrics import stage_timer
+from .state_journal import record_state
 
 
-def update_completed_files_database(unique_completed_files_list: list) -> None:
+def update_completed_files_database(args: argparse.Namespace, unique_completed_files_list: list) -> None:
     """
     Append the unique list of .STP files that were converted this cycle to the CompletedFiles database.
 
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
     :param unique_completed_files_list: List of unique .STP file names that were converted this cycle.
     :type unique_completed_files_list: list
     :return: None
     :rtype: None
     """
 
-    # Create a Pandas DataFrame from the unique list of converted .STP files
-    completed_files = pandas.DataFrame(unique_completed_files_list, columns=['CompletedFiles'])
-
     print("Updating the CompletedFiles database with the latest completed files...")
 
-    # Append the completed files DataFrame to the existing CompletedFiles table in the CompletedFiles database
-    conn = sqlite3.connect(os.path.join('AutoSTPtoHDF5Converter', 'CompletedFiles.db'))
-    completed_files.to_sql('CompletedFiles', conn, index=False, if_exists='append')
-    conn.close()
+    # Mark the files as committed in the lease queue if this node shares the input folder with other nodes, so no node
+    # claims them again
+    queue = lease_queue(args)
+    if queue is not None:
+        queue.commit(unique_completed_files_list)
+
+    # Append the completed files to the existing CompletedFiles table in the CompletedFiles database in a single small
+    # transaction, ignoring files that were already recorded
+    with stage_timer('db_update'):
+        completed_files_store().add(unique_completed_files_list)
+
+    # Record that the files were committed in the state journal if one is kept
+    record_state(args, unique_completed_files_list, 'committed')
@@ -1,7 +1,7 @@
 """
 Author: Ayush Doshi
 
-Contains the "update_patient_database" function.
+Contains the "update_patient_database" function as well as necessary subfunctions.
 """
 
 import argparse
@@ -11,20 +11,29 @@ import sqlite3
 
 import pandas
 
+from .pending_offsets import get_pending_offsets_index
 
-def update_patient_database(args: argparse.Namespace) -> None:
+# Number of .CSV rows to read in and upsert at a time
+CSV_CHUNK_SIZE = 100000
+
+
+def update_patient_database(args: argparse.Namespace) -> pandas.DataFrame:
     """
     Updates the existing PatientOffset table in the patient offset database with update .CSVs if present in the
-    patient database update folder.
+    patient database update folder, and moves the skipped files that the update has patient information for back to the
+    input folder.
 
     :param args: argparse.Namespace that contains the arguments provided by the user.
     :type args: argparse.Namespace
-    :return: None
-    :rtype: None
+    :return: pandas.DataFrame that contains [Path, Filename, Size] for the files that were moved back to the input
+    folder, which were already stable when they were skipped and can be converted right away.
+    :rtype: pandas.DataFrame
     """
 
     print("Checking for patient database updates...")
 
+    requeued_files = pandas.DataFrame(columns=['Path', 'Filename', 'Size'])
+
     # Search folder with patient database updates for .CSV files
     update_csv_files = glob.glob(os.path.join(args.database_update, '*.csv'))
 
@@ -32,46 +41,119 @@ def update_patient_database(args: argparse.Namespace) -> None:
     if update_csv_files:
         print("Patient update CSV(s) found. Reading them in...")
 
-        # Pull the existing PatientOffset table from the patient offset SQLite database into a Pandas dataframe
         conn = sqlite3.connect(args.database)
-        patient_info = pandas.read_sql_query('SELECT * from PatientOffset', conn)
-        conn.close()
 
-        # Create a copy to use for comparison later as well as store old column labels
-        old_patient_info = patient_info.copy()
-        pi_columns = patient_info.columns
+        # Make sure the STPFile column has a unique index that the upserts can resolve conflicts on
+        ensure_stp_file_index(conn)
+
+        # Stream the found .CSV files in chunks and upsert them into the PatientOffset table in a single transaction,
+        # counting the rows that were actually inserted or changed and joining the rows against the index of the files
+        # that were skipped for missing patient information
+        pending_offsets_index = get_pending_offsets_index(args.output)
+        arrived_files = {}
+        changes_before = conn.total_changes
+        with conn:
+            for update_csv_file in update_csv_files:
+                for chunk in pandas.read_csv(update_csv_file, chunksize=CSV_CHUNK_SIZE):
+                    arrived_files.update(pending_offsets_index.match(upsert_patient_info(conn, chunk)))
+        changes = conn.total_changes - changes_before
+        conn.close()
 
-        # Read in the found .CSV files into Pandas dataframes and concat them with the PatientOffset table
+        # Remove the .CSV files only after their rows were committed
         for update_csv_file in update_csv_files:
-            patient_info = pandas.concat([patient_info, pandas.read_csv(update_csv_file)], ignore_index=True)
             os.remove(update_csv_file)
 
-        # Drops NA in the STPFile, PatientID, and Offset columns and removes duplicates besides the last value in the
-        # STPFile column
-        patient_info = patient_info.dropna(subset=pi_columns).drop_duplicates(subset=[pi_columns[0]], ignore_index=True,
-                                                                              keep='last')
-        patient_info = patient_info[pi_columns]
-
         # If there is a difference between the original patient offset table and the new one (i.e. if any new offsets
         # have been added)
-        if not old_patient_info.equals(patient_info):
-            print("Updating existing PatientOffset database...")
-
-            # Replace existing patient offset table with the new patient offset table with added rows
-            conn = sqlite3.connect(args.database)
-            patient_info.to_sql('PatientOffset', conn, index=False, if_exists='replace')
-            conn.close()
-
-            # Check if Output\Skipped\NotInPatientDatabase folder exists
-            if os.path.isdir(os.path.join(args.output, 'Skipped', 'NotInPatientDatabase')):
-                print("Moving skipped files back to input folder...")
-
-                # Find and move back any .STP files that were skipped due to there not being an associated offset in
-                # the patient offset database
-                skipped_files = glob.glob(os.path.join(args.output, 'Skipped', 'NotInPatientDatabase', '*.?tp'))
-                for skipped_file in skipped_files:
-                    os.rename(skipped_file, os.path.join(args.input, os.path.basename(skipped_file)))
+        if changes:
+            print(f"Updated {changes} row(s) of the existing PatientOffset database...")
         else:
             print("No new changes were found. Keeping original patient offset table...")
+
+        # Move only the skipped files whose patient information just arrived back to the input folder
+        if arrived_files:
+            requeued_files = requeue_skipped_files(args, arrived_files)
     else:
         print("No patient update CSVs were found...")
+
+    return requeued_files
+
+
+def requeue_skipped_files(args: argparse.Namespace, arrived_files: dict) -> pandas.DataFrame:
+    """
+    Move skipped files from the Output\\Skipped\\NotInPatientDatabase folder back to the input folder.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param arrived_files: Dictionary of the filename to the size of the skipped files whose patient information
+        arrived.
+    :type arrived_files: dict
+    :return: pandas.DataFrame that contains [Path, Filename, Size] for the files that were moved back.
+    :rtype: pandas.DataFrame
+    """
+
+    print(f"Moving {len(arrived_files)} skipped file(s) whose patient information arrived back to input folder...")
+
+    requeued_files = []
+    for filename, size in arrived_files.items():
+        input_path = os.path.join(args.input, filename)
+        try:
+            os.rename(os.path.join(args.output, 'Skipped', 'NotInPatientDatabase', filename), input_path)
+        except FileNotFoundError:
+            continue
+        requeued_files.append((input_path, filename, size))
+    get_pending_offsets_index(args.output).remove(list(arrived_files))
+
+    return pandas.DataFrame(requeued_files, columns=['Path', 'Filename', 'Size'])
+
+
+def ensure_stp_file_index(conn: sqlite3.Connection) -> None:
+    """
+    Create a unique index on the STPFile column of the PatientOffset table if it does not have one, e.g. because the
+    table was rewritten without its primary key, keeping only the latest row of any duplicate STPFile.
+
+    :param conn: sqlite3.Connection to the patient offset database.
+    :type conn: sqlite3.Connection
+    :return: None
+    :rtype: None
+    """
+
+    # Check if any unique index covers exactly the STPFile column
+    for _, index_name, unique, *_ in conn.execute("PRAGMA index_list('PatientOffset')").fetchall():
+        columns = [row[2] for row in conn.execute(f"PRAGMA index_info('{index_name}')")]
+        if unique and columns == ['STPFile']:
+            return
+
+    print("Adding a unique index on STPFile to the PatientOffset table...")
+    with conn:
+        conn.execute('DELETE FROM PatientOffset WHERE rowid NOT IN (SELECT MAX(rowid) FROM PatientOffset '
+                     'GROUP BY STPFile)')
+        conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS PatientOffsetSTPFile ON PatientOffset (STPFile)')
+
+
+def upsert_patient_info(conn: sqlite3.Connection, patient_info: pandas.DataFrame) -> list:
+    """
+    Insert new STPFile associations into the PatientOffset table and update existing ones whose PatientID or Offset
+    changed.
+
+    :param conn: sqlite3.Connection to the patient offset database.
+    :type conn: sqlite3.Connection
+    :param patient_info: pandas.DataFrame that contains [STPFile, PatientID, Offset] read in from an update .CSV.
+    :type patient_info: pandas.DataFrame
+    :return: List of the STPFile values of the rows that were upserted.
+    :rtype: list
+    """
+
+    # Drops NA in the STPFile, PatientID, and Offset columns and removes duplicates besides the last value in the
+    # STPFile column
+    patient_info = patient_info.loc[:, ['STPFile', 'PatientID', 'Offset']].dropna() \
+        .drop_duplicates(subset=['STPFile'], keep='last')
+    patient_info = patient_info.astype({'STPFile': 'str', 'PatientID': 'int64', 'Offset': 'int64'})
+
+    # Rows are upserted in .CSV order, so the latest association of a duplicate STPFile wins across chunks and files
+    conn.executemany('INSERT INTO PatientOffset (STPFile, PatientID, Offset) VALUES (?, ?, ?) '
+                     'ON CONFLICT(STPFile) DO UPDATE SET PatientID = excluded.PatientID, Offset = excluded.Offset '
+                     'WHERE PatientID IS NOT excluded.PatientID OR Offset IS NOT excluded.Offset',
+                     patient_info.itertuples(index=False, name=None))
+
+    return list(patient_info['STPFile'])
@@ -0,0 +1,168 @@
+"""
+Author: Ayush Doshi
+
+Contains the "WaveBacklog" class that durably queues the .STP files whose vital signs were converted for the background
+conversion with wave data, and the functions that give each tier of a tiered conversion its arguments.
+"""
+
+import argparse
+import functools
+import os
+import sqlite3
+import time
+
+from .metrics import gauge
+
+# Path to the WaveBacklog database relative to the folder the AutoSTPtoHDF5Converter is run from
+WAVE_BACKLOG_DATABASE = os.path.join('AutoSTPtoHDF5Converter', 'WaveBacklog.db')
+
+
+class WaveBacklog:
+    """
+    Durable first-in, first-out queue of the .STP files that still need their conversion with wave data, so the
+    background tier picks up where it left off after a restart. Files whose conversion with wave data failed stay in the
+    database, marked with the time they failed, and are not taken again.
+    """
+
+    def __init__(self, database_path: str = WAVE_BACKLOG_DATABASE) -> None:
+        """
+        :param database_path: String that is the path to the WaveBacklog SQLite database.
+        :type database_path: str
+        """
+
+        self.conn = sqlite3.connect(database_path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS "WaveBacklog" ("Filename" TEXT PRIMARY KEY, "Path" TEXT, '
+                          '"Size" INTEGER, "PatientID" TEXT, "Offset" INTEGER, "Added" REAL, "Failed" REAL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS "WaveBacklogAdded" ON "WaveBacklog" ("Added")')
+
+        # Add the column of failed files to backlogs created before failed files were kept
+        if 'Failed' not in {row[1] for row in self.conn.execute('PRAGMA table_info("WaveBacklog")')}:
+            self.conn.execute('ALTER TABLE "WaveBacklog" ADD COLUMN "Failed" REAL')
+        self.conn.commit()
+        gauge('stp_wave_backlog_files', len(self))
+
+    def __len__(self) -> int:
+        return self.conn.execute('SELECT COUNT(*) FROM WaveBacklog WHERE Failed IS NULL').fetchone()[0]
+
+    def add(self, file: dict) -> None:
+        """
+        Queue a file whose vital signs were converted for its conversion with wave data.
+
+        :param file: Dictionary that contains the Path, Filename, Size, PatientID, and Offset of the .STP file.
+        :type file: dict
+        :return: None
+        :rtype: None
+        """
+
+        self.conn.execute('INSERT OR IGNORE INTO WaveBacklog VALUES (?, ?, ?, ?, ?, ?, NULL)',
+                          (file['Filename'], file['Path'], int(file['Size']), str(file['PatientID']),
+                           int(file['Offset']), time.time()))
+        self.conn.commit()
+        gauge('stp_wave_backlog_files', len(self))
+
+    def take(self, limit: int, exclude: set) -> list:
+        """
+        Get the oldest queued files that are not already being converted and did not fail.
+
+        :param limit: Integer that is the maximum number of files to get.
+        :type limit: int
+        :param exclude: Set of the filenames that are being converted.
+        :type exclude: set
+        :return: List of dictionaries that contain the Path, Filename, Size, PatientID, and Offset of the files.
+        :rtype: list
+        """
+
+        files = []
+        for filename, path, size, patient_id, offset in self.conn.execute(
+                'SELECT Filename, Path, Size, PatientID, Offset FROM WaveBacklog WHERE Failed IS NULL ORDER BY Added'):
+            if len(files) >= limit:
+                break
+            if filename not in exclude:
+                files.append({'Path': path, 'Filename': filename, 'Size': size, 'PatientID': patient_id,
+                              'Offset': offset})
+
+        return files
+
+    def remove(self, filename: str) -> None:
+        """
+        Remove a file from the queue once its conversion with wave data finished or it cannot be converted anymore.
+
+        :param filename: String that is the filename of the .STP file.
+        :type filename: str
+        :return: None
+        :rtype: None
+        """
+
+        self.conn.execute('DELETE FROM WaveBacklog WHERE Filename = ?', (filename,))
+        self.conn.commit()
+        gauge('stp_wave_backlog_files', len(self))
+
+
+    def fail(self, filename: str) -> None:
+        """
+        Mark a file as failed once its conversion with wave data failed, so it is kept in the database but not taken
+        again.
+
+        :param filename: String that is the filename of the .STP file.
+        :type filename: str
+        :return: None
+        :rtype: None
+        """
+
+        self.conn.execute('UPDATE WaveBacklog SET Failed = ? WHERE Filename = ?', (time.time(), filename))
+        self.conn.commit()
+        gauge('stp_wave_backlog_files', len(self))
+
+
+@functools.lru_cache(maxsize=None)
+def get_wave_backlog(database_path: str = WAVE_BACKLOG_DATABASE) -> WaveBacklog:
+    """
+    Get the WaveBacklog for the database, creating it only once per process.
+
+    :param database_path: String that is the path to the WaveBacklog SQLite database.
+    :type database_path: str
+    :return: WaveBacklog for the database.
+    :rtype: WaveBacklog
+    """
+
+    return WaveBacklog(database_path)
+
+
+def tier_args(args: argparse.Namespace, wave_data: bool) -> argparse.Namespace:
+    """
+    Get the arguments of a tier of a tiered conversion. The vital signs tier keeps the .STP file in the Input folder for
+    the wave data tier, and the wave data tier is not recorded in the state journal, since an interrupted background
+    conversion is simply started over from the WaveBacklog.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param wave_data: Boolean that is True for the wave data tier and False for the vital signs tier.
+    :type wave_data: bool
+    :return: argparse.Namespace with the arguments of the tier.
+    :rtype: argparse.Namespace
+    """
+
+    if wave_data:
+        return argparse.Namespace(**{**vars(args), 'wave_data': True, 'state_journal': None})
+    return argparse.Namespace(**{**vars(args), 'wave_data': False, 'delete_stp': False})
+
+
+def locate_wave_file(args: argparse.Namespace, file: dict) -> [str, None]:
+    """
+    Find the .STP file of a queued file, which is moved to Output\Skipped\AlreadyDone if a file search found it in the
+    Input folder after its vital signs were converted, e.g. after a restart.
+
+    :param args: argparse.Namespace that contains the arguments provided by the user.
+    :type args: argparse.Namespace
+    :param file: Dictionary that contains the Path and Filename of the queued .STP file.
+    :type file: dict
+    :return: String that is the current path to the .STP file or None if it cannot be found anymore.
+    :rtype: [str, None]
+    """
+
+    for path in [file['Path'], os.path.join(args.output, 'Skipped', 'AlreadyDone', file['Filename'])]:
+        if os.path.isfile(path):
+            return path
+
+    return None
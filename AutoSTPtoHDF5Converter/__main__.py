@@ -6,6 +6,9 @@ This is the starting point of the AutoSTPtoHDF5Converter to manages the argument
 
 import os
 import pathlib
+import socket
+import sys
+import time
 
 import configargparse
 
@@ -27,15 +30,189 @@ parser.add_argument('-w', '--wave_data', help='Include wavedata. Default: False'
 parser.add_argument('-del', '--delete_stp', help='Delete .STP files if conversion if successful. Default: False',
                     action='store_true')
 parser.add_argument('-c', '--cores', help='Maximum number of cores to use. Default: 6. ', type=int, default=6)
+parser.add_argument('-as', '--autoscale', help='Raise or lower the number of concurrent conversions between '
+                                                'min_cores and cores, or max_conversions for the asyncio engine, from '
+                                                'samples of the CPU utilization, I/O wait, available memory, and free '
+                                                'space of the Processing, output, and scratch folders. Default: False.',
+                    action='store_true')
+parser.add_argument('-mn', '--min_cores', help='Lowest number of concurrent conversions with autoscale. Default: 1.',
+                    type=int, default=1)
+parser.add_argument('-ai', '--autoscale_interval', help='Time, in seconds, in between samples of the host with '
+                                                        'autoscale. Default: 30 sec.', type=float, default=30)
+parser.add_argument('-fg', '--min_free_gb', help='Free space, in GB, the Processing, output, and scratch folders have '
+                                                 'to keep with autoscale before fewer conversions are started. '
+                                                 'Default: 10 GB.', type=float, default=10)
+parser.add_argument('-e', '--engine', help='Conversion engine to use. process runs each conversion in a Python worker '
+                                            'process per core, asyncio runs the conversion tools directly as asyncio '
+                                            'subprocesses. Default: process.', type=str, choices=['process', 'asyncio'],
+                    default='process')
+parser.add_argument('-mc', '--max_conversions', help='Maximum number of concurrent conversions for the asyncio engine. '
+                                                     'Default: cores.', type=int)
+parser.add_argument('-sw', '--stp_workers', help='Split the asyncio conversions into two stages and limit the number '
+                                                 'of concurrent StpToolkit (.STP to .XML) conversions. Default: '
+                                                 'max_conversions.', type=int)
+parser.add_argument('-hw', '--hdf5_workers', help='Split the asyncio conversions into two stages and limit the number '
+                                                  'of concurrent formatconverter (.XML to .HDF5) conversions. Default: '
+                                                  'max_conversions.', type=int)
+parser.add_argument('-xs', '--xml_spool', help='Maximum number of .XML files in the Processing folder at once when the '
+                                               'conversions are split into two stages. Default: stp_workers + '
+                                               'hdf5_workers.', type=int)
+parser.add_argument('-so', '--schedule', help='Order in which ready files are started. fifo starts them in the order '
+                                              'they were found, lpt starts the longest conversions first to shorten '
+                                              'each batch, and spt starts the shortest conversions first to lower the '
+                                              'mean wait. Durations are predicted from past conversions when there is '
+                                              'enough history and from the file size otherwise. Default: fifo.',
+                    type=str, choices=SCHEDULING_POLICIES, default='fifo')
+parser.add_argument('-stk', '--stptoolkit', help='Command that runs the StpToolkit, e.g. through mono or a stand-in '
+                                                'tool. Default: the StpToolkit.exe in UniversalFileConverter.',
+                    type=str)
+parser.add_argument('-fc', '--formatconverter', help='Command that runs the formatconverter, e.g. through mono or a '
+                                                     'stand-in tool. Default: the formatconverter.exe in '
+                                                     'UniversalFileConverter.', type=str)
+parser.add_argument('-sx', '--stream_xml', help='Stream the .XML file from the StpToolkit to the formatconverter '
+                                                'through a named pipe instead of writing it to the Processing folder. '
+                                                'Falls back to .XML files if a tool rejects the pipe or named pipes '
+                                                'are not supported. Default: False.', action='store_true')
+parser.add_argument('-wr', '--hdf5_writer', help='Writer that converts the .XML file to .HDF5 file(s). formatconverter '
+                                                 'runs the formatconverter, native stream-parses the .XML file in '
+                                                 'Python with h5py and falls back to the formatconverter for files it '
+                                                 'cannot convert. Default: formatconverter.', type=str,
+                    choices=['formatconverter', 'native'], default='formatconverter')
+parser.add_argument('-sc', '--scratch', help='Scratch folder, e.g. on a local SSD or tmpfs, that the next queued .STP '
+                                             'files are staged into ahead of their conversions. Default: None.',
+                    type=str)
+parser.add_argument('-pf', '--prefetch_files', help='Maximum number of staged .STP files waiting in the scratch '
+                                                    'folder. Default: 2 x cores.', type=int)
+parser.add_argument('-pg', '--prefetch_gb', help='Maximum size, in GB, of the staged .STP files waiting in the scratch '
+                                                 'folder. Default: 10 GB.', type=float, default=10)
 parser.add_argument('-t', '--timeout', help='Number of hours to run conversions before timeout. Default: 10 hours.',
                     type=int, default=10)
+parser.add_argument('-tf', '--timeout_factor', help='Derive the timeout of each file from the conversion history as '
+                                                   'this many times its predicted duration, bounded by min_timeout and '
+                                                   'timeout. Default: None (always use timeout).', type=float)
+parser.add_argument('-mt', '--min_timeout', help='Minimum number of minutes of a timeout derived with timeout_factor. '
+                                                 'Default: 10 min.', type=int, default=10)
+parser.add_argument('-sl', '--stall_timeout', help='Time, in seconds, after which a conversion whose .XML and .HDF5 '
+                                                   'outputs in the Processing folder stopped growing is killed. '
+                                                   'Default: None.', type=int)
 parser.add_argument('-r', '--retry_filesearch_time', help='Time, in seconds, to wait in between file searches. '
                                                           'Default: 10 min/600 sec.', type=int, default=10 * 60)
 parser.add_argument('-n', '--single_hdf5_file', help='Do no split the .HDF5 file into daily .HDF5 files. '
                                                      'Default: False.', action='store_true')
+parser.add_argument('-mw', '--move_workers', help='Maximum number of de-identified .HDF5 files moved to '
+                                                  'Output\\Success at once, which hides the latency of network shares. '
+                                                  'Default: 8.', type=int, default=8)
+parser.add_argument('-dd', '--dedup', help='Fingerprint every new .STP file by its size and sampled content and move '
+                                           'the files that are byte-identical to a converted file with another name or '
+                                           'folder to Output\\Skipped\\Duplicate instead of converting them again. '
+                                           'Default: False.', action='store_true')
+parser.add_argument('-dw', '--dedup_workers', help='Maximum number of .STP files fingerprinted at once with dedup. '
+                                                   'Default: 8.', type=int, default=8)
+parser.add_argument('-pl', '--pipeline', help='Convert files as a continuous pipeline where each file is de-identified '
+                                              'and recorded as soon as its own conversion finishes instead of waiting '
+                                              'for the whole batch. Default: False.', action='store_true')
+parser.add_argument('-tr', '--tiered', help='Convert every file without wave data first and queue it for a background '
+                                            'conversion with wave data that only uses idle conversion slots and is '
+                                            'preempted when new files wait. Requires --pipeline. Default: False.',
+                    action='store_true')
+parser.add_argument('-ch', '--chunk_size', help='Walk the input folder in chunks of this many ready files and start '
+                                                'converting the first chunk while the rest of the folder is still '
+                                                'walked, so memory does not grow with the number of files. Files are '
+                                                'ready once they have not been modified for retry_filesearch_time. '
+                                                'Default: None.', type=int)
+parser.add_argument('-bf', '--backfill', help='Convert the archive in the input folder in a single pass and exit once '
+                                              'it is drained. Files that were not modified for backfill_age are ready '
+                                              'right away, the folder is walked by backfill_walkers threads at once, '
+                                              'and an interrupted backfill resumes from its checkpoint. Default: '
+                                              'False.', action='store_true')
+parser.add_argument('-ba', '--backfill_age', help='Time, in seconds, since their last modification after which files '
+                                                  'are ready with backfill. Default: 1 day/86400 sec.', type=int,
+                    default=24 * 60 * 60)
+parser.add_argument('-bw', '--backfill_walkers', help='Maximum number of directories listed at once with backfill. '
+                                                      'Default: 8.', type=int, default=8)
+parser.add_argument('-qs', '--queue_size', help='Maximum number of files waiting to be converted in pipeline mode. '
+                                                'Default: 2 x cores.', type=int)
+parser.add_argument('-st', '--settle_time', help='Watch the input folder and release each .STP file as soon as it has '
+                                                 'not changed for this many seconds instead of comparing file searches '
+                                                 'that are retry_filesearch_time apart. Default: None.', type=int)
+parser.add_argument('-we', '--watcher', help='File watcher engine to use with settle_time. Default: auto (inotify on '
+                                             'local Linux folders, otherwise polling).', type=str,
+                    choices=['auto', 'inotify', 'poll'], default='auto')
+parser.add_argument('-si', '--scan_index', help='Path to a SQLite scan index used to only search the directories of '
+                                                'the input folder that changed since the previous search. Created if '
+                                                'it does not exist. Default: None.', type=str)
+parser.add_argument('-rw', '--restat_window', help='Time, in seconds, since their last modification during which files '
+                                                   'in unchanged directories are still checked for changes by the scan '
+                                                   'index. Default: 1 hour/3600 sec.', type=int, default=60 * 60)
+parser.add_argument('-pi', '--poll_interval', help='Time, in seconds, in between checks of the file watcher. '
+                                                   'Default: 5 sec.', type=int, default=5)
+parser.add_argument('-mp', '--metrics_port', help='Serve throughput, queue depth, and per-stage latency metrics in the '
+                                                  'Prometheus text format on http://127.0.0.1:<port>/metrics. '
+                                                  'Default: None.', type=int)
+parser.add_argument('-el', '--event_log', help='Path to a JSON-lines file that every conversion and stage is appended '
+                                               'to. Default: None.', type=str)
+parser.add_argument('-oc', '--output_catalog', help='Path to a SQLite catalog that every de-identified .HDF5 file is '
+                                                    'recorded in with its patient, bed, time range, channels, and '
+                                                    'size. Created if it does not exist. Default: None.', type=str)
+parser.add_argument('-vd', '--virtual_datasets', help='Maintain a virtual .HDF5 file per patient that stitches the '
+                                                      'daily .HDF5 files of the patient together. Requires '
+                                                      '--output_catalog. Default: False.', action='store_true')
+parser.add_argument('-sj', '--state_journal', help='Path to a SQLite journal of the last durable conversion step of '
+                                                   'every file, so a restart resumes files from that step instead of '
+                                                   'converting them again. Created if it does not exist. '
+                                                   'Default: None.', type=str)
+parser.add_argument('-lq', '--lease_queue', help='Path to a SQLite lease queue on the shared volume when several nodes '
+                                                 'convert from the same input folder, so every file is converted by a '
+                                                 'single node. Created if it does not exist. Default: None.', type=str)
+parser.add_argument('-ni', '--node_id', help='Name of this node in the lease queue, which has to be unique among the '
+                                             'nodes and stay the same across restarts. Default: the host name.',
+                    type=str)
+parser.add_argument('-ld', '--lease_duration', help='Time, in seconds, after which the leases of a node that stopped '
+                                                    'renewing them are reclaimed by other nodes. Default: 10 min/600 '
+                                                    'sec.', type=int, default=10 * 60)
 
 args = parser.parse_args()
 
+# Two-stage conversions are scheduled by the asyncio engine
+if (args.stp_workers or args.hdf5_workers) and args.engine != 'asyncio':
+    parser.error('--stp_workers and --hdf5_workers require --engine asyncio')
+
+# The native writer depends on the optional h5py and NumPy packages
+if args.hdf5_writer == 'native' and not NATIVE_WRITER_AVAILABLE:
+    parser.error('--hdf5_writer native requires h5py and NumPy')
+
+# Virtual datasets are built from the files of a patient in the output catalog with the optional h5py package
+if args.virtual_datasets and not args.output_catalog:
+    parser.error('--virtual_datasets requires --output_catalog')
+if args.virtual_datasets and not VIRTUAL_DATASETS_AVAILABLE:
+    parser.error('--virtual_datasets requires h5py')
+
+# Streaming passes replace the file search of the batch cycle
+if args.chunk_size and (args.pipeline or args.settle_time):
+    parser.error('--chunk_size cannot be combined with --pipeline or --settle_time')
+if args.chunk_size is not None and args.chunk_size < 1:
+    parser.error('--chunk_size must be at least 1')
+
+# Tiered conversions share the conversion slots of the pipeline and are converted by this node alone
+if args.tiered and (not args.pipeline or args.wave_data or args.lease_queue):
+    parser.error('--tiered requires --pipeline and cannot be combined with --wave_data or --lease_queue')
+
+# Backfills walk the archive once instead of running the daemon cycle
+if args.backfill and (args.pipeline or args.settle_time):
+    parser.error('--backfill cannot be combined with --pipeline or --settle_time')
+if args.backfill and (args.backfill_age < 0 or args.backfill_walkers < 1):
+    parser.error('--backfill_age must not be negative and --backfill_walkers must be at least 1')
+
+# The concurrency controller samples the host through the optional psutil package or the /proc file system of Linux
+if args.autoscale and not AUTOSCALE_AVAILABLE:
+    parser.error('--autoscale requires psutil on systems without /proc')
+if args.autoscale and (args.min_cores < 1 or args.autoscale_interval <= 0):
+    parser.error('--min_cores must be at least 1 and --autoscale_interval must be positive')
+
+# Nodes that share an input folder are told apart by their node ID
+if not args.node_id:
+    args.node_id = socket.gethostname()
+
 if __name__ == '__main__':
 
     # Confirm that input and output folders as well as database path have been provided; if not, ask user
@@ -48,6 +225,7 @@ if __name__ == '__main__':
     if not args.database_update:
         args.database = input('Path to the folder where I should check for patient database updates: ')
     args.timeout = (args.timeout * 60 * 60)
+    args.min_timeout = (args.min_timeout * 60)
 
     # Check the paths to folders and patient database file exists
     for path in [args.input, args.output, args.database_update]:
@@ -72,16 +250,54 @@ if __name__ == '__main__':
     if not os.path.isfile(os.path.join(args.output, '_.txt')):
         pathlib.Path(os.path.join(args.input, '_.txt')).touch()
 
+    # Start collecting metrics and serving them if desired based on the user arguments
+    start_metrics(args)
+
+    # Keep the leases of this node alive if it shares the input folder with other nodes
+    start_lease_heartbeat(args)
+
+    # Finish or forget the files that were in progress when the AutoSTPtoHDF5Converter last stopped if a state journal
+    # is kept
+    resume_journal(args)
+
+    # Convert the archive in the input folder once and exit if desired based on the user arguments, checking for patient
+    # database update .CSV first so the archive is matched against the latest patient offsets
+    if args.backfill:
+        if args.database_update:
+            update_patient_database(args)
+        run_backfill(args)
+        sys.exit(0)
+
+    # Create a file watcher to release files as soon as they settle if desired based on the user arguments
+    watcher = None
+    if args.settle_time:
+        scan_index = ScanIndex(args.scan_index, args.input, args.restat_window) if args.scan_index else None
+        watcher = FileWatcher(args.input, args.settle_time, args.watcher, args.poll_interval, scan_index)
+
+    # Run the continuous conversion pipeline if desired based on the user arguments
+    if args.pipeline:
+        run_pipeline(args, watcher)
+
     # Start the cycle of finding files, converting them, and outputting them
     while True:
         print("Starting new pass...")
 
-        # Check for patient database update .CSV
-        if args.database_update:
-            update_patient_database(args)
+        # Check for patient database update .CSV and get the skipped files that were moved back to the input folder
+        # since their patient information arrived
+        requeued_files = update_patient_database(args) if args.database_update else None
+
+        # Find, convert, de-identify, and record the files chunk by chunk along with the skipped files that were just
+        # moved back if desired based on the user arguments, and wait before the next pass if no new files were found
+        if args.chunk_size:
+            if not run_streaming_pass(args, requeued_files):
+                print(f"No new files were found that are ready to be converted. Will try again in "
+                      f"{args.retry_filesearch_time} sec.")
+                time.sleep(args.retry_filesearch_time)
+            continue
 
-        # Find potential .STP files to be converted into .HDF5
-        files = find_files(args)
+        # Find potential .STP files to be converted into .HDF5 along with the skipped files that were just moved back,
+        # which were already stable when they were skipped and do not keep the search waiting for new files
+        files = find_files(args, watcher, requeued_files)
 
         # Associate .STP file to Patient ID and Offset for de-identification
         files_w_patient_info = merge_files_w_patient_info(args, files)
@@ -102,4 +318,4 @@ if __name__ == '__main__':
             continue
 
         # Update the completed files database
-        update_completed_files_database(unique_completed_files_list)
+        update_completed_files_database(args, unique_completed_files_list)
@@ -0,0 +1,139 @@
+"""
+Benchmark the throughput of passes with static numbers of concurrent conversions against --autoscale on the same
+synthetic input folder. The stand-in tools burn CPU time and then wait, like conversions that alternate between parsing
+and I/O, so the best static setting depends on the number of CPUs of the host and the mix of the two.
+
+Usage:
+python benchmarks/benchmark_autoscale.py [--files 120] [--static 1 2 4 8 16] [--cpu_seconds 0.1] [--latency 0.5]
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import shlex
+import shutil
+import sys
+import tempfile
+import time
+
+BENCHMARK_FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARK_FOLDER)
+sys.path.insert(0, os.path.join(BENCHMARK_FOLDER, '..', 'AutoSTPtoHDF5Converter'))
+
+from benchmark_end_to_end import create_input_tree, create_patient_offset_database, run_pass  # noqa: E402
+from Functions.completed_files_store import get_completed_files_store  # noqa: E402
+from Functions.concurrency_controller import get_concurrency_controller  # noqa: E402
+from Functions.conversion_history import get_conversion_history  # noqa: E402
+from Functions.patient_offset_resolver import get_patient_offset_resolver  # noqa: E402
+
+
+def run_setting(name: str, benchmark_args: argparse.Namespace, root: str, cores: int, autoscale: bool) -> None:
+    """
+    Convert a fresh synthetic input folder with a single pass and print the throughput.
+
+    :param name: String that is the name of the setting to print.
+    :type name: str
+    :param benchmark_args: argparse.Namespace that contains the arguments of the benchmark.
+    :type benchmark_args: argparse.Namespace
+    :param root: String that is the path to the folder to run the setting in.
+    :type root: str
+    :param cores: Integer that is the number of concurrent conversions or the upper bound with autoscale.
+    :type cores: int
+    :param autoscale: Boolean that is True to adjust the number of concurrent conversions to the host.
+    :type autoscale: bool
+    :return: None
+    :rtype: None
+    """
+
+    # Run from a fresh folder, since the Processing folder and the databases are relative to it, and start a fresh
+    # concurrency controller
+    folder = os.path.join(root, name)
+    os.makedirs(os.path.join(folder, 'AutoSTPtoHDF5Converter'))
+    os.chdir(folder)
+    for get_cached in [get_completed_files_store, get_concurrency_controller, get_conversion_history,
+                       get_patient_offset_resolver]:
+        get_cached.cache_clear()
+    for subfolder in ['Processing', os.path.join('Output', 'Converted')]:
+        os.makedirs(subfolder)
+        open(os.path.join(subfolder, '_.txt'), 'w').close()
+    filenames = create_input_tree('Input', benchmark_args.files, benchmark_args.size)
+    create_patient_offset_database('PatientOffset.db', filenames, 0)
+
+    fake_tools = f'{shlex.quote(sys.executable)} {shlex.quote(os.path.join(BENCHMARK_FOLDER, "fake_tools.py"))}'
+    tool_options = f'--latency {benchmark_args.latency} --cpu_seconds {benchmark_args.cpu_seconds}'
+    args = argparse.Namespace(
+        input='Input', output='Output', database='PatientOffset.db', database_update=None, system='cs',
+        wave_data=False, delete_stp=False, cores=cores, engine='process', max_conversions=None, stp_workers=None,
+        hdf5_workers=None, xml_spool=None, schedule='fifo', stptoolkit=f'{fake_tools} stptoolkit {tool_options}',
+        formatconverter=f'{fake_tools} formatconverter {tool_options}', stream_xml=False, timeout=3600,
+        timeout_factor=None, min_timeout=600, stall_timeout=None, single_hdf5_file=False,
+        hdf5_writer='formatconverter', move_workers=8, autoscale=autoscale, min_cores=1,
+        autoscale_interval=benchmark_args.interval, min_free_gb=0, scratch=None, prefetch_files=None, prefetch_gb=10,
+        dedup=False, dedup_workers=8, scan_index=None, restat_window=3600, output_catalog=None,
+        virtual_datasets=False, state_journal=None, lease_queue=None, node_id=None, lease_duration=600)
+
+    # Keep the console output of the pass to count the decisions of the controller
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        start_time = time.perf_counter()
+        _, converted = run_pass(args)
+        total_time = time.perf_counter() - start_time
+
+    decisions = [line for line in output.getvalue().splitlines() if ' concurrent conversions from ' in line]
+    final_limit = decisions[-1].split(' to ', 1)[1].split()[0] if decisions else '-'
+    print(f"{name:<16}{converted:>10}{total_time:>10.1f}{converted / total_time * 3600:>14.0f}{len(decisions):>11}"
+          f"{final_limit:>8}")
+    if benchmark_args.verbose:
+        for decision in decisions:
+            print(f"    {decision}")
+
+    os.chdir(root)
+    shutil.rmtree(folder, ignore_errors=True)
+
+
+def main() -> None:
+    """
+    Run the autoscale benchmark with the arguments provided by the user.
+
+    :return: None
+    :rtype: None
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmark static numbers of concurrent conversions against '
+                                                 'autoscale with stand-in tools.')
+    parser.add_argument('--files', help='Number of .STP files to convert per setting. Default: 120.', type=int,
+                        default=120)
+    parser.add_argument('--size', help='Size of every .STP file in bytes. Default: 1024.', type=int, default=1024)
+    parser.add_argument('--static', help='Static numbers of concurrent conversions. Default: 1 2 4 8 16.', type=int,
+                        nargs='+', default=[1, 2, 4, 8, 16])
+    parser.add_argument('--cpu_seconds', help='Seconds of CPU time every tool burns. Default: 0.1.', type=float,
+                        default=0.1)
+    parser.add_argument('--latency', help='Seconds every tool waits after burning CPU time. Default: 0.5.', type=float,
+                        default=0.5)
+    parser.add_argument('--interval', help='Seconds in between samples of the controller. Default: 1.', type=float,
+                        default=1)
+    parser.add_argument('--verbose', help='Print every decision of the controller. Default: False.',
+                        action='store_true')
+    parser.add_argument('--directory', help='Folder to create the synthetic data in. Default: a temporary folder.',
+                        type=str)
+    benchmark_args = parser.parse_args()
+
+    root = os.path.abspath(tempfile.mkdtemp(prefix='autoscale_benchmark_', dir=benchmark_args.directory))
+    working_directory = os.getcwd()
+    try:
+        print(f"{os.cpu_count()} CPUs, {benchmark_args.files} files, tools burn {benchmark_args.cpu_seconds} sec of "
+              f"CPU time and wait {benchmark_args.latency} sec")
+        print(f"{'Setting':<16}{'Files':>10}{'Seconds':>10}{'Files/hour':>14}{'Decisions':>11}{'Limit':>8}")
+        for cores in benchmark_args.static:
+            run_setting(f'static {cores}', benchmark_args, root, cores, False)
+        run_setting(f'autoscale 1-{max(benchmark_args.static)}', benchmark_args, root, max(benchmark_args.static),
+                    True)
+
+    finally:
+        os.chdir(working_directory)
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+Benchmark the fingerprints of --dedup: the sample hash of every new .STP file, one after another and in parallel,
+against the full hash that is only needed when a sample hash matches a converted file. Point --directory to the input
+share to measure a real setup.
+
+Usage:
+python benchmarks/benchmark_dedup.py [--files 20] [--size_mb 200] [--workers 8] [--directory PATH]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'AutoSTPtoHDF5Converter'))
+
+from Functions.fingerprint import full_hash, hash_files, sample_hash  # noqa: E402
+
+
+def time_hashing(name: str, hash_function, paths: list, workers: int) -> None:
+    """
+    Hash every file and print the time per file and the throughput relative to the size of the files.
+
+    :param name: String that is the name of the hashing method to print.
+    :type name: str
+    :param hash_function: Function that hashes a single file, i.e. sample_hash or full_hash.
+    :type hash_function: Callable
+    :param paths: List of the paths to the files to hash.
+    :type paths: list
+    :param workers: Integer that is the maximum number of files hashed at once.
+    :type workers: int
+    :return: None
+    :rtype: None
+    """
+
+    start_time = time.perf_counter()
+    hash_files(hash_function, paths, workers)
+    seconds = time.perf_counter() - start_time
+    megabytes = sum(os.path.getsize(path) for path in paths) / (1024 * 1024)
+    print(f"{name:<24}{workers:>8}{seconds:>10.2f}{seconds / len(paths) * 1000:>12.1f}{megabytes / seconds:>12.0f}")
+
+
+def main() -> None:
+    """
+    Run the dedup benchmark with the arguments provided by the user.
+
+    :return: None
+    :rtype: None
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmark the sample and full hashes of --dedup.')
+    parser.add_argument('--files', help='Number of .STP files to hash. Default: 20.', type=int, default=20)
+    parser.add_argument('--size_mb', help='Size of every .STP file in MB. Default: 200.', type=float, default=200)
+    parser.add_argument('--workers', help='Number of files hashed at once in parallel. Default: 8.', type=int,
+                        default=8)
+    parser.add_argument('--directory', help='Folder to create the .STP files in, e.g. on the input share. Default: a '
+                                            'temporary folder.', type=str)
+    benchmark_args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix='dedup_benchmark_', dir=benchmark_args.directory)
+    try:
+        content = os.urandom(1024 * 1024)
+        paths = []
+        for i in range(benchmark_args.files):
+            path = os.path.join(folder, f'BED{i:03}-{1500000000 + i * 3600}.Stp')
+            with open(path, 'wb') as stp_file:
+                stp_file.write(i.to_bytes(8, 'little'))
+                for _ in range(int(benchmark_args.size_mb)):
+                    stp_file.write(content)
+            paths.append(path)
+
+        # The files were just written and are in the page cache, so the times are a lower bound for a network share
+        print(f"{'Hash':<24}{'Workers':>8}{'Seconds':>10}{'ms/file':>12}{'MB/s':>12}")
+        time_hashing('sample', sample_hash, paths, 1)
+        time_hashing('sample', sample_hash, paths, benchmark_args.workers)
+        time_hashing('full', full_hash, paths, 1)
+        time_hashing('full', full_hash, paths, benchmark_args.workers)
+
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
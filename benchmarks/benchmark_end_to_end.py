@@ -0,0 +1,258 @@
+"""
+Benchmark a full pass of the AutoSTPtoHDF5Converter, i.e. scanning the input folder, looking up the CompletedFiles and
+patient offset databases, converting, de-identifying, and recording the files, on a synthetic input tree with the
+stand-in tools in benchmarks/fake_tools.py.
+
+Scenarios:
+small       10k small files with fast tools, which is dominated by the overhead of the wrapper itself
+huge        a few huge files, which is dominated by copying and the tools
+databases   1k files against 1M-row PatientOffset and CompletedFiles databases
+failures    files that fail or hang, which are killed by the stall timeout
+
+Usage:
+python benchmarks/benchmark_end_to_end.py [--scenario all] [--scale 1] [--cores 6] [--engine process]
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import shlex
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+BENCHMARK_FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_FOLDER, '..', 'AutoSTPtoHDF5Converter'))
+
+from Functions.completed_files_store import COMPLETED_FILES_DATABASE, get_completed_files_store  # noqa: E402
+from Functions.conversion_history import get_conversion_history  # noqa: E402
+from Functions.convert_files import convert_files  # noqa: E402
+from Functions.deidentify_file_names import deidentify_file_names  # noqa: E402
+from Functions.find_files import remove_completed_files, scan_input_files  # noqa: E402
+from Functions.merge_files_w_patient_info import merge_files_w_patient_info  # noqa: E402
+from Functions.patient_offset_resolver import get_patient_offset_resolver  # noqa: E402
+from Functions.update_completed_files_database import update_completed_files_database  # noqa: E402
+
+# Files, .STP size in bytes, extra database rows, and stand-in tool options of every scenario before scaling
+SCENARIOS = {
+    'small': {'files': 10000, 'size': 4 * 1024, 'database_rows': 0, 'tool_options': '--latency 0.01'},
+    'huge': {'files': 4, 'size': 256 * 1024 * 1024, 'database_rows': 0, 'tool_options': '--seconds_per_mb 0.002'},
+    'databases': {'files': 1000, 'size': 4 * 1024, 'database_rows': 1000000, 'tool_options': '--latency 0.01'},
+    'failures': {'files': 200, 'size': 4 * 1024, 'database_rows': 0,
+                 'tool_options': '--latency 0.01 --fail_rate 0.05 --hang_rate 0.02'},
+}
+
+
+def create_input_tree(input_folder: str, files: int, size: int, files_per_folder: int = 500) -> list:
+    """
+    Create a synthetic input folder of .STP files spread across bed folders.
+
+    :param input_folder: String that is the path to the input folder to create.
+    :type input_folder: str
+    :param files: Integer that is the number of .STP files to create.
+    :type files: int
+    :param size: Integer that is the size of every .STP file in bytes.
+    :type size: int
+    :param files_per_folder: Integer that is the number of .STP files in each bed folder.
+    :type files_per_folder: int
+    :return: List of the filenames that were created.
+    :rtype: list
+    """
+
+    filenames = []
+    content = b'x' * size
+    for i in range(files):
+        bed = f'BED{i // files_per_folder:03}'
+        os.makedirs(os.path.join(input_folder, bed), exist_ok=True)
+        filename = f'{bed}-{1500000000 + i * 3600}.Stp'
+        with open(os.path.join(input_folder, bed, filename), 'wb') as stp_file:
+            stp_file.write(content)
+        filenames.append(filename)
+
+    return filenames
+
+
+def create_patient_offset_database(database_path: str, filenames: list, extra_rows: int) -> None:
+    """
+    Create a PatientOffset database with an entry for every file plus extra rows of unrelated files.
+
+    :param database_path: String that is the path to the patient offset database to create.
+    :type database_path: str
+    :param filenames: List of .STP filenames to add to the database.
+    :type filenames: list
+    :param extra_rows: Integer that is the number of unrelated rows to add.
+    :type extra_rows: int
+    :return: None
+    :rtype: None
+    """
+
+    with contextlib.closing(sqlite3.connect(database_path)) as conn, conn:
+        conn.execute('CREATE TABLE PatientOffset (STPFile TEXT, PatientID INTEGER, Offset INTEGER)')
+        conn.executemany('INSERT INTO PatientOffset VALUES (?, ?, ?)',
+                         ((f'OLD{i // 1000:04}-{1000000000 + i}.Stp', i % 5000, 86400 * (i % 365))
+                          for i in range(extra_rows)))
+        conn.executemany('INSERT INTO PatientOffset VALUES (?, ?, ?)',
+                         ((filename, i % 5000, 86400 * (i % 365)) for i, filename in enumerate(filenames)))
+        conn.execute('CREATE UNIQUE INDEX PatientOffsetSTPFile ON PatientOffset (STPFile)')
+
+
+def create_completed_files_database(database_path: str, rows: int) -> None:
+    """
+    Create a CompletedFiles database with rows of unrelated files that were converted before.
+
+    :param database_path: String that is the path to the CompletedFiles database to create.
+    :type database_path: str
+    :param rows: Integer that is the number of rows to add.
+    :type rows: int
+    :return: None
+    :rtype: None
+    """
+
+    with contextlib.closing(sqlite3.connect(database_path)) as conn, conn:
+        conn.execute('CREATE TABLE "CompletedFiles" ("CompletedFiles" TEXT UNIQUE, PRIMARY KEY("CompletedFiles"))')
+        conn.executemany('INSERT INTO CompletedFiles VALUES (?)',
+                         ((f'OLD{i // 1000:04}-{1000000000 + i}.Stp',) for i in range(rows)))
+
+
+def run_pass(args: argparse.Namespace) -> tuple:
+    """
+    Run a single pass of the conversion cycle the way __main__ does, timing each step.
+
+    :param args: argparse.Namespace that contains the arguments of the AutoSTPtoHDF5Converter.
+    :type args: argparse.Namespace
+    :return: Tuple of a dictionary of step name to seconds and the number of converted files.
+    :rtype: tuple
+    """
+
+    timings = {}
+
+    start_time = time.perf_counter()
+    files = scan_input_files(args)
+    files['Filename'] = files['Path'].apply(os.path.basename)
+    timings['scan'] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    files = remove_completed_files(args, files)
+    files_w_patient_info = merge_files_w_patient_info(args, files)
+    timings['database lookup'] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    convert_files(args, files_w_patient_info)
+    timings['conversion'] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    completed_files = deidentify_file_names(args, files_w_patient_info)
+    timings['rename'] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    if completed_files:
+        update_completed_files_database(args, completed_files)
+    timings['database update'] = time.perf_counter() - start_time
+
+    return timings, len(completed_files) if completed_files else 0
+
+
+def run_scenario(name: str, benchmark_args: argparse.Namespace, root: str) -> None:
+    """
+    Create the synthetic data of a scenario, run a pass on it, and print the results.
+
+    :param name: String that is the name of the scenario.
+    :type name: str
+    :param benchmark_args: argparse.Namespace that contains the arguments of the benchmark.
+    :type benchmark_args: argparse.Namespace
+    :param root: String that is the path to the folder to run the scenario in.
+    :type root: str
+    :return: None
+    :rtype: None
+    """
+
+    scenario = SCENARIOS[name]
+    files = max(1, int(scenario['files'] * benchmark_args.scale))
+    size = max(1, int(scenario['size'] * benchmark_args.size_scale))
+    database_rows = int(scenario['database_rows'] * benchmark_args.scale)
+
+    # Run from the scenario folder, since the Processing folder and CompletedFiles database are relative to it, and
+    # forget the databases opened by earlier scenarios under the same relative paths
+    scenario_root = os.path.join(root, name)
+    os.makedirs(os.path.join(scenario_root, 'AutoSTPtoHDF5Converter'))
+    os.chdir(scenario_root)
+    for get_database in [get_completed_files_store, get_conversion_history, get_patient_offset_resolver]:
+        get_database.cache_clear()
+    for folder in ['Processing', os.path.join('Output', 'Converted')]:
+        os.makedirs(folder)
+        open(os.path.join(folder, '_.txt'), 'w').close()
+
+    print(f"Scenario '{name}': creating {files} files of {size} bytes and {database_rows} extra database rows...")
+    filenames = create_input_tree('Input', files, size)
+    open(os.path.join('Input', '_.txt'), 'w').close()
+    create_patient_offset_database('PatientOffset.db', filenames, database_rows)
+    create_completed_files_database(COMPLETED_FILES_DATABASE, database_rows)
+
+    fake_tools = f'{shlex.quote(sys.executable)} {shlex.quote(os.path.join(BENCHMARK_FOLDER, "fake_tools.py"))}'
+    args = argparse.Namespace(
+        input='Input', output='Output', database='PatientOffset.db', database_update=None, system='cs',
+        wave_data=False, delete_stp=False, cores=benchmark_args.cores, engine=benchmark_args.engine,
+        max_conversions=None, stp_workers=None, hdf5_workers=None, xml_spool=None, schedule='fifo',
+        stptoolkit=f'{fake_tools} stptoolkit {scenario["tool_options"]}',
+        formatconverter=f'{fake_tools} formatconverter {scenario["tool_options"]}', stream_xml=False,
+        timeout=3600, timeout_factor=None, min_timeout=600, stall_timeout=5, single_hdf5_file=False,
+        hdf5_writer='formatconverter', move_workers=8, autoscale=False, min_cores=1, autoscale_interval=30,
+        min_free_gb=10, scratch=None, prefetch_files=None, prefetch_gb=10,
+        dedup=False, dedup_workers=8, scan_index=None, restat_window=3600, output_catalog=None,
+        virtual_datasets=False, state_journal=None, lease_queue=None, node_id=None, lease_duration=600)
+
+    # Silence the per-file console output of the pass
+    with contextlib.redirect_stdout(io.StringIO()):
+        start_time = time.perf_counter()
+        timings, converted = run_pass(args)
+        total_time = time.perf_counter() - start_time
+
+    print(f"{'Step':<24}{'Seconds':>12}")
+    for step, seconds in timings.items():
+        print(f"{step:<24}{seconds:>12.2f}")
+    print(f"{'total':<24}{total_time:>12.2f}")
+    print(f"Converted {converted}/{files} files: {converted / total_time * 3600:.0f} files/hour\n")
+
+
+def main() -> None:
+    """
+    Run the end-to-end benchmark with the arguments provided by the user.
+
+    :return: None
+    :rtype: None
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmark full passes on synthetic data with stand-in tools.')
+    parser.add_argument('--scenario', help='Scenario to run. Default: all.', type=str,
+                        choices=list(SCENARIOS) + ['all'], default='all')
+    parser.add_argument('--scale', help='Factor for the number of files and database rows. Default: 1.', type=float,
+                        default=1)
+    parser.add_argument('--size_scale', help='Factor for the size of the files. Default: 1.', type=float, default=1)
+    parser.add_argument('--cores', help='Number of concurrent conversions. Default: 6.', type=int, default=6)
+    parser.add_argument('--engine', help='Conversion engine. Default: process.', type=str,
+                        choices=['process', 'asyncio'], default='process')
+    parser.add_argument('--directory', help='Folder to create the synthetic data in. Default: a temporary folder.',
+                        type=str)
+    parser.add_argument('--keep', help='Keep the synthetic data after the benchmark. Default: False.',
+                        action='store_true')
+    benchmark_args = parser.parse_args()
+
+    root = benchmark_args.directory if benchmark_args.directory else tempfile.mkdtemp(prefix='end_to_end_benchmark_')
+    working_directory = os.getcwd()
+
+    try:
+        for name in SCENARIOS if benchmark_args.scenario == 'all' else [benchmark_args.scenario]:
+            run_scenario(name, benchmark_args, os.path.abspath(root))
+            os.chdir(working_directory)
+
+    finally:
+        os.chdir(working_directory)
+        if not benchmark_args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
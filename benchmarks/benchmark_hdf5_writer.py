@@ -0,0 +1,164 @@
+"""
+Benchmark the native .XML to .HDF5 writer, and optionally the formatconverter, on synthetic StpToolkit .XML files of
+increasing size and report the conversion time, throughput, and peak resident memory of each.
+
+Usage:
+python benchmarks/benchmark_hdf5_writer.py [--sizes 10 100 1000] [--formatconverter "mono formatconverter.exe"]
+"""
+
+import argparse
+import datetime
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'AutoSTPtoHDF5Converter'))
+
+from Functions.conversion_tools import formatconverter_params  # noqa: E402
+from Functions.native_hdf5_writer import NATIVE_WRITER_AVAILABLE, write_native_hdf5  # noqa: E402
+
+# Vital signs in every record and the waveform channels with their sample rates
+VITAL_SIGNS = ('HR', 'SPO2-%', 'RESP', 'NBP-S', 'NBP-D', 'NBP-M', 'TEMP', 'PVC')
+WAVEFORMS = (('II', 240), ('SPO2', 60), ('RESP', 60))
+
+
+def create_xml(xml_path: str, size_mb: float, wave_data: bool) -> int:
+    """
+    Create a synthetic StpToolkit .XML file with a record of vital signs, and waveforms if desired, every 2 seconds.
+
+    :param xml_path: String that is the path to the .XML file to create.
+    :type xml_path: str
+    :param size_mb: Float that is the approximate size of the .XML file in MB.
+    :type size_mb: float
+    :param wave_data: Boolean that is True to add waveform records.
+    :type wave_data: bool
+    :return: Integer that is the number of records written.
+    :rtype: int
+    """
+
+    start_time = datetime.datetime(2017, 1, 1, 20, 0, 0)
+    target_size = size_mb * 1024 * 1024
+    records = 0
+    with open(xml_path, 'w') as xml_file:
+        xml_file.write('<?xml version="1.0" encoding="utf-8"?>\n<PatientData>\n')
+        while xml_file.tell() < target_size:
+            collection_time = (start_time + datetime.timedelta(seconds=2 * records)).isoformat()
+            vital_signs = ''.join(f'<VitalSign><Par>{name}</Par><Value UOM="">{(records + i) % 150}</Value></VitalSign>'
+                                  for i, name in enumerate(VITAL_SIGNS))
+            xml_file.write(f'<VitalSigns CollectionTimeUTC="{collection_time}">{vital_signs}</VitalSigns>\n')
+            if wave_data:
+                waveforms = ''.join(f'<WaveformData Channel="{channel}" UOM="mV" SampleRate="{rate}">'
+                                    f'{",".join(str((records + i) % 1024) for i in range(2 * rate))}</WaveformData>'
+                                    for channel, rate in WAVEFORMS)
+                xml_file.write(f'<Waveforms CollectionTimeUTC="{collection_time}">{waveforms}</Waveforms>\n')
+            records += 1
+        xml_file.write('</PatientData>\n')
+
+    return records
+
+
+def time_native(xml_path: str) -> tuple:
+    """
+    Convert an .XML file with the native writer.
+
+    :param xml_path: String that is the path to the .XML file.
+    :type xml_path: str
+    :return: Tuple of the seconds the conversion took and the peak resident memory of this process in MB so far.
+    :rtype: tuple
+    """
+
+    args = argparse.Namespace(single_hdf5_file=False)
+    start_time = time.perf_counter()
+    if not write_native_hdf5(args, xml_path, 86400 * 100):
+        raise RuntimeError(f'The native writer could not convert {xml_path}')
+    seconds = time.perf_counter() - start_time
+
+    # ru_maxrss is in KB on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    return seconds, peak
+
+
+def time_formatconverter(formatconverter: str, xml_path: str) -> tuple:
+    """
+    Convert an .XML file with the formatconverter the way the AutoSTPtoHDF5Converter runs it.
+
+    :param formatconverter: String that is the command that runs the formatconverter.
+    :type formatconverter: str
+    :param xml_path: String that is the path to the .XML file.
+    :type xml_path: str
+    :return: Tuple of the seconds the conversion took and the peak memory of the child processes in MB.
+    :rtype: tuple
+    """
+
+    args = argparse.Namespace(formatconverter=formatconverter, single_hdf5_file=False)
+    start_time = time.perf_counter()
+    subprocess.run(formatconverter_params(args, xml_path, 86400 * 100), stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL, check=True)
+    seconds = time.perf_counter() - start_time
+
+    # ru_maxrss is in KB on Linux
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+    return seconds, peak
+
+
+def main() -> None:
+    """
+    Run the .HDF5 writer benchmark with the arguments provided by the user.
+
+    :return: None
+    :rtype: None
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmark the native .XML to .HDF5 writer on synthetic .XML files.')
+    parser.add_argument('--sizes', help='Sizes of the .XML files in MB. Default: 10 100 1000.', type=float, nargs='+',
+                        default=[10, 100, 1000])
+    parser.add_argument('--wave_data', help='Add waveform records to the .XML files. Default: False.',
+                        action='store_true')
+    parser.add_argument('--formatconverter', help='Command that runs the formatconverter to compare against. '
+                                                  'Default: None.', type=str)
+    parser.add_argument('--directory', help='Folder to create the synthetic files in. Default: a temporary folder.',
+                        type=str)
+    benchmark_args = parser.parse_args()
+
+    if not NATIVE_WRITER_AVAILABLE:
+        parser.error('The native writer requires h5py and NumPy')
+
+    root = benchmark_args.directory if benchmark_args.directory else tempfile.mkdtemp(prefix='hdf5_writer_benchmark_')
+    os.makedirs(root, exist_ok=True)
+
+    print(f"{'Writer':<18}{'XML MB':>10}{'Records':>12}{'Seconds':>10}{'MB/s':>10}{'Peak RSS MB':>12}{'HDF5 MB':>10}")
+    try:
+        for size_mb in benchmark_args.sizes:
+            writers = [('native', time_native)]
+            if benchmark_args.formatconverter:
+                writers.append(('formatconverter',
+                                lambda path: time_formatconverter(benchmark_args.formatconverter, path)))
+
+            for writer, time_writer in writers:
+                # Use a fresh folder per run so the .HDF5 files of both writers are measured separately
+                folder = os.path.join(root, f'{writer}-{size_mb:g}')
+                os.makedirs(folder)
+                xml_path = os.path.join(folder, 'BED01-1483300800.xml')
+                records = create_xml(xml_path, size_mb, benchmark_args.wave_data)
+                xml_mb = os.path.getsize(xml_path) / (1024 * 1024)
+
+                seconds, peak = time_writer(xml_path)
+                hdf5_mb = sum(os.path.getsize(os.path.join(folder, name)) for name in os.listdir(folder)
+                              if name.endswith('.hdf5')) / (1024 * 1024)
+                print(f"{writer:<18}{xml_mb:>10.1f}{records:>12}{seconds:>10.2f}{xml_mb / seconds:>10.1f}"
+                      f"{peak:>12.1f}{hdf5_mb:>10.1f}")
+                shutil.rmtree(folder)
+
+    finally:
+        if not benchmark_args.directory:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+Benchmark moving de-identified .HDF5 files into per-patient folders one after another with os.renames, the way they
+used to be moved, against the batched move engine with different numbers of workers. Point --directory to a network
+share to measure the latency the workers hide.
+
+Usage:
+python benchmarks/benchmark_move_engine.py [--files 2000] [--patients 50] [--workers 1 4 8 16] [--directory PATH]
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'AutoSTPtoHDF5Converter'))
+
+from Functions import move_engine  # noqa: E402
+
+
+def create_batch(folder: str, files: int, patients: int) -> tuple:
+    """
+    Create a folder of empty daily .HDF5 files and their de-identified destination paths across patient folders.
+
+    :param folder: String that is the path to the folder to create the batch in.
+    :type folder: str
+    :param files: Integer that is the number of .HDF5 files to create.
+    :type files: int
+    :param patients: Integer that is the number of patients the files belong to.
+    :type patients: int
+    :return: Tuple of the list of source paths and the list of destination paths.
+    :rtype: tuple
+    """
+
+    converted_folder = os.path.join(folder, 'Converted')
+    os.makedirs(converted_folder)
+    source_paths, destination_paths = [], []
+    for i in range(files):
+        patient_id = str(i % patients)
+        source_path = os.path.join(converted_folder, f'BED{i % 100:02}-{1500000000 + i}-_-2017-01-{i % 28 + 1:02}.hdf5')
+        open(source_path, 'wb').close()
+        source_paths.append(source_path)
+        destination_paths.append(os.path.join(folder, 'Success', patient_id, f'UVA_{patient_id}_{i:05}_V.hdf5'))
+
+    return source_paths, destination_paths
+
+
+def main() -> None:
+    """
+    Run the move engine benchmark with the arguments provided by the user.
+
+    :return: None
+    :rtype: None
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmark the batched move engine against moving files one after '
+                                                 'another.')
+    parser.add_argument('--files', help='Number of .HDF5 files in the batch. Default: 2000.', type=int, default=2000)
+    parser.add_argument('--patients', help='Number of patient folders the files are moved to. Default: 50.', type=int,
+                        default=50)
+    parser.add_argument('--workers', help='Numbers of workers of the move engine to compare. Default: 1 4 8 16.',
+                        type=int, nargs='+', default=[1, 4, 8, 16])
+    parser.add_argument('--directory', help='Folder to create the files in, e.g. on a network share. Default: a '
+                                            'temporary folder.', type=str)
+    benchmark_args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='move_engine_benchmark_', dir=benchmark_args.directory)
+    try:
+        print(f"{'Engine':<18}{'Files':>8}{'Seconds':>10}{'Files/sec':>12}")
+
+        # Move the files one after another the way deidentify_file_names used to
+        folder = os.path.join(root, 'os.renames')
+        source_paths, destination_paths = create_batch(folder, benchmark_args.files, benchmark_args.patients)
+        start_time = time.perf_counter()
+        for source_path, destination_path in zip(source_paths, destination_paths):
+            os.renames(source_path, destination_path)
+        seconds = time.perf_counter() - start_time
+        print(f"{'os.renames':<18}{benchmark_args.files:>8}{seconds:>10.2f}{benchmark_args.files / seconds:>12.0f}")
+
+        for workers in benchmark_args.workers:
+            # Forget the folders created by the previous run so every run creates its own
+            folder = os.path.join(root, f'{workers}-workers')
+            source_paths, destination_paths = create_batch(folder, benchmark_args.files, benchmark_args.patients)
+            move_engine.CREATED_FOLDERS.clear()
+            start_time = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                move_engine.move_files(source_paths, destination_paths, workers)
+            seconds = time.perf_counter() - start_time
+            print(f"{f'{workers} workers':<18}{benchmark_args.files:>8}{seconds:>10.2f}"
+                  f"{benchmark_args.files / seconds:>12.0f}")
+
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""
+Benchmark several AutoSTPtoHDF5Converter nodes that convert from the same input folder through a lease queue, with the
+stand-in tools in benchmarks/fake_tools.py, and report the throughput of each number of nodes and whether every file was
+committed exactly once.
+
+Every node is a separate process with its own working directory, i.e. its own Processing folder and CompletedFiles
+database, like a separate host, and all nodes share the input folder, output folder, patient database, and lease queue.
+
+Usage:
+python benchmarks/benchmark_multi_node.py [--nodes 1 2 4] [--files 200] [--cores 2] [--latency 0.05]
+"""
+
+import argparse
+import collections
+import contextlib
+import glob
+import io
+import json
+import os
+import shlex
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARK_FOLDER)
+sys.path.insert(0, os.path.join(BENCHMARK_FOLDER, '..', 'AutoSTPtoHDF5Converter'))
+
+from benchmark_end_to_end import create_input_tree, create_patient_offset_database, run_pass  # noqa: E402
+from Functions.lease_queue import start_lease_heartbeat  # noqa: E402
+
+
+def run_node(node_args: argparse.Namespace) -> None:
+    """
+    Run passes of a single node until the shared input folder is empty and print the files it committed as JSON.
+
+    :param node_args: argparse.Namespace that contains the arguments of the node.
+    :type node_args: argparse.Namespace
+    :return: None
+    :rtype: None
+    """
+
+    shared = node_args.shared
+    os.makedirs(os.path.join(node_args.node_folder, 'AutoSTPtoHDF5Converter'))
+    os.makedirs(os.path.join(node_args.node_folder, 'Processing'))
+    os.chdir(node_args.node_folder)
+    open(os.path.join('Processing', '_.txt'), 'w').close()
+
+    tool_options = f'--latency {node_args.latency}'
+    fake_tools = f'{shlex.quote(sys.executable)} {shlex.quote(os.path.join(BENCHMARK_FOLDER, "fake_tools.py"))}'
+    args = argparse.Namespace(
+        input=os.path.join(shared, 'Input'), output=os.path.join(shared, 'Output'),
+        database=os.path.join(shared, 'PatientOffset.db'), database_update=None, system='cs', wave_data=False,
+        delete_stp=False, cores=node_args.cores, engine='process', max_conversions=None, stp_workers=None,
+        hdf5_workers=None, xml_spool=None, schedule='fifo', stptoolkit=f'{fake_tools} stptoolkit {tool_options}',
+        formatconverter=f'{fake_tools} formatconverter {tool_options}', stream_xml=False, timeout=3600,
+        timeout_factor=None, min_timeout=600, stall_timeout=None, single_hdf5_file=False,
+        hdf5_writer='formatconverter', move_workers=8, autoscale=False, min_cores=1, autoscale_interval=30,
+        min_free_gb=10, scratch=None, prefetch_files=None, prefetch_gb=10,
+        dedup=False, dedup_workers=8, scan_index=None, restat_window=3600, output_catalog=None,
+        virtual_datasets=False, state_journal=None, lease_queue=os.path.join(shared, 'Leases.db'),
+        node_id=node_args.node_id, lease_duration=60)
+
+    # Keep passing over the input folder until every file was committed by some node and moved out of it
+    committed = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        start_lease_heartbeat(args)
+        while glob.glob(os.path.join(args.input, '**', '*.Stp'), recursive=True):
+            _, converted = run_pass(args)
+            if not converted:
+                time.sleep(0.2)
+        with contextlib.closing(sqlite3.connect(args.lease_queue)) as conn:
+            committed = [row[0] for row in conn.execute('SELECT Filename FROM Leases WHERE Owner = ? AND '
+                                                        'State = \'done\'', (args.node_id,))]
+
+    print(json.dumps(committed))
+
+
+def run_nodes(benchmark_args: argparse.Namespace, root: str, nodes: int) -> None:
+    """
+    Create the shared synthetic data, run the nodes on it at once, and print the results.
+
+    :param benchmark_args: argparse.Namespace that contains the arguments of the benchmark.
+    :type benchmark_args: argparse.Namespace
+    :param root: String that is the path to the folder to run the nodes in.
+    :type root: str
+    :param nodes: Integer that is the number of nodes to run.
+    :type nodes: int
+    :return: None
+    :rtype: None
+    """
+
+    shared = os.path.join(root, f'{nodes}-nodes')
+    os.makedirs(os.path.join(shared, 'Output', 'Converted'))
+    open(os.path.join(shared, 'Output', 'Converted', '_.txt'), 'w').close()
+    filenames = create_input_tree(os.path.join(shared, 'Input'), benchmark_args.files, 4 * 1024)
+    open(os.path.join(shared, 'Input', '_.txt'), 'w').close()
+    create_patient_offset_database(os.path.join(shared, 'PatientOffset.db'), filenames, 0)
+
+    start_time = time.perf_counter()
+    processes = [subprocess.Popen([sys.executable, os.path.abspath(__file__), '--run_node', '--shared', shared,
+                                   '--node_folder', os.path.join(shared, f'node{i}'), '--node_id', f'node{i}',
+                                   '--cores', str(benchmark_args.cores), '--latency', str(benchmark_args.latency)],
+                                  stdout=subprocess.PIPE, text=True) for i in range(nodes)]
+    commits = collections.Counter()
+    per_node = []
+    for process in processes:
+        stdout, _ = process.communicate()
+        node_committed = json.loads(stdout.strip().splitlines()[-1])
+        per_node.append(len(node_committed))
+        commits.update(node_committed)
+    total_time = time.perf_counter() - start_time
+
+    # Every file has to be committed by exactly one node and de-identified exactly once
+    success_files = len(glob.glob(os.path.join(shared, 'Output', 'Success', '**', '*.hdf5'), recursive=True))
+    missing = len(set(filenames) - set(commits))
+    duplicates = sum(1 for committed_count in commits.values() if committed_count > 1)
+    print(f"{nodes:>6}{total_time:>10.2f}{benchmark_args.files / total_time * 3600:>14.0f}"
+          f"{'/'.join(map(str, per_node)):>24}{success_files:>10}{missing:>10}{duplicates:>12}")
+
+
+def main() -> None:
+    """
+    Run the multi-node benchmark, or a single node of it, with the arguments provided by the user.
+
+    :return: None
+    :rtype: None
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmark several nodes that share an input folder through a lease '
+                                                 'queue on synthetic data with stand-in tools.')
+    parser.add_argument('--nodes', help='Numbers of nodes to run. Default: 1 2 4.', type=int, nargs='+',
+                        default=[1, 2, 4])
+    parser.add_argument('--files', help='Number of .STP files in the shared input folder. Default: 200.', type=int,
+                        default=200)
+    parser.add_argument('--cores', help='Number of concurrent conversions per node. Default: 2.', type=int, default=2)
+    parser.add_argument('--latency', help='Seconds every stand-in tool run takes. Default: 0.05.', type=float,
+                        default=0.05)
+    parser.add_argument('--directory', help='Folder to create the synthetic data in. Default: a temporary folder.',
+                        type=str)
+    parser.add_argument('--run_node', help=argparse.SUPPRESS, action='store_true')
+    parser.add_argument('--shared', help=argparse.SUPPRESS, type=str)
+    parser.add_argument('--node_folder', help=argparse.SUPPRESS, type=str)
+    parser.add_argument('--node_id', help=argparse.SUPPRESS, type=str)
+    benchmark_args = parser.parse_args()
+
+    if benchmark_args.run_node:
+        run_node(benchmark_args)
+        return
+
+    root = benchmark_args.directory if benchmark_args.directory else tempfile.mkdtemp(prefix='multi_node_benchmark_')
+    try:
+        print(f"{'Nodes':>6}{'Seconds':>10}{'Files/hour':>14}{'Committed per node':>24}{'Success':>10}"
+              f"{'Missing':>10}{'Duplicates':>12}")
+        for nodes in benchmark_args.nodes:
+            run_nodes(benchmark_args, os.path.abspath(root), nodes)
+
+    finally:
+        if not benchmark_args.directory:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""
+Benchmark the persistent scan index against the full recursive search of the input folder on a synthetic tree of
+nested bed folders.
+
+Usage:
+python benchmarks/benchmark_scan_index.py [--files 1000000] [--files_per_folder 500] [--changed_folders 0.01]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'AutoSTPtoHDF5Converter'))
+
+from Functions.find_files import scan_input_files  # noqa: E402
+from Functions.scan_index import ScanIndex  # noqa: E402
+
+
+def create_tree(root: str, files: int, files_per_folder: int) -> list:
+    """
+    Create a synthetic input folder of empty .STP files spread across nested unit and bed folders.
+
+    :param root: String that is the path to the folder to create the tree in.
+    :type root: str
+    :param files: Integer that is the total number of .STP files to create.
+    :type files: int
+    :param files_per_folder: Integer that is the number of .STP files in each bed folder.
+    :type files_per_folder: int
+    :return: List of paths to the bed folders that were created.
+    :rtype: list
+    """
+
+    folders = []
+    for i in range(0, files, files_per_folder):
+        folder_number = i // files_per_folder
+        folder = os.path.join(root, f'UNIT{folder_number // 100:03}', f'BED{folder_number % 100:02}')
+        os.makedirs(folder, exist_ok=True)
+        folders.append(folder)
+        for j in range(i, min(i + files_per_folder, files)):
+            open(os.path.join(folder, f'BED{folder_number % 100:02}-{1500000000 + j}.Stp'), 'wb').close()
+
+    return folders
+
+
+def timed(function, *args) -> tuple:
+    """
+    Call a function and measure how long it took.
+
+    :param function: Function to call.
+    :param args: Arguments to pass to the function.
+    :return: Tuple of the seconds the call took and the result of the function.
+    :rtype: tuple
+    """
+
+    start_time = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start_time, result
+
+
+def main() -> None:
+    """
+    Run the scan index benchmark with the arguments provided by the user.
+
+    :return: None
+    :rtype: None
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmark the scan index against the full recursive search.')
+    parser.add_argument('--files', help='Number of .STP files in the synthetic tree. Default: 1000000.', type=int,
+                        default=1000000)
+    parser.add_argument('--files_per_folder', help='Number of .STP files per bed folder. Default: 500.', type=int,
+                        default=500)
+    parser.add_argument('--changed_folders', help='Fraction of bed folders that get a new file before the incremental '
+                                                  'search. Default: 0.01.', type=float, default=0.01)
+    parser.add_argument('--directory', help='Folder to create the synthetic tree in. Default: a temporary folder.',
+                        type=str)
+    parser.add_argument('--keep', help='Keep the synthetic tree after the benchmark. Default: False.',
+                        action='store_true')
+    benchmark_args = parser.parse_args()
+
+    root = benchmark_args.directory if benchmark_args.directory else tempfile.mkdtemp(prefix='scan_index_benchmark_')
+    input_folder = os.path.join(root, 'Input')
+    index_path = os.path.join(root, 'ScanIndex.db')
+
+    try:
+        print(f"Creating {benchmark_args.files} files in {input_folder}...")
+        creation_time, folders = timed(create_tree, input_folder, benchmark_args.files,
+                                       benchmark_args.files_per_folder)
+        print(f"Created {len(folders)} bed folders in {creation_time:.1f} sec.")
+
+        # Wait out the modification time resolution so the freshly created folders can be trusted by the index
+        time.sleep(2)
+
+        # Search the tree the way find_files does without an index
+        args = argparse.Namespace(input=input_folder, scan_index=None, restat_window=0)
+        full_time, full_files = timed(scan_input_files, args)
+
+        # Build the index from scratch, then search again with an unchanged tree after loading the index from disk
+        build_time, _ = timed(lambda: ScanIndex(index_path, input_folder, 0).scan())
+        load_time, scan_index = timed(ScanIndex, index_path, input_folder, 0)
+        unchanged_time, unchanged_files = timed(scan_index.scan)
+
+        # Add a new file to a fraction of the bed folders and search incrementally again
+        changed_folders = folders[::max(1, int(1 / benchmark_args.changed_folders))] \
+            if benchmark_args.changed_folders > 0 else []
+        for folder in changed_folders:
+            open(os.path.join(folder, f'{os.path.basename(folder)}-2000000000.Stp'), 'wb').close()
+        time.sleep(2)
+        changed_time, changed_files = timed(scan_index.scan)
+
+        if len(unchanged_files) != len(full_files) or len(changed_files) != len(full_files) + len(changed_folders):
+            raise RuntimeError('The scan index did not find the same files as the full recursive search.')
+
+        print(f"{'Search':<40}{'Seconds':>12}{'Files':>12}")
+        print(f"{'Full recursive search (find_files)':<40}{full_time:>12.2f}{len(full_files):>12}")
+        print(f"{'Scan index build':<40}{build_time:>12.2f}{len(full_files):>12}")
+        print(f"{'Scan index load from disk':<40}{load_time:>12.2f}{'':>12}")
+        print(f"{'Incremental search, no changes':<40}{unchanged_time:>12.2f}{len(unchanged_files):>12}")
+        print(f"{f'Incremental search, {len(changed_folders)} changed folders':<40}{changed_time:>12.2f}"
+              f"{len(changed_files):>12}")
+        print(f"Incremental search speed-up: {full_time / max(changed_time, 1e-9):.1f}x")
+
+    finally:
+        if not benchmark_args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""
+Benchmark the scheduling policies by replaying a size distribution of .STP files through a simulated batch with a
+fixed number of conversion slots and reporting the makespan and mean completion latency of each policy.
+
+The size distribution is replayed from a ConversionHistory database, where the recorded durations are used as the true
+durations, from a .CSV file with a Size column, e.g. a listing of the input folder, or generated synthetically.
+
+Usage:
+python benchmarks/benchmark_scheduling.py [--history ConversionHistory.db | --sizes sizes.csv] [--cores 6]
+"""
+
+import argparse
+import heapq
+import os
+import random
+import sys
+
+import pandas
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'AutoSTPtoHDF5Converter'))
+
+from Functions.conversion_history import ConversionHistory  # noqa: E402
+from Functions.scheduling import SCHEDULING_POLICIES, order_files  # noqa: E402
+
+
+def synthetic_files(files: int, seed: int) -> pandas.DataFrame:
+    """
+    Create a synthetic batch where most .STP files are vitals-only files of a few MB and a few are huge wave data files.
+
+    :param files: Integer that is the number of .STP files in the batch.
+    :type files: int
+    :param seed: Integer that seeds the random sizes.
+    :type seed: int
+    :return: pandas.DataFrame that contains [Filename, Size] for the batch.
+    :rtype: pandas.DataFrame
+    """
+
+    rng = random.Random(seed)
+    sizes = [int(rng.lognormvariate(15, 0.8)) if rng.random() > 0.05 else int(rng.lognormvariate(20, 0.5))
+             for _ in range(files)]
+    return pandas.DataFrame({'Filename': [f'BED{i % 20:02}-{1500000000 + i}.Stp' for i in range(files)],
+                             'Size': sizes})
+
+
+def simulate(durations: list, cores: int) -> tuple:
+    """
+    Start each conversion in the given order as soon as one of the conversion slots is free.
+
+    :param durations: List of the seconds each conversion takes, in the order they are started.
+    :type durations: list
+    :param cores: Integer that is the number of conversion slots.
+    :type cores: int
+    :return: Tuple of the makespan and the mean completion latency in seconds.
+    :rtype: tuple
+    """
+
+    free_times = [0.0] * cores
+    completion_times = []
+    for duration in durations:
+        start_time = heapq.heappop(free_times)
+        completion_times.append(start_time + duration)
+        heapq.heappush(free_times, start_time + duration)
+
+    if not completion_times:
+        return 0.0, 0.0
+    return max(completion_times), sum(completion_times) / len(completion_times)
+
+
+def main() -> None:
+    """
+    Run the scheduling benchmark with the arguments provided by the user.
+
+    :return: None
+    :rtype: None
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmark the scheduling policies on a replayed size distribution.')
+    parser.add_argument('--history', help='ConversionHistory database to replay. Its recorded durations are the true '
+                                          'durations and are also used to predict durations. Default: None.', type=str)
+    parser.add_argument('--sizes', help='.CSV file with a Size (and optionally Filename) column to replay. '
+                                        'Default: None.', type=str)
+    parser.add_argument('--files', help='Number of files in the synthetic batch. Default: 1000.', type=int,
+                        default=1000)
+    parser.add_argument('--cores', help='Number of conversion slots. Default: 6.', type=int, default=6)
+    parser.add_argument('--throughput', help='MB per second converted when there are no recorded durations. '
+                                             'Default: 2.', type=float, default=2)
+    parser.add_argument('--system', help='Replay the conversions of this EHR system. Default: cs.', type=str,
+                        choices=['u', 'p', 'cs', 'pix'], default='cs')
+    parser.add_argument('--wave_data', help='Replay the conversions that included wave data. Default: False.',
+                        action='store_true')
+    parser.add_argument('--seed', help='Seed for the synthetic batch and the order it was found in. Default: 0.',
+                        type=int, default=0)
+    benchmark_args = parser.parse_args()
+
+    # Load the batch and the true duration of every conversion
+    history = None
+    if benchmark_args.history:
+        history = ConversionHistory(benchmark_args.history)
+        files = pandas.read_sql('SELECT Filename, Size, Seconds FROM ConversionHistory WHERE System = ? AND '
+                                'WaveData = ?', history.conn,
+                                params=(benchmark_args.system, int(benchmark_args.wave_data)))
+        source = benchmark_args.history
+    elif benchmark_args.sizes:
+        files = pandas.read_csv(benchmark_args.sizes)
+        if 'Filename' not in files:
+            files['Filename'] = [f'FILE-{i}.Stp' for i in range(len(files))]
+        source = benchmark_args.sizes
+    else:
+        files = synthetic_files(benchmark_args.files, benchmark_args.seed)
+        source = f'{benchmark_args.files} synthetic files'
+    if 'Seconds' not in files:
+        files['Seconds'] = files['Size'] / (benchmark_args.throughput * 1024 * 1024)
+
+    # The order the files were found in is arbitrary, so shuffle it for FIFO
+    files = files.sample(frac=1, random_state=benchmark_args.seed).reset_index(drop=True)
+
+    print(f"Replaying {len(files)} conversions ({source}) on {benchmark_args.cores} conversion slots")
+    print(f"{'Policy':<24}{'Makespan (h)':>16}{'Mean latency (h)':>20}")
+    for policy in SCHEDULING_POLICIES:
+        args = argparse.Namespace(schedule=policy, system=benchmark_args.system, wave_data=benchmark_args.wave_data)
+        ordered_files = order_files(args, files, history if history else ConversionHistory(':memory:'))
+        makespan, mean_latency = simulate(list(ordered_files['Seconds']), benchmark_args.cores)
+        print(f"{policy:<24}{makespan / 3600:>16.2f}{mean_latency / 3600:>20.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Benchmark staging .STP files into a destination folder with shutil.copy, the way they used to be copied, against the
+staging fast paths, i.e. a hard link, reflink, copy_file_range, or regular copy, whichever the two folders allow. Point
+--source to the input share and --destination to the Processing or scratch folder to measure a real setup.
+
+Usage:
+python benchmarks/benchmark_staging.py [--files 20] [--size_mb 100] [--source PATH] [--destination PATH]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'AutoSTPtoHDF5Converter'))
+
+from Functions.staging import stage_file  # noqa: E402
+
+
+def copy_with_shutil(source_path: str, destination_path: str) -> str:
+    """
+    Copy a file the way the .STP files used to be copied into the Processing folder.
+
+    :param source_path: String that is the path to the file to copy.
+    :type source_path: str
+    :param destination_path: String that is the path of the copy.
+    :type destination_path: str
+    :return: String that is the method that copied the file.
+    :rtype: str
+    """
+
+    shutil.copy(source_path, destination_path)
+    return 'copy'
+
+
+def time_staging(name: str, stage, source_paths: list, destination_folder: str) -> None:
+    """
+    Stage every source file into the destination folder, print the throughput, and delete the staged files.
+
+    :param name: String that is the name of the staging method to print.
+    :type name: str
+    :param stage: Function that stages a file, called with (source_path, destination_path), and returns the method.
+    :param source_paths: List of the paths of the files to stage.
+    :type source_paths: list
+    :param destination_folder: String that is the path to the folder to stage the files into.
+    :type destination_folder: str
+    :return: None
+    :rtype: None
+    """
+
+    destination_paths = [os.path.join(destination_folder, os.path.basename(path)) for path in source_paths]
+    start_time = time.perf_counter()
+    methods = {stage(source_path, destination_path)
+               for source_path, destination_path in zip(source_paths, destination_paths)}
+    seconds = time.perf_counter() - start_time
+    megabytes = sum(os.path.getsize(path) for path in source_paths) / (1024 * 1024)
+    print(f"{name:<16}{', '.join(sorted(methods)):<20}{seconds:>10.2f}{megabytes / seconds:>12.0f}")
+
+    for destination_path in destination_paths:
+        os.remove(destination_path)
+
+
+def main() -> None:
+    """
+    Run the staging benchmark with the arguments provided by the user.
+
+    :return: None
+    :rtype: None
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmark the staging fast paths against shutil.copy.')
+    parser.add_argument('--files', help='Number of .STP files to stage. Default: 20.', type=int, default=20)
+    parser.add_argument('--size_mb', help='Size of every .STP file in MB. Default: 100.', type=float, default=100)
+    parser.add_argument('--source', help='Folder to create the .STP files in, e.g. on the input share. Default: a '
+                                         'temporary folder.', type=str)
+    parser.add_argument('--destination', help='Folder to stage the .STP files into, e.g. the scratch folder. '
+                                              'Default: a temporary folder next to the source.', type=str)
+    benchmark_args = parser.parse_args()
+
+    source_folder = tempfile.mkdtemp(prefix='staging_benchmark_source_', dir=benchmark_args.source)
+    destination_folder = tempfile.mkdtemp(prefix='staging_benchmark_destination_', dir=benchmark_args.destination)
+    try:
+        content = os.urandom(1024 * 1024)
+        source_paths = []
+        for i in range(benchmark_args.files):
+            source_path = os.path.join(source_folder, f'BED{i:03}-{1500000000 + i * 3600}.Stp')
+            with open(source_path, 'wb') as source_file:
+                for _ in range(int(benchmark_args.size_mb)):
+                    source_file.write(content)
+            source_paths.append(source_path)
+
+        print(f"{'Staging':<16}{'Method':<20}{'Seconds':>10}{'MB/s':>12}")
+        time_staging('shutil.copy', copy_with_shutil, source_paths, destination_folder)
+        time_staging('stage_file', stage_file, source_paths, destination_folder)
+
+    finally:
+        shutil.rmtree(source_folder, ignore_errors=True)
+        shutil.rmtree(destination_folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+Benchmark the candidate chain of a pass, i.e. the search of the input folder, the CompletedFiles filter, and the patient
+offset merge, as a single batch against streaming it in chunks, and report the time until the first files could be
+converted, the total time, and the peak memory of each for input folders of increasing size.
+
+Usage:
+python benchmarks/benchmark_streaming.py [--files 10000 100000 1000000] [--chunk_size 1000]
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCHMARK_FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARK_FOLDER)
+sys.path.insert(0, os.path.join(BENCHMARK_FOLDER, '..', 'AutoSTPtoHDF5Converter'))
+
+from benchmark_end_to_end import create_input_tree, create_patient_offset_database  # noqa: E402
+from Functions.completed_files_store import get_completed_files_store  # noqa: E402
+from Functions.find_files import find_file_chunks, remove_completed_files, scan_input_files  # noqa: E402
+from Functions.merge_files_w_patient_info import merge_files_w_patient_info  # noqa: E402
+from Functions.patient_offset_resolver import get_patient_offset_resolver  # noqa: E402
+
+
+def batch_candidates(args: argparse.Namespace) -> tuple:
+    """
+    Find the convertable files of the input folder as a single batch the way the batch cycle does.
+
+    :param args: argparse.Namespace that contains the arguments of the AutoSTPtoHDF5Converter.
+    :type args: argparse.Namespace
+    :return: Tuple of the seconds until the first files could be converted and the number of convertable files.
+    :rtype: tuple
+    """
+
+    start_time = time.perf_counter()
+    files = scan_input_files(args)
+    files['Filename'] = files['Path'].apply(os.path.basename)
+    files = merge_files_w_patient_info(args, remove_completed_files(args, files))
+    return time.perf_counter() - start_time, len(files)
+
+
+def streamed_candidates(args: argparse.Namespace) -> tuple:
+    """
+    Find the convertable files of the input folder chunk by chunk the way a streaming pass does.
+
+    :param args: argparse.Namespace that contains the arguments of the AutoSTPtoHDF5Converter.
+    :type args: argparse.Namespace
+    :return: Tuple of the seconds until the first files could be converted and the number of convertable files.
+    :rtype: tuple
+    """
+
+    start_time = time.perf_counter()
+    first_chunk_seconds = None
+    convertable = 0
+    for files in find_file_chunks(args, args.chunk_size):
+        files = merge_files_w_patient_info(args, files)
+        if first_chunk_seconds is None and not files.empty:
+            first_chunk_seconds = time.perf_counter() - start_time
+        convertable += len(files)
+    return first_chunk_seconds, convertable
+
+
+def main() -> None:
+    """
+    Run the streaming benchmark with the arguments provided by the user.
+
+    :return: None
+    :rtype: None
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmark batch and streaming candidate chains on synthetic input '
+                                                 'folders.')
+    parser.add_argument('--files', help='Numbers of .STP files in the input folder. Default: 10000 100000 1000000.',
+                        type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--chunk_size', help='Number of files per chunk. Default: 1000.', type=int, default=1000)
+    parser.add_argument('--directory', help='Folder to create the synthetic data in. Default: a temporary folder.',
+                        type=str)
+    benchmark_args = parser.parse_args()
+
+    root = os.path.abspath(tempfile.mkdtemp(prefix='streaming_benchmark_', dir=benchmark_args.directory))
+    working_directory = os.getcwd()
+    try:
+        print(f"{'Chain':<12}{'Files':>10}{'First files s':>15}{'Total s':>10}{'Peak MB':>10}")
+        for files in benchmark_args.files:
+            # Run from a fresh folder, since the CompletedFiles database is relative to it
+            folder = os.path.join(root, str(files))
+            os.makedirs(os.path.join(folder, 'AutoSTPtoHDF5Converter'))
+            os.chdir(folder)
+            for get_database in [get_completed_files_store, get_patient_offset_resolver]:
+                get_database.cache_clear()
+            filenames = create_input_tree('Input', files, 0)
+            create_patient_offset_database('PatientOffset.db', filenames, 0)
+            del filenames
+            args = argparse.Namespace(input='Input', output='Output', database='PatientOffset.db', scan_index=None,
+                                      retry_filesearch_time=0, chunk_size=benchmark_args.chunk_size,
+                                      lease_queue=None, state_journal=None, dedup=False)
+
+            for chain, find_candidates in [('batch', batch_candidates), ('streaming', streamed_candidates)]:
+                tracemalloc.start()
+                start_time = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    first_seconds, convertable = find_candidates(args)
+                total_seconds = time.perf_counter() - start_time
+                peak = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+                tracemalloc.stop()
+                print(f"{chain:<12}{convertable:>10}{first_seconds:>15.2f}{total_seconds:>10.2f}{peak:>10.1f}")
+
+            os.chdir(working_directory)
+            shutil.rmtree(folder, ignore_errors=True)
+
+    finally:
+        os.chdir(working_directory)
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+"""
+Stand-in StpToolkit and formatconverter that accept the same parameters as the real tools and emit synthetic .XML and
+.HDF5 files, so the AutoSTPtoHDF5Converter can be benchmarked and tested on machines without the PreVent Tools.
+
+The options of the stand-in come before the parameters that the AutoSTPtoHDF5Converter adds, e.g.:
+python AutoSTPtoHDF5Converter --stptoolkit "python benchmarks/fake_tools.py stptoolkit --latency 0.5 --fail_rate 0.01"
+                              --formatconverter "python benchmarks/fake_tools.py formatconverter --days 2"
+
+Failures and hangs are decided from the seed and the filename, so the same files fail in every run.
+"""
+
+import argparse
+import datetime
+import os
+import random
+import stat
+import sys
+import time
+
+# Number of bytes read or written at once, so the outputs grow steadily like the outputs of the real tools
+CHUNK_SIZE = 1024 * 1024
+
+
+def parse_args() -> tuple:
+    """
+    Parse the options of the stand-in and leave the parameters of the real tool.
+
+    :return: Tuple of argparse.Namespace of the stand-in options and the list of remaining tool parameters.
+    :rtype: tuple
+    """
+
+    parser = argparse.ArgumentParser(description='Stand-in StpToolkit and formatconverter.')
+    parser.add_argument('tool', help='Tool to stand in for.', choices=['stptoolkit', 'formatconverter'])
+    parser.add_argument('--latency', help='Seconds every conversion takes at least. Default: 0.', type=float,
+                        default=0)
+    parser.add_argument('--seconds_per_mb', help='Additional seconds per MB of input. Default: 0.', type=float,
+                        default=0)
+    parser.add_argument('--cpu_seconds', help='Seconds of CPU time every conversion burns on top of its latency. '
+                                              'Default: 0.', type=float, default=0)
+    parser.add_argument('--wave_factor', help='Factor the latency of conversions with wave data, i.e. without -xw, is '
+                                              'multiplied by. Default: 1.', type=float, default=1)
+    parser.add_argument('--size_ratio', help='Size of the output relative to the input. Default: 5 for stptoolkit '
+                                             'and 0.2 for formatconverter.', type=float)
+    parser.add_argument('--days', help='Number of daily .HDF5 files the formatconverter creates without -n. '
+                                       'Default: 1.', type=int, default=1)
+    parser.add_argument('--fail_rate', help='Fraction of files that fail with exit code 1. Default: 0.', type=float,
+                        default=0)
+    parser.add_argument('--hang_rate', help='Fraction of files that hang without progress. Default: 0.', type=float,
+                        default=0)
+    parser.add_argument('--hang_seconds', help='Seconds a hanging file hangs for. Default: 36000.', type=float,
+                        default=36000)
+    parser.add_argument('--reject_pipes', help='Fail with exit code 1 if the input is a named pipe, like a tool that '
+                                               'seeks in its input.', action='store_true')
+    parser.add_argument('--seed', help='Seed that decides which files fail or hang. Default: 0.', type=int, default=0)
+    return parser.parse_known_args()
+
+
+def copy_synthetic(input_path: str, output_path: str, size_ratio: float) -> int:
+    """
+    Read the whole input and write a synthetic output of size_ratio times its size in chunks.
+
+    :param input_path: String that is the path to the input file, which may be a named pipe.
+    :type input_path: str
+    :param output_path: String that is the path to the output file, which may be a named pipe.
+    :type output_path: str
+    :param size_ratio: Float that is the size of the output relative to the input.
+    :type size_ratio: float
+    :return: Integer that is the number of bytes read from the input.
+    :rtype: int
+    """
+
+    input_size = 0
+    with open(input_path, 'rb') as input_file:
+        while True:
+            chunk = input_file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            input_size += len(chunk)
+
+    remaining = int(input_size * size_ratio)
+    with open(output_path, 'wb') as output_file:
+        while remaining > 0:
+            chunk_size = min(remaining, CHUNK_SIZE)
+            output_file.write(b'x' * chunk_size)
+            output_file.flush()
+            remaining -= chunk_size
+
+    return input_size
+
+
+def main() -> None:
+    """
+    Run the stand-in tool with the options and parameters provided.
+
+    :return: None
+    :rtype: None
+    """
+
+    fake_args, params = parse_args()
+
+    # Get the input and output paths from the parameters of the real tool
+    if fake_args.tool == 'stptoolkit':
+        input_path = params[0]
+        outputs = [params[params.index('-o') + 1]]
+        size_ratio = fake_args.size_ratio if fake_args.size_ratio is not None else 5
+    else:
+        input_path = params[-1]
+        size_ratio = fake_args.size_ratio if fake_args.size_ratio is not None else 0.2
+
+        # Name the outputs with the %d%i-_-%s.%t pattern, where %s is the offset start date of each day of data
+        basename = os.path.splitext(os.path.basename(input_path))[0]
+        seconds = basename.rsplit('-', 1)[-1]
+        offset = int(params[params.index('--offset') + 1]) if '--offset' in params else 0
+        start_date = datetime.datetime(1970, 1, 1) + datetime.timedelta(
+            seconds=(int(seconds) if seconds.isdigit() else 0) + offset)
+        days = 1 if '-n' in params else fake_args.days
+        outputs = [os.path.join(os.path.dirname(input_path),
+                                f'{basename}-_-{(start_date + datetime.timedelta(days=day)):%Y-%m-%d}.hdf5')
+                   for day in range(days)]
+
+    # Fail like a tool that seeks in its input if the input is a named pipe
+    if fake_args.reject_pipes and stat.S_ISFIFO(os.stat(input_path).st_mode):
+        sys.exit(1)
+
+    # Decide if this file fails or hangs the same way in every run
+    rng = random.Random(f'{fake_args.seed}:{fake_args.tool}:{os.path.basename(input_path)}')
+    outcome = rng.random()
+    if outcome < fake_args.hang_rate:
+        time.sleep(fake_args.hang_seconds)
+    if outcome < fake_args.hang_rate + fake_args.fail_rate:
+        sys.exit(1)
+
+    # Convert the input into the first output and split it into the rest
+    input_size = copy_synthetic(input_path, outputs[0], size_ratio / len(outputs))
+    for output in outputs[1:]:
+        with open(output, 'wb') as output_file:
+            output_file.write(b'x' * int(input_size * size_ratio / len(outputs)))
+
+    # Burn CPU time like the parsing of the real tools before waiting out the latency
+    cpu_start_time = time.process_time()
+    while time.process_time() - cpu_start_time < fake_args.cpu_seconds:
+        pass
+
+    latency = fake_args.latency if '-xw' in params or fake_args.tool != 'stptoolkit' else \
+        fake_args.latency * fake_args.wave_factor
+    time.sleep(latency + fake_args.seconds_per_mb * input_size / (1024 * 1024))
+
+
+if __name__ == '__main__':
+    main()
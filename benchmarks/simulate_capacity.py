@@ -0,0 +1,329 @@
+"""
+Predict how long a backlog of .STP files takes to drain by replaying it through the batch cycle or the pipeline in
+virtual time, e.g. to compare 12 and 24 cores before converting a 40 TB backlog for days.
+
+The files come from a walk of the input folder, a .CSV listing with a Path or Filename column, a Size column, and
+optionally an Mtime column, the Files table of a scan index, or a synthetic size distribution. Every conversion takes
+its recorded duration from a ConversionHistory database if the file was converted before, the duration predicted from
+the history otherwise, and its size divided by --throughput without enough history. Durations are assumed not to
+depend on the number of concurrent conversions.
+
+The batch cycle is replayed the way find_files and convert_files run it: a pass takes the files that were present at
+the first of two searches --retry_filesearch_time apart, orders them with the scheduling policy, converts them on
+--cores conversion slots, and only starts the next pass once every conversion of the batch finished. The pipeline is
+replayed the way run_pipeline runs it: a search every --retry_filesearch_time finds the stable files, which refill a
+work queue of --queue_size files whenever a conversion finishes, and every free conversion slot starts the next file of
+the queue. A conversion that takes longer than its timeout is
+killed at the timeout and moved to Output\\Failed\\TimedOut, where the timeout of every file is derived the same way as
+for a single tool run.
+
+Usage:
+python benchmarks/simulate_capacity.py [--input PATH | --listing files.csv | --scan_index ScanIndex.db | --files N]
+                                       [--history ConversionHistory.db] [--cores 12 24] [--mode batch]
+"""
+
+import argparse
+import bisect
+import heapq
+import os
+import sqlite3
+import sys
+import time
+
+import numpy
+import pandas
+
+BENCHMARK_FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARK_FOLDER)
+sys.path.insert(0, os.path.join(BENCHMARK_FOLDER, '..', 'AutoSTPtoHDF5Converter'))
+
+from benchmark_scheduling import synthetic_files  # noqa: E402
+from Functions.conversion_history import ConversionHistory  # noqa: E402
+from Functions.find_files import walk_input_files  # noqa: E402
+from Functions.job_monitor import conversion_timeouts  # noqa: E402
+from Functions.scheduling import SCHEDULING_POLICIES, order_files, scheduling_keys  # noqa: E402
+
+
+def load_files(sim_args: argparse.Namespace) -> tuple:
+    """
+    Load the files to replay with their sizes and the seconds after the start of the simulation they are complete at.
+
+    :param sim_args: argparse.Namespace that contains the arguments of the simulator.
+    :type sim_args: argparse.Namespace
+    :return: Tuple of pandas.DataFrame that contains [Filename, Size, Arrival] in the order the files were found and a
+    string that describes where they came from.
+    :rtype: tuple
+    """
+
+    if sim_args.input:
+        files = pandas.DataFrame(walk_input_files(sim_args.input), columns=['Path', 'Size', 'Mtime'])
+        source = sim_args.input
+    elif sim_args.listing:
+        files = pandas.read_csv(sim_args.listing)
+        source = sim_args.listing
+    elif sim_args.scan_index:
+        with sqlite3.connect(sim_args.scan_index) as conn:
+            files = pandas.read_sql('SELECT Path, Size, Mtime FROM Files', conn)
+        source = sim_args.scan_index
+    else:
+        files = synthetic_files(sim_args.files, sim_args.seed)
+        source = f'{sim_args.files} synthetic files'
+
+    if 'Filename' not in files:
+        files['Filename'] = files['Path'].map(os.path.basename)
+
+    # Replay the modification times as the times the files finished copying or treat every file as already waiting
+    if sim_args.arrivals == 'mtime' and 'Mtime' in files:
+        files['Arrival'] = files['Mtime'] - files['Mtime'].min()
+    else:
+        files['Arrival'] = 0.0
+
+    files = files.loc[:, ['Filename', 'Size', 'Arrival']].sort_values('Arrival', kind='mergesort')
+    return files.reset_index(drop=True), source
+
+
+def conversion_durations(files: pandas.DataFrame, history: ConversionHistory, args: argparse.Namespace,
+                         throughput: float) -> pandas.Series:
+    """
+    Get the seconds every conversion takes from its recorded duration, its predicted duration, or its size.
+
+    :param files: pandas.DataFrame that contains [Filename, Size] for the files.
+    :type files: pandas.DataFrame
+    :param history: ConversionHistory with the recorded durations.
+    :type history: ConversionHistory
+    :param args: argparse.Namespace that contains the system and wave_data of the conversions.
+    :type args: argparse.Namespace
+    :param throughput: Float that is the MB per second converted without enough history.
+    :type throughput: float
+    :return: pandas.Series of the seconds of every conversion with the index of files.
+    :rtype: pandas.Series
+    """
+
+    recorded = dict(history.conn.execute('SELECT Filename, Seconds FROM ConversionHistory WHERE System = ? AND '
+                                         'WaveData = ?', (args.system, int(args.wave_data))))
+    predicted = history.predict(files, args.system, args.wave_data)
+    if predicted is None:
+        predicted = files['Size'] / (throughput * 1024 * 1024)
+
+    return files['Filename'].map(recorded).fillna(predicted).astype(float)
+
+
+def simulate_batches(files: pandas.DataFrame, args: argparse.Namespace, cores: int,
+                     history: ConversionHistory) -> dict:
+    """
+    Replay the batch cycle, where every pass waits for all conversions of its batch before the next search starts.
+
+    :param files: pandas.DataFrame that contains [Filename, Size, Arrival, Seconds, Timeout] sorted by Arrival.
+    :type files: pandas.DataFrame
+    :param args: argparse.Namespace that contains the arguments of the AutoSTPtoHDF5Converter to replay.
+    :type args: argparse.Namespace
+    :param cores: Integer that is the number of conversion slots.
+    :type cores: int
+    :param history: ConversionHistory that the scheduling policy predicts durations from.
+    :type history: ConversionHistory
+    :return: Dictionary of the completion times, busy seconds, number of timeouts, and number of passes.
+    :rtype: dict
+    """
+
+    arrivals = files['Arrival'].tolist()
+    completions = numpy.empty(len(files))
+    busy_seconds = 0.0
+    timeouts = 0
+    passes = 0
+
+    now = 0.0
+    found = 0
+    while found < len(files):
+
+        # Search until a search finds files that were already there at the search before it
+        initial_search = now
+        while True:
+            now = initial_search + args.retry_filesearch_time
+            ready = bisect.bisect_right(arrivals, initial_search)
+            if ready > found:
+                break
+            initial_search = now
+
+        # Convert the batch in the order of the scheduling policy on the conversion slots
+        batch = order_files(args, files.iloc[found:ready], history)
+        found = ready
+        passes += 1
+        free_times = [now] * cores
+        for index, seconds, timeout in zip(batch.index, batch['Seconds'], batch['Timeout']):
+            start_time = heapq.heappop(free_times)
+            duration = min(seconds, timeout)
+            timeouts += seconds > timeout
+            busy_seconds += duration
+            completions[index] = start_time + duration
+            heapq.heappush(free_times, start_time + duration)
+
+        # The next pass starts once the whole batch finished
+        now = max(free_times)
+
+    return {'completions': completions, 'busy_seconds': busy_seconds, 'timeouts': timeouts, 'passes': passes}
+
+
+def simulate_pipeline(files: pandas.DataFrame, args: argparse.Namespace, cores: int,
+                      history: ConversionHistory) -> dict:
+    """
+    Replay the pipeline, where searches keep feeding a bounded work queue and every free slot starts the next file.
+
+    :param files: pandas.DataFrame that contains [Filename, Size, Arrival, Seconds, Timeout] sorted by Arrival.
+    :type files: pandas.DataFrame
+    :param args: argparse.Namespace that contains the arguments of the AutoSTPtoHDF5Converter to replay.
+    :type args: argparse.Namespace
+    :param cores: Integer that is the number of conversion slots.
+    :type cores: int
+    :param history: ConversionHistory that the scheduling policy predicts durations from.
+    :type history: ConversionHistory
+    :return: Dictionary of the completion times, busy seconds, number of timeouts, and number of searches.
+    :rtype: dict
+    """
+
+    arrivals = files['Arrival'].tolist()
+    seconds = files['Seconds'].tolist()
+    timeouts = files['Timeout'].tolist()
+    queue_size = args.queue_size if args.queue_size else 2 * cores
+
+    # Order the files the way order_files does, i.e. by the scheduling key and then by the order they were found in
+    if args.schedule == 'fifo':
+        keys = [0.0] * len(files)
+    else:
+        keys = scheduling_keys(args, files, history).tolist()
+        if args.schedule == 'lpt':
+            keys = [-key for key in keys]
+
+    completions = numpy.empty(len(files))
+    busy_seconds = 0.0
+    timed_out = 0
+    searches = 0
+
+    # Heaps of the stable files that did not fit into the work queue yet, i.e. the pending files, the work queue, and
+    # the end times of the running conversions
+    candidates = []
+    work_queue = []
+    running = []
+
+    found = 0
+    finished = 0
+    previous_search = None
+    next_search = 0.0
+    while finished < len(files):
+
+        # Search the input folder when it is due before the next conversion finishes
+        if not running or next_search <= running[0][0]:
+            now = next_search
+            searches += 1
+
+            # Files are stable once they were there at the previous search
+            if previous_search is not None:
+                while found < len(files) and arrivals[found] <= previous_search:
+                    heapq.heappush(candidates, (keys[found], found))
+                    found += 1
+            previous_search = now
+            next_search = now + args.retry_filesearch_time
+
+            # Skip the searches that cannot find anything while nothing is converting
+            if not running and not work_queue and not candidates and found < len(files):
+                skipped = max(0, int((arrivals[found] - now) // args.retry_filesearch_time) - 1)
+                previous_search += skipped * args.retry_filesearch_time
+                next_search += skipped * args.retry_filesearch_time
+                searches += skipped
+
+        # Finish the next conversion
+        else:
+            now, index = heapq.heappop(running)
+            completions[index] = now
+            finished += 1
+
+        # Refill the work queue from the pending files after every search and finished conversion, and start files from
+        # the work queue until every conversion slot is in use
+        while candidates and len(work_queue) < queue_size:
+            heapq.heappush(work_queue, heapq.heappop(candidates))
+        while work_queue and len(running) < cores:
+            index = heapq.heappop(work_queue)[1]
+            duration = min(seconds[index], timeouts[index])
+            timed_out += seconds[index] > timeouts[index]
+            busy_seconds += duration
+            heapq.heappush(running, (now + duration, index))
+
+    return {'completions': completions, 'busy_seconds': busy_seconds, 'timeouts': timed_out, 'passes': searches}
+
+
+def main() -> None:
+    """
+    Run the capacity simulator with the arguments provided by the user.
+
+    :return: None
+    :rtype: None
+    """
+
+    parser = argparse.ArgumentParser(description='Predict the drain time of a backlog of .STP files in virtual time.')
+    parser.add_argument('--input', help='Input folder to walk for the .STP files. Default: None.', type=str)
+    parser.add_argument('--listing', help='.CSV listing with a Path or Filename column, a Size column, and optionally '
+                                          'an Mtime column. Default: None.', type=str)
+    parser.add_argument('--scan_index', help='Scan index database to read the .STP files from. Default: None.',
+                        type=str)
+    parser.add_argument('--files', help='Number of synthetic files without a listing. Default: 100000.', type=int,
+                        default=100000)
+    parser.add_argument('--arrivals', help='backlog treats every file as waiting at the start, mtime replays the '
+                                           'modification times as the times the files arrived. Default: backlog.',
+                        type=str, choices=['backlog', 'mtime'], default='backlog')
+    parser.add_argument('--history', help='ConversionHistory database with the recorded durations. Default: None.',
+                        type=str)
+    parser.add_argument('--throughput', help='MB per second converted without enough history. Default: 2.',
+                        type=float, default=2)
+    parser.add_argument('--cores', help='Numbers of conversion slots to compare. Default: 6.', type=int, nargs='+',
+                        default=[6])
+    parser.add_argument('--mode', help='Conversion cycle to replay. Default: batch.', type=str,
+                        choices=['batch', 'pipeline'], default='batch')
+    parser.add_argument('--schedule', help='Scheduling policy. Default: fifo.', type=str, choices=SCHEDULING_POLICIES,
+                        default='fifo')
+    parser.add_argument('--retry_filesearch_time', help='Seconds in between file searches. Default: 600.', type=int,
+                        default=600)
+    parser.add_argument('--queue_size', help='Work queue size of the pipeline. Default: 2 x cores.', type=int)
+    parser.add_argument('--timeout', help='Hours before a conversion times out. Default: 10.', type=float, default=10)
+    parser.add_argument('--timeout_factor', help='Derive timeouts from the history as this many times the predicted '
+                                                 'duration. Default: None.', type=float)
+    parser.add_argument('--min_timeout', help='Minimum minutes of a derived timeout. Default: 10.', type=float,
+                        default=10)
+    parser.add_argument('--system', help='EHR system of the conversions. Default: cs.', type=str,
+                        choices=['u', 'p', 'cs', 'pix'], default='cs')
+    parser.add_argument('--wave_data', help='Replay conversions that include wave data. Default: False.',
+                        action='store_true')
+    parser.add_argument('--seed', help='Seed of the synthetic files. Default: 0.', type=int, default=0)
+    sim_args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    files, source = load_files(sim_args)
+    history = ConversionHistory(sim_args.history if sim_args.history else ':memory:')
+
+    # Arguments of the AutoSTPtoHDF5Converter that the replayed scheduling and timeout logic reads
+    args = argparse.Namespace(schedule=sim_args.schedule, system=sim_args.system, wave_data=sim_args.wave_data,
+                              retry_filesearch_time=sim_args.retry_filesearch_time, queue_size=sim_args.queue_size,
+                              timeout=sim_args.timeout * 60 * 60, timeout_factor=sim_args.timeout_factor,
+                              min_timeout=sim_args.min_timeout * 60)
+    files['Seconds'] = conversion_durations(files, history, args, sim_args.throughput)
+    files['Timeout'] = conversion_timeouts(args, files, history)
+
+    print(f"Replaying {len(files)} files ({files['Size'].sum() / 1024 ** 4:.2f} TB, {source}) through the "
+          f"{sim_args.mode} cycle with {sim_args.schedule}, {sim_args.retry_filesearch_time} sec in between searches, "
+          f"and {files['Seconds'].sum() / 3600:.0f} hours of conversions")
+    print(f"{'Cores':>6}{'Drain (h)':>12}{'Utilization':>13}{'p50 (h)':>10}{'p90 (h)':>10}{'p99 (h)':>10}"
+          f"{'Timeouts':>10}{'Passes' if sim_args.mode == 'batch' else 'Searches':>10}")
+
+    simulate = simulate_batches if sim_args.mode == 'batch' else simulate_pipeline
+    for cores in sim_args.cores:
+        result = simulate(files, args, cores, history)
+        drain_time = float(result['completions'].max()) if len(files) else 0.0
+        utilization = result['busy_seconds'] / (cores * drain_time) if drain_time else 0.0
+        p50, p90, p99 = numpy.percentile(result['completions'] - files['Arrival'].to_numpy(), [50, 90, 99]) / 3600 \
+            if len(files) else (0.0, 0.0, 0.0)
+        print(f"{cores:>6}{drain_time / 3600:>12.1f}{utilization:>13.1%}{p50:>10.1f}{p90:>10.1f}{p99:>10.1f}"
+              f"{result['timeouts']:>10}{result['passes']:>10}")
+
+    print(f"Simulated in {time.perf_counter() - start_time:.1f} sec")
+
+
+if __name__ == '__main__':
+    main()
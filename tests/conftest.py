@@ -0,0 +1,83 @@
+"""
+Shared fixtures of the AutoSTPtoHDF5Converter tests, which run against temporary folders laid out like the folder the
+AutoSTPtoHDF5Converter is run from and use the stand-in tools in benchmarks/fake_tools.py.
+"""
+
+import os
+import shlex
+import subprocess
+import sys
+import time
+
+import pandas
+import pytest
+
+REPOSITORY_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPOSITORY_FOLDER, 'AutoSTPtoHDF5Converter'))
+sys.path.insert(0, os.path.join(REPOSITORY_FOLDER, 'benchmarks'))
+
+from benchmark_end_to_end import create_input_tree, create_patient_offset_database  # noqa: E402
+from Functions.completed_files_store import completed_files_store, get_completed_files_store  # noqa: E402
+from Functions.conversion_history import conversion_history, get_conversion_history  # noqa: E402
+from Functions.lease_queue import get_lease_queue  # noqa: E402
+from Functions.output_catalog import get_output_catalog  # noqa: E402
+from Functions.state_journal import get_state_journal  # noqa: E402
+from Functions.wave_backlog import get_wave_backlog  # noqa: E402
+
+# Command that runs the stand-in tools
+FAKE_TOOLS = f'{shlex.quote(sys.executable)} ' \
+             f'{shlex.quote(os.path.join(REPOSITORY_FOLDER, "benchmarks", "fake_tools.py"))}'
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    """
+    Change into a temporary folder with the Input, Output, Updates, and AutoSTPtoHDF5Converter folders, and close the
+    databases the test opened through the cached getters afterwards.
+    """
+
+    for folder in ['Input', 'Output', 'Updates', 'AutoSTPtoHDF5Converter']:
+        os.makedirs(tmp_path / folder)
+    monkeypatch.chdir(tmp_path)
+
+    yield tmp_path
+
+    if get_completed_files_store.cache_info().currsize:
+        completed_files_store().close()
+    if get_conversion_history.cache_info().currsize:
+        conversion_history().close()
+    get_completed_files_store.cache_clear()
+    get_conversion_history.cache_clear()
+    get_lease_queue.cache_clear()
+    get_output_catalog.cache_clear()
+    get_state_journal.cache_clear()
+    get_wave_backlog.cache_clear()
+
+
+@pytest.fixture
+def run_backfill(workspace):
+    """
+    Get a function that creates .STP files that are ready to be backfilled, all of them with patient information, and
+    runs the AutoSTPtoHDF5Converter on them with the stand-in tools until the input folder is drained. The patient
+    information of the last updated files is only in a patient database update .CSV, and the options of the stand-in
+    StpToolkit and formatconverter, e.g. to make them fail or hang, are given as strings.
+    """
+
+    def run(files: int, *options: str, updated: int = 0, stptoolkit: str = '',
+            formatconverter: str = '') -> subprocess.CompletedProcess:
+        filenames = create_input_tree('Input', files, 4096)
+        create_patient_offset_database('PatientOffset.db', filenames[:files - updated], 0)
+        if updated:
+            pandas.DataFrame({'STPFile': filenames[files - updated:], 'PatientID': 1, 'Offset': 0}) \
+                .to_csv(os.path.join('Updates', 'PatientOffsetUpdate.csv'), index=False)
+        modified = time.time() - 7 * 86400
+        for filename in filenames:
+            os.utime(os.path.join('Input', filename.split('-')[0], filename), (modified, modified))
+
+        return subprocess.run([sys.executable, os.path.join(REPOSITORY_FOLDER, 'AutoSTPtoHDF5Converter'), '-i', 'Input',
+                               '-o', 'Output', '-d', 'PatientOffset.db', '-du', 'Updates', '-s', 'cs', '--backfill',
+                               '-stk', f'{FAKE_TOOLS} stptoolkit {stptoolkit}',
+                               '-fc', f'{FAKE_TOOLS} formatconverter {formatconverter}', *options],
+                              stdin=subprocess.DEVNULL, capture_output=True, text=True, timeout=120)
+
+    return run
@@ -0,0 +1,52 @@
+"""
+Tests of the async_converter coroutine and the AsyncConversionExecutor that runs it.
+"""
+
+import argparse
+import os
+
+import pytest
+
+from conftest import FAKE_TOOLS
+from Functions.async_converter import AsyncConversionExecutor, async_converter
+
+
+def converter_args(stptoolkit: str = '') -> argparse.Namespace:
+    return argparse.Namespace(output='Output', system='cs', wave_data=False, single_hdf5_file=False,
+                              stptoolkit=f'{FAKE_TOOLS} stptoolkit {stptoolkit}',
+                              formatconverter=f'{FAKE_TOOLS} formatconverter', stream_xml=False,
+                              hdf5_writer='formatconverter', scratch=None, prefetch_files=None, prefetch_gb=None,
+                              timeout=1, min_timeout=None, timeout_factor=None, stall_timeout=None,
+                              state_journal=False, lease_queue=None, cores=1)
+
+
+@pytest.fixture
+def stp_file(workspace):
+    for folder in ['Processing', os.path.join('Output', 'Converted')]:
+        os.makedirs(folder)
+    path = os.path.join('Input', 'BED001-1500000000.Stp')
+    with open(path, 'wb') as stp_file:
+        stp_file.write(b'x' * 4096)
+    return path
+
+
+def test_executor_reports_the_stages_of_a_conversion(stp_file):
+    stages = []
+    executor = AsyncConversionExecutor(1, progress_callback=lambda filename, stage: stages.append((filename, stage)))
+    executor.submit(async_converter, stp_file, 'BED001-1500000000.Stp', 0, converter_args()).result()
+    executor.shutdown()
+
+    assert [stage for _, stage in stages] == ['copy', 'stptoolkit', 'formatconverter', 'move', 'done']
+    assert {filename for filename, _ in stages} == {'BED001-1500000000.Stp'}
+    assert os.listdir(os.path.join('Output', 'Converted')) == ['BED001-1500000000-_-2017-07-14.hdf5']
+
+
+def test_failed_conversion_reports_its_end(stp_file):
+    stages = []
+    executor = AsyncConversionExecutor(1, progress_callback=lambda filename, stage: stages.append(stage))
+    future = executor.submit(async_converter, stp_file, 'BED001-1500000000.Stp', 0, converter_args('--fail_rate 1'))
+    with pytest.raises(FileNotFoundError):
+        future.result()
+    executor.shutdown()
+
+    assert stages == ['copy', 'stptoolkit', 'formatconverter', 'move', 'failed']
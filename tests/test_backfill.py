@@ -0,0 +1,14 @@
+"""
+Tests of the one-shot backfill of an archive.
+"""
+
+import os
+
+
+def test_backfill_uses_latest_patient_offsets(run_backfill):
+    result = run_backfill(3, updated=1)
+
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert not os.path.exists(os.path.join('Output', 'Skipped', 'NotInPatientDatabase'))
+    assert sum(len(filenames) for _, _, filenames in os.walk(os.path.join('Output', 'Success'))) == 3
+    assert not os.listdir('Updates')
@@ -0,0 +1,70 @@
+"""
+End-to-end tests of the conversion engines with the stand-in tools.
+"""
+
+import os
+
+import pytest
+
+# Options of every conversion engine, where the asyncio engine with stage workers converts in two stages
+ENGINES = {
+    'process': ['--engine', 'process', '--cores', '2'],
+    'asyncio': ['--engine', 'asyncio', '--max_conversions', '2'],
+    'two-stage': ['--engine', 'asyncio', '--stp_workers', '1', '--hdf5_workers', '1'],
+}
+
+
+def output_files(folder: str) -> list:
+    return sorted(filename for _, _, filenames in os.walk(os.path.join('Output', folder)) for filename in filenames)
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_engine_converts_files(run_backfill, engine):
+    result = run_backfill(3, *ENGINES[engine])
+
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert 'Successful: 3, Timeout: 0, Error: 0' in result.stdout
+    assert len(output_files('Success')) == 3
+    assert not output_files('Failed')
+    assert os.listdir('Processing') == ['_.txt']
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_engine_moves_errored_files(run_backfill, engine):
+    result = run_backfill(2, *ENGINES[engine], stptoolkit='--fail_rate 1')
+
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert 'Successful: 0, Timeout: 0, Error: 2' in result.stdout
+    assert output_files(os.path.join('Failed', 'ErroredOut')) == ['BED000-1500000000.Stp', 'BED000-1500003600.Stp']
+    assert not output_files('Success')
+    assert os.listdir('Processing') == ['_.txt']
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_engine_kills_stalled_conversions(run_backfill, engine):
+    result = run_backfill(1, *ENGINES[engine], '--stall_timeout', '1', stptoolkit='--hang_rate 1 --hang_seconds 60')
+
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert 'Successful: 0, Timeout: 1, Error: 0' in result.stdout
+    assert output_files(os.path.join('Failed', 'TimedOut')) == ['BED000-1500000000.Stp']
+    assert not output_files('Success')
+
+
+@pytest.mark.parametrize('engine', ['process', 'asyncio'])
+def test_streaming_is_rejected_when_formatconverter_rejects_pipe(run_backfill, engine):
+    result = run_backfill(3, *ENGINES[engine], '--stream_xml', formatconverter='--reject_pipes')
+
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert 'Successful: 3, Timeout: 0, Error: 0' in result.stdout
+    assert 'Falling back to .XML files' in result.stdout
+    assert len(output_files('Success')) == 3
+
+
+@pytest.mark.parametrize('engine', ['process', 'asyncio'])
+def test_streaming_is_kept_when_stptoolkit_fails(run_backfill, engine):
+    result = run_backfill(2, *ENGINES[engine], '--stream_xml', stptoolkit='--fail_rate 1')
+
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert 'Successful: 0, Timeout: 0, Error: 2' in result.stdout
+    assert 'Falling back to .XML files' not in result.stdout
+    assert os.listdir('Processing') == ['_.txt']
@@ -0,0 +1,43 @@
+"""
+Tests of the ConversionHistory and the per-file timeouts derived from it.
+"""
+
+import os
+import threading
+
+from Functions.conversion_history import ConversionHistory, conversion_history
+
+
+def test_history_is_shared_across_threads(workspace):
+    history = ConversionHistory(os.path.join('AutoSTPtoHDF5Converter', 'ConversionHistory.db'))
+
+    # Open and use the history from another thread, e.g. the event loop of the asyncio engine
+    thread = threading.Thread(target=history.add, args=('BED001-1500000000.Stp', 4096, 1.0, 'cs', False))
+    thread.start()
+    thread.join()
+
+    history.add('BED001-1500003600.Stp', 4096, 1.0, 'cs', False)
+    assert history.conn.execute('SELECT COUNT(*) FROM ConversionHistory').fetchone()[0] == 2
+    history.close()
+
+
+def test_forked_worker_opens_its_own_history(workspace, monkeypatch):
+    parent_history = conversion_history()
+    assert conversion_history() is parent_history
+
+    # A worker forked from the parent has another process ID and must not use the connection of the parent
+    getpid = os.getpid
+    monkeypatch.setattr(os, 'getpid', lambda: -1)
+    worker_history = conversion_history()
+    assert worker_history is not parent_history
+    worker_history.close()
+    monkeypatch.setattr(os, 'getpid', getpid)
+
+
+def test_asyncio_engine_with_timeout_factor(run_backfill):
+    result = run_backfill(3, '--engine', 'asyncio', '--timeout_factor', '3')
+
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert 'Error: 0' in result.stdout and 'Error: 1' not in result.stdout
+    assert not os.path.exists(os.path.join('Output', 'Failed'))
+    assert len(os.listdir(os.path.join('Output', 'Success'))) == 3
@@ -0,0 +1,61 @@
+"""
+Tests of how the outcome of a finished conversion is handled.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import datetime
+import os
+import sqlite3
+import sys
+import time
+
+from Functions.conversion_tools import cleanup, remove_converted_files
+from Functions.convert_files import handle_conversion_result
+
+
+class BrokenHistory:
+    """
+    ConversionHistory whose database cannot be written.
+    """
+
+    def add(self, *args) -> None:
+        raise sqlite3.OperationalError('database is locked')
+
+
+def test_history_failure_keeps_conversion_successful(workspace, monkeypatch):
+    args = argparse.Namespace(output='Output', system='cs', wave_data=False, delete_stp=False, state_journal=None,
+                              lease_queue=None)
+    input_stp_path = os.path.join('Input', 'BED001-1500000000.Stp')
+    with open(input_stp_path, 'wb') as stp_file:
+        stp_file.write(b'x' * 4096)
+    monkeypatch.setattr(sys.modules['Functions.convert_files'], 'conversion_history', BrokenHistory)
+
+    future = concurrent.futures.Future()
+    future.set_result(datetime.timedelta(seconds=1))
+    counts = collections.Counter()
+
+    assert handle_conversion_result(args, future, input_stp_path, counts, time.time())
+    assert counts == {'Successful': 1}
+    assert os.path.isfile(input_stp_path)
+    assert not os.path.exists(os.path.join('Output', 'Failed'))
+
+
+def test_cleanup_keeps_files_of_other_basenames(workspace):
+    os.makedirs('Processing')
+    for filename in ['BED001-1.Stp', 'BED001-1.xml', 'BED001-1.preempt', 'BED001-1-_-1500000000.hdf5',
+                     'BED001-10.Stp', 'BED001-11.xml', 'BED001-10-_-1500000000.hdf5']:
+        open(os.path.join('Processing', filename), 'w').close()
+
+    cleanup('BED001-1')
+    assert sorted(os.listdir('Processing')) == ['BED001-10-_-1500000000.hdf5', 'BED001-10.Stp', 'BED001-11.xml']
+
+
+def test_converted_files_of_bracketed_basenames_are_matched_literally(workspace):
+    os.makedirs('Processing')
+    for filename in ['BED[1]-1-_-1500000000.hdf5', 'BED1-1-_-1500000000.hdf5']:
+        open(os.path.join('Processing', filename), 'w').close()
+
+    remove_converted_files('BED[1]-1')
+    assert os.listdir('Processing') == ['BED1-1-_-1500000000.hdf5']
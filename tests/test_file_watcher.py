@@ -0,0 +1,80 @@
+"""
+Tests of the FileWatcher that releases each .STP file once it has settled.
+"""
+
+import os
+import sys
+import time
+
+import pytest
+
+from Functions.file_watcher import IN_EVENT_HEADER, IN_Q_OVERFLOW, FileWatcher, inotify_supported
+
+requires_inotify = pytest.mark.skipif(sys.platform != 'linux' or not inotify_supported('.'),
+                                      reason='inotify is not available')
+
+
+def write_file(path: str, size: int = 4096) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'ab') as stp_file:
+        stp_file.write(b'x' * size)
+
+
+def test_file_is_released_once_it_settled(workspace):
+    path = os.path.join('Input', 'BED001', 'BED001-1500000000.Stp')
+    write_file(path)
+    watcher = FileWatcher('Input', 0.5, 'poll', 0.1)
+
+    assert watcher.poll() == []
+    time.sleep(0.6)
+    assert watcher.poll() == [(path, 4096)]
+
+    # A released file is not released again
+    time.sleep(0.2)
+    assert watcher.poll() == []
+
+
+def test_growing_file_restarts_its_settle_time(workspace):
+    path = os.path.join('Input', 'BED001-1500000000.Stp')
+    write_file(path)
+    watcher = FileWatcher('Input', 0.5, 'poll', 0.1)
+
+    # The file is still being copied
+    time.sleep(0.3)
+    write_file(path)
+    time.sleep(0.3)
+    assert watcher.poll() == []
+
+    assert watcher.wait(2) == [(path, 8192)]
+
+
+@requires_inotify
+def test_files_in_new_folders_are_watched(workspace):
+    watcher = FileWatcher('Input', 0.2, 'inotify')
+    assert watcher.engine == 'inotify'
+
+    path = os.path.join('Input', 'BED002', 'BED002-1500000000.Stp')
+    write_file(path)
+    assert watcher.wait(5) == [(path, 4096)]
+    watcher.close()
+
+
+@requires_inotify
+def test_event_queue_overflow_searches_the_input_folder_again(workspace):
+    watcher = FileWatcher('Input', 0, 'inotify')
+
+    # Replace the inotify instance with a pipe, so the file below is only found by the search after the overflow
+    watcher.stop_inotify()
+    read_fd, write_fd = os.pipe()
+    os.set_blocking(read_fd, False)
+    watcher.inotify_fd = read_fd
+
+    path = os.path.join('Input', 'BED001-1500000000.Stp')
+    write_file(path)
+    assert watcher.poll() == []
+
+    os.write(write_fd, IN_EVENT_HEADER.pack(-1, IN_Q_OVERFLOW, 0, 0))
+    assert watcher.poll() == [(path, 4096)]
+
+    os.close(write_fd)
+    watcher.close()
@@ -0,0 +1,35 @@
+"""
+Tests of how .STP files that are ready to be converted are found.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import pandas
+
+from Functions.find_files import find_files
+
+
+def test_requeued_files_are_found_in_the_same_pass(workspace, monkeypatch):
+    args = argparse.Namespace(input='Input', output='Output', scan_index=None, retry_filesearch_time=600,
+                              lease_queue=None, dedup=False)
+
+    # A skipped file that was just moved back, a file that has settled, and a file that is still being copied
+    for filename, age in [('BED001-1500000000.Stp', 86400), ('BED002-1500000000.Stp', 86400),
+                          ('BED003-1500000000.Stp', 0)]:
+        path = os.path.join('Input', filename)
+        with open(path, 'wb') as stp_file:
+            stp_file.write(b'x' * 4096)
+        os.utime(path, (time.time() - age, time.time() - age))
+    requeued_files = pandas.DataFrame([(os.path.join('Input', 'BED001-1500000000.Stp'), 'BED001-1500000000.Stp', 4096)],
+                                      columns=['Path', 'Filename', 'Size'])
+
+    def sleep(seconds: float) -> None:
+        raise AssertionError(f"Waited {seconds} sec. for new files although requeued files were ready")
+
+    monkeypatch.setattr(sys.modules['Functions.find_files'].time, 'sleep', sleep)
+
+    files = find_files(args, None, requeued_files)
+    assert sorted(files['Filename']) == ['BED001-1500000000.Stp', 'BED002-1500000000.Stp']
@@ -0,0 +1,63 @@
+"""
+Tests of how --dedup fingerprints .STP files and skips the ones whose content was already converted.
+"""
+
+import argparse
+import os
+
+import pandas
+
+from Functions import fingerprint
+from Functions.completed_files_store import completed_files_store
+from Functions.fingerprint import remove_duplicate_files
+
+
+def create_files(files: dict) -> pandas.DataFrame:
+    paths = []
+    for filename, content in files.items():
+        path = os.path.join('Input', filename.split('-')[0], filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as stp_file:
+            stp_file.write(content)
+        paths.append(path)
+    return pandas.DataFrame({'Path': paths, 'Filename': list(files)})
+
+
+def test_only_byte_identical_files_are_duplicates(workspace, monkeypatch):
+    # Sample few bytes, so a change between the sampled blocks only shows up in the full hash
+    monkeypatch.setattr(fingerprint, 'HEAD_BYTES', 16)
+    monkeypatch.setattr(fingerprint, 'TAIL_BYTES', 16)
+    monkeypatch.setattr(fingerprint, 'SAMPLE_BLOCKS', 2)
+    monkeypatch.setattr(fingerprint, 'SAMPLE_BLOCK_BYTES', 16)
+    args = argparse.Namespace(output='Output', dedup_workers=2)
+    content = bytes(range(256)) * 16
+
+    converted = create_files({'BED001-1500000000.Stp': content})
+    assert list(remove_duplicate_files(args, converted)['Filename']) == ['BED001-1500000000.Stp']
+    completed_files_store().add(['BED001-1500000000.Stp'])
+
+    # A copy under another name is moved to the skipped output folder
+    copy = create_files({'BED002-1500000000.Stp': content})
+    assert remove_duplicate_files(args, copy).empty
+    assert os.listdir(os.path.join('Output', 'Skipped', 'Duplicate')) == ['BED002-1500000000.Stp']
+
+    # A file that only differs in a byte that is not sampled matches the sample but not the full hash
+    changed = bytearray(content)
+    changed[1000] ^= 0xFF
+    files = create_files({'BED003-1500000000.Stp': bytes(changed)})
+    assert fingerprint.sample_hash(files['Path'][0]) == fingerprint.sample_hash(converted['Path'][0])
+    assert list(remove_duplicate_files(args, files)['Filename']) == ['BED003-1500000000.Stp']
+    assert os.path.isfile(os.path.join('Input', 'BED003', 'BED003-1500000000.Stp'))
+
+
+def test_copy_of_a_file_being_converted_is_deferred(workspace):
+    args = argparse.Namespace(output='Output', dedup_workers=2)
+    files = create_files({'BED001-1500000000.Stp': b'x' * 4096, 'BED002-1500000000.Stp': b'x' * 4096})
+
+    # The copy waits for a later pass, when the original is either converted or gone
+    assert list(remove_duplicate_files(args, files)['Filename']) == ['BED001-1500000000.Stp']
+    assert os.path.isfile(os.path.join('Input', 'BED002', 'BED002-1500000000.Stp'))
+
+    completed_files_store().add(['BED001-1500000000.Stp'])
+    assert remove_duplicate_files(args, files.iloc[1:]).empty
+    assert os.listdir(os.path.join('Output', 'Skipped', 'Duplicate')) == ['BED002-1500000000.Stp']
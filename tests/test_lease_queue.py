@@ -0,0 +1,94 @@
+"""
+Tests of the LeaseQueue that lets several nodes share an input folder, with one LeaseQueue per node on one database.
+"""
+
+import concurrent.futures
+import threading
+import time
+
+from Functions.lease_queue import LeaseQueue
+
+
+def test_concurrent_claims_take_every_file_once(workspace):
+    nodes = [LeaseQueue('LeaseQueue.db', f'node{i}', 60) for i in range(2)]
+    filenames = [f'BED001-{1500000000 + i * 3600}.Stp' for i in range(50)]
+    barrier = threading.Barrier(len(nodes))
+
+    def claim_all(node: LeaseQueue) -> list:
+        barrier.wait()
+        return [filename for filename in filenames if node.claim(filename) is not None]
+
+    with concurrent.futures.ThreadPoolExecutor(len(nodes)) as executor:
+        claimed = list(executor.map(claim_all, nodes))
+
+    assert sorted(claimed[0] + claimed[1]) == sorted(filenames)
+    assert not set(claimed[0]) & set(claimed[1])
+    for node in nodes:
+        node.conn.close()
+
+
+def test_expired_lease_is_taken_over(workspace):
+    node1 = LeaseQueue('LeaseQueue.db', 'node1', 1)
+    node2 = LeaseQueue('LeaseQueue.db', 'node2', 60)
+
+    assert node1.claim('BED001-1500000000.Stp') is False
+    assert node2.claim('BED001-1500000000.Stp') is None
+
+    # node1 stops renewing its lease, so node2 reclaims the file once the lease expired
+    time.sleep(1.1)
+    assert node2.claim('BED001-1500000000.Stp') is True
+    assert node1.claim('BED001-1500000000.Stp') is None
+    assert node1.owned(['BED001-1500000000.Stp']) == set()
+
+    node1.conn.close()
+    node2.conn.close()
+
+
+def test_commit_by_non_owner_commits_nothing(workspace):
+    node1 = LeaseQueue('LeaseQueue.db', 'node1', 60)
+    node2 = LeaseQueue('LeaseQueue.db', 'node2', 60)
+    node1.claim('BED001-1500000000.Stp')
+
+    assert node2.commit(['BED001-1500000000.Stp', 'BED001-1500003600.Stp']) == []
+    assert node1.commit(['BED001-1500000000.Stp']) == ['BED001-1500000000.Stp']
+
+    # A committed file is never claimed or committed again, not even by its former owner
+    assert node1.commit(['BED001-1500000000.Stp']) == []
+    assert node1.claim('BED001-1500000000.Stp') is None
+    assert node2.unavailable(['BED001-1500000000.Stp']) == ({'BED001-1500000000.Stp'}, set())
+
+    node1.conn.close()
+    node2.conn.close()
+
+
+def test_release_frees_only_own_leases(workspace):
+    node1 = LeaseQueue('LeaseQueue.db', 'node1', 60)
+    node2 = LeaseQueue('LeaseQueue.db', 'node2', 60)
+    node1.claim('BED001-1500000000.Stp')
+
+    # Another node cannot release the lease
+    node2.release(['BED001-1500000000.Stp'])
+    assert node2.unavailable(['BED001-1500000000.Stp']) == (set(), {'BED001-1500000000.Stp'})
+
+    node1.release(['BED001-1500000000.Stp'])
+    assert node2.unavailable(['BED001-1500000000.Stp']) == (set(), set())
+    assert node2.claim('BED001-1500000000.Stp') is False
+
+    node1.conn.close()
+    node2.conn.close()
+
+
+def test_lookups_are_batched(workspace):
+    node1 = LeaseQueue('LeaseQueue.db', 'node1', 60)
+    node2 = LeaseQueue('LeaseQueue.db', 'node2', 60)
+    filenames = [f'BED001-{1500000000 + i * 3600}.Stp' for i in range(2000)]
+    for filename in filenames[::2]:
+        node1.claim(filename)
+    node1.commit(filenames[:10])
+
+    # More candidates than fit into a single query
+    assert node1.owned(filenames) == set(filenames[10::2])
+    assert node2.unavailable(filenames) == (set(filenames[:10:2]), set(filenames[10::2]))
+
+    node1.conn.close()
+    node2.conn.close()
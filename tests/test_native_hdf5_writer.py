@@ -0,0 +1,80 @@
+"""
+Tests of the native .XML to .HDF5 writer.
+"""
+
+import argparse
+import os
+
+import pytest
+
+h5py = pytest.importorskip('h5py')
+numpy = pytest.importorskip('numpy')
+
+from Functions import native_hdf5_writer  # noqa: E402
+from Functions.native_hdf5_writer import write_native_hdf5  # noqa: E402
+
+# Records on both sides of midnight of the identifiable dates, and a missing vital sign value
+STP_XML = '''<?xml version="1.0"?>
+<PatientData>
+  <VitalSigns CollectionTimeUTC="2017-07-14T23:59:00">
+    <VitalSign><Par>HR</Par><Value UOM="Bpm">80</Value></VitalSign>
+  </VitalSigns>
+  <Waveforms CollectionTimeUTC="2017-07-14T23:59:00">
+    <WaveformData Channel="II" UOM="mV" SampleRate="240">1,2,3</WaveformData>
+  </Waveforms>
+  <VitalSigns CollectionTimeUTC="2017-07-15T00:01:00">
+    <VitalSign><Par>HR</Par><Value UOM="Bpm">---</Value></VitalSign>
+  </VitalSigns>
+  <Waveforms CollectionTimeUTC="2017-07-15T00:01:00">
+    <WaveformData Channel="II" UOM="mV" SampleRate="240">4,5</WaveformData>
+  </Waveforms>
+</PatientData>
+'''
+
+
+def write_xml(text: str) -> str:
+    os.makedirs('Processing', exist_ok=True)
+    path = os.path.join('Processing', 'BED001-1500076740.xml')
+    with open(path, 'w') as xml_file:
+        xml_file.write(text)
+    return path
+
+
+def hdf5_files() -> list:
+    return sorted(filename for filename in os.listdir('Processing') if filename.endswith('.hdf5'))
+
+
+def test_records_are_offset_and_split_by_day(workspace):
+    assert write_native_hdf5(argparse.Namespace(single_hdf5_file=False), write_xml(STP_XML), 86400)
+
+    assert hdf5_files() == ['BED001-1500076740-_-2017-07-13.hdf5', 'BED001-1500076740-_-2017-07-14.hdf5']
+    with h5py.File(os.path.join('Processing', 'BED001-1500076740-_-2017-07-13.hdf5'), 'r') as hdf5_file:
+        assert hdf5_file['VitalSigns/HR/time'][:].tolist() == [1500076740000 - 86400000]
+        assert hdf5_file['VitalSigns/HR/data'][:].tolist() == [80]
+        assert hdf5_file['VitalSigns/HR/data'].attrs['Unit of Measure'] == 'Bpm'
+        assert hdf5_file['Waveforms/II/data'][:].tolist() == [1, 2, 3]
+        assert hdf5_file['Waveforms/II/points'][:].tolist() == [3]
+    with h5py.File(os.path.join('Processing', 'BED001-1500076740-_-2017-07-14.hdf5'), 'r') as hdf5_file:
+        assert numpy.isnan(hdf5_file['VitalSigns/HR/data'][0])
+        assert hdf5_file['Waveforms/II/data'][:].tolist() == [4, 5]
+
+
+def test_single_file_holds_every_day(workspace, monkeypatch):
+    # Flush after every record so the datasets are appended to
+    monkeypatch.setattr(native_hdf5_writer, 'FLUSH_SIZE', 1)
+    assert write_native_hdf5(argparse.Namespace(single_hdf5_file=True), write_xml(STP_XML), 0)
+
+    assert hdf5_files() == ['BED001-1500076740-_-2017-07-14.hdf5']
+    with h5py.File(os.path.join('Processing', 'BED001-1500076740-_-2017-07-14.hdf5'), 'r') as hdf5_file:
+        assert hdf5_file['VitalSigns/HR/time'][:].tolist() == [1500076740000, 1500076860000]
+        assert hdf5_file['Waveforms/II/data'][:].tolist() == [1, 2, 3, 4, 5]
+
+
+def test_broken_xml_falls_back_without_partial_files(workspace, monkeypatch):
+    # Write the records before the broken end of the file is parsed
+    monkeypatch.setattr(native_hdf5_writer, 'FLUSH_SIZE', 1)
+    assert not write_native_hdf5(argparse.Namespace(single_hdf5_file=False), write_xml(STP_XML[:-60]), 0)
+    assert hdf5_files() == []
+
+    assert not write_native_hdf5(argparse.Namespace(single_hdf5_file=False), write_xml('<PatientData/>'), 0)
+    assert hdf5_files() == []
@@ -0,0 +1,64 @@
+"""
+Tests of the OutputCatalog and the per-patient virtual .HDF5 files.
+"""
+
+import argparse
+import os
+
+import pandas
+import pytest
+
+h5py = pytest.importorskip('h5py')
+
+from Functions.output_catalog import catalog_output_files, get_output_catalog  # noqa: E402
+
+
+def create_hdf5(path: str, times: list, data: list) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with h5py.File(path, 'w') as hdf5_file:
+        hdf5_file['VitalSigns/HR/time'] = times
+        hdf5_file['VitalSigns/HR/data'] = data
+
+
+def test_files_are_cataloged_and_stitched_in_time_order(workspace):
+    patient_folder = os.path.join('Output', 'Success', '1')
+    first_path = os.path.join(patient_folder, 'UVA_1_17360_BED001-1499990400_V.hdf5')
+    second_path = os.path.join(patient_folder, 'UVA_1_17361_BED001-1500076800_V.hdf5')
+    create_hdf5(first_path, [1499990400000, 1499990460000], [80, 81])
+    create_hdf5(second_path, [1500076800000], [82])
+    args = argparse.Namespace(output='Output', output_catalog='OutputCatalog.db', virtual_datasets=True,
+                              wave_data=False)
+
+    # The later file is de-identified first
+    catalog_output_files(args, pandas.DataFrame({
+        'EndPath': [second_path, first_path], 'PatientID': ['1', '1'], 'Bed': ['BED001', 'BED001'],
+        'Filename': ['BED001-1500076800.Stp', 'BED001-1499990400.Stp'], 'Seconds': ['1500076800', '1499990400']}))
+
+    catalog = get_output_catalog('OutputCatalog.db')
+    assert catalog.patient_files('1') == [first_path, second_path]
+    assert catalog.conn.execute('SELECT Start, End FROM OutputFiles WHERE Path = ?', (first_path,)).fetchone() == \
+        (1499990400000, 1499990460000)
+    assert catalog.conn.execute('SELECT Channel, Samples FROM OutputChannels WHERE Path = ?',
+                                (first_path,)).fetchall() == [('VitalSigns/HR', 2)]
+
+    with h5py.File(os.path.join(patient_folder, 'UVA_1_virtual.hdf5'), 'r') as virtual_file:
+        assert virtual_file['VitalSigns/HR/data'][:].tolist() == [80, 81, 82]
+        assert virtual_file['VitalSigns/HR/time'][:].tolist() == [1499990400000, 1499990460000, 1500076800000]
+    catalog.close()
+
+
+def test_file_without_times_starts_at_its_stp_file(workspace):
+    path = os.path.join('Output', 'Success', '1', 'UVA_1_17360_BED001-1499990400_V.hdf5')
+    os.makedirs(os.path.dirname(path))
+    with h5py.File(path, 'w') as hdf5_file:
+        hdf5_file.create_group('VitalSigns')
+    args = argparse.Namespace(output='Output', output_catalog='OutputCatalog.db', virtual_datasets=False,
+                              wave_data=True)
+
+    catalog_output_files(args, pandas.DataFrame({'EndPath': [path], 'PatientID': ['1'], 'Bed': ['BED001'],
+                                                 'Filename': ['BED001-1500076800.Stp'], 'Seconds': ['1499990400']}))
+
+    catalog = get_output_catalog('OutputCatalog.db')
+    assert catalog.conn.execute('SELECT Start, End, WaveData FROM OutputFiles').fetchone() == (1499990400000, None, 1)
+    assert not os.path.exists(os.path.join('Output', 'Success', '1', 'UVA_1_virtual.hdf5'))
+    catalog.close()
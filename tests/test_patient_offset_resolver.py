@@ -0,0 +1,39 @@
+"""
+Tests of the PatientOffsetResolver that looks up the PatientID and Offset of the candidate .STP files.
+"""
+
+import contextlib
+import sqlite3
+
+from benchmark_end_to_end import create_patient_offset_database
+from Functions.patient_offset_resolver import PatientOffsetResolver
+
+
+def test_cached_lookups_are_refreshed_after_another_connection_commits(workspace):
+    create_patient_offset_database('PatientOffset.db', ['BED001-1500000000.Stp'], 0)
+    resolver = PatientOffsetResolver('PatientOffset.db')
+
+    files = resolver.resolve(['BED001-1500000000.Stp', 'BED002-1500000000.Stp'])
+    assert list(files.itertuples(index=False, name=None)) == [('BED001-1500000000.Stp', 0, 0)]
+    assert resolver.cache['BED002-1500000000.Stp'] is None
+
+    # The missing file is added by another connection, e.g. update_patient_database, and the cached miss is dropped
+    with contextlib.closing(sqlite3.connect('PatientOffset.db')) as conn, conn:
+        conn.execute('INSERT INTO PatientOffset VALUES (\'BED002-1500000000.Stp\', 7, 86400)')
+
+    files = resolver.resolve(['BED001-1500000000.Stp', 'BED002-1500000000.Stp'])
+    assert sorted(files.itertuples(index=False, name=None)) == [('BED001-1500000000.Stp', 0, 0),
+                                                                ('BED002-1500000000.Stp', 7, 86400)]
+    resolver.close()
+
+
+def test_lookups_are_batched(workspace):
+    filenames = [f'BED001-{1500000000 + i * 3600}.Stp' for i in range(2000)]
+    create_patient_offset_database('PatientOffset.db', filenames[::2], 100)
+    resolver = PatientOffsetResolver('PatientOffset.db')
+
+    # More candidates than fit into a single query
+    files = resolver.resolve(filenames)
+    assert sorted(files['Filename']) == sorted(filenames[::2])
+    assert len(resolver.cache) == len(filenames)
+    resolver.close()
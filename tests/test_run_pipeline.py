@@ -0,0 +1,68 @@
+"""
+Tests of how the pipeline keeps its work queue filled.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import os
+
+from Functions.job_monitor import ConversionPreempted
+from Functions.run_pipeline import finish_wave_conversion, top_up_work_queue
+from Functions.wave_backlog import get_wave_backlog
+
+
+def test_work_queue_is_topped_up_from_pending_files():
+    args = argparse.Namespace(schedule='fifo')
+    pending_files = collections.deque({'Path': f'Input/BED001-{i}.Stp', 'Filename': f'BED001-{i}.Stp', 'Size': 4096}
+                                      for i in range(5))
+    work_queue = collections.deque()
+
+    top_up_work_queue(args, pending_files, work_queue, 2)
+    assert [file['Filename'] for file in work_queue] == ['BED001-0.Stp', 'BED001-1.Stp']
+    assert len(pending_files) == 3
+
+    # A finished conversion frees a slot, which the next pending file takes without another search
+    work_queue.popleft()
+    top_up_work_queue(args, pending_files, work_queue, 2)
+    assert [file['Filename'] for file in work_queue] == ['BED001-1.Stp', 'BED001-2.Stp']
+    assert len(pending_files) == 2
+
+
+def test_preempted_wave_conversion_stays_in_backlog(workspace):
+    os.makedirs('Processing')
+    file = {'Path': 'Input/BED001-0.Stp', 'Filename': 'BED001-0.Stp', 'Size': 4096, 'PatientID': 1, 'Offset': 0}
+    backlog = get_wave_backlog()
+    backlog.add(file)
+
+    future = concurrent.futures.Future()
+    future.set_exception(ConversionPreempted())
+    file.update(Wave=True, Preempted=True)
+
+    # The file is still queued for its conversion with wave data, so its path must stay claimed
+    assert not finish_wave_conversion(argparse.Namespace(), future, file, collections.Counter(), 0.0)
+    assert len(backlog) == 1
+
+
+def test_failed_wave_conversion_keeps_its_file(workspace):
+    os.makedirs('Processing')
+    path = os.path.join('Output', 'Skipped', 'AlreadyDone', 'BED001-0.Stp')
+    os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as stp_file:
+        stp_file.write(b'x' * 4096)
+    file = {'Path': path, 'Filename': 'BED001-0.Stp', 'Size': 4096, 'PatientID': 1, 'Offset': 0, 'Wave': True}
+    backlog = get_wave_backlog()
+    backlog.add(file)
+
+    future = concurrent.futures.Future()
+    future.set_exception(FileNotFoundError('Processing/BED001-0.xml'))
+    counts = collections.Counter()
+
+    # The vital signs of the file were converted, so only its entry in the WaveBacklog is marked as failed
+    assert finish_wave_conversion(argparse.Namespace(output='Output'), future, file, counts, 0.0)
+    assert counts == {'Error': 1}
+    assert os.path.isfile(path)
+    assert not os.path.exists(os.path.join('Output', 'Failed'))
+    assert len(backlog) == 0
+    assert backlog.take(1, set()) == []
+    assert backlog.conn.execute('SELECT Failed FROM WaveBacklog').fetchone()[0] is not None
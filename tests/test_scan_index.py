@@ -0,0 +1,48 @@
+"""
+Tests of the ScanIndex that incrementally searches the input folder.
+"""
+
+import glob
+import os
+
+from Functions.scan_index import ScanIndex
+
+
+def create_file(path: str) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as stp_file:
+        stp_file.write(b'x' * 4096)
+
+
+def test_scan_matches_recursive_glob(workspace):
+    create_file(os.path.join('Input', 'BED001', 'BED001-1500000000.Stp'))
+    create_file(os.path.join('Input', 'BED002-1500000000.Stp'))
+    create_file(os.path.join('Input', '.hidden', 'BED003-1500000000.Stp'))
+    create_file(os.path.join('Input', '.BED004-1500000000.Stp'))
+
+    # The paths are joined from the input folder as given, like the paths of requeued files
+    input_folder = os.path.join('.', 'Input') + os.sep
+    found_paths = [path for path, _, _ in ScanIndex('ScanIndex.db', input_folder).scan()]
+
+    assert sorted(found_paths) == sorted(glob.glob(os.path.join(input_folder, '**', '*.?tp'), recursive=True))
+    assert os.path.join(input_folder, 'BED002-1500000000.Stp') in found_paths
+
+
+def test_unreadable_folder_is_skipped(workspace, monkeypatch):
+    create_file(os.path.join('Input', 'BED001', 'BED001-1500000000.Stp'))
+    create_file(os.path.join('Input', 'BED002', 'BED002-1500000000.Stp'))
+    scan_index = ScanIndex('ScanIndex.db', 'Input')
+
+    scandir = os.scandir
+
+    def unreadable_scandir(path):
+        if path == os.path.join('Input', 'BED001'):
+            raise PermissionError(13, 'Permission denied', path)
+        return scandir(path)
+
+    monkeypatch.setattr(os, 'scandir', unreadable_scandir)
+    assert [path for path, _, _ in scan_index.scan()] == [os.path.join('Input', 'BED002', 'BED002-1500000000.Stp')]
+
+    # The folder is listed again once it can be read
+    monkeypatch.setattr(os, 'scandir', scandir)
+    assert len(scan_index.scan()) == 2
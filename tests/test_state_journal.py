@@ -0,0 +1,71 @@
+"""
+Tests of the StateJournal and how conversions are resumed from it.
+"""
+
+import argparse
+import os
+import sqlite3
+
+import pandas
+
+from Functions.state_journal import StateJournal, record_state, resume_conversion, resume_journal, state_journal
+
+
+def journal_args(wave_data: bool) -> argparse.Namespace:
+    return argparse.Namespace(output='Output', wave_data=wave_data, single_hdf5_file=False, state_journal='Journal.db',
+                              lease_queue=None, move_workers=1, output_catalog=None)
+
+
+def discover_file(args: argparse.Namespace, filename: str) -> str:
+    path = os.path.join('Input', filename)
+    with open(path, 'wb') as stp_file:
+        stp_file.write(b'x' * 4096)
+    state_journal(args).discover(pandas.DataFrame([(path, filename, 1, 0)],
+                                                  columns=['Path', 'Filename', 'PatientID', 'Offset']))
+    return path
+
+
+def create_output(path: str) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as output_file:
+        output_file.write(b'x' * 1024)
+
+
+def test_hdf5_files_are_deidentified_with_the_options_they_were_converted_with(workspace):
+    converted_path = os.path.join('Output', 'Converted', 'BED001-1500000000-_-2017-07-14.hdf5')
+    discover_file(journal_args(True), 'BED001-1500000000.Stp')
+    create_output(converted_path)
+    record_state(journal_args(True), ['BED001-1500000000.Stp'], 'hdf5_done', [converted_path])
+
+    # The run that resumes converts without wave data, but the file was converted with wave data
+    os.makedirs('Processing')
+    resume_journal(journal_args(False))
+
+    assert os.listdir(os.path.join('Output', 'Success', '1')) == ['UVA_1_17362_BED001-1500000000_VW.hdf5']
+    assert state_journal(journal_args(False)).get('BED001-1500000000.Stp')['State'] == 'committed'
+
+
+def test_xml_file_is_only_resumed_with_the_same_options(workspace):
+    processing_xml_path = os.path.join('Processing', 'BED001-1500000000.xml')
+    input_stp_path = discover_file(journal_args(True), 'BED001-1500000000.Stp')
+    create_output(processing_xml_path)
+    record_state(journal_args(True), ['BED001-1500000000.Stp'], 'xml_done', [processing_xml_path])
+
+    assert resume_conversion(journal_args(True), input_stp_path, 'BED001-1500000000.Stp') == 'xml_done'
+    assert resume_conversion(journal_args(False), input_stp_path, 'BED001-1500000000.Stp') is None
+    assert not os.path.exists(processing_xml_path)
+
+
+def test_journal_without_option_columns_is_migrated(workspace):
+    conn = sqlite3.connect('Journal.db')
+    conn.execute('CREATE TABLE "FileStates" ("Filename" TEXT, "Path" TEXT, "PatientID" TEXT, "Offset" INTEGER, '
+                 '"State" TEXT, "Outputs" TEXT, "Updated" REAL, PRIMARY KEY("Filename"))')
+    conn.execute('INSERT INTO FileStates VALUES (\'BED001-1500000000.Stp\', \'Input\', \'1\', 0, \'staged\', NULL, 0)')
+    conn.commit()
+    conn.close()
+
+    journal = StateJournal('Journal.db')
+    assert journal.get('BED001-1500000000.Stp')['WaveData'] is None
+    journal.record(['BED001-1500000000.Stp'], 'xml_done', None, {'WaveData': True, 'SingleHdf5File': False})
+    assert journal.get('BED001-1500000000.Stp')['WaveData'] is True
+    journal.conn.close()